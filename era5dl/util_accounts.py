@@ -0,0 +1,327 @@
+'''A pool of CDS accounts to spread the requests of a batch over.
+
+CDS caps the number of requests queued or running at the same time per
+account. With a pool of accounts, a batch keeps up to the sum of their caps
+in flight. Each request is submitted with the account chosen by fair share:
+
+    * only accounts with fewer active (submitted and not yet completed)
+      requests than their <max_active> are used.
+    * accounts backing off, after the server throttled their submissions
+      or polls, are used only if no other account is free.
+    * among the others, the account with the lowest share of its
+      <max_active> in use, then with the fewest requests submitted per
+      slot, is chosen, so that the load follows the caps of the accounts.
+
+Each account has its own util_pacer.Pacer, so a throttled account backs
+off without slowing down the others. The polls and the download of a
+request are made with the account that submitted it.
+
+Accounts are given as dicts, or in a JSON file holding a list of them:
+
+    [
+        {"name": "a", "url": "https://cds.climate.copernicus.eu/api",
+         "key": "<KEY>", "max_active": 2},
+        {"name": "b", "rc": "~/.cdsapirc_b", "max_active": 4}
+    ]
+
+where "rc" is the path to a .cdsapirc file giving the url and key. An
+account without url or key reads them from ~/.cdsapirc, as cdsapi does.
+'''
+
+from __future__ import print_function
+import os
+import json
+import threading
+import cdsapi
+from . import util_cds
+from . import util_pacer
+
+__all__=[
+        'Account', 'AccountPool', 'loadAccounts', 'getAccountPool',
+        'MAX_ACTIVE'
+        ]
+
+# default max number of active requests per account
+MAX_ACTIVE = 2
+
+
+class Account(object):
+    def __init__(self, name, url=None, key=None, max_active=MAX_ACTIVE,
+                 pause=0, verbose=True, events=None):
+        '''A CDS account in an AccountPool
+
+        Args:
+            name (str): name of the account, used in messages.
+        Keyword Args:
+            url (str or None): API url. If None, read from ~/.cdsapirc.
+            key (str or None): API key. If None, read from ~/.cdsapirc.
+            max_active (int): max number of requests of the account queued or
+                running at the same time.
+            pause (float): initial number of seconds between two submissions
+                of the account. See util_pacer.Pacer.
+            verbose (bool): if True, print the throttles of the account.
+            events (EventLog or None): if not None, write the throttles of
+                the account to this event log.
+        '''
+
+        if max_active < 1:
+            raise Exception("<max_active> of account %s should be >= 1." % name)
+
+        self.name = name
+        self.url = url
+        self.key = key
+        self.max_active = max_active
+        self.pacer = util_pacer.Pacer(interval=pause, verbose=verbose,
+                                      events=events, name=name)
+        self.n_active = 0
+        self.n_submitted = 0
+
+    def getClient(self):
+        '''Create a cdsapi client of the account, see util_cds.getClient()'''
+
+        return util_cds.getClient(url=self.url, key=self.key, fail_fast=True)
+
+    def getState(self):
+        '''Get the usage of the account
+
+        Returns:
+            result (dict): 'name', 'n_active', 'max_active', 'n_submitted',
+                and the state of its pacer as 'pacer'.
+        '''
+
+        return {'name': self.name, 'n_active': self.n_active,
+                'max_active': self.max_active,
+                'n_submitted': self.n_submitted,
+                'pacer': self.pacer.getState()}
+
+
+class AccountPool(object):
+    def __init__(self, accounts, pause=0, verbose=True, events=None):
+        '''Pool of CDS accounts with per-account caps and back-off
+
+        Args:
+            accounts (list): dicts with keys 'name', 'url', 'key', 'rc' and
+                'max_active', see loadAccounts(), or Account objects.
+        Keyword Args:
+            pause, verbose, events: passed to the Accounts created from
+                dicts.
+        '''
+
+        self.accounts = []
+        for ii, aii in enumerate(accounts):
+            if not isinstance(aii, Account):
+                aii = _makeAccount(aii, ii, pause, verbose, events)
+            self.accounts.append(aii)
+
+        if len(self.accounts) == 0:
+            raise Exception("No account in the account pool.")
+        names = [aii.name for aii in self.accounts]
+        if len(set(names)) < len(names):
+            raise Exception("Account names in the account pool should be unique.")
+
+        self.verbose = verbose
+        self.max_retries = max(aii.pacer.max_retries for aii in self.accounts)
+        self.condition = threading.Condition()
+
+    @property
+    def max_active(self):
+        '''Total number of requests the accounts can keep active'''
+
+        return sum(aii.max_active for aii in self.accounts)
+
+    def _choose(self):
+        '''Choose the account to submit the next request with
+
+        Returns:
+            result (Account or None): account with a free slot, by fair
+                share, see the module docstring. None if all accounts are
+                full.
+        '''
+
+        free = [aii for aii in self.accounts if aii.n_active < aii.max_active]
+        if len(free) == 0:
+            return None
+
+        def getKey(account):
+            backoff = account.pacer.getState()['backoff_s']
+            return (backoff, float(account.n_active) / account.max_active,
+                    float(account.n_submitted) / account.max_active)
+
+        # keeps the order of the accounts on ties
+        return min(free, key=getKey)
+
+    def tryAcquire(self):
+        '''Take a slot of the account to submit the next request with
+
+        Returns:
+            result (Account or None): account chosen, see _choose(). None if
+                all accounts are full. A slot taken is given back with
+                release().
+        '''
+
+        with self.condition:
+            account = self._choose()
+            if account is not None:
+                account.n_active += 1
+            return account
+
+    def acquire(self):
+        '''Take a slot of an account, waiting for one if all are full
+
+        Returns:
+            result (Account): account chosen, see tryAcquire().
+        '''
+
+        with self.condition:
+            while True:
+                account = self._choose()
+                if account is not None:
+                    account.n_active += 1
+                    return account
+                self.condition.wait()
+
+    def release(self, account):
+        '''Give back a slot of an account, once its request is completed or failed'''
+
+        with self.condition:
+            account.n_active -= 1
+            self.condition.notify()
+
+    def submit(self, account, data_target, job_dict, request_id=None):
+        '''Submit a request with an account, when allowed by its pacer
+
+        Args:
+            account (Account): account holding a slot for the request.
+            data_target (str): target dataset.
+            job_dict (dict): dictionary describing the data retrieval task.
+        Keyword Args:
+            request_id (str or None): id of a request to re-attach to. See
+                util_cds.attachOrSubmit(). A request submitted by another
+                account is not found, and a new one is submitted.
+        Returns:
+            handle (obj): handle of the request.
+
+        A throttled submission raises the error, after backing off the
+        account, so that the caller can try another account.
+        '''
+
+        account.pacer.acquire()
+        try:
+            handle, _ = util_cds.attachOrSubmit(account.getClient(), data_target,
+                                                job_dict, request_id=request_id)
+        except Exception as e:
+            if util_pacer.isThrottleError(e):
+                account.pacer.onThrottle(e)
+            raise
+
+        account.pacer.onSuccess()
+        with self.condition:
+            account.n_submitted += 1
+
+        return handle
+
+    def call(self, data_target, job_dict, request_id=None):
+        '''Submit a request with the account chosen by fair share
+
+        Args are the same as submit().
+        Returns:
+            account (Account): account that submitted the request, holding a
+                slot until release() is called.
+            handle (obj): handle of the request.
+
+        A throttled submission is retried, with the account chosen afresh,
+        up to <max_retries> times. Other errors are raised, with the slot
+        given back.
+        '''
+
+        n_tries = 0
+        while True:
+            account = self.acquire()
+            try:
+                handle = self.submit(account, data_target, job_dict,
+                                     request_id=request_id)
+            except Exception as e:
+                self.release(account)
+                if not util_pacer.isThrottleError(e) or n_tries >= self.max_retries:
+                    raise
+                n_tries += 1
+            else:
+                return account, handle
+
+    def getState(self):
+        '''Get the usage of the accounts
+
+        Returns:
+            result (list): dicts, see Account.getState().
+        '''
+
+        with self.condition:
+            return [aii.getState() for aii in self.accounts]
+
+
+def _makeAccount(account_dict, idx, pause, verbose, events):
+    '''Create an Account from a dict of the account file'''
+
+    account_dict = dict(account_dict)
+    unknown = set(account_dict).difference(['name', 'url', 'key', 'rc',
+                                            'max_active'])
+    if len(unknown) > 0:
+        raise Exception("Unknown account field(s): %s." % ', '.join(sorted(unknown)))
+
+    rc = account_dict.pop('rc', None)
+    if rc is not None:
+        config = cdsapi.api.read_config(os.path.expanduser(rc))
+        account_dict.setdefault('url', config.get('url'))
+        account_dict.setdefault('key', config.get('key'))
+
+    name = str(account_dict.pop('name', 'account%d' % idx))
+    return Account(name, pause=pause, verbose=verbose, events=events,
+                   **account_dict)
+
+
+def loadAccounts(abpath_in):
+    '''Load the accounts of a pool from a JSON file
+
+    Args:
+        abpath_in (str): path to a JSON file holding a list of dicts, each
+            with the keys: 'name', 'url' and 'key', or 'rc', the path to a
+            .cdsapirc file, and 'max_active'. See the module docstring.
+    Returns:
+        result (list): list of dicts, the accounts.
+    '''
+
+    with open(os.path.expanduser(abpath_in), 'r') as fin:
+        result = json.load(fin)
+
+    if not isinstance(result, list):
+        raise Exception("Account file %s should hold a list of accounts." % abpath_in)
+
+    return result
+
+
+def getAccountPool(accounts, pause=0, verbose=True, events=None):
+    '''Get an AccountPool from the accounts given to a batch
+
+    Args:
+        accounts (AccountPool, list or str): an AccountPool, returned as it
+            is, a list of dicts or Accounts, or the path to a JSON file of
+            accounts, see loadAccounts().
+    Keyword Args:
+        pause, verbose, events: see AccountPool.
+    Returns:
+        result (AccountPool): the pool of accounts.
+    '''
+
+    if isinstance(accounts, AccountPool):
+        return accounts
+    if isinstance(accounts, str):
+        accounts = loadAccounts(accounts)
+
+    result = AccountPool(accounts, pause=pause, verbose=verbose, events=events)
+    if verbose:
+        print('\n# <batch_download>: Spread requests over %d account(s): %s, up to %d active request(s).'
+              % (len(result.accounts), ', '.join('%s (%d)' % (aii.name, aii.max_active)
+                                                for aii in result.accounts),
+                 result.max_active))
+
+    return result
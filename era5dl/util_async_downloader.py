@@ -0,0 +1,272 @@
+'''Asyncio based submit-then-poll download engine.
+
+Requests are submitted without waiting for them to complete. A single
+polling loop checks the states of all the in-flight requests, and the
+download of a request is started as soon as it is completed, so that the
+time spent in the server queue by one request overlaps with the transfers
+of others.
+
+The cdsapi calls are blocking, they are run in a thread pool by the event
+loop. Submissions are paced by a util_pacer.Pacer, which backs off when the
+server throttles submissions or polls. With a util_accounts.AccountPool,
+each request is submitted with an account with a free slot, and paced by
+the pacer of that account.
+'''
+
+from __future__ import print_function
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from . import util_cds
+from . import util_pacer
+
+__all__=[
+        'runJobsAsync', 'POLL_INTERVAL'
+        ]
+
+# default number of seconds between two polls of the in-flight requests
+POLL_INTERVAL = 10
+
+# max number of seconds between two checks for a free account slot
+ACCOUNT_WAIT = 1.
+
+
+async def _pipeline(jobs, client, max_requests, max_downloads, poll_interval,
+                    pacer, on_done, on_fail, on_state, postprocess, accounts,
+                    fetch):
+    '''Submit, poll and download all jobs on the running event loop'''
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_requests + max_downloads)
+    # in-flight (submitted but not completed) requests
+    request_slots = asyncio.Semaphore(max_requests)
+    download_slots = asyncio.Semaphore(max_downloads)
+    # requests being watched by the poller:
+    # jobid -> (handle, future, request_id, pacer)
+    watch = {}
+    # jobs already reported as running
+    running = set()
+    # jobid -> number of throttled polls in a row
+    throttled = {}
+    finished = asyncio.Event()
+
+    def call(func, *args):
+        return loop.run_in_executor(executor, func, *args)
+
+    async def poll():
+        while not (finished.is_set() and len(watch) == 0):
+            if len(watch) > 0:
+                items = list(watch.items())
+                states = await asyncio.gather(
+                    *[call(util_cds.getRequestState, hii) for _, (hii, _, _, _) in items],
+                    return_exceptions=True)
+
+                backoff = 0.
+                for (jobid, (hii, fii, rii, pii)), sii in zip(items, states):
+                    if isinstance(sii, Exception) and util_pacer.isThrottleError(sii)\
+                            and throttled.get(jobid, 0) < pii.max_retries:
+                        # keep watching, poll again after the back-off
+                        throttled[jobid] = throttled.get(jobid, 0) + 1
+                        backoff = max(backoff, pii.onThrottle(sii))
+                        continue
+
+                    throttled.pop(jobid, None)
+                    if isinstance(sii, Exception):
+                        del watch[jobid]
+                        fii.set_exception(sii)
+                    elif sii == 'completed':
+                        del watch[jobid]
+                        fii.set_result(hii)
+                    elif sii == 'running' and jobid not in running:
+                        running.add(jobid)
+                        await call(on_state, jobid, sii, rii)
+
+                await asyncio.sleep(max(poll_interval, backoff))
+            else:
+                await asyncio.sleep(poll_interval)
+
+    async def submit(data_target, job_dict, request_id):
+        n_tries = 0
+        while True:
+            wait = pacer.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                handle, _ = await call(util_cds.attachOrSubmit, client,
+                                       data_target, job_dict, request_id)
+            except Exception as e:
+                if not util_pacer.isThrottleError(e) or n_tries >= pacer.max_retries:
+                    raise
+                n_tries += 1
+                pacer.onThrottle(e)
+            else:
+                pacer.onSuccess()
+                return None, handle
+
+    async def submitWithAccount(data_target, job_dict, request_id):
+        n_tries = 0
+        while True:
+            # wait for a free account slot without blocking the loop
+            account = accounts.tryAcquire()
+            if account is None:
+                await asyncio.sleep(min(poll_interval, ACCOUNT_WAIT))
+                continue
+            try:
+                handle = await call(accounts.submit, account, data_target,
+                                    job_dict, request_id)
+            except Exception as e:
+                accounts.release(account)
+                if not util_pacer.isThrottleError(e) or n_tries >= accounts.max_retries:
+                    raise
+                n_tries += 1
+            else:
+                return account, handle
+
+    async def runJob(jobid, data_target, job_dict, abpath_out, request_id):
+        while True:
+            try:
+                account = None
+                try:
+                    cached = fetch is not None and await call(fetch, jobid)
+                    if not cached:
+                        if accounts is None:
+                            account, handle = await submit(data_target, job_dict,
+                                                           request_id)
+                        else:
+                            account, handle = await submitWithAccount(
+                                data_target, job_dict, request_id)
+                        request_id = await call(util_cds.getRequestId, handle)
+                        await call(on_state, jobid, 'submitted', request_id)
+                        future = loop.create_future()
+                        watch[jobid] = (handle, future, request_id,
+                                        pacer if account is None else account.pacer)
+                        await future
+                finally:
+                    request_slots.release()
+                    if account is not None:
+                        accounts.release(account)
+
+                if not cached:
+                    async with download_slots:
+                        await call(on_state, jobid, 'downloading', request_id)
+                        await call(util_cds.downloadResult, handle, abpath_out)
+
+                    if postprocess is not None:
+                        await call(postprocess, jobid, handle, abpath_out)
+            except Exception as e:
+                delay = await call(on_fail, jobid, e)
+                if delay is None:
+                    return
+                # requeue: wait without holding a request slot
+                await asyncio.sleep(delay)
+                await request_slots.acquire()
+                request_id = None
+            else:
+                await call(on_done, jobid)
+                return
+
+    # only the live tasks are kept, so that memory does not grow with the
+    # number of jobs, and the errors raised by finished ones
+    tasks = set()
+    errors = []
+
+    def onTaskDone(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    poller = asyncio.ensure_future(poll())
+    jobs = iter(jobs)
+    try:
+        while len(errors) == 0:
+            await request_slots.acquire()
+            # taking a job may block, e.g. to claim it from a shared queue
+            item = await call(next, jobs, None)
+            if item is None:
+                request_slots.release()
+                break
+            task = asyncio.ensure_future(runJob(*item))
+            tasks.add(task)
+            task.add_done_callback(onTaskDone)
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        finished.set()
+        await poller
+        executor.shutdown(wait=True)
+
+    return
+
+
+def runJobsAsync(jobs, on_done, on_fail, max_requests=8, max_downloads=4,
+                 poll_interval=None, pause=0, client=None, on_state=None,
+                 pacer=None, postprocess=None, accounts=None, fetch=None):
+    '''Run retrieval jobs with the submit-then-poll engine
+
+    Args:
+        jobs (iterable): yields tuples of (jobid, data_target, job_dict,
+            abpath_out, request_id), each defines a download job. <request_id>
+            is the id of a request submitted earlier for the job, to re-attach
+            to, or None. Consumed lazily: a new job is taken only when an
+            in-flight request slot is free.
+        on_done (callable): called as on_done(jobid) after a job's data are
+            downloaded.
+        on_fail (callable): called as on_fail(jobid, exception) after a job
+            fails at any stage. If it returns a number, the job is run again
+            after that number of seconds, with a new request. If it returns
+            None, the job is dropped.
+    Keyword Args:
+        max_requests (int): max number of requests submitted but not yet
+            completed on the server.
+        max_downloads (int): max number of concurrent downloads.
+        poll_interval (float or None): number of seconds between two polls of
+            the states of in-flight requests. If None, use POLL_INTERVAL.
+        pause (float): initial number of seconds between two submissions,
+            used if <pacer> is None.
+        client (cdsapi.Client or None): client to submit requests with. If
+            None, create one using util_cds.getClient(), failing fast on
+            throttled requests for the pacer to back off.
+        on_state (callable or None): if a callable, called as
+            on_state(jobid, state, request_id) when a job enters the
+            'submitted', 'running' and 'downloading' states.
+        pacer (Pacer or None): util_pacer.Pacer adapting the rate of
+            submissions, and backing off when submissions or polls are
+            throttled. If None, create one starting at 1 submission per
+            <pause> seconds.
+        postprocess (callable or None): if a callable, called as
+            postprocess(jobid, handle, abpath_out) after a job's data are
+            downloaded, e.g. to verify or convert the file. An Exception
+            raised fails the job. Run in a worker thread, not holding a
+            download slot.
+        accounts (AccountPool or None): if not None, submit each request
+            with an account of this util_accounts.AccountPool with a free
+            slot, chosen by fair share, instead of <client>. The account
+            paces the submission and the polls of the request with its own
+            pacer, and its slot is given back once the request is completed
+            or failed.
+        fetch (callable or None): if a callable, called as fetch(jobid)
+            before a job's request is submitted, e.g. to get its data from a
+            download cache. If it returns True, the job is not submitted and
+            is done. Run in a worker thread, holding a request slot.
+
+    <jobs> is iterated and the callbacks are called in worker threads, not
+    on the event loop, so that they may block, e.g. on a database. The
+    callbacks of different jobs may run at the same time.
+    '''
+
+    if client is None and accounts is None:
+        client = util_cds.getClient(fail_fast=True)
+    if pacer is None:
+        pacer = util_pacer.Pacer(interval=pause)
+    if poll_interval is None:
+        poll_interval = POLL_INTERVAL
+    if on_state is None:
+        on_state = lambda jobid, state, request_id: None
+
+    asyncio.run(_pipeline(jobs, client, max(1, max_requests),
+                          max(1, max_downloads), poll_interval, pacer,
+                          on_done, on_fail, on_state, postprocess, accounts,
+                          fetch))
+
+    return
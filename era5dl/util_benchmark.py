@@ -0,0 +1,274 @@
+'''Benchmarks of batch planning and execution, against a local fake CDS
+server (see util_fake_cds).
+
+Two benchmarks are run for each batch size:
+
+    planner: generate all the job dicts of a batch, giving the latency to
+        the 1st job, the total planning time and the peak memory.
+    batch: run a batch with batchDownload() against the fake server,
+        giving jobs/hour, bytes/s and the peak memory.
+
+Usage:
+
+    python -m era5dl.util_benchmark --jobs 10 100 1000 100000 \\
+        --backend async --max_workers 16 --json results.json
+'''
+
+from __future__ import print_function
+import io
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from . import util_cds
+from . import util_downloader
+from . import util_async_downloader
+from .util_fake_cds import FakeCDSServer
+
+__all__=[
+        'makeJobDict', 'benchPlanner', 'benchBatch', 'runBenchmarks',
+        'printResults'
+        ]
+
+# default batch sizes
+JOB_COUNTS = [10, 100, 1000, 10000, 100000]
+
+# template of the benchmark jobs
+BENCH_TEMPLATE = dict(util_downloader.TEMPLATE_DICT,
+                      pressure_level=['500'], year=['2000'])
+
+
+def makeJobDict(n_jobs):
+    '''Create a job dict giving a batch of <n_jobs> jobs
+
+    Args:
+        n_jobs (int): number of jobs.
+    Returns:
+        result (dict): job dict splitting the batch by variable and year: 10
+            variables if <n_jobs> is a multiple of 10, 1 otherwise.
+    '''
+
+    n_vars = 10 if n_jobs % 10 == 0 else 1
+    return {'variable': ['var%d' % ii for ii in range(n_vars)],
+            'year': [str(1000 + ii) for ii in range(n_jobs // n_vars)]}
+
+
+@contextlib.contextmanager
+def _traceMemory(enabled):
+    '''Trace the peak memory of a with block, in a dict yielded'''
+
+    result = {'peak_mb': None}
+    if not enabled:
+        yield result
+        return
+
+    own_trace = not tracemalloc.is_tracing()
+    if own_trace:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield result
+    finally:
+        result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024.**2, 3)
+        if own_trace:
+            tracemalloc.stop()
+
+
+def benchPlanner(n_jobs, outputdir, trace_memory=True):
+    '''Benchmark the planning of a batch
+
+    Args:
+        n_jobs (int): number of jobs in the batch.
+        outputdir (str): absolute path to an empty folder.
+    Keyword Args:
+        trace_memory (bool): if True, measure the peak memory with
+            tracemalloc, which slows down the run.
+    Returns:
+        result (dict): keys 'n_jobs', 'first_job_s' (latency to the 1st
+            job dict), 'plan_s' (time to generate all the job dicts),
+            'jobs_per_s' and 'peak_mb'.
+    '''
+
+    job_dict = makeJobDict(n_jobs)
+    with _traceMemory(trace_memory) as memory:
+        t0 = time.time()
+        jobs = util_downloader.iterBatchJobDicts(BENCH_TEMPLATE, job_dict, [],
+                                                 outputdir)
+        next(jobs)
+        first = time.time() - t0
+        count = 1 + sum(1 for _ in jobs)
+        total = time.time() - t0
+
+    if count != n_jobs:
+        raise Exception("Expected %d jobs, got %d." % (n_jobs, count))
+
+    return {'n_jobs': n_jobs, 'first_job_s': round(first, 6),
+            'plan_s': round(total, 6),
+            'jobs_per_s': round(n_jobs / total, 1) if total > 0 else None,
+            'peak_mb': memory['peak_mb']}
+
+
+def benchBatch(n_jobs, outputdir, backend='sync', max_workers=8,
+               queue_delay=0.1, run_time=0.1, failure_rate=0.,
+               payload_size=100*1024, poll_interval=0.05, trace_memory=True,
+               quiet=True):
+    '''Benchmark the execution of a batch against a fake CDS server
+
+    Args:
+        n_jobs (int): number of jobs in the batch.
+        outputdir (str): absolute path to an empty folder to download to.
+    Keyword Args:
+        backend (str): 'sync' or 'async', see util_downloader.processJobs().
+        max_workers (int): max number of concurrent jobs.
+        queue_delay, run_time, failure_rate, payload_size: behaviour of the
+            fake server, see util_fake_cds.FakeCDSServer.
+        poll_interval (float): seconds between polls of a request.
+        trace_memory (bool): if True, measure the peak memory with
+            tracemalloc, which slows down the run.
+        quiet (bool): if True, suppress the progress messages of the batch.
+    Returns:
+        result (dict): keys 'n_jobs', 'n_done', 'n_failed', 'wall_s',
+            'jobs_per_hour', 'bytes', 'bytes_per_s', 'peak_mb', and the
+            counters of the server (see FakeCDSServer.getStats()).
+    '''
+
+    job_dict = makeJobDict(n_jobs)
+    old_polls = util_cds.POLL_START, util_async_downloader.POLL_INTERVAL
+    util_cds.POLL_START = poll_interval
+    util_async_downloader.POLL_INTERVAL = poll_interval
+    # cdsapi clients reset the level of their logger, filter instead
+    cds_logger = logging.getLogger('cdsapi')
+    cds_filter = lambda record: record.levelno >= logging.WARNING
+    if quiet:
+        cds_logger.addFilter(cds_filter)
+
+    out = io.StringIO() if quiet else None
+    try:
+        with FakeCDSServer(queue_delay=queue_delay, run_time=run_time,
+                           failure_rate=failure_rate,
+                           payload_size=payload_size) as server,\
+                _traceMemory(trace_memory) as memory,\
+                contextlib.redirect_stdout(out) if quiet else contextlib.ExitStack():
+            t0 = time.time()
+            util_downloader.batchDownload(
+                BENCH_TEMPLATE, job_dict, [], outputdir, dry=False, pause=0,
+                max_workers=max_workers, backend=backend)
+            wall = time.time() - t0
+            stats = server.getStats()
+    finally:
+        util_cds.POLL_START, util_async_downloader.POLL_INTERVAL = old_polls
+        cds_logger.removeFilter(cds_filter)
+
+    n_done = len(util_downloader.loadDownloadedList(
+        os.path.join(outputdir, 'downloaded_list.txt')))
+    nbytes = sum(os.path.getsize(os.path.join(outputdir, fii))
+                 for fii in os.listdir(outputdir) if fii.endswith('.nc'))
+
+    result = {'n_jobs': n_jobs, 'n_done': n_done, 'n_failed': n_jobs - n_done,
+              'wall_s': round(wall, 3),
+              'jobs_per_hour': round(n_done / wall * 3600, 1),
+              'bytes': nbytes, 'bytes_per_s': round(nbytes / wall, 1),
+              'peak_mb': memory['peak_mb']}
+    result.update(('server_%s' % kk, vv) for kk, vv in stats.items())
+
+    return result
+
+
+def runBenchmarks(job_counts=None, execute_max=1000, outputdir=None,
+                  verbose=True, **kwargs):
+    '''Run the planner and batch benchmarks for several batch sizes
+
+    Keyword Args:
+        job_counts (list or None): batch sizes. If None, use JOB_COUNTS.
+        execute_max (int): max batch size to run the batch benchmark for.
+            Larger batches are only planned.
+        outputdir (str or None): absolute path to a folder to create the
+            work folders in. If None, use a temporary folder.
+        verbose (bool): if True, print the results.
+        **kwargs: keyword args passed to benchBatch().
+    Returns:
+        result (list): list of dicts, one for each benchmark run, with the
+            'benchmark' key giving 'planner' or 'batch'.
+    '''
+
+    if job_counts is None:
+        job_counts = JOB_COUNTS
+
+    tmpdir = tempfile.mkdtemp(dir=outputdir)
+    result = []
+    try:
+        for nii in job_counts:
+            workdir = os.path.join(tmpdir, 'plan%d' % nii)
+            os.makedirs(workdir)
+            resii = benchPlanner(nii, workdir)
+            resii['benchmark'] = 'planner'
+            result.append(resii)
+
+            if nii <= execute_max:
+                workdir = os.path.join(tmpdir, 'batch%d' % nii)
+                os.makedirs(workdir)
+                resii = benchBatch(nii, workdir, **kwargs)
+                resii['benchmark'] = 'batch'
+                result.append(resii)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if verbose:
+        printResults(result)
+
+    return result
+
+
+def printResults(results):
+    '''Print benchmark results as tables'''
+
+    columns = {
+        'planner': ['n_jobs', 'first_job_s', 'plan_s', 'jobs_per_s', 'peak_mb'],
+        'batch': ['n_jobs', 'n_done', 'n_failed', 'wall_s', 'jobs_per_hour',
+                  'bytes_per_s', 'peak_mb'],
+    }
+
+    for kk, cols in columns.items():
+        rows = [rii for rii in results if rii['benchmark'] == kk]
+        if len(rows) == 0:
+            continue
+        print('\n# <util_benchmark>: %s' % kk)
+        print(''.join(cii.rjust(15) for cii in cols))
+        for rii in rows:
+            print(''.join(str(rii.get(cii)).rjust(15) for cii in cols))
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark era5dl batches against a fake CDS server.')
+    parser.add_argument('--jobs', type=int, nargs='+', default=JOB_COUNTS,
+                        help='batch sizes')
+    parser.add_argument('--execute_max', type=int, default=1000,
+                        help='max batch size to execute, larger ones are only planned')
+    parser.add_argument('--backend', default='sync', choices=['sync', 'async'])
+    parser.add_argument('--max_workers', type=int, default=8)
+    parser.add_argument('--queue_delay', type=float, default=0.1)
+    parser.add_argument('--run_time', type=float, default=0.1)
+    parser.add_argument('--failure_rate', type=float, default=0.)
+    parser.add_argument('--payload_size', type=int, default=100*1024)
+    parser.add_argument('--no_trace_memory', action='store_true',
+                        help='do not measure peak memory')
+    parser.add_argument('--json', default=None,
+                        help='file to save the results to, in JSON format')
+    args = parser.parse_args()
+
+    results = runBenchmarks(
+        args.jobs, execute_max=args.execute_max, backend=args.backend,
+        max_workers=args.max_workers, queue_delay=args.queue_delay,
+        run_time=args.run_time, failure_rate=args.failure_rate,
+        payload_size=args.payload_size,
+        trace_memory=not args.no_trace_memory)
+
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump(results, fout, indent=2)
@@ -0,0 +1,400 @@
+'''Content-addressed download cache, shared by batches and processes.
+
+A downloaded file is stored in the cache folder under the hash of its
+canonical request (see getCacheKey()), so that two requests asking for the
+same data, e.g. from different projects saving into different output
+folders, share one download. A request found in the cache is served by
+hard-linking (or copying, if linking is not possible) the cached file to the
+output path, without going through CDS.
+
+The cache folder contains:
+
+    cache.db: SQLite index of the cached files, with their sizes and last
+        access times.
+    data/<ab>/<key><ext>: cached files.
+
+The total size of the cached files can be capped: least recently used files
+are evicted to stay in the budget. The cache can be used at the same time by
+several processes: index updates are serialized by SQLite transactions, and
+files are written under a temporary name and renamed into place, so a reader
+never sees a partial file.
+
+A request not in the cache but covered by a cached NetCDF file, e.g. asking
+for a smaller area, fewer time steps or levels, is served by slicing that
+file locally (see util_slice).
+'''
+
+from __future__ import print_function
+import os
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from .util_general import canonicalRequest
+from .util_slice import requestCovers, getCoverIndex, sliceNetCDF
+
+__all__=[
+        'DownloadCache', 'getCacheKey', 'CACHE_DIR_ENV'
+        ]
+
+# environment variable giving the default cache folder
+CACHE_DIR_ENV = 'ERA5DL_CACHE_DIR'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    cache_key TEXT PRIMARY KEY,
+    data_target TEXT,
+    request TEXT,
+    path TEXT,
+    size INTEGER,
+    created REAL,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_target ON entries (data_target);
+'''
+
+# columns indexing the entries by the requests they may cover, see
+# util_slice.getCoverIndex(). NULL if the file can not be sliced.
+COVER_COLUMNS = [('cover_group', 'TEXT'), ('year_min', 'INTEGER'),
+                 ('year_max', 'INTEGER'), ('month_min', 'INTEGER'),
+                 ('month_max', 'INTEGER')]
+COVER_INDEX = '''
+CREATE INDEX IF NOT EXISTS entries_cover ON entries (cover_group, size)
+'''
+
+
+def getCacheKey(data_target, job_dict):
+    '''Get the key of a request in the download cache
+
+    Args:
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        key (str): sha256 hex digest of the canonical form of the request,
+            with the 'area' bounds snapped to the grid.
+    '''
+
+    request = canonicalRequest(data_target, job_dict, snap_area=True)
+    text = json.dumps(request, sort_keys=True)
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _getTempPath(abpath, suffix='tmp'):
+    '''Get a temporary path next to <abpath>, unique to the process and thread'''
+
+    return '%s.%d.%d.%s' % (abpath, os.getpid(), threading.get_ident(), suffix)
+
+
+def _linkTemp(abpath_in, abpath_out):
+    '''Hard link a file to a temporary path next to <abpath_out>, or copy it
+    if linking fails
+
+    Returns:
+        tmp_path (str): the temporary path, to be renamed to <abpath_out>.
+    '''
+
+    tmp_path = _getTempPath(abpath_out)
+    try:
+        os.link(abpath_in, tmp_path)
+    except OSError:
+        # e.g. on a different file system
+        shutil.copy2(abpath_in, tmp_path)
+
+    return tmp_path
+
+
+def _linkOrCopy(abpath_in, abpath_out):
+    '''Hard link a file to a new path, or copy it if linking fails
+
+    The new file is first created under a temporary name in the destination
+    folder, then renamed to <abpath_out>, replacing any existing file.
+    '''
+
+    os.replace(_linkTemp(abpath_in, abpath_out), abpath_out)
+
+
+class DownloadCache(object):
+    def __init__(self, cache_dir=None, max_bytes=None):
+        '''Content-addressed download cache
+
+        Keyword Args:
+            cache_dir (str or None): absolute path to the cache folder.
+                Created if not exists. If None, read from the
+                ERA5DL_CACHE_DIR environment variable.
+            max_bytes (int or None): disk budget of the cache, in bytes. If
+                None, the cache is not size-capped.
+        '''
+
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV)
+            if not cache_dir:
+                raise Exception("<cache_dir> not given and %s not set."
+                                % CACHE_DIR_ENV)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.data_dir = os.path.join(cache_dir, 'data')
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # transactions are managed explicitly, see _transaction()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'cache.db'),
+                                    timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        with self._transaction() as cur:
+            for sqlii in SCHEMA.strip().split(';'):
+                if sqlii.strip():
+                    cur.execute(sqlii)
+            self._addCoverColumns(cur)
+            cur.execute(COVER_INDEX)
+
+    def _addCoverColumns(self, cur):
+        '''Add the cover index columns to the index of an older cache'''
+
+        columns = [rii[1] for rii in cur.execute('PRAGMA table_info(entries)')]
+        if COVER_COLUMNS[0][0] in columns:
+            return
+
+        for name, typeii in COVER_COLUMNS:
+            cur.execute('ALTER TABLE entries ADD COLUMN %s %s' % (name, typeii))
+        rows = cur.execute('SELECT cache_key, data_target, request FROM entries'
+                           ).fetchall()
+        for key, data_target, request in rows:
+            index = getCoverIndex(data_target, json.loads(request))
+            if index is not None:
+                cur.execute(
+                    'UPDATE entries SET cover_group=?, year_min=?, year_max=?, '
+                    'month_min=?, month_max=? WHERE cache_key=?', index + (key,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        '''Run statements in a write transaction, locking out other processes'''
+
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                yield cur
+            except BaseException:
+                cur.execute('ROLLBACK')
+                raise
+            else:
+                cur.execute('COMMIT')
+
+    def _getPath(self, key, ext):
+        return os.path.join(self.data_dir, key[:2], key + ext)
+
+    def fetch(self, data_target, job_dict, abpath_out, subset=True):
+        '''Serve a request from the cache
+
+        Args:
+            data_target (str): target dataset.
+            job_dict (dict): dictionary describing the data retrieval task.
+            abpath_out (str): absolute path to save the data to.
+        Keyword Args:
+            subset (bool): if True and the request is not in the cache, look
+                for a cached NetCDF file covering the request, and slice it
+                to get the data.
+        Returns:
+            hit (bool): True if the request is in the cache and has been
+                linked or copied to <abpath_out>, or sliced from a cached
+                file, False otherwise.
+        '''
+
+        outputdir = os.path.dirname(abpath_out)
+        if outputdir and not os.path.exists(outputdir):
+            os.makedirs(outputdir, exist_ok=True)
+
+        key = getCacheKey(data_target, job_dict)
+        with self._transaction() as cur:
+            row = cur.execute('SELECT path FROM entries WHERE cache_key=?',
+                              (key,)).fetchone()
+            if row is not None:
+                cur.execute('UPDATE entries SET last_access=? WHERE cache_key=?',
+                            (time.time(), key))
+
+        if row is None:
+            if subset:
+                return self._fetchSubset(data_target, job_dict, abpath_out)
+            return False
+
+        try:
+            _linkOrCopy(row[0], abpath_out)
+        except (IOError, OSError):
+            # evicted by another process in the meantime, or lost
+            with self._transaction() as cur:
+                cur.execute('DELETE FROM entries WHERE cache_key=? AND path=?',
+                            (key, row[0]))
+            return False
+
+        return True
+
+    def findCover(self, data_target, job_dict):
+        '''Find the smallest cached file covering a request
+
+        Args:
+            data_target (str): target dataset.
+            job_dict (dict): dictionary describing the data retrieval task.
+        Returns:
+            key (str or None): cache key of the covering file, None if not
+                found.
+            path (str or None): absolute path to the covering file.
+
+        See util_slice.requestCovers() for the covering rules. Only the
+        entries in the same cover group as the request, with year and month
+        spans including its own, are decoded and checked.
+        '''
+
+        index = getCoverIndex(data_target, job_dict)
+        if index is None:
+            return None, None
+
+        group, year_min, year_max, month_min, month_max = index
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT cache_key, request, path FROM entries '
+                'WHERE cover_group=? AND year_min<=? AND year_max>=? '
+                'AND month_min<=? AND month_max>=? ORDER BY size',
+                (group, year_min, year_max, month_min, month_max)).fetchall()
+
+        for key, request, path in rows:
+            if requestCovers(data_target, json.loads(request), job_dict):
+                return key, path
+
+        return None, None
+
+    def _fetchSubset(self, data_target, job_dict, abpath_out):
+        '''Serve a request by slicing a cached file covering it'''
+
+        key, path = self.findCover(data_target, job_dict)
+        if key is None:
+            return False
+
+        try:
+            sliceNetCDF(path, abpath_out, data_target, job_dict)
+        except Exception as e:
+            print('\n# <DownloadCache>: Failed to slice cached file %s: %s'
+                  % (path, e))
+            return False
+
+        with self._transaction() as cur:
+            cur.execute('UPDATE entries SET last_access=? WHERE cache_key=?',
+                        (time.time(), key))
+
+        return True
+
+    def add(self, data_target, job_dict, abpath_in):
+        '''Add a downloaded file to the cache
+
+        Args:
+            data_target (str): target dataset.
+            job_dict (dict): dictionary describing the data retrieval task.
+            abpath_in (str): absolute path to the downloaded file.
+        Returns:
+            key (str or None): cache key of the request, None if the file is
+                larger than the disk budget and not cached.
+
+        The file is hard-linked into the cache if possible, so caching does
+        not use extra disk space until the original file is removed. Least
+        recently used files are then evicted to keep the cache in budget.
+        '''
+
+        size = os.path.getsize(abpath_in)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return None
+
+        key = getCacheKey(data_target, job_dict)
+        path = self._getPath(key, os.path.splitext(abpath_in)[1])
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = _linkTemp(abpath_in, path)
+
+        # the file is renamed into place in the transaction, so that an
+        # eviction by another process can not remove it once indexed
+        index = getCoverIndex(data_target, job_dict) or (None, ) * 5
+        now = time.time()
+        with self._transaction() as cur:
+            os.replace(tmp_path, path)
+            cur.execute(
+                'INSERT OR REPLACE INTO entries (cache_key, data_target, '
+                'request, path, size, created, last_access, cover_group, '
+                'year_min, year_max, month_min, month_max) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, data_target, json.dumps(job_dict), path, size, now, now)
+                + tuple(index))
+
+        self.evict()
+
+        return key
+
+    def evict(self, max_bytes=None):
+        '''Remove least recently used files until the cache is in budget
+
+        Keyword Args:
+            max_bytes (int or None): disk budget, in bytes. If None, use the
+                budget of the cache.
+        Returns:
+            n_evicted (int): number of files removed.
+        '''
+
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+
+        removed = []
+        with self._transaction() as cur:
+            total = cur.execute('SELECT COALESCE(SUM(size), 0) FROM entries'
+                                ).fetchone()[0]
+            if total > max_bytes:
+                rows = cur.execute('SELECT cache_key, path, size FROM entries '
+                                   'ORDER BY last_access').fetchall()
+                for key, path, size in rows:
+                    if total <= max_bytes:
+                        break
+                    cur.execute('DELETE FROM entries WHERE cache_key=?', (key,))
+                    total -= size
+                    # moved aside in the transaction, so that the same
+                    # request re-added by another process is not removed
+                    trash_path = _getTempPath(path, 'evicted')
+                    try:
+                        os.replace(path, trash_path)
+                    except OSError:
+                        continue
+                    removed.append(trash_path)
+
+        # files already linked out stay valid after their cache link is removed
+        for pathii in removed:
+            try:
+                os.remove(pathii)
+            except OSError:
+                pass
+
+        return len(removed)
+
+    def getTotalSize(self):
+        '''Get the total size of the cached files, in bytes'''
+
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries'
+                                     ).fetchone()[0]
+
+    def __contains__(self, request):
+        '''Check whether a (data_target, job_dict) request is in the cache'''
+
+        key = getCacheKey(*request)
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM entries WHERE cache_key=?',
+                                    (key,)).fetchone()
+        return row is not None
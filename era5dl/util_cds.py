@@ -0,0 +1,270 @@
+'''Thin wrappers around the cdsapi client, for submitting a request without
+waiting for it, polling its state and downloading its result.
+
+Works with both the legacy CDS API (cdsapi.api.Result handles) and the new
+Climate Data Store API (ecmwf.datastores Remote handles) that recent cdsapi
+versions switch to depending on the key format.
+'''
+
+from __future__ import print_function
+import time
+import warnings
+import requests
+import cdsapi
+from . import util_transfer
+from . import util_pacer
+
+__all__=[
+        'getClient', 'submitRequest', 'attachRequest', 'attachOrSubmit',
+        'getRequestId',
+        'getRequestState', 'getResultLocation', 'waitRequest',
+        'downloadResult', 'POLL_START'
+        ]
+
+# seconds before the 1st poll of a request in waitRequest()
+POLL_START = 1.
+
+# .update() and .reply on the new API handles are kept for backward
+# compatibility and warn on every call.
+warnings.filterwarnings('ignore', message='.update and .reply are available',
+                        category=DeprecationWarning)
+
+
+def _recordErrors(session):
+    '''Keep the status of the last failed http response of a session
+
+    cdsapi replaces the status of a failed response by 'Could not connect'
+    once it stops retrying. The status is kept in <session>.last_error to
+    tell callers why.
+    '''
+
+    session.last_error = None
+
+    def hook(response, *args, **kwargs):
+        if response.status_code >= 400:
+            session.last_error = 'HTTP %d %s' % (response.status_code,
+                                                 response.reason)
+
+    session.hooks['response'].append(hook)
+
+    return session
+
+
+def _explainError(session, error):
+    '''Add the status of the last failed http response to a cdsapi error'''
+
+    last_error = getattr(session, 'last_error', None)
+    if last_error is not None and 'Could not connect' in str(error):
+        return Exception('%s: %s' % (error, last_error))
+    return error
+
+
+def getClient(url=None, key=None, quiet=False, fail_fast=False, **kwargs):
+    '''Create a cdsapi client that returns right after submitting a request
+
+    Keyword Args:
+        url (str or None): API url. If None, read from ~/.cdsapirc.
+        key (str or None): API key. If None, read from ~/.cdsapirc.
+        quiet (bool): if True, suppress cdsapi's info messages.
+        fail_fast (bool): if True, raise http errors the server may recover
+            from (429, 5xx, connection errors) right away, instead of retrying
+            them in cdsapi for up to <retry_max> * <sleep_max> seconds. For
+            callers backing off themselves, see util_pacer.
+        **kwargs: other keyword args passed to cdsapi.Client().
+    Returns:
+        client (cdsapi.Client): client with wait_until_complete=False. Each
+            client gets its own http session so that clients with different
+            keys do not share credentials.
+    '''
+
+    kwargs.setdefault('progress', False)
+    if fail_fast:
+        kwargs['retry_max'] = 1
+    return cdsapi.Client(url=url, key=key, quiet=quiet,
+                         wait_until_complete=False, delete=False,
+                         session=_recordErrors(requests.Session()), **kwargs)
+
+
+def submitRequest(client, data_target, job_dict):
+    '''Submit a retrieval request without waiting for it to complete
+
+    Args:
+        client (cdsapi.Client): client created by getClient().
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        handle (obj): handle of the submitted request.
+    '''
+
+    try:
+        return client.retrieve(data_target, job_dict)
+    except Exception as e:
+        raise _explainError(getattr(client, 'session', None), e)
+
+
+def attachRequest(client, request_id):
+    '''Get a handle of a request submitted earlier
+
+    Args:
+        client (cdsapi.Client): client created by getClient().
+        request_id (str): id of the request on the CDS server.
+    Returns:
+        handle (obj): handle of the request.
+    '''
+
+    if hasattr(client, 'client'):
+        # new CDS API through ecmwf.datastores
+        return client.client.get_remote(request_id)
+
+    return cdsapi.api.Result(client, {'request_id': request_id})
+
+
+def attachOrSubmit(client, data_target, job_dict, request_id=None):
+    '''Re-attach to a request submitted earlier, or submit a new one
+
+    Args:
+        client (cdsapi.Client): client created by getClient().
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Keyword Args:
+        request_id (str or None): id of a request submitted earlier for the
+            same task. If None, or if the request is no longer available on
+            the server (expired, deleted or failed), submit a new request.
+    Returns:
+        handle (obj): handle of the request.
+        submitted (bool): True if a new request has been submitted.
+    '''
+
+    if request_id is not None:
+        handle = attachRequest(client, request_id)
+        try:
+            getRequestState(handle)
+        except Exception:
+            pass
+        else:
+            return handle, False
+
+    return submitRequest(client, data_target, job_dict), True
+
+
+def getRequestId(handle):
+    '''Get the server side id of a submitted request'''
+
+    request_id = getattr(handle, 'request_id', None)
+    if request_id is None:
+        request_id = handle.reply['request_id']
+    return request_id
+
+
+def getRequestState(handle):
+    '''Poll the server for the state of a submitted request
+
+    Args:
+        handle (obj): handle of the request.
+    Returns:
+        state (str): 'queued', 'running' or 'completed'.
+
+    Raise Exception if the request has failed on the server.
+    '''
+
+    try:
+        handle.update()
+    except Exception as e:
+        raise _explainError(getattr(handle, 'session', None), e)
+    reply = handle.reply
+    state = reply['state']
+
+    if state in ['queued', 'accepted']:
+        return 'queued'
+    if state in ['running', 'completed']:
+        return state
+    if state == 'failed':
+        error = reply.get('error', {})
+        raise Exception('%s. %s.' % (error.get('message'), error.get('reason')))
+
+    raise Exception('Unknown API state [%s]' % state)
+
+
+def getResultLocation(handle):
+    '''Get the download url and size of a completed request
+
+    Args:
+        handle (obj): handle of a completed request.
+    Returns:
+        url (str): url of the result file.
+        size (int): size of the result file in bytes.
+    '''
+
+    if hasattr(handle, 'get_results'):
+        results = handle.get_results()
+        return results.location, results.content_length
+
+    return handle.location, handle.content_length
+
+
+def waitRequest(handle, sleep_max=120, callback=None, sleep_start=None,
+                pacer=None):
+    '''Block until a submitted request completes
+
+    Args:
+        handle (obj): handle of the request.
+    Keyword Args:
+        sleep_max (float): max number of seconds between two polls. Polling
+            interval starts at <sleep_start> seconds and grows by 1.5x after
+            each poll.
+        callback (callable or None): if a callable, called as callback(state)
+            whenever the state of the request changes.
+        sleep_start (float or None): number of seconds between the 1st two
+            polls. If None, use POLL_START.
+        pacer (Pacer or None): if not None, polls throttled by the server
+            are reported to this util_pacer.Pacer and retried after its
+            back-off, up to its <max_retries> times in a row.
+    Returns:
+        handle (obj): handle of the completed request.
+    '''
+
+    sleep = POLL_START if sleep_start is None else sleep_start
+    last_state = None
+    n_tries = 0
+    while True:
+        try:
+            state = getRequestState(handle)
+        except Exception as e:
+            if pacer is None or not util_pacer.isThrottleError(e) or\
+                    n_tries >= pacer.max_retries:
+                raise
+            n_tries += 1
+            time.sleep(max(sleep, pacer.onThrottle(e)))
+            continue
+
+        n_tries = 0
+        if state != last_state and callback is not None:
+            callback(state)
+        last_state = state
+
+        if state == 'completed':
+            return handle
+
+        time.sleep(sleep)
+        sleep = min(sleep * 1.5, sleep_max)
+
+
+def downloadResult(handle, abpath_out):
+    '''Download the result of a completed request
+
+    Args:
+        handle (obj): handle of a completed request.
+        abpath_out (str): absolute path to save downloaded data.
+    Returns:
+        abpath_out (str): absolute path of the saved file.
+
+    Data are transferred with util_transfer.downloadFile(), which resumes an
+    interrupted transfer from the last byte received.
+    '''
+
+    url, size = getResultLocation(handle)
+    util_transfer.downloadFile(url, abpath_out, size=size,
+                               session=getattr(handle, 'session', None),
+                               verify=getattr(handle, 'verify', True))
+
+    return abpath_out
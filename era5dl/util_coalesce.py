@@ -0,0 +1,158 @@
+'''Functions for merging fragmented jobs into fewer, larger rectangular jobs.
+
+A job tuple, e.g. (('variable', 'u'), ('year', (1999, 2000))), covers the
+cells of the cartesian product of its values. After skipping, the remaining
+jobs of a batch are often a ragged set of small pieces. coalesceJobs() takes
+the union of the cells of all jobs, so that exact and partial overlaps
+between jobs are dropped, and covers them with a small number of
+non-overlapping hyper-rectangles, each under a size cap. Each rectangle is
+sent as one request, saving queue round-trips.
+'''
+
+from __future__ import print_function
+from .util_general import isListTuple
+from .util_request_size import countFields, MAX_FIELDS
+
+__all__=[
+        'expandJob', 'coalesceJobs'
+        ]
+
+
+def expandJob(job):
+    '''Get the cells covered by a job tuple
+
+    Args:
+        job (tuple): tuple of (key, value) pairs. A value can be a single
+            value, or a chunk (tuple or list) of values.
+    Returns:
+        result (list): list of tuples of (key, single value) pairs.
+    '''
+
+    result = [()]
+    for kk, vv in job:
+        values = vv if isListTuple(vv) else (vv,)
+        result = [cii + ((kk, vii),) for cii in result for vii in values]
+
+    return result
+
+
+def _rectToJob(keys, rect, orders):
+    '''Convert a rectangle of value sets to a job tuple'''
+
+    job = []
+    for kk, values in zip(keys, rect):
+        values = sorted(values, key=orders[kk].get)
+        job.append((kk, values[0] if len(values) == 1 else tuple(values)))
+
+    return tuple(job)
+
+
+def _mergeAlong(rects, dim, keys, orders, size_func, max_size):
+    '''Merge rectangles that differ only along dimension <dim>
+
+    Args:
+        rects (list): list of rectangles, each a tuple of frozensets of
+            values, one for each key in <keys>.
+        dim (int): index of the dimension to merge along.
+    Returns:
+        result (list): list of merged rectangles.
+    '''
+
+    groups = {}
+    for rii in rects:
+        groups.setdefault(rii[:dim] + rii[dim+1:], []).append(rii[dim])
+
+    result = []
+    for other, dim_sets in groups.items():
+        values = set()
+        for sii in dim_sets:
+            values.update(sii)
+        values = sorted(values, key=orders[keys[dim]].get)
+
+        # greedily fill chunks along <dim> up to the size cap
+        chunk = []
+        for vii in values:
+            trial = other[:dim] + (frozenset(chunk + [vii]),) + other[dim:]
+            if len(chunk) > 0 and size_func(_rectToJob(keys, trial, orders)) > max_size:
+                result.append(other[:dim] + (frozenset(chunk),) + other[dim:])
+                chunk = []
+            chunk.append(vii)
+        result.append(other[:dim] + (frozenset(chunk),) + other[dim:])
+
+    return result
+
+
+def coalesceJobs(jobs, template_dict=None, max_fields=None, verbose=True):
+    '''Merge job tuples into a small cover of non-overlapping rectangles
+
+    Args:
+        jobs (list): list of job tuples, each a tuple of (key, value) pairs
+            with the same keys in the same order, e.g. from skipJobs().
+    Keyword Args:
+        template_dict (dict or None): default job dict. The size of a merged
+            job is counted (see util_request_size.countFields()) on
+            <template_dict> updated with the job's values. If None, count
+            the number of cells of the job.
+        max_fields (int or None): max size of a merged job. If None, use
+            util_request_size.MAX_FIELDS. Input jobs larger than this are
+            kept as they are, and other jobs' cells they cover dropped.
+    Returns:
+        result (list): list of job tuples covering exactly the cells of
+            <jobs>, each cell once. A value of a merged job is a single value
+            or a tuple of values.
+
+    Rectangles are grown by repeatedly merging those that differ along
+    only one dimension, taking the dimensions in turn until no more merge
+    is possible.
+    '''
+
+    jobs = list(jobs)
+    if len(jobs) == 0:
+        return []
+
+    if max_fields is None:
+        max_fields = MAX_FIELDS
+
+    keys = [kk for kk, _ in jobs[0]]
+    if template_dict is None:
+        size_func = lambda job: len(expandJob(job))
+    else:
+        size_func = lambda job: countFields(dict(template_dict, **dict(job)))
+
+    # order of values along each dimension, by first appearance
+    orders = dict((kk, {}) for kk in keys)
+    # take the union of the cells: drops duplicate and overlapping jobs
+    cells = set()
+    big = []
+    for jobii in jobs:
+        if size_func(jobii) > max_fields:
+            big.append(jobii)
+            continue
+        for cii in expandJob(jobii):
+            for kk, vv in cii:
+                orders[kk].setdefault(vv, len(orders[kk]))
+            cells.add(tuple(frozenset((vv,)) for _, vv in cii))
+
+    for jobii in big:
+        cells.difference_update(tuple(frozenset((vv,)) for _, vv in cii)
+                                for cii in expandJob(jobii))
+
+    rects = list(cells)
+    while True:
+        n_rects = len(rects)
+        for dim in range(len(keys)):
+            rects = _mergeAlong(rects, dim, keys, orders, size_func, max_fields)
+        if len(rects) >= n_rects:
+            break
+
+    result = [_rectToJob(keys, rii, orders) for rii in rects]
+    # follow the order of the input jobs
+    result.sort(key=lambda job: [orders[kk][vv[0] if isinstance(vv, tuple) else vv]
+                                 for kk, vv in job])
+    result.extend(big)
+
+    if verbose:
+        print('\n# <coalesceJobs>: Number of jobs before merging: %d' % len(jobs))
+        print('# <coalesceJobs>: Number of jobs after merging: %d' % len(result))
+
+    return result
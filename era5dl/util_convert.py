@@ -0,0 +1,254 @@
+'''Local conversion of GRIB downloads to NetCDF.
+
+The NetCDF conversion on CDS is slow, and its output is larger than GRIB. A
+NetCDF job can instead be fetched in GRIB, and converted locally, in a pool
+of processes, as soon as each file arrives. The NetCDF file has the same
+name and layout as a native NetCDF download from CDS:
+
+    * dimensions 'valid_time', 'pressure_level', 'latitude' and 'longitude'.
+    * data variables named after their shortName in the parameter tables of
+      util_read_param_table, as in NetCDF files from CDS, e.g. 'z', 't2m'
+      (shortName '2t') or 'u10' (shortName '10u').
+    * time in 'seconds since 1970-01-01', data compressed with zlib.
+
+Conversion requires the xarray, cfgrib and netCDF4 packages.
+'''
+
+from __future__ import print_function
+import os
+import re
+from .util_general import toList, ProcessPool
+from . import util_read_param_table
+
+__all__=[
+        'isNetCDFRequest', 'getGribRequest', 'getGribPath', 'getNetCDFName',
+        'getVariableNames', 'convertGrib', 'Converter', 'COMPLEVEL'
+        ]
+
+# zlib compression level of converted files
+COMPLEVEL = 1
+
+# coordinates kept from the cfgrib datasets, others (e.g. 'step', 'surface')
+# are dropped, as in NetCDF files from CDS
+KEEP_COORDS = ['number', 'valid_time', 'isobaricInhPa', 'latitude', 'longitude']
+
+# cfgrib dimension names -> names in NetCDF files from CDS
+RENAME_DIMS = {'isobaricInhPa': 'pressure_level'}
+
+# encoding of the time axis in NetCDF files from CDS
+TIME_ENCODING = {'units': 'seconds since 1970-01-01',
+                 'calendar': 'proleptic_gregorian', 'dtype': 'int64'}
+
+
+def _getFormatKey(job_dict):
+    for kk in ['format', 'data_format']:
+        if kk in job_dict:
+            return kk
+    return None
+
+
+def isNetCDFRequest(job_dict):
+    '''Check whether a request asks for NetCDF data'''
+
+    kk = _getFormatKey(job_dict)
+    if kk is None:
+        return False
+    return all(str(vv).startswith('netcdf') for vv in toList(job_dict[kk]))
+
+
+def getGribRequest(job_dict):
+    '''Get the request fetching the data of a NetCDF request in GRIB
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (dict): copy of <job_dict>, asking for 'grib' format.
+    '''
+
+    result = dict(job_dict)
+    result[_getFormatKey(job_dict) or 'format'] = 'grib'
+    return result
+
+
+def getGribPath(abpath_out):
+    '''Get the path to download the GRIB data of a NetCDF file to'''
+
+    return abpath_out + '.grb'
+
+
+def getNetCDFName(short_name):
+    '''Get the name of a variable in NetCDF files from its shortName
+
+    Args:
+        short_name (str): shortName in the parameter tables, e.g. 'z', '2t'.
+    Returns:
+        result (str): name in NetCDF files, e.g. 'z', 't2m'. shortNames
+            starting with a height move it to the end, as cfVarName does in
+            ecCodes: '2t' -> 't2m', '10u' -> 'u10', '100v' -> 'v100'.
+    '''
+
+    match = re.match(r'^(\d+)(\D.*)$', short_name)
+    if match is None:
+        return short_name
+
+    height, name = match.groups()
+    return name + height + ('m' if height == '2' else '')
+
+
+def getVariableNames(job_dict):
+    '''Get the NetCDF names of the variables of a request
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (dict): keys: paramIds (int), values: names in NetCDF files,
+            see getNetCDFName(). Variables not found in the parameter tables
+            are not included.
+    '''
+
+    result = {}
+    for vii in toList(job_dict.get('variable', [])):
+        entry = util_read_param_table.lookupParam(vii)
+        if entry is not None:
+            result[int(entry['paramId'])] = getNetCDFName(entry['shortName'])
+
+    return result
+
+
+def _importAll():
+    '''Import the packages needed for conversion'''
+
+    try:
+        import xarray
+        import cfgrib
+        import netCDF4
+    except ImportError:
+        raise Exception("Converting GRIB to NetCDF requires the xarray, cfgrib and netCDF4 packages.")
+
+    return xarray, cfgrib
+
+
+def convertGrib(abpath_in, abpath_out, job_dict=None, complevel=COMPLEVEL):
+    '''Convert a GRIB file to NetCDF, in the layout of NetCDF files from CDS
+
+    Args:
+        abpath_in (str): absolute path to the GRIB file.
+        abpath_out (str): absolute path to save the NetCDF file.
+    Keyword Args:
+        job_dict (dict or None): dictionary describing the data retrieval
+            task, to name the variables after the parameter tables. If None,
+            or a variable is not found in the tables, the variable is named
+            after its GRIB shortName.
+        complevel (int): zlib compression level, 0 for no compression.
+
+    The output is written to a temporary file first, which is renamed to
+    <abpath_out> once complete.
+    '''
+
+    xarray, cfgrib = _importAll()
+
+    names = getVariableNames(job_dict) if job_dict is not None else {}
+    # index by valid time, as in NetCDF files from CDS. Do not write index
+    # files next to the downloads.
+    datasets = cfgrib.open_datasets(
+        abpath_in, backend_kwargs={'time_dims': ('valid_time',), 'indexpath': ''})
+    if len(datasets) == 0:
+        raise Exception("No GRIB message found in %s." % abpath_in)
+
+    try:
+        parts = []
+        for dsii in datasets:
+            dsii = dsii.drop_vars([cii for cii in dsii.coords
+                                   if cii not in KEEP_COORDS])
+            if 'valid_time' not in dsii.dims:
+                # a single time step
+                dsii = dsii.expand_dims('valid_time')
+            dsii = dsii.rename(dict((kk, vv) for kk, vv in RENAME_DIMS.items()
+                                    if kk in dsii.dims))
+            rename = {}
+            for kk, vii in dsii.data_vars.items():
+                param_id = vii.attrs.get('GRIB_paramId')
+                name = names.get(param_id)
+                if name is None:
+                    name = getNetCDFName(vii.attrs.get('GRIB_shortName', kk))
+                if name != kk:
+                    rename[kk] = name
+            parts.append(dsii.rename(rename))
+
+        ds = xarray.merge(parts, combine_attrs='drop_conflicts')
+        ds.attrs['history'] = 'Converted from GRIB by era5dl.'
+
+        encoding = {'valid_time': dict(TIME_ENCODING)}
+        for kk in ds.data_vars:
+            encoding[kk] = {'zlib': complevel > 0}
+            if complevel > 0:
+                encoding[kk]['complevel'] = complevel
+
+        tmp_path = '%s.%d.tmp' % (abpath_out, os.getpid())
+        try:
+            ds.to_netcdf(tmp_path, format='NETCDF4', engine='netcdf4',
+                         encoding=encoding)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, abpath_out)
+    finally:
+        for dsii in datasets:
+            dsii.close()
+
+    return
+
+
+def _convertItem(item):
+    '''Convert a file in a worker process, see convertGrib()
+
+    Args:
+        item (tuple): (abpath_in, abpath_out, job_dict, complevel).
+    Returns:
+        error (str or None): error of a failed conversion, None if converted.
+    '''
+
+    try:
+        convertGrib(*item)
+    except Exception as e:
+        return str(e)
+
+    return None
+
+
+class Converter(ProcessPool):
+    def __init__(self, max_workers=None, complevel=COMPLEVEL, keep_grib=False):
+        '''Convert downloaded GRIB files to NetCDF in a pool of processes
+
+        Keyword Args:
+            max_workers (int or None): number of processes. If None, the
+                number of CPUs.
+            complevel (int): zlib compression level of the NetCDF files.
+            keep_grib (bool): if False, remove each GRIB file once converted.
+
+        Raises an Exception if the packages needed for conversion are
+        missing, before any data are downloaded.
+        '''
+
+        _importAll()
+
+        ProcessPool.__init__(self, max_workers)
+        self.complevel = complevel
+        self.keep_grib = keep_grib
+
+    def convert(self, abpath_in, abpath_out, job_dict=None):
+        '''Convert a GRIB file to NetCDF, waiting for the result
+
+        Args are the same as convertGrib().
+
+        Raises an Exception if the conversion fails.
+        '''
+
+        error = self.executor.submit(_convertItem, (
+            abpath_in, abpath_out, job_dict, self.complevel)).result()
+        if error is not None:
+            raise Exception('Conversion to NetCDF failed: %s' % error)
+
+        if not self.keep_grib:
+            os.remove(abpath_in)
@@ -10,12 +10,37 @@ import copy
 import json
 import time
 import logging
-import logging.config
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait,\
+        FIRST_COMPLETED
 from pprint import pprint
-import cdsapi
-from .util_general import get1stOrList, toList, getAttrProduct
+from .util_general import get1stOrList, toList, iterAttrProduct,\
+        countAttrProduct, appendLine, DOWN_FILE_KEY
+from .util_request_size import autoSplitFields
+from .util_coalesce import coalesceJobs, expandJob
 from . import util_read_param_table
 from . import util_request_parser
+from . import util_async_downloader
+from . import util_cds
+from . import util_events
+from .util_job_store import JobStore, getJobKey, ACTIVE_STATES
+from .util_cache import DownloadCache, CACHE_DIR_ENV
+from .util_pacer import Pacer
+from .util_verify import Verifier
+from .util_merge import Merger, getRequestAxes, MERGE_DIR
+from .util_convert import Converter, isNetCDFRequest, getGribRequest,\
+        getGribPath
+from .util_rechunk import Rechunker
+from .util_schedule import orderJobs, countGroups
+from .util_job_plan import JobPlan, makeProductPlan, makeJobPlan,\
+        getJobFileName
+from .util_plan_report import planReport, printReport
+from .util_history import DurationModel, EtaTracker, loadModel, getRequestShape
+from .util_accounts import getAccountPool
+from .util_job_queue import JobQueue, QueueWorker, QUEUE_DB, LEASE_TIME
+from .util_retry import RetryQueue, classifyError, getRetryDelay,\
+        recordFailure, getPermanentFailures, FAILURE_MANIFEST, MAX_RETRIES
 
 
 # logger config
@@ -43,13 +68,44 @@ LOG_CONFIG = {
     }
 }
 
+# guards the configuration of loggers
+_LOGGER_LOCK = threading.Lock()
+
 __all__=[
-        'retrieveData', 'getLogger', 'skipJobs', 'loadDownloadedList',
-        'prepareJobDict', 'prepareBatchJobDicts', 'processJob',
+        'retrieveData', 'getLogger', 'skipJobs', 'iterSkipJobs',
+        'loadDownloadedList', 'prepareJobDict', 'prepareBatchJobDicts',
+        'iterBatchJobDicts', 'planBatchJobs', 'processJob',
         'processJobs', 'batchDownload', 'batchDownloadFromWebRequest',
-        'TEMPLATE_DICT'
+        'publishBatch', 'runWorker', 'TEMPLATE_DICT', 'BATCH_OPTIONS'
         ]
 
+# options of a batch run, and their default values. See batchDownload().
+BATCH_OPTIONS = {
+    'max_workers': 1,
+    'backend': 'sync',
+    'state_db': 'job_state.db',
+    'coalesce': False,
+    'max_fields': None,
+    'cache_dir': None,
+    'cache_max_bytes': None,
+    'events_file': util_events.EVENTS_FILE,
+    'profile': False,
+    'max_retries': MAX_RETRIES,
+    'retry_failed': False,
+    'verify': False,
+    'merge': None,
+    'merge_chunks': None,
+    'merge_complevel': 4,
+    'fetch_grib': False,
+    'rechunk': None,
+    'rechunk_compression': 'zlib',
+    'rechunk_pack': False,
+    'order': None,
+    'accounts': None,
+    'report': None,
+    'history': None,
+}
+
 TEMPLATE_DICT = {
     'data_target': 'reanalysis-era5-pressure-levels',
     'product_type': 'reanalysis',
@@ -90,7 +146,9 @@ TEMPLATE_DICT = {
 }
 
 
-def retrieveData(data_target, job_dict, abpath_out, dry=True):
+def retrieveData(data_target, job_dict, abpath_out, dry=True, request_id=None,
+                 callback=None, cache=None, pacer=None, verify=None,
+                 convert=None, accounts=None, wait=True):
     '''Send cdsapi retrieval request.
 
     Args:
@@ -101,56 +159,160 @@ def retrieveData(data_target, job_dict, abpath_out, dry=True):
             not exists already.
     Keyword Args:
         dry (bool): if True, only print the request job without submitting it.
+        request_id (str or None): id of a request submitted earlier for the
+            same task, e.g. by a run that got interrupted. If given and still
+            available on the server, wait for that request instead of
+            submitting a new one.
+        callback (callable or None): if a callable, called as
+            callback(state, request_id) when the job enters the 'submitted',
+            'running' and 'downloading' states, with state 'downloaded' when
+            the transfer is complete, and with state 'cached' if the data
+            are found in <cache>.
+        cache (DownloadCache or None): if not None, look for the data in this
+            download cache before submitting the request, and add the
+            downloaded file to it.
+        pacer (Pacer or None): if not None, submit the request when allowed by
+            this util_pacer.Pacer, and back off and retry when the server
+            throttles the submission or the polls. If None, cdsapi retries
+            throttled requests itself.
+        verify (callable or None): if a callable, called as
+            verify(abpath_out, size) after the download, where <size> is the
+            size of the result given by the server. It raises an Exception if
+            the downloaded file is bad, which is then not added to <cache>.
+        convert (callable or None): if a callable, fetch the data of the
+            NetCDF request <job_dict> in GRIB instead, to <abpath_out>.grb,
+            and call convert(abpath_grib, abpath_out) after <verify> to
+            convert them to NetCDF. See util_convert.
+        accounts (AccountPool or None): if not None, submit the request with
+            an account of this util_accounts.AccountPool, chosen by fair
+            share, waiting for a free slot if all accounts are full. The
+            pacer of the account is used instead of <pacer>, and the slot is
+            given back once the request is completed or failed.
+        wait (bool): if False, return once the data are downloaded, leaving
+            <verify>, <convert> and the addition of the file to <cache> to
+            the caller.
+    Returns:
+        finish (callable or None): if <wait> is False, a callable running
+            <verify>, <convert> and adding the file to <cache>, e.g. in
+            another thread while the next job downloads. It raises an
+            Exception if the file is bad. None if there is nothing left to
+            do.
 
     NOTE that all requirest data are saved into a single file. If data size
     is big, consider break into smaller pieces, using for instance a for-loop.
+
+    Data are first written to a <abpath_out>.part file, which is renamed to
+    <abpath_out> only after the transfer completes. An interrupted transfer
+    is resumed from the last byte received.
     '''
 
     outputdir = os.path.dirname(abpath_out)
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
+    # request sent to CDS, and file to download to
+    request, abpath_down = job_dict, abpath_out
+    if convert is not None:
+        request, abpath_down = getGribRequest(job_dict), getGribPath(abpath_out)
+
     # -------------Run retrieval or dry run-------------
     if dry:
         print('\n########### DRY RUN ############\n')
         print('job_dict = ')
-        pprint(job_dict)
+        pprint(request)
         print('data_target = ', data_target)
         print('\nSave file to:', abpath_out)
     else:
-        c = cdsapi.Client()
-        c.retrieve(data_target, job_dict, abpath_out)
+        if callback is None:
+            callback = lambda state, request_id: None
+
+        if cache is not None and cache.fetch(data_target, job_dict, abpath_out):
+            print('\n# <retrieveData>: Found data in cache, saved to: %s' % abpath_out)
+            callback('cached', None)
+            return
+
+        account = None
+        if accounts is not None:
+            account, handle = accounts.call(data_target, request,
+                                            request_id=request_id)
+            pacer = account.pacer
+        elif pacer is None:
+            c = util_cds.getClient()
+            handle, _ = util_cds.attachOrSubmit(c, data_target, request,
+                                                request_id=request_id)
+        else:
+            c = util_cds.getClient(fail_fast=True)
+            handle, _ = pacer.call(util_cds.attachOrSubmit, c, data_target,
+                                   request, request_id=request_id)
 
-    return
+        try:
+            request_id = util_cds.getRequestId(handle)
+            callback('submitted', request_id)
+
+            def stateCallback(state):
+                if state == 'running':
+                    callback(state, request_id)
+
+            util_cds.waitRequest(handle, callback=stateCallback, pacer=pacer)
+        finally:
+            if account is not None:
+                accounts.release(account)
+
+        callback('downloading', request_id)
+        util_cds.downloadResult(handle, abpath_down)
+        callback('downloaded', request_id)
+
+        def finish():
+            if verify is not None:
+                verify(abpath_down, util_cds.getResultLocation(handle)[1])
+            if convert is not None:
+                convert(abpath_down, abpath_out)
+
+            if cache is not None:
+                cache.add(data_target, job_dict, abpath_out)
+
+        if not wait:
+            return finish
+        finish()
+
+    return None
 
 
 def getLogger(idx, filename, config_base):
-    '''Get a new logger for job indexed idx
+    '''Get a logger for job indexed idx
 
     Args:
         idx (int): numerical id for the logger.
         filename (str): absolute file path for log file.
-        config_base (dict): basic log config to modify.
+        config_base (dict): basic log config, giving the format and level of
+            the 'default' handler.
     Returns:
         logger (logger): logger.
+
+    The logger is configured only on the 1st call for a given <idx> and
+    <filename>. Records are written to file through a queue by a background
+    thread (see util_events.getQueueHandler()), so the logger can be shared by
+    concurrent jobs.
     '''
 
     logger_name = '%s-%s' % (__name__, str(idx))
-    logger_dict = {
-        logger_name: {
-            'handlers': ['default'],
-            'level': 'INFO',
-            'propagate': True
-        }}
+    logger = logging.getLogger(logger_name)
+    handler_config = config_base['handlers']['default']
+    fmt = config_base['formatters'][handler_config['formatter']]['format']
+    handler = util_events.getQueueHandler(filename, logging.Formatter(fmt))
 
-    config_base['loggers'] = logger_dict
-    config_base['handlers']['default']['filename'] = filename
-    logging.config.dictConfig(config_base)
+    with _LOGGER_LOCK:
+        if handler not in logger.handlers:
+            # a logger moved to another file
+            for hii in list(logger.handlers):
+                logger.removeHandler(hii)
+            logger.addHandler(handler)
+            logger.setLevel(handler_config['level'])
 
-    return logging.getLogger(logger_name)
+    return logger
 
 
-def skipJobs(job_list, skip_list, down_list):
+def skipJobs(job_list, skip_list, down_list, fail_list=None):
     '''Remove certain jobs from given job list
 
     Args:
@@ -159,40 +321,157 @@ def skipJobs(job_list, skip_list, down_list):
             (('vars', 'u_component_of_wind'), ('years', 1997), ('pressure_levels', 1000))
         skip_list (list): list of tuples, jobs to skip.
         down_list (list): list of tuples, finished jobs.
+    Keyword Args:
+        fail_list (list or None): list of dicts, jobs failed permanently in
+            earlier runs, also to skip.
     Returns:
         result (list): list of tuples, jobs defined in <job_list>, with those
-            skipped (in <skip_list) or finished (<down_list>) removed.
+            skipped (in <skip_list), finished (<down_list>) or failed
+            (<fail_list>) removed.
     '''
 
-    skip_list2 = []
-    for dii in skip_list:
-        lii = getAttrProduct(dii)
-        skip_list2.extend(lii)
+    if len(job_list) == 0:
+        return []
 
-    # skip jobs from down_list
-    job1 = job_list[0]
-    fields = [ii[0] for ii in job1]
+    fields = [ii[0] for ii in job_list[0]]
+    skip_set, down_set, fail_set = _getSkipSets(fields, skip_list, down_list,
+                                                fail_list)
+    skip_all = skip_set.union(down_set, fail_set)
+    result = [jobii for jobii in job_list if jobii not in skip_all]
+    _printSkipCounts(len(job_list), skip_set, down_set, fail_set, len(result))
 
-    skip_list3 = []
-    for dii in down_list:
-        lii = tuple([(kk, dii[kk]) for kk in fields])
-        skip_list3.append(lii)
+    return result
 
-    skip_list2.extend(skip_list3)
-    result = list(set(job_list).difference(skip_list2))
 
-    print('\n# <util_downloader>: Number of jobs defined: %d' % len(job_list))
+def _printSkipCounts(n_jobs, skip_set, down_set, fail_set, n_left=None):
+    '''Print the numbers of jobs defined and skipped
+
+    Args:
+        n_jobs (int): number of jobs defined.
+        skip_set, down_set, fail_set (set): job tuples skipped from the skip
+            list, finished and failed permanently, see _getSkipSets().
+    Keyword Args:
+        n_left (int or None): number of jobs after skipping, not printed if
+            None.
+    '''
+
+    print('\n# <util_downloader>: Number of jobs defined: %d' % n_jobs)
     print(
         '# <util_downloader>: Number of skipped jobs from <skip_list>: %d' %
-        len(skip_list2))
+        len(skip_set))
     print(
         '# <util_downloader>: Number of already downloaded jobs: %d' %
-        len(skip_list3))
-    print('# <util_downloader>: Number of jobs after skipping: %d' % len(result))
+        len(down_set))
+    if len(fail_set) > 0:
+        print(
+            '# <util_downloader>: Number of jobs failed permanently in earlier runs: %d' %
+            len(fail_set.difference(down_set)))
+    if n_left is not None:
+        print('# <util_downloader>: Number of jobs after skipping: %d' % n_left)
+
+    return
+
+
+def _getJobTuples(fields, dict_list):
+    '''Get the job tuples of jobs given as dicts, e.g. in the downloaded list
+
+    Returns:
+        result (set): tuples of the values of <fields> of the dicts in
+            <dict_list> having them all, and of the single value jobs
+            covered by chunked or merged jobs.
+    '''
+
+    result = set()
+    for dii in dict_list:
+        if all(kk in dii for kk in fields):
+            # chunks of values are saved as lists in json
+            jobii = tuple([(kk, tuple(dii[kk]) if isinstance(dii[kk], list)
+                            else dii[kk]) for kk in fields])
+            result.add(jobii)
+            # single value jobs covered by a chunked or merged job
+            if any(isinstance(dii[kk], list) for kk in fields):
+                result.update(expandJob(jobii))
 
     return result
 
 
+def _getSkipSets(fields, skip_list, down_list, fail_list=None):
+    '''Get the sets of job tuples to skip
+
+    Args:
+        fields (list): keys of the attributes defining a job, in the order
+            they appear in the job tuples.
+        skip_list (list): list of dicts, jobs to skip.
+        down_list (list): list of dicts, finished jobs.
+    Keyword Args:
+        fail_list (list or None): list of dicts, jobs failed permanently.
+    Returns:
+        skip_set (set): job tuples to skip from <skip_list>.
+        down_set (set): job tuples of finished jobs from <down_list>.
+        fail_set (set): job tuples of failed jobs from <fail_list>.
+    '''
+
+    skip_set = set()
+    for dii in skip_list:
+        skip_set.update(iterAttrProduct(dii))
+
+    down_set = _getJobTuples(fields, down_list)
+    fail_set = _getJobTuples(fields, fail_list or [])
+
+    return skip_set, down_set, fail_set
+
+
+def iterSkipJobs(jobs, fields, skip_list, down_list, fail_list=None):
+    '''Lazily remove certain jobs from given jobs
+
+    Args:
+        jobs (iterable): yields tuples, each defining some aspects of a data
+            retrieval task, as skipJobs().
+        fields (list): keys of the attributes defining a job, in the order
+            they appear in the job tuples.
+        skip_list (list): list of dicts, jobs to skip.
+        down_list (list): list of dicts, finished jobs.
+    Keyword Args:
+        fail_list (list or None): list of dicts, jobs failed permanently in
+            earlier runs, also to skip.
+    Returns:
+        result (generator): yields the tuples in <jobs> not in <skip_list>,
+            <down_list> or <fail_list>, in the same order.
+    '''
+
+    skip_set, down_set, fail_set = _getSkipSets(fields, skip_list, down_list,
+                                                fail_list)
+    skip_set.update(down_set, fail_set)
+
+    for jobii in jobs:
+        if jobii not in skip_set:
+            yield jobii
+
+
+def _getBatchSkipSet(job_dict, skip_list, outputdir, skip_failed):
+    '''Get the job tuples of a batch to skip, and print their numbers
+
+    Args:
+        job_dict (dict): dict defining the batch download job.
+        skip_list (list): list of dicts, jobs to skip.
+        outputdir (str): absolute path to the folder of the downloaded list
+            and of the failure manifest.
+        skip_failed (bool): if True, also skip the jobs failed permanently
+            in earlier runs.
+    Returns:
+        result (set): job tuples skipped from <skip_list>, finished, or
+            failed permanently.
+    '''
+
+    down_list = loadDownloadedList(os.path.join(outputdir, 'downloaded_list.txt'))
+    fail_list = _loadFailedList(outputdir, skip_failed)
+    skip_set, down_set, fail_set = _getSkipSets(
+        list(job_dict.keys()), skip_list, down_list, fail_list)
+    _printSkipCounts(countAttrProduct(job_dict), skip_set, down_set, fail_set)
+
+    return skip_set.union(down_set, fail_set)
+
+
 def loadDownloadedList(abpath_in):
     '''Load list of downloaded jobs
 
@@ -211,6 +490,9 @@ def loadDownloadedList(abpath_in):
     else:
         down_list = []
 
+    for dii in down_list:
+        dii.pop(DOWN_FILE_KEY, None)
+
     return down_list
 
 
@@ -267,19 +549,10 @@ def prepareJobDict(var_list, years, months, days, hours, time_step, level_type,
     var_list = toList(var_list)
 
     # ------------------Check variable------------------
-    varname_tables = util_read_param_table.readAllTables()
-
-    for vv in var_list:
-        if level_type == 's':
-            valid_names = []
-            for dd in util_read_param_table.getSurfaceTables(varname_tables):
-                valid_names.extend(dd['Variable name in CDS'])
-        elif level_type == 'p':
-            valid_names = varname_tables['table9']['Variable name in CDS']
-
-        if vv not in valid_names:
-            raise Exception(
-                "Variable %s is not found in table. Double check the variable name." % vv)
+    invalid = util_read_param_table.checkVariables(var_list, level_type)
+    if len(invalid) > 0:
+        raise Exception(
+            "Variable %s is not found in table. Double check the variable name." % invalid[0])
 
     var_list = get1stOrList(var_list)
 
@@ -332,7 +605,8 @@ def prepareJobDict(var_list, years, months, days, hours, time_step, level_type,
 
 
 def prepareBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
-        naming_func=None):
+        naming_func=None, store=None, coalesce=False, max_fields=None,
+        skip_failed=True, order=None, model=None):
     '''Prepare a list of job dictionaries for a batch download task.
 
     Args:
@@ -348,6 +622,11 @@ def prepareBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
                 'year': range(1979, 1981),
             }
 
+            A value can also be a list of chunks, each a tuple of values,
+            to retrieve several values in one job. If 'auto', split
+            <template_dict> automatically into jobs under the CDS size limit,
+            see util_request_size.autoSplitFields().
+
         skip_list (list): list of dicts, each in the same format as <job_dict>.
             This is used to exclude/skip certain jobs.
         outputdir (str): absolute path to the folder to save downloaded data.
@@ -364,48 +643,268 @@ def prepareBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
             dash concatenated string joining the attributes that define the job.
             E.g.
                 [ID02]700-geopotential-2000.nc
+        store (JobStore or None): if not None, also skip jobs recorded as
+            done in this job state store.
+        coalesce (bool): if True, merge the jobs left after skipping into a
+            small number of non-overlapping larger jobs, each asking for at
+            most <max_fields> fields. See util_coalesce.coalesceJobs().
+        max_fields (int or None): max number of fields in a merged job, or
+            in a sub-job with <job_dict> 'auto'. If None, use
+            util_request_size.MAX_FIELDS.
+        skip_failed (bool): if True, also skip the jobs recorded as failed
+            permanently in the failure manifest in <outputdir>. See
+            util_retry.
+        order (str or None): if 'locality', order the jobs by dataset, year
+            and month, to run jobs reading the same archive data together.
+            If 'largest', run the largest jobs first. If 'longest', run the
+            jobs predicted to take longest first. See util_schedule. If
+            None, keep the order of the attribute combinations of <job_dict>.
+            Job ids in default file names do not depend on the order.
+        model (DurationModel or None): model predicting the durations of the
+            jobs for the 'longest' order, see util_history. If None, use the
+            default rates of util_plan_report.
     Returns:
         result (list): a list of dicts, each defines a download job. This dict
             is the 2nd input arg to the cdsapi.Client().retrieve() method.
+
+    The jobs are the ones yielded by iterBatchJobDicts(), in a list.
     '''
 
-    # try get downloaded jobs
-    down_list_file = os.path.join(outputdir, 'downloaded_list.txt')
-    down_list = loadDownloadedList(down_list_file)
+    return list(iterBatchJobDicts(template_dict, job_dict, skip_list,
+                                  outputdir, naming_func=naming_func,
+                                  store=store, coalesce=coalesce,
+                                  max_fields=max_fields,
+                                  skip_failed=skip_failed, order=order,
+                                  model=model))
+
+
+def _getIdWidth(job_dict, jobs=None):
+    '''Get the number of digits of the job ids in default file names
+
+    Args:
+        job_dict (dict): dict defining the batch download job.
+    Keyword Args:
+        jobs (list or None): coalesced job tuples, if any.
+    Returns:
+        result (int): width of the number of jobs defined in <job_dict>,
+            before skipping, so that the file name of a job does not change
+            as other jobs get done. With <jobs>, width of the number of
+            coalesced jobs.
+    '''
+
+    if jobs is not None:
+        return len(str(len(jobs)))
+
+    return len(str(countAttrProduct(job_dict)))
+
+
+def _orderJobs(job_dicts, order, model=None):
+    '''Order job dicts with an ordering policy of util_schedule
+
+    Returns:
+        result (list or iterable): <job_dicts>, as they are if <order> is
+            None, otherwise as an ordered list.
+    '''
+
+    if order is None:
+        return job_dicts
+
+    result = orderJobs(job_dicts, order, model=model)
+    print('# <util_downloader>: Jobs in %s order: %d job(s) in %d run(s) of the same dataset and month.'
+          % (order, len(result), countGroups(result)))
+
+    return result
+
+
+def iterBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
+        naming_func=None, store=None, coalesce=False, max_fields=None,
+        skip_failed=True, order=None, model=None):
+    '''Lazily prepare job dictionaries for a batch download task.
+
+    Args and Keyword Args are the same as prepareBatchJobDicts().
+    Returns:
+        result (generator or list): yields dicts, each defines a download
+            job. This dict is the 2nd input arg to the
+            cdsapi.Client().retrieve() method. A list if <order> is given.
+
+    Jobs are generated on demand, through the pipeline of attribute
+    combinations -> skip filter -> job dict -> file name, so the 1st job is
+    available right away, and memory use does not grow with the number of
+    jobs. Job ids in default file names are padded to the width of the
+    number of jobs before skipping.
+
+    With <coalesce>=True, the job tuples left after skipping are collected
+    and merged before the 1st job dict is created. With an <order>, all job
+    dicts are created and ordered before the 1st one is yielded.
+
+    Job dicts are shallow copies of <template_dict>: list values not given
+    in <job_dict> are shared between jobs and should not be modified in
+    place.
+    '''
+
+    if job_dict == 'auto':
+        job_dict = autoSplitFields(template_dict, max_fields=max_fields,
+                                   verbose=False)
+
+    skip_set = _getBatchSkipSet(job_dict, skip_list, outputdir, skip_failed)
+    jobs = (jobii for jobii in iterAttrProduct(job_dict)
+            if jobii not in skip_set)
+    id_width = _getIdWidth(job_dict)
+    if coalesce:
+        jobs = coalesceJobs(jobs, template_dict, max_fields)
+        id_width = _getIdWidth(job_dict, jobs)
+
+    result = _iterJobDicts(jobs, template_dict, outputdir, naming_func, store,
+                           id_width)
+
+    return _orderJobs(result, order, model)
+
+
+def planBatchJobs(template_dict, job_dict, skip_list, outputdir,
+        naming_func=None, store=None, coalesce=False, max_fields=None,
+        skip_failed=True, order=None, model=None):
+    '''Plan the jobs of a batch download task in a compact JobPlan.
+
+    Args and Keyword Args are the same as prepareBatchJobDicts().
+    Returns:
+        result (JobPlan): plan of the jobs, see util_job_plan. Iterating the
+            plan yields the same job dicts as iterBatchJobDicts(), in the
+            same order, each created only when it is reached.
+
+    Instead of a dict per job, the plan keeps the values of each field of
+    <job_dict> once, and a row of small integer indices per job, so that
+    batches of millions of jobs take a few MB. The plan can be saved with
+    JobPlan.save(), and loaded with util_job_plan.loadJobPlan().
+
+    Requires the numpy package.
+    '''
+
+    if job_dict == 'auto':
+        job_dict = autoSplitFields(template_dict, max_fields=max_fields,
+                                   verbose=False)
+
+    skip_set = _getBatchSkipSet(job_dict, skip_list, outputdir, skip_failed)
+
+    if coalesce:
+        jobs = [jobii for jobii in iterAttrProduct(job_dict)
+                if jobii not in skip_set]
+        jobs = coalesceJobs(jobs, template_dict, max_fields)
+        plan = makeJobPlan(jobs, template_dict, outputdir,
+                           naming_func=naming_func,
+                           id_width=_getIdWidth(job_dict, jobs))
+    else:
+        plan = makeProductPlan(template_dict, job_dict, outputdir,
+                               skip_set=skip_set, naming_func=naming_func,
+                               id_width=_getIdWidth(job_dict))
+
+    # one query for all the finished jobs, no pass over the plan if none
+    done_keys = set() if store is None else store.getDoneKeys()
+    if len(done_keys) > 0:
+        n_planned = len(plan)
+        keep = [getJobKey(requestii['data_target'], requestii) not in done_keys
+                for requestii in map(plan.getRequest, range(n_planned))]
+        plan = plan.take(keep, renumber=True)
+        if len(plan) < n_planned:
+            print('# <util_downloader>: Number of finished jobs in job store: %d'
+                  % (n_planned - len(plan)))
+
+    print('# <util_downloader>: Planned %d job(s) in %d bytes.'
+          % (len(plan), plan.nbytes))
+
+    if order is None:
+        return plan
+
+    plan = plan.orderBy(order, model=model)
+    print('# <util_downloader>: Jobs in %s order: %d job(s).' % (order, len(plan)))
+
+    return plan
+
+
+def _loadFailedList(outputdir, skip_failed):
+    '''Load the jobs failed permanently in earlier runs, to skip them
+
+    Returns:
+        fail_list (list): list of dicts, the request dicts of the jobs in the
+            failure manifest of <outputdir> failed permanently. Empty if
+            <skip_failed> is False.
+    '''
+
+    if not skip_failed:
+        return []
+
+    abpath_in = os.path.join(outputdir, FAILURE_MANIFEST)
+    fail_list = getPermanentFailures(abpath_in)
+    if len(fail_list) > 0:
+        print('# <util_downloader>: Skip the jobs failed permanently in earlier runs, listed in %s. Fix them, or set retry_failed=True to submit them again.'
+              % abpath_in)
+
+    return fail_list
+
+
+def _iterJobDicts(jobs, template_dict, outputdir, naming_func, store,
+                  id_width):
+    '''Create complete job dicts from job tuples
 
-    # form imcomplete job dicts
-    jobs = getAttrProduct(job_dict)
-    jobs = skipJobs(jobs, skip_list, down_list)
-    jobs = [dict(ii) for ii in jobs]
+    Args:
+        jobs (iterable): yields tuples of (key, value) pairs, each defines
+            the attributes of a job that differ from <template_dict>.
+        template_dict (dict): default job dict.
+        outputdir (str): absolute path to the folder to save downloaded data.
+        naming_func (callable or None): see prepareBatchJobDicts().
+        store (JobStore or None): if not None, skip jobs recorded as done in
+            this job state store.
+        id_width (int): number of digits of the job ids in default file names.
+    Returns:
+        result (generator): yields dicts, each defines a download job.
+    '''
 
-    result = []
-    for ii, jobii in enumerate(jobs):
+    template_dict = copy.deepcopy(template_dict)
+
+    ii = 0
+    for jobii in jobs:
+        jobii = dict(jobii)
 
         # get the complete job dict: tmpdictii
-        jobid = str(ii).rjust(len(str(len(jobs))), '0')
-        tmpdictii = copy.deepcopy(template_dict)
+        tmpdictii = dict(template_dict)
         tmpdictii.update(jobii)
 
-        # ---------------Get output file name---------------
-        if naming_func is None:
-            keys = list(jobii.keys())
-            keys.sort()
-            values = [jobii[kk] for kk in keys]
-            fileout_name = '[ID%s]%s%s' % (
-                jobid, '-'.join(map(str, values)),
-                '.nc' if tmpdictii['format'] == 'netcdf' else '.grb')
-        else:
-            fileout_name = naming_func(tmpdictii)
+        if store is not None and store.isDone(
+                getJobKey(tmpdictii['data_target'], tmpdictii)):
+            continue
+
+        jobid = str(ii).rjust(id_width, '0')
+        ii += 1
 
+        # ---------------Get output file name---------------
+        fileout_name = getJobFileName(jobii, tmpdictii, jobid, naming_func)
         abpath_out = os.path.join(outputdir, fileout_name)
         tmpdictii['abpath_out'] = abpath_out
 
-        result.append(tmpdictii)
+        yield tmpdictii
 
-    return result
 
+def _startJob(job_dict, jobid, outputdir, logger):
+    '''Log the info of a job and pop the non-request fields from its dict
+
+    Returns:
+        data_target (str): target dataset.
+        abpath_out (str): absolute path to save downloaded data.
+    '''
+
+    data_target = job_dict.pop('data_target')
+    abpath_out = job_dict.pop('abpath_out')
+
+    logger.info('<batch_download>: Output folder at: %s' % outputdir)
+    logger.info('Launch job %s' % jobid)
+    logger.info('Job %s info: %s' % (jobid, str(job_dict)))
+    logger.info('Job %s output file location: %s' % (jobid, abpath_out))
+
+    return data_target, abpath_out
 
-def processJob(job_dict, jobid, outputdir, dry):
+
+def processJob(job_dict, jobid, outputdir, dry, logger=None, store=None,
+               cache=None, events=None, pacer=None, verifier=None,
+               converter=None, accounts=None, wait=True):
     '''Process a data retrieval job
 
     Args:
@@ -414,6 +913,32 @@ def processJob(job_dict, jobid, outputdir, dry):
         jobid (str): id of the job.
         outputdir (str): absolute path to the folder to save downloaded data.
         dry (bool): if True, only print the request job without submitting it.
+    Keyword Args:
+        logger (logger or None): logger to write job info to. If None, create
+            one logging to a file in <outputdir>.
+        store (JobStore or None): if not None, record the states of the job
+            in this job state store, and re-attach to the request of the job
+            if it was submitted by an earlier run and is not yet finished.
+        cache (DownloadCache or None): if not None, serve the job from this
+            download cache if found, and add the downloaded file to it.
+        events (EventLog or None): if not None, write the timings of the
+            phases of the job to this event log.
+        pacer (Pacer or None): if not None, pace the submission of the
+            request with this util_pacer.Pacer. See retrieveData().
+        verifier (Verifier or None): if not None, check the downloaded file
+            with this util_verify.Verifier. A bad file is quarantined and the
+            job fails.
+        converter (Converter or None): if not None and <job_dict> asks for
+            NetCDF data, fetch the data in GRIB and convert them to NetCDF
+            with this util_convert.Converter.
+        accounts (AccountPool or None): if not None, submit the request with
+            an account of this util_accounts.AccountPool. See retrieveData().
+        wait (bool): if False, return once the data are downloaded, before
+            they are verified, converted and added to <cache>.
+    Returns:
+        abpath_out (str): absolute path to the downloaded data. If <wait> is
+            False, a callable instead, finishing the job and returning
+            <abpath_out>. It raises an Exception if the job fails.
 
     Function logs the job info to a log file in the specified output directory
     (<outputdir>), and calls the retrieveData() to retrieve data, or simulate
@@ -421,75 +946,663 @@ def processJob(job_dict, jobid, outputdir, dry):
     '''
 
     # ---------------Get a logger for job---------------
-    logger = getLogger( 'root', os.path.join( outputdir, 'era5_downloader.log'),
-        LOG_CONFIG)
+    if logger is None:
+        logger = getLogger( 'root', os.path.join( outputdir, 'era5_downloader.log'),
+            LOG_CONFIG)
 
     # ---------------------Retrieve---------------------
-    data_target = job_dict.pop('data_target')
-    abpath_out = job_dict.pop('abpath_out')
+    data_target, abpath_out = _startJob(job_dict, jobid, outputdir, logger)
+
+    key, request_id = None, None
+    if store is not None and not dry:
+        key, request_id, abpath_out = _attachJob(store, data_target, job_dict,
+                                                 abpath_out, jobid, logger)
+    timer = util_events.JobTimer(events, jobid,
+                                 _getDownloadPath(converter, job_dict, abpath_out))
+
+    verify = None
+    if verifier is not None:
+        def verify(abpath, size):
+            verifier.check(abpath, data_target, job_dict, size)
+
+    convert = None
+    if converter is not None and isNetCDFRequest(job_dict):
+        def convert(abpath_in, abpath):
+            converter.convert(abpath_in, abpath, job_dict)
+
+    def callback(state, rid):
+        timer(state, rid)
+        if key is not None and state in ACTIVE_STATES:
+            store.setState(key, state, request_id=rid)
+
+    def fail(e):
+        timer.finish(error=e)
+        if key is not None:
+            store.setState(key, 'failed', error=str(e))
+
+    try:
+        finish = retrieveData(data_target, job_dict, abpath_out, dry=dry,
+                              request_id=request_id, cache=cache,
+                              callback=callback, pacer=pacer, verify=verify,
+                              convert=convert, accounts=accounts, wait=False)
+    except Exception as e:
+        fail(e)
+        raise
+
+    def finishJob():
+        try:
+            if finish is not None:
+                finish()
+        except Exception as e:
+            fail(e)
+            raise
 
-    logger.info('<batch_download>: Output folder at: %s' % outputdir)
-    logger.info('Launch job %s' % jobid)
-    logger.info('Job info: %s' % (str(job_dict)))
-    logger.info('Output file location: %s' % abpath_out)
+        timer.finish()
+        if key is not None:
+            store.setState(key, 'done')
 
-    retrieveData(data_target, job_dict, abpath_out, dry=dry)
+        return abpath_out
+
+    if wait:
+        return finishJob()
+
+    return finishJob
 
-    return
 
+def _getDownloadPath(converter, job_dict, abpath_out):
+    '''Get the path to download the data of a job to
 
-def processJobs(job_dicts, outputdir, dry, pause=3, verbose=True):
+    Returns:
+        result (str): path to the GRIB file converted to <abpath_out> by
+            <converter> if the job asks for NetCDF data, otherwise
+            <abpath_out>.
+    '''
+
+    if converter is not None and isNetCDFRequest(job_dict):
+        return getGribPath(abpath_out)
+
+    return abpath_out
+
+
+def _attachJob(store, data_target, job_dict, abpath_out, jobid, logger):
+    '''Add a job to the job store and look for a request to re-attach to
+
+    Returns:
+        key (str): key of the job in the store.
+        request_id (str or None): id of the unfinished request submitted
+            for the job by an earlier run, None if not found.
+        abpath_out (str): absolute path to save downloaded data. When
+            re-attaching, the path recorded by the earlier run, so that a
+            partial download can be resumed.
+    '''
+
+    key = store.addJob(data_target, job_dict, abpath_out)
+    request_id = store.getActiveRequestId(key)
+    if request_id is not None:
+        abpath_out = store.getJob(key)['abpath_out']
+        logger.info('Job %s re-attach to request %s' % (jobid, request_id))
+
+    return key, request_id, abpath_out
+
+
+def processJobs(job_dicts, outputdir, dry, pause=3, verbose=True,
+                max_workers=1, backend='sync', store=None, cache=None,
+                events=None, pacer=None, max_retries=MAX_RETRIES,
+                retry_backoff=None, verifier=None, merger=None,
+                converter=None, rechunker=None, accounts=None, worker=None,
+                model=None):
     '''Process multiple data retrieval jobs
 
     Args:
-        job_dicts (list): a list of dicts, each defines a download job. This dict
-            is the 2nd input arg to the cdsapi.Client().retrieve() method.
+        job_dicts (list or iterable): a list of dicts, each defines a download
+            job. This dict is the 2nd input arg to the
+            cdsapi.Client().retrieve() method. Can also be an iterable, e.g.
+            from iterBatchJobDicts(), consumed lazily as workers get free.
         outputdir (str): absolute path to the folder to save downloaded data.
         dry (bool): if True, only print the request job without submitting it.
     Keyword Args:
-        pause (int): number of seconds to pause between jobs.
+        pause (int): initial number of seconds between two submissions. The
+            submission rate then adapts to the server: it increases while
+            submissions are accepted, and decreases with an exponential
+            back-off when the server throttles them. See util_pacer. If 0,
+            submissions are not paced but still back off.
+        max_workers (int): max number of jobs to run concurrently. If 1
+            (default), run jobs one after another. If > 1, run jobs in a pool
+            of <max_workers> threads, each with its own retrieval request
+            in flight. Submissions of all threads share the same pacing.
+        backend (str): 'sync' (default): each job blocks a worker until
+            its data are downloaded. 'async': submit requests without waiting,
+            poll all in-flight requests in a single asyncio loop and download
+            each one as soon as it completes. <max_workers> is then the max
+            number of requests in flight. Dry runs always use the 'sync'
+            backend.
+        store (JobStore or None): if not None, record the states of the jobs
+            in this job state store, and re-attach to the requests of jobs
+            submitted by an earlier run that are not yet finished.
+        cache (DownloadCache or None): if not None, serve jobs from this
+            download cache when found, and add downloaded files to it.
+        events (EventLog or None): if not None, write the timings of the
+            phases of each job, from the generation of its job dict to the
+            end of its post-processing, to this event log. See util_events.
+            Throttles are also written, with the state of the pacer.
+        pacer (Pacer or None): util_pacer.Pacer pacing the submissions. If
+            None, create one starting at 1 submission per <pause> seconds.
+        max_retries (int): max number of times a job failed with a transient
+            error (network, timeout, 5xx) is requeued in the run. See
+            util_retry.
+        retry_backoff (float or None): seconds before the 1st retry of a
+            job, doubled for each further retry, with random jitter. If None,
+            use util_retry.RETRY_BACKOFF.
+        verifier (Verifier or None): if not None, check each downloaded file
+            with this util_verify.Verifier, in its pool of processes. Jobs of
+            bad files are requeued, and the files moved to quarantine.
+        merger (Merger or None): if not None, merge each finished file into
+            the stores of this util_merge.Merger, in its background thread.
+        converter (Converter or None): if not None, fetch the data of NetCDF
+            jobs in GRIB, and convert them to NetCDF with this
+            util_convert.Converter, in its pool of processes.
+        rechunker (Rechunker or None): if not None, rewrite each finished
+            NetCDF file with this util_rechunk.Rechunker, in its pool of
+            processes, without waiting for the rewrite.
+        accounts (AccountPool or None): if not None, spread the requests
+            over the accounts of this util_accounts.AccountPool, by fair
+            share, keeping at most <max_active> requests of each account
+            active. Each account paces and backs off its requests on its
+            own, <pacer> is then used by none. Set <max_workers> to at least
+            the total <max_active> of the accounts to use them all.
+        worker (QueueWorker or None): if not None, <job_dicts> are jobs
+            claimed from a shared queue by this util_job_queue.QueueWorker,
+            and each job finished or failed for good is recorded in the
+            queue. See runWorker().
+        model (DurationModel or None): if not None and the number of jobs
+            is known, predict the duration of each job with this
+            util_history.DurationModel, and print the estimated time left
+            in the run each time a job finishes. See util_history.EtaTracker.
+    Returns:
+        done_list (list): list of dicts, finished jobs.
+        fail_list (list): list of dicts, jobs failed for good.
+
+    Jobs failed for good are also appended, with their errors, to the
+    failure manifest util_retry.FAILURE_MANIFEST in <outputdir>.
     '''
 
-    if len(job_dicts) == 0:
+    if backend not in ['sync', 'async']:
+        raise Exception("<backend> can be either 'sync' or 'async'.")
+
+    fail_list = []
+    done_list = []
+
+    # total number of jobs, None if not known beforehand
+    n_jobs = len(job_dicts) if hasattr(job_dicts, '__len__') else None
+    if n_jobs == 0:
         print('\n# <batch_download>: No job to run.')
-    else:
-        fail_list = []
-        done_list = []
-        down_list_file = os.path.join(outputdir, 'downloaded_list.txt')
+        return done_list, fail_list
 
-        for ii, jobii in enumerate(job_dicts):
+    down_list_file = os.path.join(outputdir, 'downloaded_list.txt')
+    fail_list_file = os.path.join(outputdir, FAILURE_MANIFEST)
+    # one logger shared by all jobs, configured only once
+    logger = getLogger('root', os.path.join(outputdir, 'era5_downloader.log'),
+        LOG_CONFIG)
+    # guards the fail/done lists, the downloaded list file and stdout
+    lock = threading.Lock()
+    # job id -> number of retries made
+    n_retries = {}
+    n_started = [0]
+    t0 = time.time()
+    if pacer is None and not dry:
+        pacer = Pacer(interval=pause, verbose=verbose, events=events)
+    if events is not None:
+        events.emit(None, 'batch_start', n_jobs=n_jobs, backend=backend,
+                    max_workers=max_workers, dry=dry)
+    # verify, convert and cache each downloaded file in these threads, while
+    # the next jobs are submitted and downloaded
+    finisher = None
+    finishing = []
+    if backend != 'async' and not dry and (verifier is not None or
+            converter is not None or cache is not None):
+        finisher = ThreadPoolExecutor(max_workers=max(max_workers or 1, 1))
+    eta = None
+    if model is not None and n_jobs is not None and not dry:
+        if isinstance(job_dicts, JobPlan):
+            seconds = model.predictPlan(job_dicts)[0]
+        else:
+            seconds = [model.predict(jobii)[0] for jobii in job_dicts]
+        eta = EtaTracker(seconds, max_workers)
+
+    def emitPlan(idstr, jobii, plan_time):
+        # the shape of the request is learned from by util_history
+        if events is not None:
+            events.emit(idstr, 'plan', duration=round(plan_time, 6),
+                        **getRequestShape(jobii))
+
+    def reportEta(idstr):
+        if eta is not None:
+            with lock:
+                eta.finish(int(idstr) - 1)
+                print('\n# <batch_download>: %s.' % eta.getProgress())
+
+    def getIdStr(ii):
+        n_started[0] = max(n_started[0], ii+1)
+        if n_jobs is None:
+            return str(ii+1)
+        return str(ii+1).rjust(len(str(n_jobs)), '0')
+
+    def getProgress(idstr):
+        if n_jobs is None:
+            return idstr
+        return '%s/%d' % (idstr, n_jobs)
+
+    def recordDone(idstr, data_target, jobii, abpath_out):
+        with lock:
+            done_list.append(jobii)
+            # with its file, for verifyOutputdir() to find a bad file's line
+            appendLine(down_list_file, json.dumps(dict(jobii, **{
+                DOWN_FILE_KEY: os.path.relpath(abpath_out, outputdir)})))
+        reportEta(idstr)
+        if worker is not None:
+            worker.done(data_target, jobii)
+        if rechunker is not None:
+            rechunker.submit(abpath_out)
+        if merger is not None:
+            merger.add(abpath_out)
+
+    def recordFail(idstr, data_target, jobii, e):
+        '''Requeue a failed job or record it as failed
+
+        Returns:
+            delay (float or None): seconds to wait before retrying the job,
+                None if failed for good.
+        '''
+
+        category = classifyError(e)
+        n_tries = n_retries.get(idstr, 0)
+        if category == 'transient' and n_tries < max_retries and not dry:
+            n_retries[idstr] = n_tries + 1
+            delay = getRetryDelay(n_tries + 1, retry_backoff)
+            with lock:
+                print('\n# <batch_download>: Job %s failed (%s), retry %d/%d in %.0f s.'
+                      % (idstr, e, n_tries + 1, max_retries, delay))
+            logger.info('Job %s requeued after error: %s' % (idstr, e))
+            if events is not None:
+                events.emit(idstr, 'retry', attempt=n_tries + 1,
+                            delay=round(delay, 3), category=category,
+                            error=str(e))
+            return delay
+
+        with lock:
+            print('Failed job %s.' %idstr, e)
+            fail_list.append(jobii)
+            if not dry:
+                recordFailure(fail_list_file, data_target, jobii, e, category,
+                              n_tries + 1)
+        if worker is not None and not dry:
+            worker.failed(data_target, jobii, e)
+        reportEta(idstr)
+
+    def reportJob(ii, job_full, delay):
+        if delay is None:
+            queue.done()
+        else:
+            queue.retry((ii, job_full, None), delay)
 
-            idstr = str(ii+1).rjust(len(str(len(job_dicts))), '0')
-            print('\n# <batch_download>: Processing job %s/%d\n' %(idstr, len(job_dicts)))
+    def endJob(ii, idstr, jobii, job_full, finish):
+        '''Wait for the post-processing of a job, and record it'''
 
+        delay = None
+        try:
+            abpath_out = finish()
+        except Exception as e:
+            delay = recordFail(idstr, job_full['data_target'], jobii, e)
+        else:
+            if not dry:
+                recordDone(idstr, job_full['data_target'], jobii, abpath_out)
+        finally:
+            reportJob(ii, job_full, delay)
+
+    def runJob(ii, jobii, plan_time):
+        idstr = getIdStr(ii)
+        if plan_time is not None:
+            emitPlan(idstr, jobii, plan_time)
+        with lock:
+            print('\n# <batch_download>: Processing job %s\n' % getProgress(idstr))
+
+        # processJob() pops the non-request fields, keep them for retries
+        job_full = dict(jobii)
+        delay = None
+        try:
+            finish = processJob(jobii, idstr, outputdir, dry, logger=logger,
+                                store=store, cache=cache, events=events,
+                                pacer=pacer, verifier=verifier,
+                                converter=converter, accounts=accounts,
+                                wait=False)
+        except Exception as e:
             try:
-                processJob(jobii, idstr, outputdir, dry)
-            except Exception as e:
-                print('Failed job %s.' %idstr, e)
-                fail_list.append(jobii)
+                delay = recordFail(idstr, job_full['data_target'], jobii, e)
+            finally:
+                reportJob(ii, job_full, delay)
+            return
+
+        if finisher is None:
+            endJob(ii, idstr, jobii, job_full, finish)
+        else:
+            with lock:
+                finishing.append(finisher.submit(endJob, ii, idstr, jobii,
+                                                 job_full, finish))
+
+    if backend == 'async' and not dry:
+        # jobs are started lazily by the engine, keep track of their dicts
+        # and store keys
+        started = {}
+
+        def iterJobs():
+            for ii, jobii, plan_time in _iterTimed(job_dicts):
+                idstr = getIdStr(ii)
+                emitPlan(idstr, jobii, plan_time)
+                with lock:
+                    print('\n# <batch_download>: Submitting job %s\n' % getProgress(idstr))
+                data_target, abpath_out = _startJob(jobii, idstr, outputdir, logger)
+                key, request_id = None, None
+                if store is not None:
+                    key, request_id, abpath_out = _attachJob(
+                        store, data_target, jobii, abpath_out, idstr, logger)
+                abpath_down = _getDownloadPath(converter, jobii, abpath_out)
+                timer = util_events.JobTimer(events, idstr, abpath_down)
+                started[idstr] = (jobii, key, data_target, abpath_out, timer)
+                request = jobii
+                if abpath_down != abpath_out:
+                    request = getGribRequest(jobii)
+                yield idstr, data_target, request, abpath_down, request_id
+
+        def onState(idstr, state, request_id):
+            key, timer = started[idstr][1], started[idstr][4]
+            timer(state, request_id)
+            if key is not None:
+                store.setState(key, state, request_id=request_id)
+
+        def fetchJob(idstr):
+            jobii, _, data_target, abpath_out, timer = started[idstr]
+            if not cache.fetch(data_target, jobii, abpath_out):
+                return False
+            logger.info('Job %s found in cache' % idstr)
+            timer('cached')
+            return True
+
+        def onDone(idstr):
+            jobii, key, data_target, abpath_out, timer = started.pop(idstr)
+            timer.finish()
+            if key is not None:
+                store.setState(key, 'done')
+            recordDone(idstr, data_target, jobii, abpath_out)
+
+        def postprocessJob(idstr, handle, abpath_down):
+            # run in a worker thread of the engine, not on its event loop
+            jobii, _, data_target, abpath_out, timer = started[idstr]
+            timer('downloaded')
+            if verifier is not None:
+                verifier.check(abpath_down, data_target, jobii,
+                               util_cds.getResultLocation(handle)[1])
+            if abpath_down != abpath_out:
+                converter.convert(abpath_down, abpath_out, jobii)
+            if cache is not None:
+                cache.add(data_target, jobii, abpath_out)
+
+        def onFail(idstr, e):
+            jobii, key, data_target, abpath_out, timer = started.pop(idstr)
+            timer.finish(error=e)
+            if key is not None:
+                store.setState(key, 'failed', error=str(e))
+            delay = recordFail(idstr, data_target, jobii, e)
+            if delay is not None:
+                # time the next attempt afresh
+                started[idstr] = (jobii, key, data_target, abpath_out,
+                                  util_events.JobTimer(events, idstr,
+                                      _getDownloadPath(converter, jobii, abpath_out)))
+            return delay
+
+        util_async_downloader.runJobsAsync(
+            iterJobs(), onDone, onFail, on_state=onState,
+            max_requests=max_workers, max_downloads=max_workers,
+            pacer=pacer, postprocess=postprocessJob, accounts=accounts,
+            fetch=None if cache is None else fetchJob)
+    else:
+        # failed jobs are requeued into <queue> by runJob() and endJob()
+        queue = RetryQueue(_iterTimed(job_dicts))
+        try:
+            if max_workers is None or max_workers <= 1:
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        break
+                    runJob(*item)
             else:
-                if not dry:
-                    done_list.append(jobii)
-                    with open(down_list_file, 'a') as down_fout:
-                        json.dump(jobii, down_fout)
-                        down_fout.write('\n')
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    # only take new jobs when workers get free
+                    futures = set()
+                    while True:
+                        if len(futures) >= 2 * max_workers:
+                            done, futures = wait(futures,
+                                                 return_when=FIRST_COMPLETED)
+                            for fii in done:
+                                fii.result()
+                        item = queue.get()
+                        if item is None:
+                            break
+                        futures.add(executor.submit(runJob, *item))
+
+                    for fii in as_completed(futures):
+                        fii.result()
+        finally:
+            if finisher is not None:
+                finisher.shutdown(wait=True)
+
+        for fii in finishing:
+            fii.result()
+
+    pacer_state = None if pacer is None else pacer.getState()
+    if events is not None:
+        events.emit(None, 'batch_end', n_done=len(done_list),
+                    n_failed=len(fail_list),
+                    duration=round(time.time() - t0, 6), pacer=pacer_state,
+                    accounts=None if accounts is None else accounts.getState())
+    if pacer_state is not None and pacer_state['n_throttled'] > 0:
+        print('\n# <batch_download>: Throttled by server %d times, last reason: %s. Final rate: %s jobs/s.'
+              % (pacer_state['n_throttled'], pacer_state['last_reason'],
+                 pacer_state['rate']))
+
+    # ------------------Print summary------------------
+    if n_started[0] == 0:
+        print('\n# <batch_download>: No job to run.')
+    elif len(fail_list) == 0:
+        print('\n# <batch_download>: All done.')
+    else:
+        print('\n# <batch_download>: Failed jobs:')
 
-                time.sleep(pause)
+        for ii in fail_list:
+            print(ii)
 
-        # ------------------Print summary------------------
-        if len(fail_list) == 0:
-            print('\n# <batch_download>: All done.')
-        else:
-            print('\n# <batch_download>: Failed jobs:')
+    return done_list, fail_list
+
+
+def _iterTimed(job_dicts):
+    '''Enumerate job dicts, timing the generation of each one
+
+    Returns:
+        result (generator): yields tuples of (index, job dict, seconds spent
+            in getting the job dict from <job_dicts>).
+    '''
+
+    job_dicts = iter(job_dicts)
+    ii = 0
+    while True:
+        t0 = time.time()
+        try:
+            jobii = next(job_dicts)
+        except StopIteration:
+            return
+        yield ii, jobii, time.time() - t0
+        ii += 1
+
+
+def _openStore(outputdir, state_db, dry):
+    '''Open the job state store of a batch, None if disabled or dry run'''
+
+    if state_db is None or dry:
+        return None
+
+    return JobStore(os.path.join(outputdir, state_db))
+
+
+def _openCache(cache_dir, cache_max_bytes, dry):
+    '''Open the shared download cache, None if disabled or dry run'''
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir or dry:
+        return None
+
+    return DownloadCache(cache_dir, max_bytes=cache_max_bytes)
 
-            for ii in fail_list:
-                print(ii)
+
+def _loadHistory(history, outputdir, events_file, verbose):
+    '''Get the duration model of a batch from the job events of past runs
+
+    Returns:
+        result (DurationModel): <history> if a DurationModel, otherwise
+            fitted on the events files in <history>, or on <events_file> in
+            <outputdir> if None.
+    '''
+
+    if isinstance(history, DurationModel):
+        return history
+    if history is None:
+        history = [] if events_file is None else\
+                [os.path.join(outputdir, events_file)]
+
+    return loadModel(history, verbose=verbose)
+
+
+def _getBatchOptions(options):
+    '''Check the options of a batch and fill in the default values
+
+    Args:
+        options (dict): options given to batchDownload() or
+            batchDownloadFromWebRequest().
+    Returns:
+        result (dict): all the options in BATCH_OPTIONS, the ones not in
+            <options> with their default values.
+    '''
+
+    unknown = sorted(set(options).difference(BATCH_OPTIONS))
+    if len(unknown) > 0:
+        raise Exception('Unknown batch option(s): %s.' % ', '.join(unknown))
+
+    result = dict(BATCH_OPTIONS)
+    result.update(options)
+
+    return result
+
+
+def _runBatch(template_dict, job_dict, skip_list, outputdir, dry, pause,
+              naming_func, verbose, options):
+    '''Plan and run the jobs of a batch
+
+    Args are the same as batchDownload(), <options> a dict of all the
+    options in BATCH_OPTIONS.
+    '''
+
+    report, order = options['report'], options['order']
+    if report not in [None, 'table', 'json']:
+        raise Exception("<report> can be either 'table', 'json' or None.")
+    model = None
+    if not dry or report is not None or order == 'longest':
+        model = _loadHistory(options['history'], outputdir,
+                             options['events_file'], verbose)
+
+    store = _openStore(outputdir, options['state_db'], dry)
+    cache = _openCache(options['cache_dir'], options['cache_max_bytes'], dry)
+    events = None
+    if options['events_file'] is not None:
+        events = util_events.EventLog(os.path.join(outputdir,
+                                                   options['events_file']))
+    profile = options['profile']
+    profiler = util_events.Profiler(outputdir, enabled=profile)
+    verifier = Verifier() if options['verify'] and not dry else None
+    converter = Converter() if options['fetch_grib'] and not dry else None
+    rechunker = None
+    if options['rechunk'] and not dry:
+        rechunker = Rechunker(access=options['rechunk'],
+                              compression=options['rechunk_compression'],
+                              pack=options['rechunk_pack'], verbose=verbose)
+    pool = None
+    if options['accounts'] is not None and not dry:
+        pool = getAccountPool(options['accounts'], pause=pause,
+                              verbose=verbose, events=events)
+    merger = None
+    merge = options['merge']
+    if merge and not dry:
+        merger = Merger(os.path.join(outputdir, MERGE_DIR),
+                        getRequestAxes(template_dict, job_dict),
+                        fmt='netcdf' if merge is True else merge,
+                        chunks=options['merge_chunks'],
+                        complevel=options['merge_complevel'], verbose=verbose)
+
+    try:
+        with profiler.phase('planning'):
+            # job dicts generated on demand, so that the 1st job is submitted
+            # right away. A report, or an order, needs all the jobs first:
+            # plan them in a compact JobPlan then.
+            plan_func = iterBatchJobDicts
+            if report is not None:
+                plan_func = planBatchJobs
+            elif order is not None:
+                try:
+                    import numpy
+                except ImportError:
+                    pass
+                else:
+                    plan_func = planBatchJobs
+            jobs = plan_func(template_dict, job_dict, skip_list, outputdir,
+                             naming_func=naming_func, store=store,
+                             coalesce=options['coalesce'],
+                             max_fields=options['max_fields'],
+                             skip_failed=not options['retry_failed'],
+                             order=order, model=model)
+            if profile and plan_func is iterBatchJobDicts:
+                jobs = list(jobs)
+            if report is not None:
+                printReport(planReport(jobs, max_workers=options['max_workers'],
+                                       model=model), fmt=report)
+                if dry:
+                    return
+
+        with profiler.phase('execution'):
+            processJobs(jobs, outputdir, dry, pause, verbose,
+                        max_workers=options['max_workers'],
+                        backend=options['backend'], store=store, cache=cache,
+                        events=events, max_retries=options['max_retries'],
+                        verifier=verifier, merger=merger,
+                        converter=converter, rechunker=rechunker,
+                        accounts=pool, model=model)
+    finally:
+        if store is not None:
+            store.close()
+        if cache is not None:
+            cache.close()
+        if verifier is not None:
+            verifier.close()
+        if converter is not None:
+            converter.close()
+        if rechunker is not None:
+            rechunker.close()
+        if merger is not None:
+            merger.close()
+        util_events.flushLogs()
 
     return
 
 
 def batchDownload(template_dict, job_dict, skip_list, outputdir, dry, pause=3,
-                  naming_func=None, verbose=True):
+                  naming_func=None, verbose=True, **options):
     '''Start a batch downloading job
 
     Args:
@@ -509,7 +1622,8 @@ def batchDownload(template_dict, job_dict, skip_list, outputdir, dry, pause=3,
         outputdir (str): absolute path to the folder to save downloaded data.
         dry (bool): if True, only print the request job without submitting it.
     Keyword Args:
-        pause (int): number of seconds to pause between jobs.
+        pause (int): initial number of seconds between two submissions,
+            adapted to the server. See processJobs().
         naming_func (callable or None): if a callable, a function that accepts
             a single input argument which a dict (as <template_dict>) defining
             the data retrieval task, and returns a string as the filename
@@ -522,21 +1636,114 @@ def batchDownload(template_dict, job_dict, skip_list, outputdir, dry, pause=3,
             dash concatenated string joining the attributes that define the job.
             E.g.
                 [ID02]700-geopotential-2000.nc
+        verbose (bool): if True, print progress messages.
+
+    Options, the other keyword args, are the same for
+    batchDownloadFromWebRequest(). Their default values are in
+    BATCH_OPTIONS:
+
+        max_workers (int): max number of jobs to run concurrently. See
+            processJobs().
+        backend (str): 'sync' (default) or 'async'. See processJobs().
+        state_db (str or None): name of the SQLite database in <outputdir>
+            recording the state of each job. A rerun skips the jobs finished
+            and re-attaches to the requests still queued or running on the
+            server. If None, do not keep job states.
+        coalesce (bool): if True, merge the jobs left after skipping into a
+            small number of non-overlapping larger jobs, to save CDS queue
+            round-trips. See util_coalesce.coalesceJobs().
+        max_fields (int or None): max number of fields in a merged job, or
+            in a sub-job with <job_dict> 'auto', or with <split_fields> 'auto'
+            in batchDownloadFromWebRequest(). If None, use util_request_size.MAX_FIELDS.
+        cache_dir (str or None): absolute path to a download cache folder,
+            which can be shared by batches and processes. Jobs found in the
+            cache are hard-linked or copied from it instead of downloaded, and
+            downloaded files are added to it. If None, use the folder given by
+            the ERA5DL_CACHE_DIR environment variable, if set.
+        cache_max_bytes (int or None): disk budget of the download cache, in
+            bytes. Least recently used files are evicted to stay in budget.
+            If None, the cache is not size-capped.
+        events_file (str or None): name of the JSONL file in <outputdir> to
+            write the timings of the phases of each job to. See util_events.
+            If None, do not write job events.
+        profile (bool): if True, profile the planning and execution phases
+            of the batch with cProfile and tracemalloc, and save the profiles
+            in <outputdir>. Job dicts are then all generated in the
+            planning phase.
+        max_retries (int): max number of times a job failed with a transient
+            error (network, timeout, 5xx) is requeued in the run. See
+            processJobs().
+        retry_failed (bool): if False, skip the jobs recorded as failed
+            permanently (e.g. invalid variable, request too large) in the
+            failure manifest of <outputdir> by an earlier run. If True,
+            submit them again.
+        verify (bool): if True, check each downloaded file in a pool of
+            processes: its size, format and content against the request. See
+            util_verify. Bad files are moved to the 'quarantine' folder in
+            <outputdir>, and their jobs requeued.
+        merge (str or None): if 'netcdf' or 'zarr', merge each finished
+            NetCDF file, while later ones are still downloading, into a
+            NetCDF4 file or Zarr store per variable and level type, in the
+            'merged' folder in <outputdir>. See util_merge. If None, do not
+            merge.
+        merge_chunks (dict or None): chunk sizes of the merged stores, keyed
+            by dimension names, e.g. {'valid_time': 24}. See util_merge.Merger.
+        merge_complevel (int): compression level of the merged stores, 0 for
+            no compression.
+        fetch_grib (bool): if True, fetch the data of NetCDF jobs in GRIB,
+            which is faster on CDS and smaller to transfer, and convert each
+            file to NetCDF locally, in a pool of processes, as it arrives.
+            File names and variable names are the same as for NetCDF
+            downloads. See util_convert.
+        rechunk (str or None): if 'timeseries' or 'map', rewrite each
+            finished NetCDF file as NetCDF4, in a pool of processes while
+            further downloads go on, with chunks suited to reading time series
+            at points, or whole maps. See util_rechunk. If None, keep the
+            files as downloaded.
+        rechunk_compression (str or None): compression of the rewritten
+            files: 'zlib', 'zstd' or None.
+        rechunk_pack (bool): if True, pack float data of the rewritten files
+            into int16, with scale_factor and add_offset.
+        order (str or None): if 'locality', run the jobs grouped by dataset,
+            year and month, so that the server can reuse the data it staged
+            for the previous jobs. If 'largest', run the largest jobs first,
+            to shorten the run with concurrent workers. If 'longest', run
+            the jobs predicted to take longest first, see <history>. All
+            orders are deterministic. See util_schedule. If None, run the
+            jobs in the order of the attribute combinations of <job_dict>.
+        accounts (list, str or None): CDS accounts to spread the requests
+            over, each with its own cap of active requests and back-off: a
+            list of dicts with keys 'name', 'url', 'key' (or 'rc', the path
+            to a .cdsapirc file) and 'max_active', or the path to a JSON
+            file holding such a list. See util_accounts. Set <max_workers>
+            to at least the sum of the caps. If None, use the account of
+            ~/.cdsapirc.
+        report (str or None): if 'table' or 'json', print a planning report
+            of the batch: the number of jobs, their fields, estimated sizes
+            and durations, and the estimated wall clock time with
+            <max_workers> workers. See util_plan_report. With <dry>=True,
+            the jobs are then not printed one by one. Requires numpy.
+        history (str, list, DurationModel or None): job events files of
+            past runs, to fit a util_history.DurationModel of the duration
+            and size of requests on. The model is used by the 'longest'
+            <order>, the planning <report>, and to print the estimated time
+            left as jobs finish. If None, use the <events_file> of
+            <outputdir>, from earlier runs.
     '''
 
+    options = _getBatchOptions(options)
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
         print('\n# <batch_download>: Create folder at: %s' % outputdir)
 
-    jobs = prepareBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
-                                naming_func=naming_func)
-    processJobs(jobs, outputdir, dry, pause, verbose)
+    _runBatch(template_dict, job_dict, skip_list, outputdir, dry, pause,
+              naming_func, verbose, options)
 
     return
 
 
 def batchDownloadFromWebRequest(request_file, outputdir, split_fields, dry,
-        pause=3, naming_func=None, verbose=True):
+        pause=3, naming_func=None, verbose=True, **options):
     '''Start a batch downloading job split from a web api request
 
     Args:
@@ -550,9 +1757,12 @@ def batchDownloadFromWebRequest(request_file, outputdir, split_fields, dry,
             If 'variable'=['u', 'v'], 'year'=[1999, 2000], 'pressure_level'=
             [900, 950, 1000], this will create 2x2x3 = 12 sub-jobs, starting
             with ('variable'='u', 'year'=1999, 'pressure_level'=900).
+            If 'auto', choose the split dimensions and chunk sizes such that
+            each sub-job asks for at most <max_fields> fields.
         dry (bool): if True, only print the request job without submitting it.
     Keyword Args:
-        pause (int): number of seconds to pause between jobs.
+        pause (int): initial number of seconds between two submissions,
+            adapted to the server. See processJobs().
         naming_func (callable or None): if a callable, a function that accepts
             a single input argument which a dict (as <template_dict>) defining
             the data retrieval task, and returns a string as the filename
@@ -565,8 +1775,12 @@ def batchDownloadFromWebRequest(request_file, outputdir, split_fields, dry,
             dash concatenated string joining the attributes that define the job.
             E.g.
                 [ID02]700-geopotential-2000.nc
+        verbose (bool): if True, print progress messages.
+        **options: options of the batch, e.g. <max_workers>, <backend> or
+            <max_fields>, see batchDownload().
     '''
 
+    options = _getBatchOptions(options)
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
         print('\n# <batch_download>: Create folder at: %s' % outputdir)
@@ -575,10 +1789,158 @@ def batchDownloadFromWebRequest(request_file, outputdir, split_fields, dry,
 
     # split jobs
     #jobs=util_request_parser.splitBy(job_dict, split_fields)
-    job_dict = dict([(kk, template_dict[kk]) for kk in split_fields])
+    if split_fields == 'auto':
+        job_dict = autoSplitFields(template_dict,
+                                   max_fields=options['max_fields'],
+                                   verbose=verbose)
+    else:
+        job_dict = dict([(kk, template_dict[kk]) for kk in split_fields])
 
-    jobs = prepareBatchJobDicts(template_dict, job_dict, [], outputdir,
-                                naming_func=naming_func)
-    processJobs(jobs, outputdir, dry, pause, verbose)
+    _runBatch(template_dict, job_dict, [], outputdir, dry, pause,
+              naming_func, verbose, options)
 
     return
+
+
+def publishBatch(template_dict, job_dict, skip_list, outputdir, queue_db=None,
+                 naming_func=None, coalesce=False, max_fields=None,
+                 retry_failed=False, order=None):
+    '''Publish the jobs of a batch to a job queue shared by workers
+
+    Args:
+        template_dict, job_dict, skip_list, outputdir: see batchDownload().
+            Jobs finished or skipped in <outputdir> are not published.
+    Keyword Args:
+        queue_db (str or None): absolute path to the SQLite database of the
+            queue, on a file system shared with the worker hosts. If None,
+            util_job_queue.QUEUE_DB in <outputdir>.
+        naming_func, coalesce, max_fields, retry_failed, order: see
+            batchDownload().
+    Returns:
+        queue_db (str): absolute path to the database of the queue.
+
+    The jobs are then run by workers started with runWorker(), on any
+    number of hosts. Publishing again adds only the jobs not in the queue
+    yet. See util_job_queue.
+    '''
+
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+        print('\n# <batch_download>: Create folder at: %s' % outputdir)
+    if queue_db is None:
+        queue_db = os.path.join(outputdir, QUEUE_DB)
+
+    jobs = prepareBatchJobDicts(template_dict, job_dict, skip_list, outputdir,
+                                naming_func=naming_func, coalesce=coalesce,
+                                max_fields=max_fields,
+                                skip_failed=not retry_failed, order=order)
+    queue = JobQueue(queue_db)
+    try:
+        n_added = queue.publish(jobs)
+        counts = queue.countStates()
+    finally:
+        queue.close()
+
+    print('\n# <batch_download>: Published %d new job(s) to %s. Jobs in queue: %s'
+          % (n_added, queue_db, ', '.join('%s: %d' % (kk, counts[kk])
+                                          for kk in sorted(counts))))
+
+    return queue_db
+
+
+def runWorker(queue_db, outputdir, pause=3, verbose=True, max_workers=1,
+              backend='sync', worker_id=None, lease_time=LEASE_TIME, wait=None,
+              state_db='job_state.db', cache_dir=None, cache_max_bytes=None,
+              events_file=util_events.EVENTS_FILE, max_retries=MAX_RETRIES,
+              verify=False, fetch_grib=False, accounts=None):
+    '''Run the jobs of a shared job queue, until all are finished
+
+    Args:
+        queue_db (str): absolute path to the SQLite database of the queue,
+            see publishBatch().
+        outputdir (str): absolute path to the folder to save downloaded data
+            in, e.g. on a disk local to the worker host. File names are the
+            ones given by the coordinator.
+    Keyword Args:
+        pause, verbose, max_workers, backend, state_db, cache_dir,
+            cache_max_bytes, events_file, max_retries, verify, fetch_grib,
+            accounts: see batchDownload(). The job state database, logs and
+            events of the worker are in <outputdir>.
+        worker_id (str or None): id of the worker in the queue. If None, use
+            '<host name>-<process id>'.
+        lease_time (float): number of seconds the lease of a claimed job
+            lasts without being renewed. Leases are renewed while the worker
+            runs, the jobs of a worker that crashed are claimed again once
+            their leases expire.
+        wait (float or None): number of seconds to wait before looking for
+            jobs again, when all the jobs left are leased by other workers.
+            If None, a 4th of <lease_time>.
+    Returns:
+        done_list (list): list of dicts, jobs finished by this worker.
+        fail_list (list): list of dicts, jobs failed for good in this worker.
+
+    Jobs are claimed one at a time, as workers get free, so hosts share the
+    batch as fast as each one downloads. The worker returns when no job is
+    pending or leased in the queue.
+    '''
+
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+        print('\n# <batch_download>: Create folder at: %s' % outputdir)
+    if wait is None:
+        wait = lease_time / 4.
+
+    queue = JobQueue(queue_db, lease_time=lease_time)
+    worker = QueueWorker(queue, worker_id=worker_id, outputdir=outputdir)
+    store = _openStore(outputdir, state_db, False)
+    cache = _openCache(cache_dir, cache_max_bytes, False)
+    events = None
+    if events_file is not None:
+        events = util_events.EventLog(os.path.join(outputdir, events_file))
+    verifier = Verifier() if verify else None
+    converter = Converter() if fetch_grib else None
+    pool = None
+    if accounts is not None:
+        pool = getAccountPool(accounts, pause=pause, verbose=verbose,
+                              events=events)
+
+    done_list = []
+    fail_list = []
+    print('\n# <batch_download>: Worker %s running jobs of %s.'
+          % (worker.worker_id, queue_db))
+    try:
+        while True:
+            job_dict = worker.claim()
+            if job_dict is None:
+                if queue.isFinished():
+                    break
+                # jobs left are leased by other workers, claim them if their
+                # leases expire
+                time.sleep(wait)
+                continue
+
+            jobs = itertools.chain([job_dict], worker.iterJobs())
+            done, failed = processJobs(
+                jobs, outputdir, False, pause, verbose, max_workers=max_workers,
+                backend=backend, store=store, cache=cache, events=events,
+                max_retries=max_retries, verifier=verifier,
+                converter=converter, accounts=pool, worker=worker)
+            done_list.extend(done)
+            fail_list.extend(failed)
+    finally:
+        worker.close()
+        queue.close()
+        if store is not None:
+            store.close()
+        if cache is not None:
+            cache.close()
+        if verifier is not None:
+            verifier.close()
+        if converter is not None:
+            converter.close()
+        util_events.flushLogs()
+
+    print('\n# <batch_download>: Worker %s finished %d job(s), %d failed.'
+          % (worker.worker_id, len(done_list), len(fail_list)))
+
+    return done_list, fail_list
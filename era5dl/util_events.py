@@ -0,0 +1,270 @@
+'''Structured job events, queue-based logging and opt-in profiling.
+
+Log records of all threads are put into a queue, and written to file by a
+single background listener thread per file, so that worker threads never
+block on, or interleave in, file writes.
+
+Job events are written as one JSON object per line, e.g.
+
+    {"time": 1792205524.3, "job": "03", "event": "queue", "duration": 812.4}
+
+with the following events per job:
+
+    'plan': time to generate the job dict.
+    'submit': time to submit the request, or re-attach to it.
+    'queue': time the request waited in the server queue. If the request was
+        never seen in the 'running' state, this includes the server run time.
+    'run': server run time.
+    'download': transfer time, with the 'bytes' and 'bytes_per_s' fields.
+    'cache_hit': job served from the download cache.
+    'postprocess': local processing time after the download.
+    'done' or 'failed': total time of the job, from its start.
+'''
+
+from __future__ import print_function
+import os
+import io
+import json
+import time
+import queue
+import atexit
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+import logging.handlers
+from contextlib import contextmanager
+
+__all__=[
+        'getQueueHandler', 'flushLogs', 'EventLog', 'JobTimer', 'Profiler',
+        'EVENTS_FILE'
+        ]
+
+# default name of the job events file in the output folder
+EVENTS_FILE = 'job_events.jsonl'
+
+# background listeners: abpath -> (queue handler, queue listener)
+_LISTENERS = {}
+_LISTENERS_LOCK = threading.Lock()
+
+
+def getQueueHandler(abpath, formatter=None):
+    '''Get a handler queueing log records to be written to a file
+
+    Args:
+        abpath (str): absolute path to the log file.
+    Keyword Args:
+        formatter (logging.Formatter or None): formatter of the records in
+            the file. Only used when the file is first opened.
+    Returns:
+        handler (logging.handlers.QueueHandler): handler putting records
+            in the queue of a background listener writing to <abpath>. The
+            same handler is returned for the same file.
+    '''
+
+    abpath = os.path.abspath(abpath)
+    with _LISTENERS_LOCK:
+        if abpath not in _LISTENERS:
+            log_queue = queue.Queue()
+            file_handler = logging.FileHandler(abpath)
+            if formatter is not None:
+                file_handler.setFormatter(formatter)
+            listener = logging.handlers.QueueListener(log_queue, file_handler)
+            listener.start()
+            _LISTENERS[abpath] = (logging.handlers.QueueHandler(log_queue),
+                                  listener)
+
+        return _LISTENERS[abpath][0]
+
+
+def flushLogs():
+    '''Write out all queued log records'''
+
+    with _LISTENERS_LOCK:
+        for _, listener in _LISTENERS.values():
+            # stop() processes the records left in the queue
+            listener.stop()
+            for hii in listener.handlers:
+                hii.flush()
+            listener.start()
+
+
+def _stopListeners():
+    with _LISTENERS_LOCK:
+        for _, listener in _LISTENERS.values():
+            listener.stop()
+            for hii in listener.handlers:
+                hii.close()
+        _LISTENERS.clear()
+
+
+atexit.register(_stopListeners)
+
+
+class EventLog(object):
+    def __init__(self, abpath):
+        '''Writer of job events to a JSONL file
+
+        Args:
+            abpath (str): absolute path to the events file. Appended to if
+                exists.
+        '''
+
+        self.abpath = os.path.abspath(abpath)
+        self.logger = logging.getLogger('%s.%s' % (__name__, self.abpath))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        handler = getQueueHandler(self.abpath, logging.Formatter('%(message)s'))
+        if handler not in self.logger.handlers:
+            self.logger.addHandler(handler)
+
+    def emit(self, jobid, event, **fields):
+        '''Write an event
+
+        Args:
+            jobid (str or None): id of the job, None for batch events.
+            event (str): name of the event.
+        Keyword Args:
+            fields: other fields of the event, JSON serializable.
+        '''
+
+        record = {'time': round(time.time(), 3), 'job': jobid, 'event': event}
+        record.update(fields)
+        self.logger.info(json.dumps(record))
+
+
+class JobTimer(object):
+    def __init__(self, events, jobid, abpath_out=None):
+        '''Time the phases of a job and write them as events
+
+        Args:
+            events (EventLog or None): event writer. If None, do nothing.
+            jobid (str): id of the job.
+        Keyword Args:
+            abpath_out (str or None): absolute path to the downloaded file,
+                to get the number of bytes downloaded.
+
+        A JobTimer can be used as the <callback> of retrieveData(): it is
+        called as timer(state, request_id) when the job enters a new state.
+        '''
+
+        self.events = events
+        self.jobid = jobid
+        self.abpath_out = abpath_out
+        self.times = {'start': time.time()}
+
+    def _emit(self, event, t0, **fields):
+        if self.events is None or t0 not in self.times:
+            return
+        duration = round(time.time() - self.times[t0], 6)
+        self.events.emit(self.jobid, event, duration=duration, **fields)
+
+    def __call__(self, state, request_id=None):
+        now = time.time()
+
+        if state == 'submitted':
+            self._emit('submit', 'start', request_id=request_id)
+        elif state == 'running':
+            self._emit('queue', 'submitted', request_id=request_id)
+        elif state == 'downloading':
+            if 'running' in self.times:
+                self._emit('run', 'running', request_id=request_id)
+            elif 'submitted' in self.times:
+                self._emit('queue', 'submitted', request_id=request_id)
+        elif state == 'downloaded':
+            nbytes = None
+            if self.abpath_out is not None and os.path.exists(self.abpath_out):
+                nbytes = os.path.getsize(self.abpath_out)
+            duration = now - self.times.get('downloading', now)
+            self._emit('download', 'downloading', request_id=request_id,
+                       bytes=nbytes,
+                       bytes_per_s=None if nbytes is None or duration <= 0
+                       else round(nbytes / duration, 1))
+        elif state == 'cached':
+            self._emit('cache_hit', 'start')
+
+        self.times[state] = now
+
+    def finish(self, error=None):
+        '''Write the post-processing time and the end of the job
+
+        Keyword Args:
+            error (Exception or str or None): error of a failed job.
+        '''
+
+        if 'downloaded' in self.times:
+            self._emit('postprocess', 'downloaded')
+        if error is None:
+            self._emit('done', 'start')
+        else:
+            self._emit('failed', 'start', error=str(error))
+
+
+class Profiler(object):
+    def __init__(self, outputdir, enabled=True, n_lines=30):
+        '''Opt-in cProfile and tracemalloc profiling of batch phases
+
+        Args:
+            outputdir (str): absolute path to the folder to save the
+                profiles to.
+        Keyword Args:
+            enabled (bool): if False, phases are not profiled.
+            n_lines (int): number of functions and allocation sites listed
+                in the summaries.
+
+        For each phase, 'profile_<phase>.prof' (cProfile stats, readable by
+        pstats or snakeviz) and 'profile_<phase>.txt' (the slowest functions,
+        peak traced memory and largest allocation sites) are saved in
+        <outputdir>. cProfile only sees the thread running the phase, while
+        tracemalloc traces the allocations of all threads.
+        '''
+
+        self.outputdir = outputdir
+        self.enabled = enabled
+        self.n_lines = n_lines
+
+    @contextmanager
+    def phase(self, name):
+        '''Profile the code run in a with block as phase <name>'''
+
+        if not self.enabled:
+            yield
+            return
+
+        own_trace = not tracemalloc.is_tracing()
+        if own_trace:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        t0 = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            duration = time.time() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if own_trace:
+                tracemalloc.stop()
+            self._save(name, profile, duration, peak, snapshot)
+
+    def _save(self, name, profile, duration, peak, snapshot):
+        abpath = os.path.join(self.outputdir, 'profile_%s' % name)
+        profile.dump_stats(abpath + '.prof')
+
+        text = io.StringIO()
+        text.write('Phase: %s\nWall time: %.3f s\nPeak traced memory: %.1f MB\n\n'
+                   % (name, duration, peak / 1024.**2))
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self.n_lines)
+        text.write('\nLargest allocation sites:\n')
+        for statii in snapshot.statistics('lineno')[:self.n_lines]:
+            text.write('%s\n' % statii)
+
+        with open(abpath + '.txt', 'w') as fout:
+            fout.write(text.getvalue())
+
+        print('\n# <Profiler>: Phase %s: %.3f s, peak memory %.1f MB, saved to %s.txt'
+              % (name, duration, peak / 1024.**2, abpath))
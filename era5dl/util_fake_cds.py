@@ -0,0 +1,369 @@
+'''A local stand-in for the CDS API server, for tests and benchmarks.
+
+The server speaks the legacy CDS API protocol used by cdsapi with a
+'<uid>:<key>' token:
+
+    GET    <url>/status.json             server status.
+    POST   <url>/resources/<dataset>     submit a request.
+    GET    <url>/tasks/<request_id>      state of a request.
+    DELETE <url>/tasks/<request_id>      delete a request.
+    GET    <url>/download/<request_id>   result file, with Range support.
+
+A submitted request stays 'queued' for <queue_delay> seconds, then
+'running' for <run_time> seconds, then becomes 'completed', or 'failed'
+with probability <failure_rate>. The result is a dummy file of
+<payload_size> bytes, starting with the NetCDF or GRIB magic bytes
+depending on the requested format.
+
+Like CDS, the server can cap the number of requests queued or running per
+API key, given with HTTP basic auth as cdsapi does.
+
+Usage:
+
+    with FakeCDSServer(queue_delay=1, run_time=2) as server:
+        # cdsapi clients now talk to the fake server
+        batchDownload(...)
+'''
+
+from __future__ import print_function
+import re
+import os
+import json
+import base64
+import time
+import uuid
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__=[
+        'FakeCDSServer'
+        ]
+
+# bytes sent per write when serving a result file
+SEND_SIZE = 64 * 1024
+
+
+def _getMagic(request):
+    '''Get the leading bytes of a dummy result file'''
+
+    fmt = request.get('format', request.get('data_format', 'grib'))
+    if isinstance(fmt, (list, tuple)):
+        fmt = fmt[0]
+    return b'CDF\x01' if str(fmt).startswith('netcdf') else b'GRIB'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # the FakeCDSServer, set on the handler class of each server
+    fake = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def sendJSON(self, code, reply):
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def getPath(self):
+        prefix = self.fake.prefix
+        if not self.path.startswith(prefix):
+            return None
+        return self.path[len(prefix):]
+
+    def do_POST(self):
+        path = self.getPath()
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+
+        match = re.match(r'^/resources/(.+)$', path or '')
+        if match is None:
+            self.sendJSON(404, {'message': 'Not found'})
+            return
+
+        code, reply = self.fake._submit(match.group(1), request, self.getKey())
+        self.sendJSON(code, reply)
+
+    def getKey(self):
+        '''Get the '<uid>:<key>' token of the basic auth of the request'''
+
+        match = re.match(r'^Basic (.+)$', self.headers.get('Authorization', ''))
+        if match is None:
+            return None
+        try:
+            return base64.b64decode(match.group(1)).decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def do_GET(self):
+        path = self.getPath() or ''
+
+        if path == '/status.json':
+            self.sendJSON(200, {})
+            return
+
+        match = re.match(r'^/tasks/([^/]+)$', path)
+        if match:
+            reply = self.fake._getReply(match.group(1))
+            if reply is None:
+                self.sendJSON(404, {'message': 'Request not found'})
+            else:
+                self.sendJSON(200, reply)
+            return
+
+        match = re.match(r'^/download/([^/]+)$', path)
+        if match:
+            self.sendResult(match.group(1))
+            return
+
+        self.sendJSON(404, {'message': 'Not found'})
+
+    def do_DELETE(self):
+        match = re.match(r'^/tasks/([^/]+)$', self.getPath() or '')
+        if match:
+            self.fake._delete(match.group(1))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def sendResult(self, request_id):
+        task = self.fake._getTask(request_id)
+        if task is None:
+            self.sendJSON(404, {'message': 'Result not found'})
+            return
+
+        size = task['size']
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = min(int(match.group(1)), size)
+
+        self.send_response(206 if start > 0 else 200)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, size - 1, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        # generate the file on the fly: magic bytes followed by zeros
+        head = task['magic']
+        pos = start
+        while pos < size:
+            nn = min(SEND_SIZE, size - pos)
+            chunk = (head[pos:] + b'\x00' * nn)[:nn] if pos < len(head) else b'\x00' * nn
+            self.wfile.write(chunk)
+            pos += nn
+
+        self.fake._addStat('bytes_sent', size - start)
+
+
+class FakeCDSServer(object):
+    def __init__(self, queue_delay=0., run_time=0., failure_rate=0.,
+                 payload_size=1024, max_queued=None, seed=None,
+                 host='127.0.0.1', port=0, max_per_key=None):
+        '''Local fake CDS API server
+
+        Keyword Args:
+            queue_delay (float): seconds a request stays in the queue.
+            run_time (float): seconds a request runs before completing.
+            failure_rate (float): probability in [0, 1] that a request fails.
+            payload_size (int or callable): size in bytes of result files, or
+                a function taking the request dict and returning the size.
+            max_queued (int or None): if not None, max number of requests
+                queued or running at the same time. Submissions over the limit
+                get a 429 'too many requests' reply.
+            seed (int or None): seed of the random generator deciding
+                failures.
+            host (str): address to listen at.
+            port (int): port to listen at. If 0, choose a free port.
+            max_per_key (int, dict or None): if not None, max number of
+                requests of an API key queued or running at the same time,
+                or a dict of such numbers keyed by the '<uid>:<key>' tokens,
+                for keys with their own cap. Submissions over the cap of
+                their key get a 429 'too many requests' reply. Keys not in
+                the dict are not capped.
+        '''
+
+        self.queue_delay = queue_delay
+        self.run_time = run_time
+        self.failure_rate = failure_rate
+        self.payload_size = payload_size
+        self.max_queued = max_queued
+        self.max_per_key = max_per_key
+        self.random = random.Random(seed)
+        self.host = host
+        self.port = port
+        self.prefix = '/api/v2'
+        self.key = '1:fake-key'
+
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.stats = {}
+        # API key -> counters
+        self.key_stats = {}
+        self.server = None
+        self.thread = None
+        self._environ = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.host, self.port, self.prefix)
+
+    def start(self):
+        '''Start serving in a background thread'''
+
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        '''Stop the server'''
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        '''Start the server, and point cdsapi clients to it
+
+        The CDSAPI_URL and CDSAPI_KEY environment variables are set to the
+        server's url and key, and restored on exit.
+        '''
+
+        self.start()
+        self._environ = dict((kk, os.environ.get(kk)) for kk in
+                             ['CDSAPI_URL', 'CDSAPI_KEY'])
+        os.environ['CDSAPI_URL'] = self.url
+        os.environ['CDSAPI_KEY'] = self.key
+
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        for kk, vv in self._environ.items():
+            if vv is None:
+                os.environ.pop(kk, None)
+            else:
+                os.environ[kk] = vv
+
+    def _addStat(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def getStats(self):
+        '''Get the request counters of the server
+
+        Returns:
+            result (dict): counts of 'submitted', 'rejected', 'polls',
+                'failed', 'completed' requests and 'bytes_sent'.
+        '''
+
+        with self.lock:
+            return dict(self.stats)
+
+    def getKeyStats(self):
+        '''Get the request counters of each API key
+
+        Returns:
+            result (dict): keys: '<uid>:<key>' tokens, values: dicts of the
+                counts of 'submitted' and 'rejected' requests, and the max
+                number of requests of the key queued or running at the same
+                time, 'max_active'.
+        '''
+
+        with self.lock:
+            return dict((kk, dict(vv)) for kk, vv in self.key_stats.items())
+
+    def _getKeyCap(self, key):
+        if isinstance(self.max_per_key, dict):
+            return self.max_per_key.get(key)
+        return self.max_per_key
+
+    def _getState(self, task, now):
+        elapsed = now - task['submitted']
+        if elapsed < self.queue_delay:
+            return 'queued'
+        if elapsed < self.queue_delay + self.run_time:
+            return 'running'
+        return 'failed' if task['fail'] else 'completed'
+
+    def _submit(self, dataset, request, key=None):
+        now = time.time()
+        with self.lock:
+            key_stats = self.key_stats.setdefault(
+                key, {'submitted': 0, 'rejected': 0, 'max_active': 0})
+            active = [tii for tii in self.tasks.values() if
+                      self._getState(tii, now) in ['queued', 'running']]
+            n_key = len([tii for tii in active if tii['key'] == key])
+            cap = self._getKeyCap(key)
+            if (self.max_queued is not None and len(active) >= self.max_queued)\
+                    or (cap is not None and n_key >= cap):
+                self.stats['rejected'] = self.stats.get('rejected', 0) + 1
+                key_stats['rejected'] += 1
+                return 429, {'message': 'Too many queued requests',
+                             'reason': 'Too many queued requests'}
+
+            size = self.payload_size
+            if callable(size):
+                size = size(request)
+
+            request_id = uuid.uuid4().hex
+            self.tasks[request_id] = {
+                'dataset': dataset,
+                'request': request,
+                'submitted': now,
+                'fail': self.random.random() < self.failure_rate,
+                'size': int(size),
+                'magic': _getMagic(request),
+                'key': key,
+            }
+            self.stats['submitted'] = self.stats.get('submitted', 0) + 1
+            key_stats['submitted'] += 1
+            key_stats['max_active'] = max(key_stats['max_active'], n_key + 1)
+
+        return 202, {'state': 'queued', 'request_id': request_id}
+
+    def _getTask(self, request_id):
+        with self.lock:
+            return self.tasks.get(request_id)
+
+    def _getReply(self, request_id):
+        task = self._getTask(request_id)
+        if task is None:
+            return None
+
+        self._addStat('polls')
+        state = self._getState(task, time.time())
+        reply = {'state': state, 'request_id': request_id}
+        if state == 'completed':
+            reply['location'] = '%s/download/%s' % (self.prefix, request_id)
+            reply['content_length'] = task['size']
+            reply['content_type'] = 'application/x-netcdf'
+            if not task.get('counted'):
+                task['counted'] = True
+                self._addStat('completed')
+        elif state == 'failed':
+            reply['error'] = {'message': 'Request failed',
+                              'reason': 'Simulated failure'}
+            if not task.get('counted'):
+                task['counted'] = True
+                self._addStat('failed')
+
+        return reply
+
+    def _delete(self, request_id):
+        with self.lock:
+            self.tasks.pop(request_id, None)
@@ -7,6 +7,16 @@ Update time: 2021-04-17 08:36:48.
 from __future__ import print_function
 import os
 import re
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# default [latitude, longitude] resolution of ERA5 grids, in degrees
+DEFAULT_GRID = [0.25, 0.25]
+
+# key of the output file, relative to the output folder, saved with each job
+# of the downloaded list
+DOWN_FILE_KEY = 'file_out'
 
 def isListTuple(x):
     """Check an input is a list or tuple or range
@@ -93,6 +103,35 @@ def autoRename(abpath):
     return newname
 
 
+def appendLine(abpath, line):
+    '''Append a line to a text file shared by processes or hosts
+
+    Args:
+        abpath (str): absolute path to the file. Created if not exists.
+        line (str): line to append, without the ending newline.
+
+    The line is written in a single write, under an exclusive POSIX lock of
+    the file where available, so that lines appended at the same time by
+    several processes, e.g. queue workers on hosts sharing a file system,
+    are not interleaved.
+    '''
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(abpath, 'a') as fout:
+        if fcntl is not None:
+            fcntl.lockf(fout, fcntl.LOCK_EX)
+        try:
+            fout.write(line + '\n')
+            fout.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.lockf(fout, fcntl.LOCK_UN)
+
+
 def getAttrProduct(job_dict):
     '''Create combinations of multiple attributes.
 
@@ -117,19 +156,147 @@ def getAttrProduct(job_dict):
                      ]
     '''
 
+    return list(iterAttrProduct(job_dict))
+
+
+def iterAttrProduct(job_dict):
+    '''Iterate through combinations of multiple attributes.
+
+    Args:
+        job_dict (dict): dict containing attributes to iterate through.
+    Returns:
+        result (generator): yields tuples of (key, value) pairs, one for each
+            combination of attributes from <job_dict>, in the same order as
+            getAttrProduct(). Combinations are created on demand.
+    '''
+
+    keys = list(job_dict.keys())
     pools = [(v,) if not isListTuple(v) else tuple(v)
              for v in job_dict.values()]
 
-    # -----------------Get combinations-----------------
-    result = [[]]
-    for pool in pools:
-        result = [x+[y] for x in result for y in pool]
+    for values in itertools.product(*pools):
+        yield tuple(zip(keys, values))
+
+
+def countAttrProduct(job_dict):
+    '''Count the combinations of multiple attributes in <job_dict>'''
+
+    result = 1
+    for v in job_dict.values():
+        result *= len(v) if isListTuple(v) else 1
+
+    return result
+
+
+def snapArea(area, grid):
+    '''Snap area bounds to the nearest grid points
+
+    Args:
+        area (list): [N, W, S, E] bounds, in degrees.
+        grid (list or float or str): [latitude, longitude] resolution of the
+            grid, in degrees, or a single value for both. A str is in the
+            'dlat/dlon' format.
+    Returns:
+        result (list): [N, W, S, E] bounds on the grid.
+    '''
+
+    if isinstance(grid, str):
+        grid = grid.split('/')
+    grid = toList(grid)
+    dlat = float(grid[0])
+    dlon = float(grid[-1])
+
+    north, west, south, east = [float(ii) for ii in area]
+    result = [round(north / dlat) * dlat, round(west / dlon) * dlon,
+              round(south / dlat) * dlat, round(east / dlon) * dlon]
+
+    return [round(ii, 6) for ii in result]
+
+
+def canonicalRequest(data_target, job_dict, snap_area=False):
+    '''Put a retrieval request into a canonical form
+
+    Args:
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Keyword Args:
+        snap_area (bool): if True, snap the 'area' bounds to the nearest grid
+            points, using the 'grid' resolution of the request, or
+            DEFAULT_GRID if not given.
+    Returns:
+        result (dict): a copy of <job_dict> with the 'data_target' key
+            added, values cast to lists of strings, sorted except for 'area'
+            and 'grid' (kept in order, as floats),
+            months and days zero-padded to 2 digits and hours to 'HH:MM'.
+            Requests asking for the same data give the same result,
+            regardless of the order and format of their values.
+    '''
+
+    result = {'data_target': str(data_target)}
+    for kk, vv in job_dict.items():
+        if kk in ['data_target', 'abpath_out']:
+            continue
+
+        values = list(vv) if isListTuple(vv) else [vv, ]
+        if kk in ['area', 'grid']:
+            # ordered values, e.g. [N, W, S, E], or 'N/W/S/E'
+            if isinstance(vv, str):
+                values = vv.split('/')
+            values = [float(ii) for ii in values]
+            if kk == 'area' and snap_area:
+                values = snapArea(values, job_dict.get('grid', DEFAULT_GRID))
+            result[kk] = values
+            continue
+
+        if kk in ['month', 'day']:
+            values = [str(int(ii)).rjust(2, '0') for ii in values]
+        elif kk == 'time':
+            values = [str(ii) if ':' in str(ii) else
+                      '%s:00' % str(ii).rjust(2, '0') for ii in values]
+            values = [ii.rjust(5, '0') for ii in values]
+        else:
+            values = [str(ii) for ii in values]
+
+        result[kk] = sorted(set(values))
+
+    return result
+
+
+def getProcessExecutor(max_workers=None):
+    '''Create a pool of worker processes
+
+    Keyword Args:
+        max_workers (int or None): number of processes. If None, the number
+            of CPUs.
+    Returns:
+        executor (ProcessPoolExecutor): the pool.
+
+    Worker processes are spawned, not forked, as the downloading process
+    runs threads, and a forked child could inherit a lock held by one of them.
+    '''
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+class ProcessPool(object):
+    def __init__(self, max_workers=None):
+        '''Base class of the helpers running work in a pool of processes
+
+        Keyword Args:
+            max_workers (int or None): number of processes. If None, the
+                number of CPUs. See getProcessExecutor().
+
+        Use as a context manager, or call close() to wait for the work
+        submitted and stop the processes.
+        '''
+
+        self.executor = getProcessExecutor(max_workers)
 
-    result2 = []
-    keys = job_dict.keys()
-    for ii, jobii in enumerate(result):
-        dii = tuple(zip(keys, jobii))
-        result2.append(dii)
+    def close(self):
+        self.executor.shutdown(wait=True)
 
-    return result2
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,353 @@
+'''Duration and size model of requests, fitted on the job events of past runs.
+
+Each job of a batch run writes its events to the job events file (see
+util_events), and its 'plan' event gives the shape of its request (see
+getRequestShape()): the dataset, the format, the number of fields and of
+grid points per field. loadSamples() collects, for each job finished after
+a download:
+
+    server_s: the time its request spent queued and running at CDS.
+    download_s: its transfer time.
+    bytes: its downloaded size.
+
+A DurationModel is fitted on these samples, for each (dataset, format):
+
+    server_s = overhead + seconds_per_field x fields
+    bytes = bytes_per_value x fields x points
+    download_s = bytes / bandwidth
+
+with least squares for the server time, and medians and totals for the
+others. A (dataset, format) with fewer than MIN_SAMPLES samples uses the fit
+on all the datasets of its format, then on all the samples (except for the
+bytes per value), then the defaults of util_plan_report.
+
+The model is used to run the longest jobs first (the 'longest' order of
+util_schedule, or LPT: longest processing time first), which shortens the
+makespan of a batch where a few jobs are much longer than the others, and
+to report the estimated time left during a run (see EtaTracker).
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+from statistics import median
+from .util_request_size import countFields
+from .util_convert import isNetCDFRequest
+from . import util_plan_report
+from .util_plan_report import countGridPoints, getJobValues, formatDuration
+
+__all__=[
+        'getRequestShape', 'loadSamples', 'DurationModel', 'loadModel',
+        'EtaTracker', 'MIN_SAMPLES'
+        ]
+
+# min number of samples to fit the model of a (dataset, format)
+MIN_SAMPLES = 3
+
+# parameters of the model
+PARAMS = ['overhead', 'seconds_per_field', 'bytes_per_value', 'bandwidth']
+
+
+def _getFormat(job_dict):
+    return 'netcdf' if isNetCDFRequest(job_dict) else 'grib'
+
+
+def getRequestShape(job_dict):
+    '''Get the shape of a request, as written in the 'plan' job event
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (dict): 'data_target': dataset, 'data_format': 'netcdf' or
+            'grib', 'fields': number of fields, see
+            util_request_size.countFields(), and 'points': number of grid
+            points per field, see util_plan_report.countGridPoints().
+    '''
+
+    return {'data_target': job_dict.get('data_target'),
+            'data_format': _getFormat(job_dict),
+            'fields': countFields(job_dict),
+            'points': countGridPoints(job_dict)}
+
+
+def loadSamples(abpaths):
+    '''Load the samples of finished jobs from job events files
+
+    Args:
+        abpaths (str or list): absolute path(s) to job events files. Missing
+            files are skipped.
+    Returns:
+        result (list): dicts with the request shape (see getRequestShape())
+            and the 'server_s', 'download_s' and 'bytes' of each job
+            finished after a download, with the shape written in its 'plan'
+            event. Jobs served from the cache are left out.
+
+    Job ids are unique within a run only: events are matched to jobs from
+    one 'batch_start' event to the next. Events of an attempt of a job
+    that failed are dropped.
+    '''
+
+    if isinstance(abpaths, str):
+        abpaths = [abpaths, ]
+
+    result = []
+    for abpathii in abpaths:
+        if not os.path.exists(abpathii):
+            continue
+
+        shapes = {}
+        timings = {}
+        with open(abpathii, 'r') as fin:
+            for line in fin:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+
+                name, jobid = event.get('event'), event.get('job')
+                if name == 'batch_start':
+                    shapes, timings = {}, {}
+                elif name == 'plan' and 'fields' in event:
+                    shapes[jobid] = dict((kk, event.get(kk)) for kk in
+                                         ['data_target', 'data_format',
+                                          'fields', 'points'])
+                elif name in ['queue', 'run']:
+                    timings.setdefault(jobid, {}).setdefault('server_s', 0.)
+                    timings[jobid]['server_s'] += event.get('duration') or 0.
+                elif name == 'download':
+                    timings.setdefault(jobid, {}).update(
+                        download_s=event.get('duration'), bytes=event.get('bytes'))
+                elif name in ['cache_hit', 'failed', 'retry']:
+                    timings.pop(jobid, None)
+                elif name == 'done':
+                    timingii = timings.pop(jobid, {})
+                    if jobid in shapes and 'server_s' in timingii and\
+                            timingii.get('bytes') is not None:
+                        sampleii = dict(shapes[jobid])
+                        sampleii.update(timingii)
+                        result.append(sampleii)
+
+    return result
+
+
+def _fitLine(xs, ys):
+    '''Fit y = a + b x with least squares, with a >= 0 and b >= 0
+
+    Returns:
+        a (float): intercept.
+        b (float): slope.
+    '''
+
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((xii - mean_x)**2 for xii in xs)
+    if var_x <= 0:
+        return median(ys), 0.
+
+    b = sum((xii - mean_x) * (yii - mean_y) for xii, yii in zip(xs, ys)) / var_x
+    a = mean_y - b * mean_x
+    if b < 0:
+        return mean_y, 0.
+    if a < 0:
+        # through the origin
+        return 0., sum(xii * yii for xii, yii in zip(xs, ys)) /\
+                sum(xii * xii for xii in xs)
+
+    return a, b
+
+
+def _fitParams(samples):
+    '''Fit the parameters of the model on some samples
+
+    Returns:
+        result (dict): values of PARAMS, None if not enough samples.
+    '''
+
+    result = dict((kk, None) for kk in PARAMS)
+    samples = [sii for sii in samples if sii.get('fields') is not None]
+    if len(samples) < MIN_SAMPLES:
+        return result
+
+    result['overhead'], result['seconds_per_field'] = _fitLine(
+        [float(sii['fields']) for sii in samples],
+        [float(sii['server_s']) for sii in samples])
+
+    ratios = [float(sii['bytes']) / (sii['fields'] * sii['points'])
+              for sii in samples if sii['fields'] * (sii['points'] or 0) > 0]
+    if len(ratios) > 0:
+        result['bytes_per_value'] = median(ratios)
+
+    timed = [sii for sii in samples if (sii.get('download_s') or 0) > 0]
+    if len(timed) > 0:
+        result['bandwidth'] = sum(float(sii['bytes']) for sii in timed) /\
+                sum(sii['download_s'] for sii in timed)
+
+    return result
+
+
+class DurationModel(object):
+    def __init__(self, samples=None):
+        '''Model of the duration and size of requests
+
+        Keyword Args:
+            samples (list or None): samples of finished jobs to fit the model
+                on, see loadSamples(). If None or too few, use the defaults
+                of util_plan_report.
+        '''
+
+        samples = samples or []
+        self.n_samples = len(samples)
+
+        groups = {}
+        for sii in samples:
+            fmt = sii.get('data_format')
+            for keyii in [(sii.get('data_target'), fmt), (None, fmt), (None, None)]:
+                groups.setdefault(keyii, []).append(sii)
+
+        self.params = dict((kk, _fitParams(vv)) for kk, vv in groups.items())
+
+    def getParams(self, data_target, data_format):
+        '''Get the parameters of the model for a dataset and format
+
+        Args:
+            data_target (str): dataset.
+            data_format (str): 'netcdf' or 'grib'.
+        Returns:
+            result (dict): values of 'overhead', 'seconds_per_field',
+                'bytes_per_value' and 'bandwidth', each from the most
+                specific fit with enough samples, or the defaults.
+        '''
+
+        defaults = {'overhead': util_plan_report.REQUEST_OVERHEAD,
+                    'seconds_per_field': 1. / util_plan_report.FIELD_RATE,
+                    'bytes_per_value': util_plan_report.BYTES_PER_VALUE[data_format],
+                    'bandwidth': util_plan_report.BANDWIDTH}
+
+        result = {}
+        for kk in PARAMS:
+            keys = [(data_target, data_format), (None, data_format), (None, None)]
+            if kk == 'bytes_per_value':
+                # values of the other format are of another size
+                keys = keys[:2]
+            for keyii in keys:
+                valueii = self.params.get(keyii, {}).get(kk)
+                if valueii is not None:
+                    result[kk] = valueii
+                    break
+            else:
+                result[kk] = defaults[kk]
+
+        return result
+
+    def predict(self, job_dict):
+        '''Predict the duration and size of a request
+
+        Args:
+            job_dict (dict): dictionary describing the data retrieval task.
+        Returns:
+            seconds (float): time from submission to the end of the download.
+            nbytes (float): downloaded size.
+        '''
+
+        shape = getRequestShape(job_dict)
+        params = self.getParams(shape['data_target'], shape['data_format'])
+        nbytes = params['bytes_per_value'] * shape['fields'] * shape['points']
+        seconds = params['overhead'] + params['seconds_per_field'] * shape['fields'] +\
+                nbytes / params['bandwidth']
+
+        return seconds, nbytes
+
+    def predictPlan(self, plan, shapes=None):
+        '''Predict the durations and sizes of the jobs of a plan
+
+        Args:
+            plan (JobPlan): plan of the jobs.
+        Keyword Args:
+            shapes (dict or None): fields and points of the jobs, from
+                util_plan_report.getPlanShapes(). If None, computed.
+        Returns:
+            seconds (ndarray): predicted seconds of each job, see predict().
+            nbytes (ndarray): predicted bytes of each job.
+        '''
+
+        if shapes is None:
+            shapes = util_plan_report.getPlanShapes(plan)
+
+        keys = ['data_target', 'format', 'data_format']
+        params = {}
+        for kk in PARAMS:
+            params[kk] = getJobValues(
+                plan, keys, lambda x: self.getParams(
+                    x.get('data_target'), _getFormat(x))[kk])
+
+        nbytes = params['bytes_per_value'] * shapes['fields'] * shapes['points']
+        seconds = params['overhead'] + params['seconds_per_field'] * shapes['fields'] +\
+                nbytes / params['bandwidth']
+
+        return seconds, nbytes
+
+
+def loadModel(abpaths, verbose=True):
+    '''Fit a DurationModel on the job events of past runs
+
+    Args:
+        abpaths (str or list): absolute path(s) to job events files, see
+            loadSamples().
+    Returns:
+        result (DurationModel): model fitted on the samples found.
+    '''
+
+    samples = loadSamples(abpaths)
+    if verbose:
+        print('\n# <loadModel>: Fit duration model on %d job(s) of past runs.'
+              % len(samples))
+
+    return DurationModel(samples)
+
+
+class EtaTracker(object):
+    def __init__(self, seconds, max_workers=1):
+        '''Estimate the time left in a batch run
+
+        Args:
+            seconds (list or ndarray): predicted seconds of each job, in the
+                order the jobs are run.
+        Keyword Args:
+            max_workers (int): number of jobs run concurrently.
+
+        The predicted seconds of the jobs left are divided by the rate the
+        predicted work is done at so far, which accounts for the concurrency
+        and for the bias of the predictions. Before any job is finished,
+        they are shared by <max_workers> workers.
+        '''
+
+        self.seconds = [float(sii) for sii in seconds]
+        self.max_workers = max(max_workers or 1, 1)
+        self.finished = set()
+        self.left = sum(self.seconds)
+        self.t0 = time.time()
+
+    def finish(self, idx):
+        '''Record the idx-th job as finished, or failed for good'''
+
+        if 0 <= idx < len(self.seconds) and idx not in self.finished:
+            self.finished.add(idx)
+            self.left -= self.seconds[idx]
+
+    def getEta(self):
+        '''Get the estimated seconds left in the run'''
+
+        done = sum(self.seconds) - self.left
+        elapsed = time.time() - self.t0
+        if done <= 0 or elapsed <= 0:
+            return max(self.left, 0.) / self.max_workers
+
+        return max(self.left, 0.) * elapsed / done
+
+    def getProgress(self):
+        '''Get the progress of the run, as a message'''
+
+        return '%d/%d job(s) finished, ETA %s' % (
+            len(self.finished), len(self.seconds), formatDuration(self.getEta()))
@@ -0,0 +1,478 @@
+'''Compact, array-backed plan of the jobs of a batch.
+
+A batch of jobs is the cartesian product of the values in <job_dict>, on top
+of the fields of <template_dict> shared by all jobs. Instead of a dict per
+job, a JobPlan stores:
+
+    template_dict: the default job dict, once.
+    keys: the fields of <job_dict>, varying between jobs.
+    axes: the values of each field in <keys>, once. A value can be a chunk
+        (tuple) of values.
+    index: a (n_jobs, n_keys) NumPy array of small unsigned integers, a row
+        per job, giving the position of its value on each axis.
+    ids: the ids of the jobs used in default file names, kept when the jobs
+        are reordered. Not stored until the jobs are reordered, the id of a
+        job being then its row.
+
+so a plan of a million jobs takes a few MB. Job dicts are created from a
+row only when needed, e.g. when the job is submitted, by iterating the plan
+or with getJobDict().
+
+A plan is saved to, and loaded from, an uncompressed .npz file with save()
+and loadJobPlan(), without pickling. A <naming_func> is not saved, and is
+given again to loadJobPlan().
+
+This requires the numpy package.
+'''
+
+from __future__ import print_function
+import os
+import copy
+import json
+import itertools
+from .util_general import isListTuple
+from .util_request_size import countFields
+from .util_schedule import ORDERS, LOCALITY_KEYS, IGNORE_KEYS, getSortValue
+
+__all__=[
+        'JobPlan', 'makeProductPlan', 'makeJobPlan', 'loadJobPlan',
+        'getJobFileName', 'importNumpy'
+        ]
+
+# version of the .npz plan file layout
+PLAN_VERSION = 1
+
+
+def importNumpy():
+    '''Import the numpy package, needed by job plans
+
+    Returns:
+        np (module): the numpy package.
+
+    Raises an Exception if numpy is not installed.
+    '''
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception("Job plans require the numpy package.")
+
+    return np
+
+
+def _getIndexType(n_values):
+    '''Get the smallest unsigned integer type indexing <n_values> values'''
+
+    np = importNumpy()
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if n_values <= np.iinfo(dtype).max + 1:
+            return dtype
+
+    return np.uint64
+
+
+def _getValueLabel(value):
+    '''Get the label of a job attribute used in default file names
+
+    A chunk of values is labelled by its 1st and last values, e.g. '01_06'.
+    '''
+
+    if isListTuple(value):
+        if len(value) == 1:
+            return str(value[0])
+        return '%s_%s' % (value[0], value[-1])
+
+    return str(value)
+
+
+def getJobFileName(job, request, jobid, naming_func=None):
+    '''Get the file name of a job
+
+    Args:
+        job (dict): attributes of the job that differ from the template.
+        request (dict): complete job dict.
+        jobid (str): id of the job, padded with 0s.
+    Keyword Args:
+        naming_func (callable or None): if a callable, called with <request>
+            to get the file name. If None, use the default name:
+                [ID<jobid>]<attributes>.nc or
+                [ID<jobid>]<attributes>.grb
+            where <attributes> joins the values in <job>, sorted by key,
+            with dashes.
+    Returns:
+        result (str): the file name, without folder path.
+    '''
+
+    if naming_func is not None:
+        return naming_func(request)
+
+    keys = sorted(job.keys())
+    return '[ID%s]%s%s' % (
+        jobid, '-'.join(_getValueLabel(job[kk]) for kk in keys),
+        '.nc' if request['format'] == 'netcdf' else '.grb')
+
+
+class JobPlan(object):
+    def __init__(self, template_dict, keys, axes, index, outputdir,
+                 ids=None, id_width=None, naming_func=None):
+        '''Compact plan of the jobs of a batch
+
+        Args:
+            template_dict (dict): default job dict.
+            keys (list): fields varying between jobs.
+            axes (list): list of lists, the values of each field in <keys>.
+            index (ndarray): (n_jobs, n_keys) array of integers, the
+                positions of the values of each job on <axes>.
+            outputdir (str): absolute path to the folder to save downloaded
+                data.
+        Keyword Args:
+            ids (ndarray or None): ids of the jobs in default file names. If
+                None, the id of a job is its row in <index>.
+            id_width (int or None): number of digits of the ids in default
+                file names. If None, the number of digits of the number of
+                jobs.
+            naming_func (callable or None): see getJobFileName().
+        '''
+
+        np = importNumpy()
+
+        self.template_dict = template_dict
+        self.keys = list(keys)
+        self.axes = [list(aii) for aii in axes]
+        self.index = np.asarray(index).reshape(-1, len(self.keys))
+        if len(self.keys) != len(self.axes):
+            raise Exception("<keys> and <axes> of a job plan should have the same length.")
+
+        if ids is not None:
+            ids = np.asarray(ids, dtype=_getIndexType(len(ids)))
+        self.ids = ids
+        if ids is not None and len(ids) != len(self.index):
+            raise Exception("<ids> and <index> of a job plan should have the same length.")
+
+        if id_width is None:
+            id_width = len(str(len(self.index)))
+        self.id_width = id_width
+        self.outputdir = outputdir
+        self.naming_func = naming_func
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        '''Iterate the job dicts, created one at a time'''
+
+        for ii in range(len(self)):
+            yield self.getJobDict(ii)
+
+    def __getitem__(self, ii):
+        return self.getJobDict(ii)
+
+    @property
+    def nbytes(self):
+        '''Number of bytes taken by the arrays of the plan'''
+
+        if self.ids is None:
+            return self.index.nbytes
+        return self.index.nbytes + self.ids.nbytes
+
+    def getJob(self, ii):
+        '''Get the attributes of the ii-th job that differ from the template
+
+        Returns:
+            result (dict): the values of the job, for each field in <keys>.
+        '''
+
+        row = self.index[ii]
+        return dict((kk, self.axes[jj][row[jj]])
+                    for jj, kk in enumerate(self.keys))
+
+    def getRequest(self, ii):
+        '''Get the request of the ii-th job
+
+        Returns:
+            result (dict): <template_dict> updated with the values of the
+                job, without the output path. List values of
+                <template_dict> are shared between jobs, and should not be
+                modified in place.
+        '''
+
+        result = dict(self.template_dict)
+        result.update(self.getJob(ii))
+
+        return result
+
+    def getJobDict(self, ii):
+        '''Get the job dict of the ii-th job
+
+        Returns:
+            result (dict): the request of the job, see getRequest(), with
+                the path to its output file as 'abpath_out'. This is the same
+                job dict as created by util_downloader.iterBatchJobDicts().
+        '''
+
+        job = self.getJob(ii)
+        result = dict(self.template_dict)
+        result.update(job)
+        jobid = ii if self.ids is None else self.ids[ii]
+        jobid = str(jobid).rjust(self.id_width, '0')
+        result['abpath_out'] = os.path.join(
+            self.outputdir, getJobFileName(job, result, jobid, self.naming_func))
+
+        return result
+
+    def take(self, rows, renumber=False):
+        '''Get a plan of some of the jobs
+
+        Args:
+            rows (ndarray or list): positions of the jobs to keep, in the
+                order to keep them, or a boolean mask of the jobs.
+        Keyword Args:
+            renumber (bool): if True, number the jobs kept afresh, as if the
+                others were never planned. Otherwise, keep their ids.
+        Returns:
+            result (JobPlan): plan of the jobs kept, sharing the template and
+                axes of this plan.
+        '''
+
+        np = importNumpy()
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        else:
+            rows = rows.astype(np.int64)
+
+        if renumber:
+            ids = None
+        elif self.ids is None:
+            ids = rows
+        else:
+            ids = self.ids[rows]
+        return JobPlan(self.template_dict, self.keys, self.axes,
+                       self.index[rows], self.outputdir, ids=ids,
+                       id_width=self.id_width, naming_func=self.naming_func)
+
+    def _getRanks(self, jj):
+        '''Get the rank of each value on the jj-th axis, for ordering
+
+        Equal values, as compared by util_schedule, have the same rank.
+        '''
+
+        np = importNumpy()
+        values = [getSortValue(vii) for vii in self.axes[jj]]
+        unique = sorted(set(values))
+        lookup = dict((vii, ii) for ii, vii in enumerate(unique))
+
+        return np.array([lookup[vii] for vii in values], dtype=np.int64)
+
+    def orderBy(self, order, model=None):
+        '''Get the plan with the jobs in the order of an ordering policy
+
+        Args:
+            order (str or None): 'locality', 'largest' or 'longest', see
+                util_schedule. If None, return the plan as it is.
+        Keyword Args:
+            model (DurationModel or None): model predicting the durations of
+                the jobs for the 'longest' order, see
+                util_schedule.orderJobs().
+        Returns:
+            result (JobPlan): plan of the same jobs, with the same ids, in
+                the same order as util_schedule.orderJobs() puts their job
+                dicts.
+
+        Jobs are sorted on the ranks of their values on each axis, with a
+        stable sort. The 'largest' policy creates the requests, one at a
+        time, to count their fields. The 'longest' policy predicts the
+        durations with DurationModel.predictPlan().
+        '''
+
+        np = importNumpy()
+        if order is None:
+            return self
+        if order not in ORDERS:
+            raise Exception("<order> can be either 'locality', 'largest', 'longest' or None.")
+
+        # fields in the order of precedence of util_schedule.getLocalityKey().
+        # Fields of the template are the same for all jobs.
+        keys = [kk for kk in LOCALITY_KEYS if kk in self.keys]
+        keys.extend(sorted(kk for kk in self.keys if kk not in LOCALITY_KEYS
+                           and kk not in IGNORE_KEYS))
+
+        columns = []
+        for kk in keys:
+            jj = self.keys.index(kk)
+            columns.append(self._getRanks(jj)[self.index[:, jj]])
+        if order == 'largest':
+            sizes = np.array([countFields(self.getRequest(ii))
+                              for ii in range(len(self))], dtype=np.int64)
+            columns.insert(0, -sizes)
+        elif order == 'longest':
+            if model is None:
+                from .util_history import DurationModel
+                model = DurationModel()
+            columns.insert(0, -model.predictPlan(self)[0])
+
+        if len(columns) == 0:
+            return self
+
+        # np.lexsort() sorts by the last key first
+        rows = np.lexsort(columns[::-1])
+
+        return self.take(rows)
+
+    def save(self, abpath_out):
+        '''Save the plan to an .npz file
+
+        Args:
+            abpath_out (str): absolute path to the .npz file.
+
+        The template, keys and axes are saved as JSON, so their values
+        should be JSON serializable. Chunks of values are loaded as tuples.
+        '''
+
+        np = importNumpy()
+        meta = {'version': PLAN_VERSION, 'template_dict': self.template_dict,
+                'keys': self.keys, 'axes': self.axes,
+                'outputdir': self.outputdir, 'id_width': self.id_width}
+
+        arrays = {'meta': np.array(json.dumps(meta)), 'index': self.index}
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        with open(abpath_out, 'wb') as fout:
+            np.savez(fout, **arrays)
+
+        return
+
+
+def loadJobPlan(abpath_in, naming_func=None):
+    '''Load a plan saved by JobPlan.save()
+
+    Args:
+        abpath_in (str): absolute path to the .npz file.
+    Keyword Args:
+        naming_func (callable or None): naming function of the jobs, see
+            getJobFileName().
+    Returns:
+        result (JobPlan): the plan.
+    '''
+
+    np = importNumpy()
+    with np.load(abpath_in, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        index = data['index']
+        ids = data['ids'] if 'ids' in data.files else None
+
+    if meta.get('version') != PLAN_VERSION:
+        raise Exception("Unsupported job plan version in %s." % abpath_in)
+
+    # chunks of values are saved as lists in json
+    axes = [[tuple(vii) if isinstance(vii, list) else vii for vii in aii]
+            for aii in meta['axes']]
+
+    return JobPlan(meta['template_dict'], meta['keys'], axes, index,
+                   meta['outputdir'], ids=ids, id_width=meta['id_width'],
+                   naming_func=naming_func)
+
+
+def makeProductPlan(template_dict, job_dict, outputdir, skip_set=None,
+                    naming_func=None, id_width=None):
+    '''Plan the jobs of the cartesian product of the values in <job_dict>
+
+    Args:
+        template_dict (dict): default job dict.
+        job_dict (dict): values of the fields varying between jobs, see
+            util_downloader.prepareBatchJobDicts().
+        outputdir (str): absolute path to the folder to save downloaded data.
+    Keyword Args:
+        skip_set (set or None): job tuples of (key, value) pairs, with the
+            keys in the order of <job_dict>, to leave out of the plan.
+        naming_func (callable or None): see getJobFileName().
+        id_width (int or None): number of digits of the ids in default file
+            names. If None, the number of digits of the number of jobs.
+    Returns:
+        result (JobPlan): plan of the jobs not in <skip_set>, in the order of
+            util_general.iterAttrProduct().
+
+    The index is created with vectorised NumPy operations: the row of a job
+    in the product is its position in the product, so skipped jobs are
+    dropped by their positions, without creating the job tuples.
+    '''
+
+    np = importNumpy()
+    keys = list(job_dict.keys())
+    axes = [list(vv) if isListTuple(vv) else [vv] for vv in job_dict.values()]
+    shape = [len(aii) for aii in axes]
+    n_jobs = int(np.prod(shape, dtype=np.int64)) if len(shape) > 0 else 1
+
+    # row of the product, 1st key varying slowest
+    index = np.empty((n_jobs, len(keys)), dtype=_getIndexType(max(shape + [1])))
+    inner = n_jobs
+    for jj, nii in enumerate(shape):
+        if n_jobs == 0:
+            break
+        inner //= nii
+        column = np.repeat(np.arange(nii, dtype=index.dtype), inner)
+        index[:, jj] = np.tile(column, n_jobs // (nii * inner))
+
+    keep = np.ones(n_jobs, dtype=bool)
+    if skip_set and n_jobs > 0:
+        # positions of each value on its axis, a value can be repeated
+        lookups = []
+        for aii in axes:
+            lookups.append({})
+            for ii, vii in enumerate(aii):
+                lookups[-1].setdefault(vii, []).append(ii)
+
+        positions = []
+        for jobii in skip_set:
+            if len(jobii) != len(keys):
+                continue
+            rowii = [lookups[jj].get(vv) for jj, (_, vv) in enumerate(jobii)]
+            if None not in rowii:
+                positions.extend(itertools.product(*rowii))
+        if len(positions) > 0:
+            positions = np.array(positions, dtype=np.int64)
+            keep[np.ravel_multi_index(positions.T, shape)] = False
+
+    if id_width is None:
+        id_width = len(str(n_jobs))
+
+    return JobPlan(copy.deepcopy(template_dict), keys, axes, index[keep],
+                   outputdir, id_width=id_width, naming_func=naming_func)
+
+
+def makeJobPlan(jobs, template_dict, outputdir, naming_func=None,
+                id_width=None):
+    '''Plan a list of jobs
+
+    Args:
+        jobs (iterable): yields job tuples of (key, value) pairs, with the
+            same keys in the same order, e.g. from
+            util_coalesce.coalesceJobs().
+        template_dict (dict): default job dict.
+        outputdir (str): absolute path to the folder to save downloaded data.
+    Keyword Args:
+        naming_func, id_width: see makeProductPlan().
+    Returns:
+        result (JobPlan): plan of <jobs>, in the same order. The values on
+            each axis are in the order of their first appearance.
+    '''
+
+    np = importNumpy()
+    keys = None
+    lookups = []
+    rows = []
+    for jobii in jobs:
+        if keys is None:
+            keys = [kk for kk, _ in jobii]
+            lookups = [{} for _ in keys]
+        rows.append([lookups[jj].setdefault(vv, len(lookups[jj]))
+                     for jj, (_, vv) in enumerate(jobii)])
+
+    if keys is None:
+        keys = []
+    axes = [list(lii.keys()) for lii in lookups]
+    dtype = _getIndexType(max([len(aii) for aii in axes] + [1]))
+    index = np.array(rows, dtype=dtype).reshape(len(rows), len(keys))
+
+    return JobPlan(copy.deepcopy(template_dict), keys, axes, index,
+                   outputdir, id_width=id_width, naming_func=naming_func)
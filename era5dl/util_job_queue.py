@@ -0,0 +1,419 @@
+'''A job queue in a SQLite database, shared by download workers on several hosts.
+
+A coordinator publishes the jobs of a batch once, e.g. from
+prepareBatchJobDicts(), into the database, on a file system shared by the
+hosts. Each worker claims jobs one at a time, with a lease:
+
+    pending -> leased -> done
+                      -> failed
+
+A claim is made in an exclusive (IMMEDIATE) transaction, so a job is given
+to a single worker. A worker renews the leases of its jobs in a background
+thread while it runs them. The lease of a worker that crashed or lost its
+connection is not renewed, and its job is claimed again by another worker
+once the lease expires. Each claim gets a new token, and a worker can only
+finish a job with the token of its claim: a worker that lost the lease of
+a job cannot record it.
+
+Jobs are keyed by util_job_store.getJobKey(), so publishing the same plan
+again adds only the jobs not in the queue yet, and finished jobs stay
+finished.
+
+Usage, on the coordinator:
+
+    publishBatch(TEMPLATE_DICT, JOB_DICT, SKIP_LIST, OUTPUTDIR)
+
+then on each worker host:
+
+    runWorker(QUEUE_DB, LOCAL_OUTPUTDIR, max_workers=4)
+
+See util_downloader.publishBatch() and util_downloader.runWorker().
+'''
+
+from __future__ import print_function
+import os
+import time
+import json
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from .util_job_store import getJobKey
+
+__all__=[
+        'JobQueue', 'QueueWorker', 'QUEUE_STATES', 'QUEUE_DB', 'LEASE_TIME'
+        ]
+
+QUEUE_STATES = ['pending', 'leased', 'done', 'failed']
+
+# default name of the queue database in the output folder of the coordinator
+QUEUE_DB = 'job_queue.db'
+
+# default number of seconds a lease lasts without being renewed
+LEASE_TIME = 300.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    job_key TEXT PRIMARY KEY,
+    seq INTEGER,
+    data_target TEXT,
+    job TEXT,
+    state TEXT,
+    worker TEXT,
+    token TEXT,
+    lease_until REAL,
+    attempts INTEGER,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS queue_state ON queue (state, seq);
+'''
+
+
+class JobQueue(object):
+    def __init__(self, abpath_db, lease_time=LEASE_TIME):
+        '''Job queue shared by workers
+
+        Args:
+            abpath_db (str): absolute path to the SQLite database file.
+                Created if not exists.
+        Keyword Args:
+            lease_time (float): number of seconds a lease of a job lasts
+                without being renewed.
+
+        The queue can be shared by threads of the same process, and by
+        processes on hosts sharing the database file, on a file system
+        supporting POSIX locks.
+        '''
+
+        self.abpath_db = abpath_db
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        # transactions are started explicitly
+        self.conn = sqlite3.connect(abpath_db, timeout=60,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        with self._transaction():
+            for sii in SCHEMA.strip().split(';'):
+                if sii.strip():
+                    self.conn.execute(sii)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        '''Run statements in an exclusive write transaction'''
+
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+
+    def publish(self, job_dicts):
+        '''Add jobs in the 'pending' state, if not in the queue already
+
+        Args:
+            job_dicts (list or iterable): dicts, each defines a download job,
+                with the 'data_target' and 'abpath_out' keys, e.g. from
+                prepareBatchJobDicts().
+        Returns:
+            n_added (int): number of jobs added. Jobs already in the queue,
+                in any state, are left as they are.
+        '''
+
+        now = time.time()
+        rows = []
+        for jobii in job_dicts:
+            rows.append((getJobKey(jobii['data_target'], jobii),
+                         jobii['data_target'], json.dumps(jobii)))
+
+        with self._transaction() as conn:
+            seq = conn.execute('SELECT MAX(seq) FROM queue').fetchone()[0]
+            seq = -1 if seq is None else seq
+            n0 = conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+            conn.executemany(
+                'INSERT OR IGNORE INTO queue (job_key, seq, data_target, job, '
+                'state, attempts, updated) VALUES (?, ?, ?, ?, ?, 0, ?)',
+                [(kk, seq + 1 + ii, dd, jj, 'pending', now)
+                 for ii, (kk, dd, jj) in enumerate(rows)])
+            n1 = conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+        return n1 - n0
+
+    def claim(self, worker):
+        '''Claim the next job, pending or with an expired lease
+
+        Args:
+            worker (str): id of the worker claiming the job.
+        Returns:
+            result (tuple or None): (key, token, job_dict) of the job claimed,
+                in the order of publication. <token> identifies the claim,
+                <job_dict> is the job dict published. None if no job can be
+                claimed.
+        '''
+
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT job_key, job, state, worker FROM queue WHERE state='pending' "
+                "OR (state='leased' AND lease_until<?) ORDER BY seq LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+
+            token = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE queue SET state='leased', worker=?, token=?, "
+                "lease_until=?, attempts=attempts+1, updated=? WHERE job_key=?",
+                (worker, token, now + self.lease_time, now, row['job_key']))
+
+        if row['state'] == 'leased':
+            print('\n# <JobQueue>: Lease of worker %s on job %s expired, claimed by %s.'
+                  % (row['worker'], row['job_key'][:10], worker))
+
+        return row['job_key'], token, json.loads(row['job'])
+
+    def _update(self, key, token, sql, args):
+        '''Update a job still leased with a token
+
+        Returns:
+            result (bool): True if updated, False if the claim of <token> is
+                no longer the lease of the job.
+        '''
+
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                sql + " WHERE job_key=? AND token=? AND state='leased'",
+                tuple(args) + (key, token))
+            return cursor.rowcount == 1
+
+    def renew(self, key, token):
+        '''Extend the lease of a claim
+
+        Returns:
+            result (bool): True if renewed, False if the lease was lost.
+        '''
+
+        now = time.time()
+        return self._update(key, token, 'UPDATE queue SET lease_until=?, updated=?',
+                            (now + self.lease_time, now))
+
+    def complete(self, key, token):
+        '''Record a claimed job as done
+
+        Returns:
+            result (bool): True if recorded, False if the lease was lost.
+        '''
+
+        return self._update(key, token, "UPDATE queue SET state='done', "
+                            "lease_until=NULL, error=NULL, updated=?",
+                            (time.time(),))
+
+    def fail(self, key, token, error):
+        '''Record a claimed job as failed for good
+
+        Returns:
+            result (bool): True if recorded, False if the lease was lost.
+        '''
+
+        return self._update(key, token, "UPDATE queue SET state='failed', "
+                            "lease_until=NULL, error=?, updated=?",
+                            (str(error), time.time()))
+
+    def release(self, key, token):
+        '''Give back a claimed job not run, e.g. by a worker stopping
+
+        Returns:
+            result (bool): True if the job is pending again, False if the
+                lease was lost.
+        '''
+
+        return self._update(key, token, "UPDATE queue SET state='pending', "
+                            "worker=NULL, lease_until=NULL, "
+                            "attempts=MAX(attempts-1, 0), updated=?",
+                            (time.time(),))
+
+    def getJobs(self, state=None):
+        '''Get the records of the jobs
+
+        Keyword Args:
+            state (str or None): if not None, only get jobs in this state.
+        Returns:
+            result (list): list of dicts, with keys 'job_key', 'seq',
+                'data_target', 'job' (the job dict), 'state', 'worker',
+                'token', 'lease_until', 'attempts', 'error' and 'updated', in
+                the order of publication.
+        '''
+
+        sql = 'SELECT * FROM queue'
+        args = ()
+        if state is not None:
+            sql += ' WHERE state=?'
+            args = (state,)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY seq', args).fetchall()
+
+        result = []
+        for rii in rows:
+            rii = dict(rii)
+            rii['job'] = json.loads(rii['job'])
+            result.append(rii)
+
+        return result
+
+    def countStates(self):
+        '''Count jobs in each state
+
+        Returns:
+            result (dict): keys: states, values: number of jobs.
+        '''
+
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT state, COUNT(*) FROM queue GROUP BY state').fetchall()
+
+        return dict((rii[0], rii[1]) for rii in rows)
+
+    def isFinished(self):
+        '''Check whether all the jobs are done or failed'''
+
+        counts = self.countStates()
+        return counts.get('pending', 0) == 0 and counts.get('leased', 0) == 0
+
+
+class QueueWorker(object):
+    def __init__(self, queue, worker_id=None, renew_interval=None,
+                 outputdir=None):
+        '''Worker claiming jobs from a JobQueue, and keeping their leases
+
+        Args:
+            queue (JobQueue): the shared job queue.
+        Keyword Args:
+            worker_id (str or None): id of the worker. If None, use
+                '<host name>-<process id>'.
+            renew_interval (float or None): number of seconds between two
+                renewals of the leases held. If None, a 3rd of the lease time
+                of <queue>.
+            outputdir (str or None): if not None, absolute path to the folder
+                to save the downloaded data in, instead of the folder of the
+                coordinator, e.g. on a disk local to the worker host. File
+                names are kept.
+        '''
+
+        self.queue = queue
+        self.worker_id = worker_id or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.renew_interval = renew_interval or queue.lease_time / 3.
+        self.outputdir = outputdir
+
+        self.lock = threading.Lock()
+        # job key -> token of the leases held
+        self.held = {}
+        self.n_claimed = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _startRenewal(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._renewLoop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _renewLoop(self):
+        while not self.stop_event.wait(self.renew_interval):
+            with self.lock:
+                held = list(self.held.items())
+            for kk, tii in held:
+                if not self.queue.renew(kk, tii):
+                    print('\n# <QueueWorker>: Worker %s lost the lease of job %s.'
+                          % (self.worker_id, kk[:10]))
+                    with self.lock:
+                        self.held.pop(kk, None)
+
+    def claim(self):
+        '''Claim the next job of the queue
+
+        Returns:
+            result (dict or None): job dict claimed, with its 'abpath_out'
+                moved into <outputdir> if given. None if no job can be
+                claimed.
+        '''
+
+        item = self.queue.claim(self.worker_id)
+        if item is None:
+            return None
+
+        key, token, job_dict = item
+        with self.lock:
+            self.held[key] = token
+            self.n_claimed += 1
+        self._startRenewal()
+
+        if self.outputdir is not None:
+            job_dict['abpath_out'] = os.path.join(
+                self.outputdir, os.path.basename(job_dict['abpath_out']))
+
+        return job_dict
+
+    def iterJobs(self):
+        '''Claim jobs one at a time, as they are taken
+
+        Returns:
+            result (generator): yields the job dicts claimed, see claim(),
+                until no job can be claimed.
+        '''
+
+        while True:
+            job_dict = self.claim()
+            if job_dict is None:
+                return
+            yield job_dict
+
+    def _pop(self, data_target, job_dict):
+        with self.lock:
+            return self.held.pop(getJobKey(data_target, job_dict), None)
+
+    def done(self, data_target, job_dict):
+        '''Record a claimed job as done in the queue'''
+
+        key = getJobKey(data_target, job_dict)
+        token = self._pop(data_target, job_dict)
+        if token is None or not self.queue.complete(key, token):
+            print('\n# <QueueWorker>: Job %s finished after its lease was lost.'
+                  % key[:10])
+
+    def failed(self, data_target, job_dict, error):
+        '''Record a claimed job as failed for good in the queue'''
+
+        key = getJobKey(data_target, job_dict)
+        token = self._pop(data_target, job_dict)
+        if token is not None:
+            self.queue.fail(key, token, error)
+
+    def close(self):
+        '''Stop renewing leases, and give back the jobs claimed not finished'''
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        with self.lock:
+            held = list(self.held.items())
+            self.held.clear()
+        for kk, tii in held:
+            self.queue.release(kk, tii)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,233 @@
+'''Persistent store of job states, in a SQLite database.
+
+Each job goes through the states:
+
+    planned -> submitted -> running -> downloading -> done
+
+and a job failing at any stage goes to 'failed'.
+
+The CDS request id of a submitted job is recorded, so that a restarted batch
+can re-attach to requests still queued or running on the server instead of
+resubmitting them. Jobs are indexed by a hash of their canonical request
+(see getJobKey()), so checking whether a job is finished is a single indexed
+look-up.
+'''
+
+from __future__ import print_function
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from .util_general import canonicalRequest
+
+__all__=[
+        'JobStore', 'getJobKey', 'JOB_STATES', 'ACTIVE_STATES'
+        ]
+
+JOB_STATES = ['planned', 'submitted', 'running', 'downloading', 'done',
+              'failed']
+
+# states of a job with a request on the CDS server that can be re-attached to
+ACTIVE_STATES = ['submitted', 'running', 'downloading']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key TEXT PRIMARY KEY,
+    data_target TEXT,
+    request TEXT,
+    abpath_out TEXT,
+    state TEXT,
+    request_id TEXT,
+    error TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+
+def getJobKey(data_target, job_dict):
+    '''Get the key identifying a job in the store
+
+    Args:
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        key (str): sha1 hex digest of the canonical form of the request.
+    '''
+
+    request = canonicalRequest(data_target, job_dict)
+    text = json.dumps(request, sort_keys=True)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class JobStore(object):
+    def __init__(self, abpath_db):
+        '''Persistent store of job states
+
+        Args:
+            abpath_db (str): absolute path to the SQLite database file.
+                Created if not exists.
+
+        The store can be shared by threads of the same process.
+        '''
+
+        self.abpath_db = abpath_db
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(abpath_db, timeout=60,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def addJob(self, data_target, job_dict, abpath_out):
+        '''Add a job in the 'planned' state, if not in the store already
+
+        Args:
+            data_target (str): target dataset.
+            job_dict (dict): dictionary describing the data retrieval task.
+            abpath_out (str): absolute path to save downloaded data.
+        Returns:
+            key (str): key of the job.
+        '''
+
+        key = getJobKey(data_target, job_dict)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO jobs (job_key, data_target, request, '
+                'abpath_out, state, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, data_target, json.dumps(job_dict), abpath_out, 'planned',
+                 now, now))
+
+        return key
+
+    def setState(self, key, state, request_id=None, error=None):
+        '''Update the state of a job
+
+        Args:
+            key (str): key of the job.
+            state (str): new state, one of JOB_STATES.
+        Keyword Args:
+            request_id (str or None): if not None, CDS request id of the job.
+            error (str or None): error message of a failed job.
+        '''
+
+        if state not in JOB_STATES:
+            raise Exception("<state> '%s' not in %s." % (state, JOB_STATES))
+
+        sql = 'UPDATE jobs SET state=?, error=?, updated=?'
+        args = [state, error, time.time()]
+        if request_id is not None:
+            sql += ', request_id=?'
+            args.append(request_id)
+        sql += ' WHERE job_key=?'
+        args.append(key)
+
+        with self.lock, self.conn:
+            self.conn.execute(sql, args)
+
+    def getJob(self, key):
+        '''Get the record of a job
+
+        Args:
+            key (str): key of the job.
+        Returns:
+            result (dict or None): record of the job, with keys 'job_key',
+                'data_target', 'request', 'abpath_out', 'state',
+                'request_id', 'error', 'created' and 'updated'. None if not
+                found.
+        '''
+
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM jobs WHERE job_key=?',
+                                    (key,)).fetchone()
+        if row is None:
+            return None
+
+        result = dict(row)
+        result['request'] = json.loads(result['request'])
+
+        return result
+
+    def getJobs(self, state=None):
+        '''Get the records of all jobs
+
+        Keyword Args:
+            state (str or None): if not None, only get jobs in this state.
+        Returns:
+            result (list): list of dicts, records of the jobs, as getJob().
+        '''
+
+        sql = 'SELECT * FROM jobs'
+        args = ()
+        if state is not None:
+            sql += ' WHERE state=?'
+            args = (state,)
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+
+        result = []
+        for rii in rows:
+            rii = dict(rii)
+            rii['request'] = json.loads(rii['request'])
+            result.append(rii)
+
+        return result
+
+    def isDone(self, key):
+        '''Check whether a job is finished'''
+
+        with self.lock:
+            row = self.conn.execute('SELECT state FROM jobs WHERE job_key=?',
+                                    (key,)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def getDoneKeys(self):
+        '''Get the keys of all finished jobs, in a single query
+
+        Returns:
+            result (set): job keys of the jobs in the 'done' state.
+        '''
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT job_key FROM jobs WHERE state='done'").fetchall()
+
+        return set(rii[0] for rii in rows)
+
+    def getActiveRequestId(self, key):
+        '''Get the CDS request id of a job that can be re-attached to
+
+        Returns:
+            request_id (str or None): request id of the job if it has been
+                submitted and is not yet finished, None otherwise.
+        '''
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT state, request_id FROM jobs WHERE job_key=?',
+                (key,)).fetchone()
+        if row is None or row[0] not in ACTIVE_STATES:
+            return None
+
+        return row[1]
+
+    def countStates(self):
+        '''Count jobs in each state
+
+        Returns:
+            result (dict): keys: states, values: number of jobs.
+        '''
+
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+
+        return dict((rii[0], rii[1]) for rii in rows)
@@ -0,0 +1,759 @@
+'''Streaming merge of the downloaded pieces of a batch into one store per
+variable.
+
+A batch split along time leaves many small files, e.g. one per variable and
+year. A Merger writes each finished piece into a single chunked, compressed
+NetCDF4 file or Zarr store per variable and level type, in a background
+thread, while later pieces are still downloading:
+
+    <merge_dir>/<variable>_<level type><.nc or .zarr>
+
+e.g. z_pressure_levels.nc, t2m_single_levels.nc.
+
+The time (and pressure level) axis of a store is laid out when the store is
+created, from the request of the batch, and each piece is written into the
+rows of its time steps. Pieces can thus be merged in any order, and rows of
+pieces not merged (yet) hold missing values. Packed values, whose
+scale_factor and add_offset differ between pieces, are unpacked to float32.
+
+Pieces are read and written one block of time steps at a time, so memory
+use stays bounded by BLOCK_SIZE, however large the stores grow.
+
+Only NetCDF pieces are merged, which requires the numpy and netCDF4
+packages. Zarr stores also require the zarr (2.x) and numcodecs packages.
+
+Usage, to merge the NetCDF files of a batch after the downloads:
+
+    python -m era5dl.util_merge OUTPUTDIR --format zarr --chunks valid_time=24
+'''
+
+from __future__ import print_function
+import os
+import queue
+import shutil
+import argparse
+import datetime
+import itertools
+import threading
+from .util_general import isListTuple
+from .util_slice import LAT_NAMES, LON_NAMES, LEVEL_NAMES, TIME_NAMES, TOL,\
+        NETCDF_LOCK, findName
+from .util_verify import getFileFormat
+
+__all__=[
+        'getRequestAxes', 'getStoreName', 'Merger', 'mergeFiles',
+        'MERGE_DIR', 'MERGE_FORMATS', 'BLOCK_SIZE'
+        ]
+
+# name of the folder in the output folder to save merged stores in
+MERGE_DIR = 'merged'
+
+# store formats and their file extensions
+MERGE_FORMATS = {'netcdf': '.nc', 'zarr': '.zarr'}
+
+# max number of elements of a variable read into memory at once
+BLOCK_SIZE = 2**22
+
+# number of elements in a default chunk
+CHUNK_SIZE = 2**20
+
+# attributes not copied from pieces, as data are unpacked
+PACKING_ATTRS = ['scale_factor', 'add_offset', '_FillValue', 'missing_value']
+
+
+def _flatten(values):
+    '''Flatten a value, a list of values or a list of chunks into a list'''
+
+    if not isListTuple(values):
+        return [values, ]
+
+    result = []
+    for vii in values:
+        result.extend(_flatten(vii))
+    return result
+
+
+def _parseTime(value):
+    '''Parse a time of the day, e.g. '06:00' or 6, into (hour, minute)'''
+
+    value = str(value)
+    if ':' in value:
+        hour, minute = value.split(':')[:2]
+        return int(hour), int(minute)
+    return int(value), 0
+
+
+def getRequestAxes(template_dict, job_dict=None):
+    '''Get the time and level axes of the data of a batch
+
+    Args:
+        template_dict (dict): default job dict of the batch.
+    Keyword Args:
+        job_dict (dict or None): dict defining the batch download job, see
+            util_downloader.batchDownload(). Its values, which can be lists
+            of chunks, replace those of <template_dict>.
+    Returns:
+        result (dict): 'times': sorted list of the datetimes asked for, from
+            the 'year', 'month', 'day' and 'time' fields, skipping invalid
+            dates. A missing 'day' or 'time' is taken as the 1st day of the
+            month at 00:00, as in monthly means. 'levels': pressure levels in
+            descending order, None if not asked for.
+    '''
+
+    request = dict(template_dict)
+    if isinstance(job_dict, dict):
+        request.update(job_dict)
+
+    def getValues(key, default):
+        return sorted(set(int(vii) for vii in _flatten(request.get(key, default))))
+
+    years = getValues('year', [])
+    months = getValues('month', range(1, 13))
+    days = getValues('day', [1])
+    hours = sorted(set(_parseTime(vii) for vii in
+                       _flatten(request.get('time', ['00:00']))))
+
+    times = []
+    for yii, mii, dii, (hii, minii) in itertools.product(years, months, days, hours):
+        try:
+            times.append(datetime.datetime(yii, mii, dii, hii, minii))
+        except ValueError:
+            # e.g. Feb 30
+            continue
+
+    levels = None
+    if 'pressure_level' in request:
+        levels = sorted(set(float(vii) for vii in
+                            _flatten(request['pressure_level'])), reverse=True)
+
+    return {'times': times, 'levels': levels}
+
+
+def getStoreName(var_name, has_levels):
+    '''Get the name of the merged store of a variable, without extension
+
+    Args:
+        var_name (str): name of the variable in the NetCDF pieces, e.g. 'z'.
+        has_levels (bool): whether the variable is on pressure levels.
+    Returns:
+        result (str): e.g. 'z_pressure_levels' or 't2m_single_levels'.
+    '''
+
+    return '%s_%s' % (var_name, 'pressure_levels' if has_levels else 'single_levels')
+
+
+def _toAttr(value):
+    '''Cast an attribute value into a JSON serializable type'''
+
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def _getRuns(indices):
+    '''Split indices into contiguous runs
+
+    Args:
+        indices (list): indices into a store, one for each index of a piece.
+    Returns:
+        result (list): list of tuples of (slice into the store, slice into
+            the piece), each a run of consecutive indices.
+    '''
+
+    result = []
+    start = 0
+    for ii in range(1, len(indices) + 1):
+        if ii == len(indices) or indices[ii] != indices[ii-1] + 1:
+            result.append((slice(indices[start], indices[ii-1] + 1),
+                           slice(start, ii)))
+            start = ii
+    return result
+
+
+class _NetCDFStore(object):
+    def __init__(self, abpath):
+        '''A merged store in a NetCDF4 file'''
+
+        import netCDF4
+
+        self.abpath = abpath
+        self.exists = os.path.exists(abpath)
+        self.ds = netCDF4.Dataset(abpath, 'a' if self.exists else 'w',
+                                  format='NETCDF4')
+
+    def create(self, dims, variables, attrs, complevel):
+        self.ds.setncatts(attrs)
+        for name, size in dims:
+            self.ds.createDimension(name, size)
+
+        for vii in variables:
+            compress = complevel > 0 and vii['chunks'] is not None
+            var = self.ds.createVariable(
+                vii['name'], vii['dtype'], vii['dims'], zlib=compress,
+                complevel=max(1, complevel), shuffle=compress,
+                chunksizes=vii['chunks'], fill_value=vii['fill_value'])
+            var.setncatts(vii['attrs'])
+            if vii['values'] is not None:
+                var[...] = vii['values']
+
+    def getValues(self, name):
+        var = self.ds.variables[name]
+        var.set_auto_mask(False)
+        return var[...]
+
+    def getAttrs(self, name):
+        var = self.ds.variables[name]
+        return dict((kk, var.getncattr(kk)) for kk in var.ncattrs())
+
+    def getDims(self, name):
+        return list(self.ds.variables[name].dimensions)
+
+    def getShape(self, name):
+        return self.ds.variables[name].shape
+
+    def getFillValue(self, name):
+        return getattr(self.ds.variables[name], '_FillValue', None)
+
+    def hasVariable(self, name):
+        return name in self.ds.variables
+
+    def write(self, name, index, data):
+        self.ds.variables[name][index] = data
+
+    def close(self):
+        self.ds.close()
+
+
+class _ZarrStore(object):
+    def __init__(self, abpath):
+        '''A merged store in a Zarr folder, readable by xarray.open_zarr()'''
+
+        try:
+            import zarr
+        except ImportError:
+            raise Exception("Zarr stores require the zarr and numcodecs packages.")
+
+        self.abpath = abpath
+        self.exists = os.path.exists(abpath)
+        self.zarr = zarr
+        self.group = zarr.open_group(abpath, mode='a')
+
+    def create(self, dims, variables, attrs, complevel):
+        from numcodecs import Blosc
+
+        compressor = None
+        if complevel > 0:
+            compressor = Blosc(cname='zstd', clevel=complevel,
+                               shuffle=Blosc.SHUFFLE)
+
+        self.group.attrs.update(dict((kk, _toAttr(vv)) for kk, vv in attrs.items()))
+        for vii in variables:
+            arr = self.group.create_dataset(
+                vii['name'], shape=vii['shape'],
+                chunks=vii['chunks'] or vii['shape'], dtype=vii['dtype'],
+                fill_value=vii['fill_value'], compressor=compressor)
+            var_attrs = dict((kk, _toAttr(vv)) for kk, vv in vii['attrs'].items())
+            # dimension names, as read by xarray
+            var_attrs['_ARRAY_DIMENSIONS'] = list(vii['dims'])
+            arr.attrs.update(var_attrs)
+            if vii['values'] is not None:
+                arr[...] = vii['values']
+
+    def getValues(self, name):
+        return self.group[name][...]
+
+    def getAttrs(self, name):
+        return dict(self.group[name].attrs)
+
+    def getDims(self, name):
+        return list(self.group[name].attrs['_ARRAY_DIMENSIONS'])
+
+    def getShape(self, name):
+        return self.group[name].shape
+
+    def getFillValue(self, name):
+        return self.group[name].fill_value
+
+    def hasVariable(self, name):
+        return name in self.group
+
+    def write(self, name, index, data):
+        self.group[name][index] = data
+
+    def close(self):
+        self.zarr.consolidate_metadata(self.abpath)
+
+
+class Merger(object):
+    def __init__(self, merge_dir, axes, fmt='netcdf', chunks=None,
+                 complevel=4, verbose=True):
+        '''Merge downloaded NetCDF pieces into one store per variable
+
+        Args:
+            merge_dir (str): absolute path to the folder to save the merged
+                stores in.
+            axes (dict): time and level axes of new stores, see
+                getRequestAxes(). Existing stores keep their own axes.
+        Keyword Args:
+            fmt (str): 'netcdf' (default): NetCDF4 files. 'zarr': Zarr stores.
+            chunks (dict or None): chunk sizes of the data variables, keyed by
+                dimension names, e.g. {'valid_time': 24, 'latitude': 100}.
+                Dimensions not given are not split, except the time
+                dimension, chunked to about CHUNK_SIZE elements per chunk,
+                and the level dimension, chunked by 1 level.
+            complevel (int): compression level, 0 for no compression. zlib
+                for NetCDF4 files, zstd for Zarr stores.
+            verbose (bool): if True, print each piece merged.
+
+        Pieces added with add() are merged in a background thread, one at a
+        time. A piece that fails to merge does not stop the others, see
+        close(). The netCDF4 package is used under util_slice.NETCDF_LOCK,
+        which other threads using it must also hold.
+        '''
+
+        if fmt not in MERGE_FORMATS:
+            raise Exception("<fmt> can be either 'netcdf' or 'zarr'.")
+
+        self.merge_dir = merge_dir
+        self.times = list(axes['times'])
+        self.levels = axes.get('levels')
+        self.fmt = fmt
+        self.chunks = chunks or {}
+        self.complevel = complevel
+        self.verbose = verbose
+
+        # store name -> (store, dict of store info)
+        self.stores = {}
+        # paths to the stores closed
+        self.paths = set()
+        self.n_merged = 0
+        # piece path -> error
+        self.failed = {}
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, abpath):
+        '''Queue a finished piece to merge in the background
+
+        Args:
+            abpath (str): absolute path to the downloaded piece.
+        '''
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put(abpath)
+
+    def _run(self):
+        while True:
+            abpath = self.queue.get()
+            if abpath is None:
+                return
+            self.mergeFile(abpath)
+
+    def mergeFile(self, abpath):
+        '''Merge a piece into the stores of its variables
+
+        Args:
+            abpath (str): absolute path to the downloaded piece.
+        Returns:
+            result (bool): True if merged, False if failed. The error is kept
+                in the 'failed' attribute.
+        '''
+
+        try:
+            with NETCDF_LOCK:
+                self._merge(abpath)
+        except Exception as e:
+            self.failed[abpath] = str(e)
+            print('\n# <Merger>: Failed to merge %s: %s' % (abpath, e))
+            return False
+
+        self.n_merged += 1
+        if self.verbose:
+            print('\n# <Merger>: Merged %s' % abpath)
+        return True
+
+    def close(self):
+        '''Wait for the queued pieces to merge, and close the stores
+
+        Returns:
+            result (dict): 'n_merged': number of pieces merged, 'failed':
+                dict of errors, keyed by the paths of the pieces failed to
+                merge, 'stores': paths to the stores.
+        '''
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        if len(self.stores) > 0 or len(self.failed) > 0:
+            with NETCDF_LOCK:
+                for store, _ in self.stores.values():
+                    store.close()
+                    self.paths.add(store.abpath)
+            self.stores = {}
+            print('\n# <Merger>: Merged %d pieces into %d stores in %s, %d failed.'
+                  % (self.n_merged, len(self.paths), self.merge_dir,
+                     len(self.failed)))
+
+        return {'n_merged': self.n_merged, 'failed': dict(self.failed),
+                'stores': sorted(self.paths)}
+
+    def _merge(self, abpath):
+        try:
+            import numpy as np
+            import netCDF4
+        except ImportError:
+            raise Exception("Merging files requires the numpy and netCDF4 packages.")
+
+        if getFileFormat(abpath) != 'netcdf':
+            raise Exception("Only NetCDF files can be merged.")
+
+        with netCDF4.Dataset(abpath, 'r') as ds:
+            dim_names = list(ds.dimensions.keys())
+            time_name = findName(dim_names, TIME_NAMES)
+            if time_name is None or time_name not in ds.variables:
+                raise Exception("No time dimension found.")
+            level_name = findName(dim_names, LEVEL_NAMES)
+            lat_name = findName(dim_names, LAT_NAMES)
+            lon_name = findName(dim_names, LON_NAMES)
+
+            data_vars = [kk for kk, vv in ds.variables.items()
+                         if lat_name in vv.dimensions and lon_name in vv.dimensions
+                         and kk not in dim_names]
+            # other variables along time, e.g. expver
+            aux_vars = [kk for kk, vv in ds.variables.items()
+                        if time_name in vv.dimensions and kk not in dim_names
+                        and kk not in data_vars and vv.dtype != str]
+            if len(data_vars) == 0:
+                raise Exception("No data variable found.")
+
+            time_var = ds.variables[time_name]
+            times = netCDF4.num2date(
+                time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'),
+                only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+            levels = None
+            if level_name is not None:
+                levels = np.asarray(ds.variables[level_name][:], dtype='float64')
+
+            for vii in data_vars:
+                var = ds.variables[vii]
+                if var.dimensions[0] != time_name:
+                    raise Exception("Time is not the 1st dimension of '%s'." % vii)
+                store, info = self._getStore(ds, vii, time_name, level_name, np)
+                index = self._getIndex(info, var, times, levels, np)
+                self._write(store, vii, var, index, info['fill_value'], np)
+                for aii in aux_vars:
+                    if store.hasVariable(aii):
+                        aux_var = ds.variables[aii]
+                        self._write(store, aii, aux_var,
+                                    self._getIndex(info, aux_var, times, levels, np),
+                                    None, np)
+
+    def _getIndex(self, info, var, times, levels, np):
+        '''Get the store indices of a piece variable along each dimension
+
+        Returns:
+            result (list): for each dimension, a list of indices into the
+                store, one for each index of the piece, or None to copy the
+                dimension as a whole.
+        '''
+
+        result = []
+        for ii, dii in enumerate(var.dimensions):
+            if ii == 0:
+                rows = []
+                for tii in times:
+                    if tii not in info['rows']:
+                        raise Exception("Time %s not in the time axis of %s."
+                                        % (tii, info['abpath']))
+                    rows.append(info['rows'][tii])
+                result.append(rows)
+            elif levels is not None and dii in LEVEL_NAMES:
+                idx = []
+                for lii in levels:
+                    found = np.where(np.abs(info['levels'] - lii) <= TOL)[0]
+                    if len(found) == 0:
+                        raise Exception("Level %s not in the level axis of %s."
+                                        % (lii, info['abpath']))
+                    idx.append(int(found[0]))
+                result.append(idx)
+            else:
+                if var.shape[ii] != info['sizes'][ii]:
+                    raise Exception("Size of dimension '%s' is %d, %d in %s."
+                                    % (dii, var.shape[ii], info['sizes'][ii],
+                                       info['abpath']))
+                result.append(None)
+
+        return result
+
+    def _write(self, store, name, var, index, fill_value, np):
+        '''Write a piece variable into a store, by blocks of time steps'''
+
+        n_per_row = int(np.prod(var.shape[1:])) if len(var.shape) > 1 else 1
+        step = max(1, BLOCK_SIZE // max(1, n_per_row))
+        var.set_auto_maskandscale(True)
+
+        for t0 in range(0, var.shape[0], step):
+            block = var[t0:t0+step]
+            if fill_value is not None:
+                block = np.ma.filled(block.astype('float32'), fill_value)
+            else:
+                block = np.ma.getdata(block)
+
+            # contiguous runs along each dimension mapped to the store
+            runs = []
+            for ii, idx in enumerate(index):
+                if ii == 0:
+                    idx = idx[t0:t0+step]
+                if idx is None:
+                    runs.append([(slice(None), slice(None))])
+                else:
+                    runs.append(_getRuns(idx))
+
+            for combii in itertools.product(*runs):
+                store.write(name, tuple(cii[0] for cii in combii),
+                            block[tuple(cii[1] for cii in combii)])
+
+    def _getStore(self, ds, var_name, time_name, level_name, np):
+        '''Open or create the store of a piece variable'''
+
+        var = ds.variables[var_name]
+        name = getStoreName(var_name, level_name in var.dimensions)
+        if name in self.stores:
+            return self.stores[name]
+
+        if not os.path.exists(self.merge_dir):
+            os.makedirs(self.merge_dir)
+        abpath = os.path.join(self.merge_dir, name + MERGE_FORMATS[self.fmt])
+        if self.fmt == 'zarr':
+            store = _ZarrStore(abpath)
+        else:
+            store = _NetCDFStore(abpath)
+
+        try:
+            if not store.exists:
+                self._createStore(store, ds, var_name, time_name, level_name, np)
+            info = self._getStoreInfo(store, var_name)
+        except:
+            store.close()
+            if not store.exists:
+                # remove a partly created store
+                if os.path.isdir(abpath):
+                    shutil.rmtree(abpath)
+                elif os.path.exists(abpath):
+                    os.remove(abpath)
+            raise
+
+        info['abpath'] = abpath
+        self.stores[name] = (store, info)
+        return store, info
+
+    def _getStoreInfo(self, store, var_name):
+        '''Read the axes of a store'''
+
+        import numpy as np
+        import cftime
+
+        dims = store.getDims(var_name)
+        attrs = store.getAttrs(dims[0])
+        times = cftime.num2date(store.getValues(dims[0]), attrs['units'],
+                                attrs.get('calendar', 'standard'),
+                                only_use_cftime_datetimes=False,
+                                only_use_python_datetimes=True)
+        levels = None
+        level_name = findName(dims, LEVEL_NAMES)
+        if level_name is not None:
+            levels = np.asarray(store.getValues(level_name), dtype='float64')
+
+        return {'rows': dict((tii, ii) for ii, tii in enumerate(times)),
+                'levels': levels, 'sizes': store.getShape(var_name),
+                'fill_value': store.getFillValue(var_name)}
+
+    def _createStore(self, store, ds, var_name, time_name, level_name, np):
+        '''Create the store of a piece variable, with the axes of the batch'''
+
+        import cftime
+
+        var = ds.variables[var_name]
+        sizes = {}
+        variables = []
+
+        # ---------------Coordinates----------------
+        for dii in var.dimensions:
+            values = None
+            if dii in ds.variables:
+                coord = ds.variables[dii]
+                attrs = dict((kk, coord.getncattr(kk)) for kk in coord.ncattrs()
+                             if kk not in PACKING_ATTRS)
+                if dii == time_name:
+                    values = cftime.date2num(self.times, coord.units,
+                                             getattr(coord, 'calendar', 'standard'))
+                    if np.issubdtype(coord.dtype, np.integer):
+                        values = np.round(values)
+                elif dii == level_name and self.levels is not None:
+                    values = self.levels
+                else:
+                    values = coord[:]
+                values = np.asarray(values).astype(coord.dtype)
+                variables.append({'name': dii, 'dtype': coord.dtype,
+                                  'dims': (dii,), 'shape': values.shape,
+                                  'attrs': attrs, 'values': values,
+                                  'chunks': None, 'fill_value': None})
+                sizes[dii] = len(values)
+            else:
+                sizes[dii] = len(ds.dimensions[dii])
+
+        # ---------Other variables, e.g. number, expver---------
+        for kk, vii in ds.variables.items():
+            if kk in ds.dimensions or kk == var_name or vii.dtype == str:
+                continue
+            if any(dii in LAT_NAMES + LON_NAMES for dii in vii.dimensions):
+                continue
+            if not set(vii.dimensions).issubset(sizes):
+                continue
+            attrs = dict((aa, vii.getncattr(aa)) for aa in vii.ncattrs()
+                         if aa not in PACKING_ATTRS)
+            values = None
+            if time_name not in vii.dimensions:
+                values = vii[...]
+            variables.append({'name': kk, 'dtype': vii.dtype,
+                              'dims': vii.dimensions,
+                              'shape': tuple(sizes[dii] for dii in vii.dimensions),
+                              'attrs': attrs, 'values': values,
+                              'chunks': None, 'fill_value': None})
+
+        # ------------------Data------------------
+        dtype = var.dtype
+        fill_value = None
+        if hasattr(var, 'scale_factor') or hasattr(var, 'add_offset') or\
+                np.issubdtype(var.dtype, np.floating):
+            # unpacked
+            dtype = np.dtype('float32')
+            fill_value = np.float32(np.nan)
+        shape = tuple(sizes[dii] for dii in var.dimensions)
+        attrs = dict((kk, var.getncattr(kk)) for kk in var.ncattrs()
+                     if kk not in PACKING_ATTRS)
+        variables.append({'name': var_name, 'dtype': dtype,
+                          'dims': var.dimensions, 'shape': shape,
+                          'attrs': attrs, 'values': None,
+                          'chunks': self._getChunks(var.dimensions, shape,
+                                                    time_name, level_name),
+                          'fill_value': fill_value})
+
+        dims = [(dii, sizes[dii]) for dii in var.dimensions]
+        attrs = dict((kk, ds.getncattr(kk)) for kk in ds.ncattrs())
+        store.create(dims, variables, attrs, self.complevel)
+
+    def _getChunks(self, dims, shape, time_name, level_name):
+        '''Get the chunk sizes of a data variable'''
+
+        result = []
+        for dii, sii in zip(dims, shape):
+            if dii in self.chunks:
+                result.append(self.chunks[dii])
+            elif dii == time_name:
+                result.append(None)
+            elif dii == level_name:
+                result.append(1)
+            else:
+                result.append(sii)
+
+        if result[0] is None:
+            n_per_row = 1
+            for cii in result[1:]:
+                n_per_row *= cii
+            result[0] = CHUNK_SIZE // max(1, n_per_row)
+
+        return [max(1, min(cii, sii)) for cii, sii in zip(result, shape)]
+
+
+def _scanAxes(abpaths):
+    '''Get the union of the time steps and levels of NetCDF pieces'''
+
+    import numpy as np
+    import netCDF4
+
+    times = set()
+    levels = set()
+    for abpath in abpaths:
+        with NETCDF_LOCK, netCDF4.Dataset(abpath, 'r') as ds:
+            dim_names = list(ds.dimensions.keys())
+            time_name = findName(dim_names, TIME_NAMES)
+            if time_name is None or time_name not in ds.variables:
+                continue
+            var = ds.variables[time_name]
+            times.update(netCDF4.num2date(
+                var[:], var.units, getattr(var, 'calendar', 'standard'),
+                only_use_cftime_datetimes=False, only_use_python_datetimes=True))
+            level_name = findName(dim_names, LEVEL_NAMES)
+            if level_name is not None and level_name in ds.variables:
+                levels.update(np.asarray(ds.variables[level_name][:],
+                                         dtype='float64').tolist())
+
+    return {'times': sorted(times),
+            'levels': sorted(levels, reverse=True) if len(levels) > 0 else None}
+
+
+def mergeFiles(abpaths, merge_dir, fmt='netcdf', chunks=None, complevel=4,
+               verbose=True):
+    '''Merge downloaded NetCDF pieces into one store per variable
+
+    Args:
+        abpaths (list): absolute paths to the pieces. Files not in NetCDF
+            format are skipped.
+        merge_dir (str): absolute path to the folder to save the stores in.
+    Keyword Args:
+        fmt, chunks, complevel, verbose: see Merger.
+    Returns:
+        result (dict): see Merger.close().
+
+    The time and level axes of new stores are the union of those of the
+    pieces.
+    '''
+
+    abpaths = [aii for aii in abpaths if getFileFormat(aii) == 'netcdf']
+    axes = _scanAxes(abpaths)
+    merger = Merger(merge_dir, axes, fmt=fmt, chunks=chunks,
+                    complevel=complevel, verbose=verbose)
+    try:
+        for abpath in abpaths:
+            merger.mergeFile(abpath)
+    finally:
+        result = merger.close()
+
+    return result
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Merge the NetCDF files of an era5dl batch into one store per variable.')
+    parser.add_argument('outputdir', help='output folder of the batch')
+    parser.add_argument('--format', default='netcdf', choices=sorted(MERGE_FORMATS),
+                        help='format of the stores, default: netcdf')
+    parser.add_argument('--chunks', default=None,
+                        help='chunk sizes, e.g. valid_time=24,latitude=100')
+    parser.add_argument('--complevel', type=int, default=4,
+                        help='compression level, 0 for no compression, default: 4')
+    parser.add_argument('--merge_dir', default=None,
+                        help='folder to save the stores in, default: <outputdir>/%s' % MERGE_DIR)
+    args = parser.parse_args()
+
+    outputdir = os.path.abspath(args.outputdir)
+    chunks = None
+    if args.chunks:
+        chunks = dict((kk, int(vv)) for kk, vv in
+                      (cii.split('=') for cii in args.chunks.split(',')))
+    abpaths = [os.path.join(outputdir, fii) for fii in sorted(os.listdir(outputdir))
+               if fii.endswith('.nc')]
+
+    mergeFiles(abpaths, args.merge_dir or os.path.join(outputdir, MERGE_DIR),
+               fmt=args.format, chunks=chunks, complevel=args.complevel)
@@ -0,0 +1,256 @@
+'''Adaptive pacing of request submissions.
+
+Submissions take tokens from a token bucket refilled at an adaptive rate,
+following the AIMD (additive increase, multiplicative decrease) scheme:
+
+    * every accepted submission raises the rate by a fixed step, up to
+      <max_rate>.
+    * every throttled submission or poll (HTTP 429 or 5xx, connection
+      error, or a 'too many queued requests' reply) cuts the rate by
+      <decrease>, down to <min_rate>, and blocks all submissions for a
+      back-off time doubling with each consecutive throttle, up to
+      <max_backoff> seconds. Throttles of requests sent before the
+      current back-off started are counted but do not cut the rate again.
+
+The state of the limiter is available from Pacer.getState(), and each
+throttle is reported, so it can be seen why the pipeline runs slowly.
+'''
+
+from __future__ import print_function
+import re
+import time
+import random
+import threading
+
+__all__=[
+        'Pacer', 'isThrottleError', 'THROTTLE_PATTERNS'
+        ]
+
+# patterns in error messages telling that the server is overloaded or
+# limiting the rate of requests
+THROTTLE_PATTERNS = [
+    r'\bhttp (429|50[0234])\b', r'\b(429|50[0234]) (client|server) error\b',
+    r'too many requests', r'too many queued', r'rate limit',
+    r'could not connect', r'connection error', r'service unavailable',
+    r'bad gateway', r'gateway time-?out', r'temporarily unavailable',
+]
+
+
+def isThrottleError(error):
+    '''Check whether an error tells that the server is throttling requests
+
+    Args:
+        error (Exception or str): error raised by a request.
+    Returns:
+        result (bool): True if the message of <error> matches one of
+            THROTTLE_PATTERNS.
+    '''
+
+    text = str(error).lower()
+    return any(re.search(pii, text) for pii in THROTTLE_PATTERNS)
+
+
+class Pacer(object):
+    def __init__(self, interval=3., min_interval=0.1, max_interval=600.,
+                 increase=0.1, decrease=0.5, backoff=5., max_backoff=600.,
+                 burst=1, max_retries=10, verbose=True, events=None,
+                 name=None):
+        '''Token bucket with an AIMD controlled rate
+
+        Keyword Args:
+            interval (float): initial number of seconds between two
+                submissions. If <= 0, submissions are not paced, but still
+                back off when throttled.
+            min_interval (float): shortest interval the rate can increase to.
+            max_interval (float): longest interval the rate can decrease to.
+            increase (float): additive increase of the rate after an accepted
+                submission, as a fraction of the initial rate.
+            decrease (float): multiplicative decrease of the rate after a
+                throttle.
+            backoff (float): seconds of the 1st back-off, doubled with each
+                consecutive throttle, with +-20% jitter.
+            max_backoff (float): max seconds of a back-off.
+            burst (int): max number of tokens saved up while idle.
+            max_retries (int): max number of times a throttled submission
+                or poll is retried before giving up.
+            verbose (bool): if True, print a message on each throttle.
+            events (EventLog or None): if not None, write a 'throttle' event
+                with the limiter state on each throttle.
+            name (str or None): name of the account paced, if not None, given
+                in the messages and events of the throttles. See
+                util_accounts.
+        '''
+
+        if interval > 0:
+            self.rate = 1. / interval
+            self.step = increase * self.rate
+        else:
+            # not paced
+            self.rate = None
+            self.step = 0.
+        self.min_rate = 1. / max_interval
+        self.max_rate = 1. / min_interval
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.burst = burst
+        self.max_retries = max_retries
+        self.verbose = verbose
+        self.events = events
+        self.name = name
+
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        # next time a token can be taken
+        self.next_time = 0.
+        self.backoff_until = 0.
+        self.n_consecutive = 0
+        self.n_accepted = 0
+        self.n_throttled = 0
+        self.last_reason = None
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self):
+        '''Reserve a submission slot
+
+        Returns:
+            wait (float): number of seconds to wait before submitting.
+        '''
+
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time, self.backoff_until)
+            if self.rate is None:
+                return start - now
+
+            # take a token at <start>, waiting for it to be refilled if needed
+            self._refill(now)
+            tokens = min(self.burst, self.tokens + (start - now) * self.rate)
+            if tokens < 1:
+                start += (1 - tokens) / self.rate
+                tokens = 1.
+            self.tokens = tokens - 1 - (start - now) * self.rate
+            self.next_time = start
+
+            return start - now
+
+    def acquire(self):
+        '''Block until a submission is allowed
+
+        Returns:
+            wait (float): number of seconds waited.
+        '''
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def onSuccess(self):
+        '''Report an accepted submission: increase the rate'''
+
+        with self.lock:
+            self.n_accepted += 1
+            self.n_consecutive = 0
+            if self.rate is not None:
+                self.rate = min(self.max_rate, self.rate + self.step)
+
+    def onThrottle(self, reason):
+        '''Report a throttled submission or poll: decrease the rate and back off
+
+        Args:
+            reason (Exception or str): error given by the server.
+        Returns:
+            wait (float): number of seconds left in the back-off.
+        '''
+
+        with self.lock:
+            now = time.time()
+            self.n_throttled += 1
+            self.last_reason = str(reason)
+            if now < self.backoff_until:
+                # already backing off, e.g. a request sent before the
+                # back-off started
+                return self.backoff_until - now
+
+            self.n_consecutive += 1
+            if self.rate is not None:
+                self._refill(now)
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            backoff = min(self.max_backoff,
+                          self.backoff * 2**(self.n_consecutive - 1))
+            backoff *= random.uniform(0.8, 1.2)
+            self.backoff_until = now + backoff
+
+        state = self.getState()
+        if self.verbose:
+            print('\n# <Pacer>: Throttled by server%s (%s). Rate: %s jobs/s, back off %.1f s.'
+                  % ('' if self.name is None else ' for account %s' % self.name,
+                     state['last_reason'], state['rate'], state['backoff_s']))
+        if self.events is not None:
+            if self.name is not None:
+                state['account'] = self.name
+            self.events.emit(None, 'throttle', **state)
+
+        return backoff
+
+    def call(self, func, *args, **kwargs):
+        '''Call a submitting function when allowed, retrying while throttled
+
+        Args:
+            func (callable): function submitting a request.
+            *args, **kwargs: args passed to <func>.
+        Returns:
+            result (obj): return value of <func>.
+
+        Errors telling that the server is throttling requests (see
+        isThrottleError()) are retried after backing off, up to <max_retries>
+        times. Other errors are raised.
+        '''
+
+        n_tries = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not isThrottleError(e) or n_tries >= self.max_retries:
+                    raise
+                n_tries += 1
+                self.onThrottle(e)
+            else:
+                self.onSuccess()
+                return result
+
+    def getState(self):
+        '''Get the state of the limiter
+
+        Returns:
+            result (dict): keys:
+                'rate': current submission rate in jobs/s, None if not paced.
+                'backoff_s': seconds left in the current back-off.
+                'throttled': True if in a back-off.
+                'n_accepted': number of accepted submissions.
+                'n_throttled': number of throttles.
+                'n_consecutive': number of back-offs since the last
+                    accepted submission.
+                'last_reason': error of the last throttle.
+        '''
+
+        with self.lock:
+            backoff_s = max(0., self.backoff_until - time.time())
+            return {
+                'rate': None if self.rate is None else round(self.rate, 6),
+                'backoff_s': round(backoff_s, 3),
+                'throttled': backoff_s > 0,
+                'n_accepted': self.n_accepted,
+                'n_throttled': self.n_throttled,
+                'n_consecutive': self.n_consecutive,
+                'last_reason': self.last_reason,
+            }
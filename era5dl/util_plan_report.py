@@ -0,0 +1,294 @@
+'''Planning report of a batch: job count, sizes and duration estimates.
+
+A dry run prints every job dict, which for a batch of thousands of jobs is
+slow and gives no overview. planReport() instead makes one vectorised pass
+over a util_job_plan.JobPlan and gives aggregate statistics:
+
+    * the number of jobs, and of jobs over util_request_size.MAX_FIELDS
+      fields, which CDS would reject.
+    * fields per job: variables x levels x valid dates x times, see
+      util_request_size.countFields().
+    * bytes per job and in total: fields x grid points x bytes per value.
+      The grid points are counted from the 'area' and 'grid' of the
+      request (the global ERA5 grid at util_general.DEFAULT_GRID if not
+      given), the bytes per value from its format, see BYTES_PER_VALUE.
+    * seconds per job: REQUEST_OVERHEAD, the time spent queued at CDS, plus
+      the fields at FIELD_RATE and the bytes at BANDWIDTH.
+    * wall clock time of the batch at a given concurrency: the total job
+      time shared by the workers, but no less than the longest job.
+
+The estimates are rough, and meant to check the shape of a batch before
+committing queue slots to it. The rates can be set to match past runs.
+
+Fields of a request are products of factors, each depending on a few
+fields only, e.g. the valid dates on 'year', 'month' and 'day'. A factor is
+computed once for each distinct combination of the values of its fields in
+the plan, then gathered for all jobs with NumPy indexing.
+
+Requires the numpy package.
+'''
+
+from __future__ import print_function
+import json
+from .util_general import DEFAULT_GRID, toList
+from .util_request_size import countFields, MAX_FIELDS
+from .util_convert import isNetCDFRequest
+from .util_job_plan import importNumpy
+
+__all__=[
+        'planReport', 'formatReport', 'printReport', 'countGridPoints',
+        'getPlanShapes', 'getJobValues', 'formatDuration',
+        'BYTES_PER_VALUE', 'REQUEST_OVERHEAD', 'FIELD_RATE', 'BANDWIDTH'
+        ]
+
+# bytes of a grid point value, by format. GRIB data from CDS are packed in
+# 16 bits, NetCDF data are float32.
+BYTES_PER_VALUE = {'grib': 2., 'netcdf': 4.}
+
+# seconds a request spends queued and staged at CDS
+REQUEST_OVERHEAD = 120.
+
+# fields processed per second by CDS for a request
+FIELD_RATE = 200.
+
+# download bandwidth, in bytes per second
+BANDWIDTH = 10 * 2**20
+
+# fields of the request each size factor depends on
+FACTOR_KEYS = [
+    ('fields', ['variable']),
+    ('fields', ['pressure_level']),
+    ('fields', ['time']),
+    ('fields', ['year', 'month', 'day']),
+    ('points', ['area', 'grid']),
+    ('value_bytes', ['format', 'data_format']),
+]
+
+
+def countGridPoints(job_dict):
+    '''Count the grid points of a field of a request
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (int): number of latitudes x number of longitudes in the
+            'area' [N, W, S, E] of the request, on its 'grid' resolution, or
+            DEFAULT_GRID if not given. The whole globe if no 'area'.
+    '''
+
+    grid = job_dict.get('grid', DEFAULT_GRID)
+    if isinstance(grid, str):
+        grid = grid.split('/')
+    grid = toList(grid)
+    dlat, dlon = float(grid[0]), float(grid[-1])
+
+    area = job_dict.get('area', [90, -180, -90, 180])
+    north, west, south, east = [float(ii) for ii in area]
+    if east < west:
+        # across the date line
+        east += 360.
+
+    n_lat = int(round(abs(north - south) / dlat)) + 1
+    n_lon = min(int(round((east - west) / dlon)) + 1, int(round(360. / dlon)))
+
+    return n_lat * n_lon
+
+
+def _getValueBytes(job_dict):
+    '''Get the bytes of a grid point value of a request'''
+
+    if isNetCDFRequest(job_dict):
+        return BYTES_PER_VALUE['netcdf']
+    return BYTES_PER_VALUE['grib']
+
+
+# function computing each kind of size factor
+_FACTOR_FUNCS = {'fields': countFields, 'points': countGridPoints,
+                 'value_bytes': _getValueBytes}
+
+
+def getPlanShapes(plan):
+    '''Get the fields and grid points of all the jobs of a plan
+
+    Args:
+        plan (JobPlan): plan of the jobs.
+    Returns:
+        result (dict): keys 'fields', 'points' and 'value_bytes', values
+            ndarrays of the number of fields, of grid points per field and
+            of bytes per value of each job, float.
+    '''
+
+    np = importNumpy()
+    result = dict((kk, np.ones(len(plan))) for kk in _FACTOR_FUNCS)
+    for kind, keys in FACTOR_KEYS:
+        result[kind] = result[kind] * getJobValues(plan, keys,
+                                                   _FACTOR_FUNCS[kind])
+
+    return result
+
+
+def getJobValues(plan, keys, func):
+    '''Get a value, depending on a few fields only, of all the jobs of a plan
+
+    Args:
+        plan (JobPlan): plan of the jobs.
+        keys (list): fields of the request the value depends on.
+        func (callable): called with a request restricted to <keys> to
+            get the value, a number.
+    Returns:
+        result (ndarray): value of each job, float.
+
+    The value is computed once for each distinct combination of the values
+    of <keys> varying in the plan, the other fields being taken from the
+    template of the plan.
+    '''
+
+    np = importNumpy()
+    base = dict((kk, plan.template_dict[kk]) for kk in keys
+                if kk in plan.template_dict)
+    columns = [plan.keys.index(kk) for kk in keys if kk in plan.keys]
+
+    if len(columns) == 0:
+        return np.full(len(plan), float(func(base)))
+
+    combos, inverse = np.unique(plan.index[:, columns], axis=0,
+                                return_inverse=True)
+    values = np.empty(len(combos))
+    for ii, rowii in enumerate(combos):
+        dictii = dict(base)
+        for jj, vv in zip(columns, rowii):
+            dictii[plan.keys[jj]] = plan.axes[jj][vv]
+        values[ii] = func(dictii)
+
+    return values[inverse.reshape(-1)]
+
+
+def _getStats(values):
+    '''Get the min, mean, max and total of an array, {} if empty'''
+
+    if len(values) == 0:
+        return {}
+
+    return {'min': float(values.min()), 'mean': float(values.mean()),
+            'max': float(values.max()), 'total': float(values.sum())}
+
+
+def planReport(plan, max_workers=1, overhead=None, field_rate=None,
+               bandwidth=None, model=None):
+    '''Get the planning report of a batch
+
+    Args:
+        plan (JobPlan): plan of the jobs, e.g. from
+            util_downloader.planBatchJobs().
+    Keyword Args:
+        max_workers (int): number of jobs run concurrently, to estimate the
+            wall clock time.
+        overhead (float or None): seconds a request spends queued at CDS. If
+            None, use REQUEST_OVERHEAD.
+        field_rate (float or None): fields processed per second by CDS. If
+            None, use FIELD_RATE.
+        bandwidth (float or None): download bandwidth in bytes per second.
+            If None, use BANDWIDTH.
+        model (DurationModel or None): if not None, estimate the bytes and
+            seconds of the jobs with this util_history.DurationModel, fitted
+            on past runs, instead of the rates above.
+    Returns:
+        result (dict): with keys:
+            'n_jobs': number of jobs.
+            'n_over_limit': number of jobs over MAX_FIELDS fields.
+            'fields', 'bytes', 'seconds': dicts of the 'min', 'mean', 'max'
+                and 'total' of the fields, bytes and seconds of the jobs.
+            'max_workers': <max_workers>.
+            'wall_clock_s': estimated wall clock time of the batch, in
+                seconds.
+    '''
+
+    np = importNumpy()
+    if overhead is None:
+        overhead = REQUEST_OVERHEAD
+    if field_rate is None:
+        field_rate = FIELD_RATE
+    if bandwidth is None:
+        bandwidth = BANDWIDTH
+
+    shapes = getPlanShapes(plan)
+    fields = shapes['fields']
+    if model is None:
+        sizes = fields * shapes['points'] * shapes['value_bytes']
+        seconds = overhead + fields / field_rate + sizes / bandwidth
+    else:
+        seconds, sizes = model.predictPlan(plan, shapes)
+
+    wall_clock = 0.
+    if len(plan) > 0:
+        wall_clock = max(seconds.sum() / max(max_workers, 1), seconds.max())
+
+    return {'n_jobs': len(plan),
+            'n_over_limit': int((fields > MAX_FIELDS).sum()),
+            'fields': _getStats(fields),
+            'bytes': _getStats(sizes),
+            'seconds': _getStats(seconds),
+            'max_workers': max_workers,
+            'wall_clock_s': float(wall_clock)}
+
+
+def formatDuration(seconds):
+    '''Format seconds as [<d>d ]HH:MM:SS'''
+
+    seconds = int(round(seconds))
+    days, seconds = divmod(seconds, 86400)
+    text = '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if days > 0:
+        text = '%dd %s' % (days, text)
+
+    return text
+
+
+def formatReport(report):
+    '''Format a planning report as a table
+
+    Args:
+        report (dict): report from planReport().
+    Returns:
+        result (str): the report as a table of the min, mean, max and total
+            of the fields, size (MB) and duration of the jobs, with the job
+            counts and the wall clock estimate.
+    '''
+
+    lines = ['Jobs: %d, over %d fields: %d' % (report['n_jobs'], MAX_FIELDS,
+                                               report['n_over_limit'])]
+    if report['n_jobs'] == 0:
+        return '\n'.join(lines)
+
+    stats = ['min', 'mean', 'max', 'total']
+    lines.append('%-12s %14s %14s %14s %14s' % tuple(['per job'] + stats))
+    rows = [('fields', report['fields'], lambda x: '%.0f' % x),
+            ('size (MB)', report['bytes'], lambda x: '%.1f' % (x / 2.**20)),
+            ('duration', report['seconds'], formatDuration)]
+    for name, values, func in rows:
+        lines.append('%-12s %14s %14s %14s %14s'
+                     % tuple([name] + [func(values[kk]) for kk in stats]))
+    lines.append('Wall clock with %d worker(s): %s'
+                 % (report['max_workers'], formatDuration(report['wall_clock_s'])))
+
+    return '\n'.join(lines)
+
+
+def printReport(report, fmt='table'):
+    '''Print a planning report
+
+    Args:
+        report (dict): report from planReport().
+    Keyword Args:
+        fmt (str): 'table', see formatReport(), or 'json'.
+    '''
+
+    if fmt == 'table':
+        print('\n# <planReport>: Planning report')
+        print(formatReport(report))
+    elif fmt == 'json':
+        print(json.dumps(report, sort_keys=True))
+    else:
+        raise Exception("<fmt> can be either 'table' or 'json'.")
+
+    return
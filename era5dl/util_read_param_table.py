@@ -1,5 +1,11 @@
 '''Functions for reading ERA5 parameter table info saved in csv format.
 
+Parameters are looked up through an index built from all tables, mapping
+the variable name in CDS to its shortName, paramId, table and level type.
+The index is built once, on first use, and saved to PARAM_INDEX_FILE, so
+that later runs load it without parsing the csv files. The saved index is
+rebuilt when a table file changes.
+
 Author: guangzhi XU (xugzhi1987@gmail.com)
 Update time: 2021-04-09 11:13:20.
 '''
@@ -8,9 +14,24 @@ from __future__ import print_function
 import os
 import glob
 import csv
+import json
+import threading
 
 TABLE_FOLDER=os.path.abspath(os.path.join(os.path.abspath(__file__), '../tables/'))
 
+# file to save the parameter index to
+PARAM_INDEX_FILE=os.path.join(os.path.expanduser('~'), '.cache', 'era5dl',
+        'param_index.json')
+
+# level type of the variables in each table: 's' for single levels, 'p' for
+# pressure levels. Tables not listed have no variable name in CDS.
+TABLE_LEVEL_TYPES=dict([('table%d' %ii, 's') for ii in range(1,9)] +
+        [('table9', 'p'),])
+
+# memoised parameter index, see getParamIndex()
+_PARAM_INDEX=None
+_PARAM_INDEX_LOCK=threading.Lock()
+
 
 def readTable(abpath_in, verbose=True):
     '''Read in a table from a csv file and return table in dict format
@@ -88,6 +109,128 @@ def getSurfaceTables(all_tables):
     '''Get only tables for surface/single level parameters'''
     return [all_tables['table%d' %ii] for ii in range(1,7)]
 
+def _getTableSignature():
+    '''Get the names, sizes and modification times of the table files'''
+
+    table_files=glob.glob(os.path.join(TABLE_FOLDER, 'table*.csv'))
+    table_files.sort()
+    return [[os.path.basename(fii), os.path.getsize(fii), os.path.getmtime(fii)]
+            for fii in table_files]
+
+def buildParamIndex(all_tables=None):
+    '''Build the parameter index from the tables
+
+    Keyword Args:
+        all_tables (dict or None): tables as returned by readAllTables(). If
+            None, read all tables.
+    Returns:
+        result (dict): keys: variable names in CDS, values: dicts with keys
+            'shortName', 'paramId', 'table', 'level_type', 'name' and
+            'units'. A name found in several tables is taken from the 1st
+            one, in the order of readAllTables().
+    '''
+
+    if all_tables is None:
+        all_tables=readAllTables()
+
+    result={}
+    for tnameii, tableii in all_tables.items():
+        if tnameii not in TABLE_LEVEL_TYPES or 'Variable name in CDS' not in tableii:
+            continue
+
+        for jj, vjj in enumerate(tableii['Variable name in CDS']):
+            if vjj in result or ' ' in vjj:
+                # e.g. 'Not available from the CDS disks'
+                continue
+            result[vjj]={
+                'shortName': tableii['shortName'][jj],
+                'paramId': tableii['paramId'][jj],
+                'table': tnameii,
+                'level_type': TABLE_LEVEL_TYPES[tnameii],
+                'name': tableii['name'][jj],
+                'units': tableii['units'][jj],
+            }
+
+    return result
+
+def getParamIndex(rebuild=False):
+    '''Get the parameter index, loading it only once
+
+    Keyword Args:
+        rebuild (bool): if True, rebuild the index from the tables.
+    Returns:
+        result (dict): parameter index, see buildParamIndex().
+
+    The index is loaded from PARAM_INDEX_FILE if saved there from the
+    current tables, otherwise built from the tables and saved.
+    '''
+
+    global _PARAM_INDEX
+
+    with _PARAM_INDEX_LOCK:
+        if _PARAM_INDEX is not None and not rebuild:
+            return _PARAM_INDEX
+
+        signature=_getTableSignature()
+        if not rebuild and os.path.exists(PARAM_INDEX_FILE):
+            try:
+                with open(PARAM_INDEX_FILE, 'r') as fin:
+                    saved=json.load(fin)
+                if saved['signature']==signature:
+                    _PARAM_INDEX=saved['index']
+                    return _PARAM_INDEX
+            except Exception:
+                pass
+
+        _PARAM_INDEX=buildParamIndex()
+
+        # saving is only an optimization, e.g. home folder may be read-only
+        try:
+            folder=os.path.dirname(PARAM_INDEX_FILE)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            tmp_path='%s.%d.tmp' %(PARAM_INDEX_FILE, os.getpid())
+            with open(tmp_path, 'w') as fout:
+                json.dump({'signature': signature, 'index': _PARAM_INDEX}, fout)
+            os.replace(tmp_path, PARAM_INDEX_FILE)
+        except (IOError, OSError):
+            pass
+
+        return _PARAM_INDEX
+
+def lookupParam(cds_name):
+    '''Look up a parameter by its Variable name in CDS
+
+    Args:
+        cds_name (str): Variable name in CDS, e.g. 'geopotential'.
+    Returns:
+        result (dict or None): entry of the parameter in the index, see
+            buildParamIndex(). None if not found.
+    '''
+
+    return getParamIndex().get(cds_name)
+
+def checkVariables(var_list, level_type=None):
+    '''Find the invalid variable names in a list
+
+    Args:
+        var_list (list): Variable names in CDS.
+    Keyword Args:
+        level_type (str or None): if 's' or 'p', also treat as invalid the
+            variables not on single levels or pressure levels, respectively.
+    Returns:
+        result (list): names in <var_list> not found in the tables.
+    '''
+
+    param_index=getParamIndex()
+    result=[]
+    for vii in var_list:
+        entry=param_index.get(vii)
+        if entry is None or (level_type is not None and entry['level_type']!=level_type):
+            result.append(vii)
+
+    return result
+
 def getShortNames(*args):
     '''Get shortName from Variable name in CDS
 
@@ -95,21 +238,16 @@ def getShortNames(*args):
         *args (tuple): tuple of strings, Variable name in CDS.
     Returns:
         results (str or list): corresponding ShortName (e.g. 'z', 't') for each
-            variable name in <*args>, ('geopotential', 'temperature').
+            variable name in <*args>, ('geopotential', 'temperature'). A name
+            not found in the tables is returned as it is.
     '''
 
+    param_index=getParamIndex()
     results=[]
-    all_tables=readAllTables()
 
     for vii in args:
-        for kjj,tjj in all_tables.items():
-            try:
-                shortnameii=queryField(tjj, 'shortName', 'Variable name in CDS', vii)
-            except:
-                shortnameii=vii
-            else:
-                break
-        results.append(shortnameii)
+        entry=param_index.get(vii)
+        results.append(vii if entry is None else entry['shortName'])
 
     if len(results)==1:
         return results[0]
@@ -0,0 +1,370 @@
+'''Rewrite downloaded NetCDF files with chunks suited to their access pattern.
+
+NetCDF files from CDS are laid out for reading whole maps, one time step
+at a time: reading the time series at a point touches every block of the
+file. A Rechunker rewrites each downloaded file as NetCDF4, in a pool of
+processes while further downloads go on, with:
+
+    * chunks for the expected access pattern: 'timeseries', chunks of all
+      the time steps over small tiles of the grid, or 'map', chunks of a
+      whole map at one time step and level.
+    * zlib or zstd compression, with the shuffle filter.
+    * optional packing of float data into int16, with scale_factor and
+      add_offset.
+
+Data are copied by blocks of whole chunks, so memory use stays bounded by
+BLOCK_SIZE. The file is written to a temporary file first, which replaces
+the original once complete, so a failed rewrite leaves the original file.
+
+Requires the numpy and netCDF4 packages.
+
+Usage, to rewrite the NetCDF files of a batch after the downloads:
+
+    python -m era5dl.util_rechunk OUTPUTDIR --access timeseries --workers 4
+'''
+
+from __future__ import print_function
+import os
+import math
+import argparse
+import itertools
+import threading
+from .util_slice import LAT_NAMES, LON_NAMES, TIME_NAMES, findName
+from .util_general import ProcessPool
+from .util_verify import getFileFormat
+
+__all__=[
+        'getChunkShape', 'rechunkFile', 'Rechunker', 'ACCESS_PATTERNS',
+        'COMPRESSIONS', 'CHUNK_SIZE', 'BLOCK_SIZE'
+        ]
+
+# access patterns to choose chunks for
+ACCESS_PATTERNS = ['timeseries', 'map']
+
+# compression filters
+COMPRESSIONS = ['zlib', 'zstd', None]
+
+# number of elements in a chunk
+CHUNK_SIZE = 2**18
+
+# max number of elements of a variable read into memory at once
+BLOCK_SIZE = 2**22
+
+# fill value of packed data
+PACKED_FILL = -32767
+
+
+def getChunkShape(dims, shape, access='timeseries', chunk_size=CHUNK_SIZE):
+    '''Get the chunk shape of a data variable for an access pattern
+
+    Args:
+        dims (list): dimension names of the variable.
+        shape (list): sizes of the dimensions.
+    Keyword Args:
+        access (str): 'timeseries': chunks of all the time steps (up to
+            <chunk_size>) over tiles of the grid of about <chunk_size>
+            elements. 'map': chunks of a whole map (up to <chunk_size>
+            elements) at one time step and level.
+        chunk_size (int): number of elements in a chunk.
+    Returns:
+        result (list): chunk size along each dimension. Dimensions other
+            than time, latitude and longitude, e.g. levels, are chunked by 1.
+    '''
+
+    if access not in ACCESS_PATTERNS:
+        raise Exception("<access> can be either 'timeseries' or 'map'.")
+
+    result = [1] * len(dims)
+    time_ax = dims.index(findName(dims, TIME_NAMES)) if\
+            findName(dims, TIME_NAMES) is not None else None
+    lat_ax = dims.index(findName(dims, LAT_NAMES))
+    lon_ax = dims.index(findName(dims, LON_NAMES))
+    n_lat, n_lon = shape[lat_ax], shape[lon_ax]
+
+    if access == 'map' or time_ax is None:
+        result[lon_ax] = min(n_lon, chunk_size)
+        result[lat_ax] = min(n_lat, max(1, chunk_size // result[lon_ax]))
+    else:
+        result[time_ax] = min(shape[time_ax], chunk_size)
+        n_tile = max(1, chunk_size // result[time_ax])
+        # a square tile
+        side = max(1, int(math.sqrt(n_tile)))
+        result[lat_ax] = min(n_lat, side)
+        result[lon_ax] = min(n_lon, max(1, n_tile // result[lat_ax]))
+
+    return result
+
+
+def _iterBlocks(shape, chunks):
+    '''Split a variable into blocks of whole chunks
+
+    Returns:
+        result (generator): yields tuples of slices, each a block of at most
+            BLOCK_SIZE elements, or of one chunk if larger, made of whole
+            chunks.
+    '''
+
+    # grow the block from the last dimension
+    block = list(chunks)
+    for ii in range(len(shape) - 1, -1, -1):
+        n_others = 1
+        for jj, bjj in enumerate(block):
+            if jj != ii:
+                n_others *= bjj
+        n_chunks = max(1, BLOCK_SIZE // (n_others * chunks[ii]))
+        block[ii] = min(shape[ii], chunks[ii] * n_chunks)
+        if block[ii] < shape[ii]:
+            break
+
+    starts = [range(0, sii, bii) for sii, bii in zip(shape, block)]
+    for startii in itertools.product(*starts):
+        yield tuple(slice(s0, min(s0 + bii, sii))
+                    for s0, bii, sii in zip(startii, block, shape))
+
+
+def _getPacking(var, np):
+    '''Get the scale_factor and add_offset to pack a variable into int16'''
+
+    shape = var.shape
+    vmin, vmax = None, None
+    for index in _iterBlocks(shape, [1] * (len(shape) - 2) + list(shape[-2:])):
+        block = var[index]
+        if np.ma.count(block) == 0:
+            continue
+        bmin, bmax = float(block.min()), float(block.max())
+        vmin = bmin if vmin is None else min(vmin, bmin)
+        vmax = bmax if vmax is None else max(vmax, bmax)
+
+    if vmin is None:
+        return 1., 0.
+
+    # keep PACKED_FILL for missing values
+    scale = (vmax - vmin) / (2**16 - 3)
+    if scale == 0:
+        scale = 1.
+    return scale, (vmax + vmin) / 2.
+
+
+def rechunkFile(abpath, access='timeseries', compression='zlib', complevel=4,
+                pack=False, chunk_size=CHUNK_SIZE):
+    '''Rewrite a NetCDF file with chunks suited to an access pattern
+
+    Args:
+        abpath (str): absolute path to the NetCDF file, rewritten in place.
+    Keyword Args:
+        access (str): 'timeseries' or 'map', see getChunkShape().
+        compression (str or None): 'zlib', 'zstd' or None for no
+            compression.
+        complevel (int): compression level.
+        pack (bool): if True, pack float data variables into int16. Data
+            already packed are kept as they are.
+        chunk_size (int): number of elements in a chunk.
+    '''
+
+    try:
+        import numpy as np
+        import netCDF4
+    except ImportError:
+        raise Exception("Rechunking files requires the numpy and netCDF4 packages.")
+
+    if compression not in COMPRESSIONS:
+        raise Exception("<compression> can be 'zlib', 'zstd' or None.")
+    if compression == 'zstd' and not getattr(netCDF4, '__has_zstandard_support__', False):
+        raise Exception("The netCDF4 library has no zstd support.")
+
+    tmp_path = '%s.%d.rechunk' % (abpath, os.getpid())
+    with netCDF4.Dataset(abpath, 'r') as ds_in:
+        dim_names = list(ds_in.dimensions.keys())
+        lat_name = findName(dim_names, LAT_NAMES)
+        lon_name = findName(dim_names, LON_NAMES)
+
+        try:
+            with netCDF4.Dataset(tmp_path, 'w', format='NETCDF4') as ds_out:
+                ds_out.setncatts(dict((kk, ds_in.getncattr(kk))
+                                      for kk in ds_in.ncattrs()))
+                for kk, dimii in ds_in.dimensions.items():
+                    ds_out.createDimension(kk, len(dimii))
+
+                for kk, var_in in ds_in.variables.items():
+                    is_data = kk not in dim_names and lat_name in var_in.dimensions\
+                            and lon_name in var_in.dimensions
+                    _copyVariable(ds_out, kk, var_in, is_data, access,
+                                  compression, complevel, pack, chunk_size, np)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, abpath)
+
+    return
+
+
+def _copyVariable(ds_out, name, var_in, is_data, access, compression,
+                  complevel, pack, chunk_size, np):
+    '''Copy a variable, with new chunks and compression if a data variable'''
+
+    attrs = dict((kk, var_in.getncattr(kk)) for kk in var_in.ncattrs()
+                 if kk != '_FillValue')
+    fill_value = getattr(var_in, '_FillValue', None)
+
+    if not is_data:
+        var_out = ds_out.createVariable(name, var_in.dtype, var_in.dimensions,
+                                        fill_value=fill_value)
+        var_out.setncatts(attrs)
+        if len(var_in.dimensions) == 0:
+            var_out.assignValue(var_in.getValue())
+        else:
+            var_in.set_auto_maskandscale(False)
+            var_out.set_auto_maskandscale(False)
+            var_out[:] = var_in[:]
+        return
+
+    dtype = var_in.dtype
+    packed = 'scale_factor' in attrs or 'add_offset' in attrs
+    if pack and not packed and np.issubdtype(dtype, np.floating):
+        scale, offset = _getPacking(var_in, np)
+        attrs['scale_factor'] = scale
+        attrs['add_offset'] = offset
+        dtype, fill_value = np.dtype('i2'), PACKED_FILL
+        # pack on write
+        raw = False
+    else:
+        raw = True
+
+    chunks = getChunkShape(list(var_in.dimensions), var_in.shape, access,
+                           chunk_size)
+    var_out = ds_out.createVariable(
+        name, dtype, var_in.dimensions, compression=compression,
+        complevel=complevel, shuffle=compression is not None,
+        chunksizes=chunks, fill_value=fill_value)
+    var_out.setncatts(attrs)
+    var_in.set_auto_maskandscale(not raw)
+    var_out.set_auto_maskandscale(not raw)
+
+    for index in _iterBlocks(var_in.shape, chunks):
+        var_out[index] = var_in[index]
+
+
+def _rechunkItem(item):
+    '''Rewrite a file in a worker process, see rechunkFile()
+
+    Args:
+        item (tuple): (abpath, access, compression, complevel, pack,
+            chunk_size).
+    Returns:
+        abpath (str): path of the file.
+        error (str or None): error of a failed rewrite, None if rewritten or
+            not a NetCDF file.
+    '''
+
+    try:
+        if getFileFormat(item[0]) == 'netcdf':
+            rechunkFile(*item)
+    except Exception as e:
+        return item[0], str(e)
+
+    return item[0], None
+
+
+class Rechunker(ProcessPool):
+    def __init__(self, max_workers=None, access='timeseries',
+                 compression='zlib', complevel=4, pack=False,
+                 chunk_size=CHUNK_SIZE, verbose=True):
+        '''Rewrite downloaded NetCDF files in a pool of processes
+
+        Keyword Args:
+            max_workers (int or None): number of processes. If None, the
+                number of CPUs.
+            access, compression, complevel, pack, chunk_size: see
+                rechunkFile().
+            verbose (bool): if True, print each file rewritten.
+
+        Files are submitted without waiting for their rewrite, so that
+        downloads go on meanwhile. Files not in NetCDF format are skipped.
+        '''
+
+        if access not in ACCESS_PATTERNS:
+            raise Exception("<access> can be either 'timeseries' or 'map'.")
+        if compression not in COMPRESSIONS:
+            raise Exception("<compression> can be 'zlib', 'zstd' or None.")
+
+        ProcessPool.__init__(self, max_workers)
+        self.options = (access, compression, complevel, pack, chunk_size)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.n_files = 0
+        # file path -> error
+        self.failed = {}
+        self.futures = set()
+
+    def submit(self, abpath):
+        '''Start rewriting a file
+
+        Args:
+            abpath (str): absolute path to the downloaded file.
+        Returns:
+            future (Future): gives (abpath, error), see close().
+        '''
+
+        future = self.executor.submit(_rechunkItem, (abpath, ) + self.options)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._onDone)
+        return future
+
+    def _onDone(self, future):
+        try:
+            abpath, error = future.result()
+        except Exception as e:
+            # e.g. a worker process died
+            abpath, error = None, str(e)
+
+        with self.lock:
+            self.futures.discard(future)
+            if error is None:
+                self.n_files += 1
+                if self.verbose:
+                    print('\n# <Rechunker>: Rewrote %s' % abpath)
+            else:
+                self.failed[abpath] = error
+                print('\n# <Rechunker>: Failed to rewrite %s, kept as it is: %s'
+                      % (abpath, error))
+
+    def close(self):
+        '''Wait for the files submitted to be rewritten
+
+        Returns:
+            result (dict): 'n_files': number of files rewritten, 'failed':
+                dict of errors, keyed by the paths of the files failed to
+                rewrite, which are left as they were.
+        '''
+
+        ProcessPool.close(self)
+        with self.lock:
+            return {'n_files': self.n_files, 'failed': dict(self.failed)}
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Rewrite the NetCDF files of an era5dl batch with chunks suited to an access pattern.')
+    parser.add_argument('outputdir', help='output folder of the batch')
+    parser.add_argument('--access', default='timeseries', choices=ACCESS_PATTERNS,
+                        help='access pattern, default: timeseries')
+    parser.add_argument('--compression', default='zlib', choices=['zlib', 'zstd', 'none'],
+                        help='compression filter, default: zlib')
+    parser.add_argument('--complevel', type=int, default=4,
+                        help='compression level, default: 4')
+    parser.add_argument('--pack', action='store_true',
+                        help='pack float data into int16')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, default: number of CPUs')
+    args = parser.parse_args()
+
+    outputdir = os.path.abspath(args.outputdir)
+    with Rechunker(max_workers=args.workers, access=args.access,
+                   compression=None if args.compression == 'none' else args.compression,
+                   complevel=args.complevel, pack=args.pack) as rechunker:
+        for fii in sorted(os.listdir(outputdir)):
+            if fii.endswith('.nc'):
+                rechunker.submit(os.path.join(outputdir, fii))
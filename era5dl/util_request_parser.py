@@ -7,16 +7,18 @@ Update time: 2021-04-08 10:10:34.
 from __future__ import print_function
 import os
 import re
-import copy
+import ast
 from pprint import pprint
 from .util_general import getAttrProduct
+from .util_request_size import autoSplitFields
 
 __all__=[
         'DATA_TARGET_PATTERN', 'DICT_PATTERN', 'DICT_KEY_VALUE_PATTERN',
-        'parseJobDict', 'splitBy', 'parseFile', 'parseString'
+        'parseJobDict', 'splitBy', 'parseFile', 'parseString', 'parseDirectory'
         ]
 
 #------------api request parsing regex------------
+# kept for compatibility, parseString() parses the request with the ast module
 DATA_TARGET_PATTERN=re.compile(r'''
 ^c\.retrieve\(  # start of the retrieve() function
 \s*'(.*?)',     # next line
@@ -41,7 +43,8 @@ def parseJobDict(job_list):
     Args:
         job_list (list): list of (key, value) pairs, where <value> is an
             unformatted string, which has to be converted to a normal string,
-            or list, using eval(value).
+            or list, using ast.literal_eval(value). Only Python literals are
+            accepted, code in <value> is never run.
     Returns:
         result (dict): dict containing all key-value pairs in <job_list>.
     '''
@@ -49,27 +52,43 @@ def parseJobDict(job_list):
     result={}
     for ii, (kii, vii) in enumerate(job_list):
         vii=vii.strip().strip(',')
-        valueii=eval(vii)
+        try:
+            valueii=ast.literal_eval(vii)
+        except (ValueError, SyntaxError):
+            raise Exception("Value of key '%s' is not a literal: %s" %(kii, vii))
         result[str(kii)]=valueii
 
     return result
 
-def splitBy(job_dict, split_fields, verbose=True):
+def splitBy(job_dict, split_fields, verbose=True, max_fields=None):
     '''Split total request job into a number of sub-jobs
 
     Args:
         job_dict (dict): parsed dictionary defining a data retrieval request job.
-        split_fields (list or tuple): dimensions along which to split the job
+        split_fields (list or tuple or str): dimensions along which to split the job
             into sub-jobs. E.g. ['variable', 'year', 'pressure_level'] will
             split the retrieval job into a number of sub-jobs such that each
             one retrieves one variable, in one year, on each pressure level.
             If 'variable'=['u', 'v'], 'year'=[1999, 2000], 'pressure_level'=
             [900, 950, 1000], this will create 2x2x3 = 12 sub-jobs, starting
             with ('variable'='u', 'year'=1999, 'pressure_level'=900).
+            If 'auto', choose the split dimensions and chunk sizes such that
+            each sub-job asks for at most <max_fields> fields. See
+            util_request_size.autoSplitFields().
+    Keyword Args:
+        max_fields (int or None): max number of fields in a sub-job when
+            <split_fields> is 'auto'. If None, use util_request_size.MAX_FIELDS.
     Returns:
         results (list): list of dicts, each defines a sub-job retrieval.
+            Sub-job dicts are shallow copies of <job_dict>: list values not
+            split are shared between sub-jobs and should not be modified in
+            place.
     '''
 
+    if split_fields == 'auto':
+        split_fields = autoSplitFields(job_dict, max_fields=max_fields,
+                                       verbose=verbose)
+
     keys=job_dict.keys()
     split_dims={}
     for kii in split_fields:
@@ -81,14 +100,18 @@ def splitBy(job_dict, split_fields, verbose=True):
             if verbose:
                 print('\n# <splitBy>: Skip "%s"' %kii)
 
-        split_dims[kii]=job_dict[kii]
+        if isinstance(split_fields, dict):
+            # chunks given by autoSplitFields()
+            split_dims[kii]=split_fields[kii]
+        else:
+            split_dims[kii]=job_dict[kii]
 
     sub_jobs=getAttrProduct(split_dims)
     results=[]
     for jobii in sub_jobs:
         jobii=dict(jobii)
-        dictii=copy.deepcopy(job_dict)
-        dictii.update(dict(jobii))
+        dictii=dict(job_dict)
+        dictii.update(jobii)
         results.append(dictii)
 
     if verbose:
@@ -109,45 +132,146 @@ def parseFile(abpath_in, verbose=True):
     '''
 
     with open(abpath_in, 'r') as fin:
-        lines=fin.readlines()
+        lines=fin.read()
         if len(lines)==0:
             raise Exception("File %s is empty." %abpath_in)
-        lines=''.join(lines)
 
-    return parseString(lines, verbose)
+    try:
+        return parseString(lines, verbose)
+    except Exception as e:
+        raise Exception("Failed to parse %s: %s" %(abpath_in, e))
+
+def _literalEval(node, names, what):
+    '''Get the value of a literal, or of a name assigned a literal
+
+    Args:
+        node (ast.AST): node of an argument of the retrieve() call.
+        names (dict): literal values of the module level assignments.
+        what (str): name of the argument, used in error messages.
+    Returns:
+        result (obj): value of <node>.
+    '''
+
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise Exception("%s '%s' is not assigned a literal." %(what, node.id))
+        return names[node.id]
+
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise Exception("%s is not a literal." %what)
 
 def parseString(lines, verbose=True):
     '''Parse a web generated API request in a string
 
     Args:
-        lines (str): API request in string format.
+        lines (str): API request in string format. Either the legacy form:
+
+            c.retrieve('reanalysis-era5-single-levels', {...}, 'download.nc')
+
+            or the newer form:
+
+            dataset = 'reanalysis-era5-single-levels'
+            request = {...}
+            client.retrieve(dataset, request).download()
+
     Returns:
         job_dict (dict): a dictionary defining the data retrieval task. This
             is the same form as the 2nd input argument to the
             cdsapi.Client().retrieve() method.
+
+    The string is parsed once with the ast module, and the values are read
+    with ast.literal_eval(), so the parsing is linear in the length of the
+    string and no code in it is run.
     '''
 
     try:
-        data_target=DATA_TARGET_PATTERN.search(lines).group(1)
-    except:
-        raise Exception("DATA_TARGET_PATTERN failed to match the string.")
+        tree=ast.parse(lines)
+    except SyntaxError as e:
+        raise Exception("API request is not valid Python: %s" %e)
+
+    # literal values assigned at module level, e.g. dataset = '...'
+    names={}
+    for nodeii in tree.body:
+        if not isinstance(nodeii, ast.Assign):
+            continue
+        try:
+            valueii=ast.literal_eval(nodeii.value)
+        except ValueError:
+            continue
+        for tii in nodeii.targets:
+            if isinstance(tii, ast.Name):
+                names[tii.id]=valueii
+
+    # the first retrieve() call, e.g. c.retrieve(...).download()
+    call=None
+    for nodeii in ast.walk(tree):
+        if isinstance(nodeii, ast.Call) and\
+                isinstance(nodeii.func, ast.Attribute) and\
+                nodeii.func.attr=='retrieve':
+            call=nodeii
+            break
+
+    if call is not None:
+        args=list(call.args)
+        kwargs=dict((kii.arg, kii.value) for kii in call.keywords)
+        if len(args)==0 and 'name' in kwargs:
+            args.append(kwargs['name'])
+        if len(args)==1 and 'request' in kwargs:
+            args.append(kwargs['request'])
+        if len(args)<2:
+            raise Exception("retrieve() should be given the dataset and the request.")
+        data_target=_literalEval(args[0], names, 'Dataset')
+        job_dict=_literalEval(args[1], names, 'Request')
+    elif 'dataset' in names and 'request' in names:
+        data_target=names['dataset']
+        job_dict=names['request']
+    else:
+        raise Exception("No retrieve() call, nor 'dataset' and 'request' assignments found.")
+
+    if not isinstance(data_target, str):
+        raise Exception("Dataset should be a string, got %r." %(data_target,))
+    if not isinstance(job_dict, dict):
+        raise Exception("Request should be a dict, got %s." %type(job_dict).__name__)
+
+    job_dict=dict((str(kk), vv) for kk, vv in job_dict.items())
+    job_dict['data_target']=data_target
 
-    try:
-        job_dict_str=DICT_PATTERN.search(lines).group(1)
-    except:
-        raise Exception("DICT_PATTERN failed to match the string.")
+    return job_dict
 
-    try:
-        job_dict_pairs=DICT_KEY_VALUE_PATTERN.findall(job_dict_str)
-    except:
-        raise Exception("DICT_KEY_VALUE_PATTERN failed to match the string.")
+def parseDirectory(abpath_dir, ext=('.txt', '.py'), verbose=True):
+    '''Parse the web generated API requests saved in the files of a folder
 
-    job_dict=parseJobDict(job_dict_pairs)
-    job_dict['data_target']=data_target
+    Args:
+        abpath_dir (str): folder containing the API request files.
+    Keyword Args:
+        ext (str or tuple): extension(s) of the files to parse. Other files
+            are skipped.
+    Returns:
+        results (dict): keys are the file names, values the job dicts, see
+            parseFile().
+        failed (dict): keys are the file names failed to parse, values the
+            error messages.
+    '''
 
-    return job_dict
+    results={}
+    failed={}
+    for fii in sorted(os.listdir(abpath_dir)):
+        abpathii=os.path.join(abpath_dir, fii)
+        if not fii.endswith(ext) or not os.path.isfile(abpathii):
+            continue
+        try:
+            results[fii]=parseFile(abpathii, verbose=False)
+        except Exception as e:
+            failed[fii]=str(e)
 
+    if verbose:
+        print('\n# <parseDirectory>: Parsed %d request file(s) in %s.' %(len(results), abpath_dir))
+        for fii, eii in sorted(failed.items()):
+            print('# <parseDirectory>: Failed to parse %s: %s' %(fii, eii))
 
+    return results, failed
 
 
 #-------------Main---------------------------------
@@ -0,0 +1,184 @@
+'''Functions for measuring the size of a retrieval request and splitting it
+automatically to fit the CDS per-request limit.
+
+The size of a request is measured by the number of fields (2D grids) it
+asks for:
+
+    variables x levels x valid calendar dates x times
+
+where impossible dates, e.g. 31 February, are not counted.
+'''
+
+from __future__ import print_function
+import calendar
+from .util_general import isListTuple
+
+__all__=[
+        'countValidDates', 'countFields', 'autoSplitFields', 'MAX_FIELDS',
+        'AUTO_SPLIT_ORDER'
+        ]
+
+# default max number of fields in a sub-request
+MAX_FIELDS = 120000
+
+# dimensions tried for splitting, in order of preference
+AUTO_SPLIT_ORDER = ['variable', 'year', 'month', 'pressure_level', 'day', 'time']
+
+
+def _getValues(job_dict, key):
+    '''Get the values of a field as a list, None if absent'''
+
+    if key not in job_dict:
+        return None
+    value = job_dict[key]
+    return list(value) if isListTuple(value) else [value, ]
+
+
+def countValidDates(years, months, days=None):
+    '''Count the valid calendar dates in a request
+
+    Args:
+        years (list): years, int or str.
+        months (list): months, int or str.
+    Keyword Args:
+        days (list or None): days of month, int or str. If None, count
+            (year, month) pairs, as in monthly means requests.
+    Returns:
+        result (int): number of valid dates. Days not in a month, e.g. 30 or
+            31 in February, are not counted.
+    '''
+
+    if days is None:
+        return len(years) * len(months)
+
+    days = [int(ii) for ii in days]
+    result = 0
+    for yy in years:
+        for mm in months:
+            n_days = calendar.monthrange(int(yy), int(mm))[1]
+            result += len([dd for dd in days if dd <= n_days])
+
+    return result
+
+
+def countFields(job_dict):
+    '''Count the number of fields asked for in a request
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (int): variables x levels x valid calendar dates x times.
+            Absent dimensions count as 1.
+    '''
+
+    result = 1
+    for kk in ['variable', 'pressure_level', 'time']:
+        values = _getValues(job_dict, kk)
+        if values is not None:
+            result *= len(values)
+
+    years = _getValues(job_dict, 'year') or [2000, ]
+    months = _getValues(job_dict, 'month') or [1, ]
+    days = _getValues(job_dict, 'day')
+
+    return result * countValidDates(years, months, days)
+
+
+def _chunk(values, size):
+    '''Split a list into consecutive chunks of given size'''
+
+    return [values[ii:ii+size] for ii in range(0, len(values), size)]
+
+
+def _largestChunk(job_dict, key, values, max_fields):
+    '''Find the largest chunk size along <key> that fits <max_fields>
+
+    Returns:
+        chunks (list): list of chunks of <values>.
+        worst (list): the chunk giving the largest request.
+        n_fields (int): number of fields in the largest request.
+    '''
+
+    def tryChunks(size):
+        chunks = _chunk(values, size)
+        counts = [countFields(dict(job_dict, **{key: cc})) for cc in chunks]
+        idx = counts.index(max(counts))
+        return chunks, chunks[idx], counts[idx]
+
+    # the size of the largest chunk grows with the chunk length, binary
+    # search for the longest chunks under the limit
+    best = tryChunks(1)
+    lo, hi = 2, len(values)
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        trial = tryChunks(mid)
+        if trial[2] <= max_fields:
+            best = trial
+            lo = mid + 1
+        else:
+            hi = mid - 1
+
+    return best
+
+
+def autoSplitFields(job_dict, max_fields=None, split_order=None, verbose=True):
+    '''Choose split dimensions and chunk sizes for a request
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Keyword Args:
+        max_fields (int or None): max number of fields in a sub-request. If
+            None, use MAX_FIELDS.
+        split_order (list or None): dimensions to split along, in order of
+            preference. If None, use AUTO_SPLIT_ORDER.
+    Returns:
+        result (dict): dict of the split dimensions. Keys: dimension names,
+            values: list of chunks, each a single value or a tuple of
+            consecutive values. Can be passed as the <job_dict> argument
+            of prepareBatchJobDicts() to create the sub-jobs.
+
+            E.g. a request for 2 variables, on 37 levels, for 1 year of
+            hourly data (650016 fields) gives:
+
+                {'variable': ['geopotential', 'temperature'],
+                 'month': [('01', '02', '03', '04'), ('05', '06', '07', '08'),
+                           ('09', '10', '11', '12')]}
+
+    Dimensions are taken one by one in <split_order>. Each is cut into as
+    few chunks as possible so that the largest sub-request, with the
+    dimensions not yet taken in full, fits in <max_fields>; if that is not
+    possible even with one value per chunk, the next dimension is taken too.
+    '''
+
+    if max_fields is None:
+        max_fields = MAX_FIELDS
+    if split_order is None:
+        split_order = AUTO_SPLIT_ORDER
+
+    # the largest sub-request so far
+    current = dict(job_dict)
+    n_fields = countFields(current)
+    result = {}
+
+    for kk in split_order:
+        if n_fields <= max_fields:
+            break
+
+        values = _getValues(job_dict, kk)
+        if values is None or len(values) <= 1:
+            continue
+
+        chunks, worst, n_fields = _largestChunk(current, kk, values, max_fields)
+        result[kk] = [cc[0] if len(cc) == 1 else tuple(cc) for cc in chunks]
+        current[kk] = worst
+
+    if n_fields > max_fields:
+        raise Exception("Can not split request into sub-requests of at most %d fields."
+                        % max_fields)
+
+    if verbose:
+        print('\n# <autoSplitFields>: Request size = %d fields' % countFields(job_dict))
+        print('# <autoSplitFields>: Split by %s, largest sub-request = %d fields'
+              % (list(result.keys()), n_fields))
+
+    return result
@@ -0,0 +1,262 @@
+'''Failure classification, in-run requeue of failed jobs and the failure
+manifest.
+
+A failed job is either:
+
+    transient: network errors, timeouts, interrupted transfers, HTTP 5xx,
+        rate limits and downloaded files failing verification. The job is
+        requeued in the same run, after a jittered exponential back-off, up
+        to a retry budget.
+    permanent: requests rejected by the server, e.g. an invalid variable
+        or a request too large, see PERMANENT_PATTERNS. The job is not
+        retried.
+    unknown: anything else, e.g. a full disk, a conversion error or a bug.
+        The job is not retried in the run.
+
+Jobs failed for good are appended to the failure manifest in the output
+folder, one JSON record per line, with the error text. The next run of the
+same batch skips the jobs that failed permanently, unless asked to retry
+them. Jobs failed with unknown errors are run again.
+'''
+
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import heapq
+import socket
+import random
+import threading
+import requests
+from .util_pacer import isThrottleError
+from .util_general import appendLine
+
+__all__=[
+        'classifyError', 'getRetryDelay', 'RetryQueue', 'recordFailure',
+        'loadFailureManifest', 'getPermanentFailures', 'FAILURE_MANIFEST',
+        'TRANSIENT_PATTERNS', 'PERMANENT_PATTERNS', 'MAX_RETRIES', 'RETRY_BACKOFF',
+        'MAX_RETRY_BACKOFF'
+        ]
+
+# name of the failure manifest in the output folder
+FAILURE_MANIFEST = 'failed_list.txt'
+
+# default number of times a transient failure is retried in a run
+MAX_RETRIES = 3
+
+# seconds of the 1st retry back-off, and max seconds of a back-off
+RETRY_BACKOFF = 30.
+MAX_RETRY_BACKOFF = 900.
+
+# patterns in error messages telling a transient failure, in addition to
+# the throttling errors of util_pacer
+TRANSIENT_PATTERNS = [
+    r'timed? ?out', r'download failed', r'connection (reset|aborted|refused)',
+    r'broken pipe', r'remote end closed', r'incomplete read',
+    r'name resolution', r'internal (server )?error', r'try again',
+    r'max retries exceeded', r'verification failed',
+]
+
+# patterns in error messages telling a request rejected by the server
+PERMANENT_PATTERNS = [
+    r'invalid (variable|parameter|param|request|value|date|time|area|grid|format|dataset|product)',
+    r'request (you have submitted )?is not valid', r'not a valid',
+    r'request (is )?too large', r'too many (items|fields)',
+    r'cost limits? exceeded', r'exceeds? (the )?(size )?limit',
+    r'no data (available|matching)', r'returned no data',
+    r'licen[cs]es? (have )?not (been )?accepted', r'dataset .*not found',
+]
+
+# exception types of transient failures
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    socket.timeout,
+)
+
+
+def classifyError(error):
+    '''Classify the error of a failed job
+
+    Args:
+        error (Exception or str): error raised by the job.
+    Returns:
+        category (str): 'transient' if the job may succeed when retried,
+            'permanent' if the request was rejected by the server, 'unknown'
+            otherwise, including local errors such as a full disk.
+    '''
+
+    if isinstance(error, TRANSIENT_ERRORS) or isThrottleError(error):
+        return 'transient'
+
+    text = str(error).lower()
+    if any(re.search(pii, text) for pii in TRANSIENT_PATTERNS):
+        return 'transient'
+
+    # a local file error is never a rejection of the request
+    if not isinstance(error, OSError) and\
+            any(re.search(pii, text) for pii in PERMANENT_PATTERNS):
+        return 'permanent'
+
+    return 'unknown'
+
+
+def getRetryDelay(attempt, backoff=None, max_backoff=None):
+    '''Get the back-off before retrying a job
+
+    Args:
+        attempt (int): number of the retry, starting from 1.
+    Keyword Args:
+        backoff (float or None): seconds of the 1st back-off. If None, use
+            RETRY_BACKOFF.
+        max_backoff (float or None): max seconds of a back-off. If None, use
+            MAX_RETRY_BACKOFF.
+    Returns:
+        delay (float): <backoff> * 2**(<attempt>-1), capped at
+            <max_backoff>, with a random jitter of +-50% so that jobs failed
+            together are not retried together.
+    '''
+
+    if backoff is None:
+        backoff = RETRY_BACKOFF
+    if max_backoff is None:
+        max_backoff = MAX_RETRY_BACKOFF
+
+    delay = min(max_backoff, backoff * 2**(attempt - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class RetryQueue(object):
+    def __init__(self, jobs):
+        '''Queue of jobs taken from an iterable, with jobs requeued after a delay
+
+        Args:
+            jobs (iterable): yields jobs, consumed lazily.
+
+        Each job taken with get() must be reported with done() or retry().
+        Requeued jobs are taken again once their delay is over, before new
+        jobs from <jobs>. Thread-safe.
+        '''
+
+        self.jobs = iter(jobs)
+        self.cond = threading.Condition()
+        # heap of (ready time, sequence number, job)
+        self.retries = []
+        self.n_seq = 0
+        # number of jobs taken but not yet reported
+        self.n_pending = 0
+        self.exhausted = False
+
+    def get(self):
+        '''Get the next job to run
+
+        Returns:
+            job (obj): a requeued job whose delay is over, or the next job
+                from <jobs>, None if there is no job left.
+
+        Block while there is no job ready but requeued jobs are waiting, or
+        jobs taken are not yet reported, as these can be requeued.
+        '''
+
+        with self.cond:
+            while True:
+                now = time.time()
+                if len(self.retries) > 0 and self.retries[0][0] <= now:
+                    self.n_pending += 1
+                    return heapq.heappop(self.retries)[2]
+
+                if not self.exhausted:
+                    try:
+                        job = next(self.jobs)
+                    except StopIteration:
+                        self.exhausted = True
+                    else:
+                        self.n_pending += 1
+                        return job
+                    continue
+
+                if self.n_pending == 0 and len(self.retries) == 0:
+                    return None
+
+                timeout = None
+                if len(self.retries) > 0:
+                    timeout = self.retries[0][0] - now
+                self.cond.wait(timeout)
+
+    def done(self):
+        '''Report a job taken as finished, or failed for good'''
+
+        with self.cond:
+            self.n_pending -= 1
+            self.cond.notify_all()
+
+    def retry(self, job, delay):
+        '''Report a job taken as failed, to run again after <delay> seconds'''
+
+        with self.cond:
+            heapq.heappush(self.retries, (time.time() + delay, self.n_seq, job))
+            self.n_seq += 1
+            self.n_pending -= 1
+            self.cond.notify_all()
+
+
+def recordFailure(abpath, data_target, job_dict, error, category, attempts):
+    '''Append a failed job to the failure manifest
+
+    Args:
+        abpath (str): absolute path to the failure manifest.
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+        error (Exception or str): error of the last attempt.
+        category (str): 'transient', 'permanent' or 'unknown', see
+            classifyError().
+        attempts (int): number of attempts made in the run.
+    '''
+
+    record = {'time': round(time.time(), 3), 'data_target': data_target,
+              'job': job_dict, 'error': str(error), 'category': category,
+              'attempts': attempts}
+    appendLine(abpath, json.dumps(record))
+
+
+def loadFailureManifest(abpath):
+    '''Load the failure manifest
+
+    Args:
+        abpath (str): absolute path to the failure manifest.
+    Returns:
+        result (list): list of dicts, each a failed job, with keys 'time',
+            'data_target', 'job' (the request dict), 'error', 'category' and
+            'attempts'. Empty if the manifest does not exist.
+    '''
+
+    if not os.path.exists(abpath):
+        return []
+
+    result = []
+    with open(abpath, 'r') as fin:
+        for lii in fin:
+            try:
+                result.append(json.loads(lii))
+            except ValueError:
+                # truncated last line of an interrupted run
+                continue
+
+    return result
+
+
+def getPermanentFailures(abpath):
+    '''Get the request dicts of the jobs failed permanently
+
+    Args:
+        abpath (str): absolute path to the failure manifest.
+    Returns:
+        result (list): list of dicts, the request dicts of the jobs recorded
+            as failed permanently, in the format of the downloaded list.
+    '''
+
+    return [rii['job'] for rii in loadFailureManifest(abpath)
+            if rii.get('category') == 'permanent']
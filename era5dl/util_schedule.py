@@ -0,0 +1,150 @@
+'''Ordering policies of the jobs of a batch.
+
+By default, jobs run in the order of the cartesian product of <job_dict>,
+e.g. all the years of one variable, then all the years of the next one.
+Jobs touching the same archive data, i.e. the same dataset and month, are
+then scattered across the run, while CDS stages the data of a request from
+tape (MARS) or its cache by month. The ordering policies are:
+
+    * 'locality': group the jobs by dataset, year and month, in ascending
+      order, so that jobs of the same month run one after another, or side
+      by side with concurrent workers, and the server can reuse the data
+      already staged.
+    * 'largest': run the largest jobs first, measured by their number of
+      fields, to shorten the makespan of a batch run by concurrent workers.
+      Jobs of the same size are grouped as with 'locality'.
+    * 'longest': run the longest jobs first (LPT), by their durations
+      predicted by a util_history.DurationModel fitted on past runs, which
+      also accounts for the area, format and dataset of the requests. Jobs
+      of the same predicted duration are grouped as with 'locality'.
+
+All are deterministic, for a given model: a batch is run in the same order
+on every run, whatever the order of <job_dict> and of the downloaded list.
+'''
+
+from __future__ import print_function
+from .util_general import isListTuple
+from .util_request_size import countFields
+
+__all__=[
+        'getLocalityKey', 'getSortValue', 'orderJobs', 'countGroups',
+        'ORDERS', 'LOCALITY_KEYS', 'IGNORE_KEYS'
+        ]
+
+# ordering policies
+ORDERS = ['locality', 'largest', 'longest']
+
+# fields grouping jobs reading the same archive data, in order of precedence.
+# Other fields are compared after these, in alphabetical order.
+LOCALITY_KEYS = ['data_target', 'product_type', 'year', 'month']
+
+# fields not part of a request, not compared in ordering jobs
+IGNORE_KEYS = ['abpath_out']
+
+
+def getSortValue(value):
+    '''Get a sort key of a field value
+
+    Args:
+        value (str, number, list or tuple): value of a field of a job dict,
+            or a chunk of values.
+    Returns:
+        result (tuple): sort key of <value>.
+
+    Numbers, and strings of numbers, e.g. 1999, '1999' or '01', are compared
+    as numbers, and before other strings. A chunk of values is compared by
+    its sorted values, a single value as a chunk of one.
+    '''
+
+    def getValue(x):
+        try:
+            return (0, float(x), '')
+        except (TypeError, ValueError):
+            return (1, 0., str(x))
+
+    if isListTuple(value):
+        return tuple(sorted(getValue(vii) for vii in value))
+
+    return (getValue(value), )
+
+
+def getLocalityKey(job_dict):
+    '''Get the sort key grouping jobs reading the same archive data
+
+    Args:
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (tuple): sort values of the LOCALITY_KEYS fields, then of the
+            other fields of <job_dict>, in alphabetical order. Jobs of the
+            same dataset, year and month have the same leading values.
+    '''
+
+    keys = [kk for kk in LOCALITY_KEYS if kk in job_dict]
+    keys.extend(sorted(kk for kk in job_dict if kk not in LOCALITY_KEYS and
+                       kk not in IGNORE_KEYS))
+
+    return tuple((kk, getSortValue(job_dict[kk])) for kk in keys)
+
+
+def _getGroupKey(job_dict):
+    '''Get the (dataset, year, month) group of a job'''
+
+    return tuple(getSortValue(job_dict[kk]) for kk in LOCALITY_KEYS
+                 if kk in job_dict)
+
+
+def orderJobs(job_dicts, order='locality', model=None):
+    '''Order the jobs of a batch
+
+    Args:
+        job_dicts (list or iterable): dicts, each defines a download job,
+            e.g. from iterBatchJobDicts().
+    Keyword Args:
+        order (str or None): ordering policy, 'locality', 'largest' or
+            'longest'. See the module docstring. If None, keep the given
+            order.
+        model (DurationModel or None): model predicting the durations of the
+            jobs for the 'longest' order. If None, a model with the default
+            rates of util_plan_report.
+    Returns:
+        result (list): the dicts in <job_dicts>, ordered.
+    '''
+
+    if order is None:
+        return list(job_dicts)
+    if order not in ORDERS:
+        raise Exception("<order> can be either 'locality', 'largest', 'longest' or None.")
+
+    if order == 'locality':
+        return sorted(job_dicts, key=getLocalityKey)
+
+    if order == 'longest':
+        if model is None:
+            from .util_history import DurationModel
+            model = DurationModel()
+        return sorted(job_dicts, key=lambda x: (-model.predict(x)[0],
+                                                getLocalityKey(x)))
+
+    return sorted(job_dicts, key=lambda x: (-countFields(x), getLocalityKey(x)))
+
+
+def countGroups(job_dicts):
+    '''Count the runs of consecutive jobs reading the same archive data
+
+    Args:
+        job_dicts (list): dicts, each defines a download job.
+    Returns:
+        result (int): number of runs of consecutive jobs of the same
+            dataset, year and month. The fewer the runs, the more jobs can
+            reuse the data staged on the server.
+    '''
+
+    result = 0
+    last = None
+    for jobii in job_dicts:
+        key = _getGroupKey(jobii)
+        if result == 0 or key != last:
+            result += 1
+            last = key
+
+    return result
@@ -0,0 +1,357 @@
+'''Functions for serving a request by slicing a file holding a superset of
+its data.
+
+A request is covered by a held (e.g. cached) request if it asks for the
+same dataset, product and format, for a subset of its variables, levels,
+dates and times, and for an area inside its area. The data of the covered
+request can then be cut out of the held NetCDF file locally, without
+going through CDS.
+
+Slicing reads variables lazily, one block of time steps at a time, so the
+whole file is never loaded into memory.
+'''
+
+from __future__ import print_function
+import os
+import json
+import hashlib
+import threading
+from .util_general import canonicalRequest
+from . import util_read_param_table
+
+__all__=[
+        'requestCovers', 'getCoverIndex', 'sliceNetCDF', 'findName',
+        'getDataVariables', 'SLICE_DIMS', 'NETCDF_LOCK'
+        ]
+
+# request fields whose values can be subset by slicing
+SLICE_DIMS = ['variable', 'pressure_level', 'year', 'month', 'day', 'time']
+
+# names of the coordinate dimensions in ERA5 NetCDF files
+LAT_NAMES = ['latitude', 'lat']
+LON_NAMES = ['longitude', 'lon']
+LEVEL_NAMES = ['pressure_level', 'level', 'isobaricInhPa']
+TIME_NAMES = ['valid_time', 'time']
+
+# tolerance in matching coordinate values, in degrees or hPa
+TOL = 1e-6
+
+# max number of elements of a variable read into memory at once
+BLOCK_SIZE = 2**24
+
+# serializes the use of the netCDF4 package by threads, as the HDF5 library
+# is not thread-safe
+NETCDF_LOCK = threading.RLock()
+
+
+def _isNetCDF(request):
+    '''Check whether a canonical request asks for NetCDF data'''
+
+    for kk in ['format', 'data_format']:
+        if kk in request:
+            return all(vv.startswith('netcdf') for vv in request[kk])
+
+    return False
+
+
+def requestCovers(data_target, held_dict, job_dict):
+    '''Check whether the data of a held request cover those of a new request
+
+    Args:
+        data_target (str): target dataset of both requests.
+        held_dict (dict): dictionary describing the held data retrieval task.
+        job_dict (dict): dictionary describing the new data retrieval task.
+    Returns:
+        result (bool): True if <job_dict> can be served by slicing the NetCDF
+            data of <held_dict>: all fields in SLICE_DIMS of <job_dict>
+            are subsets of those of <held_dict>, its 'area' (if given) is
+            inside the 'area' of <held_dict> (if given), and other fields
+            are the same.
+    '''
+
+    held = canonicalRequest(data_target, held_dict, snap_area=True)
+    new = canonicalRequest(data_target, job_dict, snap_area=True)
+
+    if not _isNetCDF(held) or not _isNetCDF(new):
+        return False
+    if set(held.keys()) - set(['area']) != set(new.keys()) - set(['area']):
+        return False
+
+    for kk, vv in new.items():
+        if kk in SLICE_DIMS:
+            if not set(vv).issubset(held[kk]):
+                return False
+        elif kk == 'area':
+            if 'area' not in held:
+                # a global file
+                continue
+            n0, w0, s0, e0 = held['area']
+            n1, w1, s1, e1 = vv
+            if n1 > n0 or w1 < w0 or s1 < s0 or e1 > e0:
+                return False
+        elif vv != held[kk]:
+            return False
+
+    if 'area' in held and 'area' not in new:
+        return False
+
+    return True
+
+
+def getCoverIndex(data_target, job_dict):
+    '''Get the values indexing a request among the requests that may cover it
+
+    Args:
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task.
+    Returns:
+        result (tuple or None): (group, year_min, year_max, month_min,
+            month_max). <group> is a hash of the dataset, of the names of the
+            fields and of the values of the fields not in SLICE_DIMS, which
+            a covered request has the same. A request covering another one
+            is in the same group, and its year and month spans include those
+            of the other one. The spans are 0 if not given. None if the data
+            of <job_dict> can not be sliced.
+
+    Used to narrow the search for covering requests, which still have to be
+    checked with requestCovers().
+    '''
+
+    request = canonicalRequest(data_target, job_dict, snap_area=True)
+    if not _isNetCDF(request):
+        return None
+
+    fixed = dict((kk, vv) for kk, vv in request.items()
+                 if kk not in SLICE_DIMS and kk != 'area')
+    text = json.dumps([sorted(set(request) - set(['area'])), fixed],
+                      sort_keys=True)
+    result = [hashlib.sha1(text.encode('utf-8')).hexdigest()]
+    for kk in ['year', 'month']:
+        try:
+            values = [int(vv) for vv in request.get(kk, ['0'])]
+        except ValueError:
+            return None
+        result.extend([min(values), max(values)])
+
+    return tuple(result)
+
+
+def findName(names, candidates):
+    '''Find the name of a coordinate among the names in a file
+
+    Args:
+        names (list): names of the dimensions or variables of a file.
+        candidates (list): possible names of the coordinate, e.g. LAT_NAMES.
+    Returns:
+        result (str or None): the 1st of <candidates> in <names>, None if
+            none is.
+    '''
+
+    for nii in candidates:
+        if nii in names:
+            return nii
+    return None
+
+
+def _getTimeIndices(var, request, np):
+    '''Get the indices of the time steps asked for in a request'''
+
+    import netCDF4
+
+    dates = netCDF4.num2date(var[:], var.units,
+                             getattr(var, 'calendar', 'standard'))
+    keep = []
+    for ii, dii in enumerate(dates):
+        if 'year' in request and str(dii.year) not in request['year']:
+            continue
+        if 'month' in request and '%02d' % dii.month not in request['month']:
+            continue
+        if 'day' in request and '%02d' % dii.day not in request['day']:
+            continue
+        if 'time' in request and '%02d:%02d' % (dii.hour, dii.minute) not in request['time']:
+            continue
+        keep.append(ii)
+
+    return np.array(keep, dtype='int64')
+
+
+def _getDimIndices(ds, request, np):
+    '''Get the indices to keep along each dimension of a held NetCDF file
+
+    Returns:
+        result (dict): keys: dimension names, values: 1D int arrays of
+            indices. Dimensions not sliced are not included.
+    '''
+
+    result = {}
+    names = list(ds.variables.keys())
+
+    if 'area' in request:
+        north, west, south, east = request['area']
+
+        lat_name = findName(names, LAT_NAMES)
+        lats = ds.variables[lat_name][:]
+        result[lat_name] = np.where((lats >= south - TOL) & (lats <= north + TOL))[0]
+
+        # longitudes counted eastward from <west>, to handle 0-360 files
+        lon_name = findName(names, LON_NAMES)
+        lons = np.mod(ds.variables[lon_name][:] - west + TOL, 360.) - TOL
+        idx = np.where(lons <= east - west + TOL)[0]
+        result[lon_name] = idx[np.argsort(lons[idx], kind='stable')]
+
+    if 'pressure_level' in request:
+        level_name = findName(names, LEVEL_NAMES)
+        levels = ds.variables[level_name][:]
+        wanted = [float(ii) for ii in request['pressure_level']]
+        result[level_name] = np.where(np.any(np.abs(
+            levels[:, None] - np.array(wanted)[None, :]) <= TOL, axis=1))[0]
+        if len(result[level_name]) != len(wanted):
+            raise Exception("Levels %s not all found in file." % wanted)
+
+    time_name = findName(names, TIME_NAMES)
+    if time_name is not None:
+        result[time_name] = _getTimeIndices(ds.variables[time_name], request, np)
+        if len(result[time_name]) == 0:
+            raise Exception("No time step of the request found in file.")
+
+    return result
+
+
+def getDataVariables(ds, request, dim_names):
+    '''Get the names of the data variables asked for in a request
+
+    Args:
+        ds (netCDF4.Dataset): opened NetCDF file.
+        request (dict): canonical request, see
+            util_general.canonicalRequest().
+        dim_names (list): names of the dimensions of <ds>.
+    Returns:
+        result (list): names of the variables of <ds> holding the 'variable'
+            values of <request>, in the same order, matched by name or GRIB
+            short name.
+
+    Raises an Exception if a variable is not found in the file.
+    '''
+
+    lat_name = findName(dim_names, LAT_NAMES)
+    lon_name = findName(dim_names, LON_NAMES)
+    data_vars = [kk for kk, vv in ds.variables.items()
+                 if lat_name in vv.dimensions and lon_name in vv.dimensions
+                 and kk not in dim_names]
+
+    short_names = util_read_param_table.getShortNames(*request['variable'])
+    if len(request['variable']) == 1:
+        short_names = [short_names, ]
+
+    result = []
+    for cds_name, short_name in zip(request['variable'], short_names):
+        for vii in data_vars:
+            var = ds.variables[vii]
+            if vii in [cds_name, short_name] or\
+                    getattr(var, 'GRIB_shortName', None) == short_name or\
+                    getattr(var, 'GRIB_cfVarName', None) == short_name:
+                result.append(vii)
+                break
+        else:
+            if len(data_vars) == 1 and len(request['variable']) == 1:
+                # the only variable in file
+                result.append(data_vars[0])
+            else:
+                raise Exception("Variable '%s' not found in file." % cds_name)
+
+    return result
+
+
+def _copyVariable(ds_in, ds_out, name, dim_indices, np):
+    '''Copy a variable to the output file, keeping the selected indices'''
+
+    var_in = ds_in.variables[name]
+    fill_value = getattr(var_in, '_FillValue', None)
+    filters = var_in.filters() or {}
+    var_out = ds_out.createVariable(name, var_in.dtype, var_in.dimensions,
+                                    zlib=filters.get('zlib', False),
+                                    complevel=filters.get('complevel', 4),
+                                    fill_value=fill_value)
+    var_out.setncatts(dict((kk, var_in.getncattr(kk)) for kk in var_in.ncattrs()
+                           if kk != '_FillValue'))
+    # keep packed values as they are
+    var_in.set_auto_maskandscale(False)
+    var_out.set_auto_maskandscale(False)
+
+    if len(var_in.dimensions) == 0:
+        var_out.assignValue(var_in.getValue())
+        return
+
+    index = [dim_indices.get(dii, slice(None)) for dii in var_in.dimensions]
+    shape = [len(ii) if not isinstance(ii, slice) else len(ds_in.dimensions[dii])
+             for ii, dii in zip(index, var_in.dimensions)]
+
+    # read and write blocks along the 1st dimension
+    n_per_row = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+    step = max(1, BLOCK_SIZE // max(1, n_per_row))
+    first = index[0]
+    if isinstance(first, slice):
+        first = np.arange(shape[0])
+    for ii in range(0, shape[0], step):
+        rows = first[ii:ii+step]
+        block = var_in[tuple([rows] + index[1:])]
+        var_out[ii:ii+len(rows)] = block
+
+
+def sliceNetCDF(abpath_in, abpath_out, data_target, job_dict):
+    '''Cut the data of a request out of a NetCDF file holding a superset
+
+    Args:
+        abpath_in (str): absolute path to the held NetCDF file.
+        abpath_out (str): absolute path to save the sliced data.
+        data_target (str): target dataset.
+        job_dict (dict): dictionary describing the data retrieval task,
+            covered by the request of <abpath_in> (see requestCovers()).
+
+    Raises an Exception if the data of the request are not all found in
+    <abpath_in>. The output is written to a temporary file first, which is
+    renamed to <abpath_out> once complete. Holds NETCDF_LOCK meanwhile.
+    '''
+
+    try:
+        import numpy as np
+        import netCDF4
+    except ImportError:
+        raise Exception("Slicing cached files requires the numpy and netCDF4 packages.")
+
+    request = canonicalRequest(data_target, job_dict, snap_area=True)
+    tmp_path = '%s.%d.slice' % (abpath_out, os.getpid())
+
+    with NETCDF_LOCK, netCDF4.Dataset(abpath_in, 'r') as ds_in:
+        dim_indices = _getDimIndices(ds_in, request, np)
+        dim_names = list(ds_in.dimensions.keys())
+        data_vars = getDataVariables(ds_in, request, dim_names)
+
+        try:
+            with netCDF4.Dataset(tmp_path, 'w', format=ds_in.data_model) as ds_out:
+                ds_out.setncatts(dict((kk, ds_in.getncattr(kk))
+                                      for kk in ds_in.ncattrs()))
+                for kk, dimii in ds_in.dimensions.items():
+                    if dimii.isunlimited():
+                        size = None
+                    elif kk in dim_indices:
+                        size = len(dim_indices[kk])
+                    else:
+                        size = len(dimii)
+                    ds_out.createDimension(kk, size)
+
+                for kk, vii in ds_in.variables.items():
+                    is_data = kk not in dim_names and\
+                        findName(vii.dimensions, LAT_NAMES) is not None and\
+                        findName(vii.dimensions, LON_NAMES) is not None
+                    if is_data and kk not in data_vars:
+                        continue
+                    _copyVariable(ds_in, ds_out, kk, dim_indices, np)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, abpath_out)
+
+    return
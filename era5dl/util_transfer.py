@@ -0,0 +1,177 @@
+'''Resumable, chunked file downloads.
+
+Data are written to a <abpath_out>.part file, next to a small
+<abpath_out>.part.json checkpoint recording the source url and expected size.
+An interrupted transfer is resumed from the last byte received using an HTTP
+Range request, either within the same call or in a later one, e.g. after the
+process is restarted. The .part file is renamed to <abpath_out> only after all
+bytes are received.
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import requests
+
+__all__=[
+        'downloadFile', 'CHUNK_SIZE'
+        ]
+
+# number of bytes read from the connection at a time
+CHUNK_SIZE = 1024 * 1024
+
+# errors after which a transfer can be resumed
+RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def _loadCheckpoint(abpath_part, url, size):
+    '''Get the number of bytes already received for <url>
+
+    Returns:
+        offset (int): number of bytes in the .part file that can be resumed.
+        size (int or None): expected size of the file.
+    '''
+
+    abpath_ckpt = abpath_part + '.json'
+    if not os.path.exists(abpath_part) or not os.path.exists(abpath_ckpt):
+        return 0, size
+
+    try:
+        with open(abpath_ckpt, 'r') as fin:
+            ckpt = json.load(fin)
+    except ValueError:
+        return 0, size
+
+    # partial data of a different result file can not be resumed
+    ckpt_size = ckpt.get('size')
+    if ckpt.get('url') != url or ckpt_size is None or \
+            (size is not None and ckpt_size != size):
+        return 0, size
+
+    return os.path.getsize(abpath_part), ckpt_size
+
+
+def _saveCheckpoint(abpath_part, url, size):
+    with open(abpath_part + '.json', 'w') as fout:
+        json.dump({'url': url, 'size': size}, fout)
+
+
+def _getTotalSize(response, offset):
+    '''Get the full size of the file being served in <response>'''
+
+    content_range = response.headers.get('Content-Range')
+    if content_range is not None and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total != '*':
+            return int(total)
+
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None:
+        return int(content_length) + offset
+
+    return None
+
+
+def downloadFile(url, abpath_out, size=None, session=None, max_tries=20,
+                 retry_sleep=1., sleep_max=60., timeout=60, verify=True,
+                 chunk_size=None, verbose=True):
+    '''Download a file with resume support
+
+    Args:
+        url (str): url of the file.
+        abpath_out (str): absolute path to save the file.
+    Keyword Args:
+        size (int or None): expected size of the file in bytes. If None, take
+            it from the Content-Length of the server response.
+        session (requests.Session or None): http session to download with. If
+            None, use a new session.
+        max_tries (int): max number of connections made before giving up.
+        retry_sleep (float): number of seconds to wait before the 1st resume.
+            Doubled after each failed attempt, capped by <sleep_max>.
+        sleep_max (float): max number of seconds to wait before a resume.
+        timeout (float): connection and read timeout in seconds.
+        verify (bool): verify the server's TLS certificate.
+        chunk_size (int or None): number of bytes read at a time. If None,
+            use CHUNK_SIZE.
+    Returns:
+        abpath_out (str): absolute path of the saved file.
+
+    Raise Exception if the file is still incomplete after <max_tries> tries.
+    '''
+
+    if session is None:
+        session = requests.Session()
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    abpath_part = abpath_out + '.part'
+    offset, size = _loadCheckpoint(abpath_part, url, size)
+    if offset == 0:
+        _saveCheckpoint(abpath_part, url, size)
+    elif verbose:
+        print('# <downloadFile>: Resume download of %s at byte %d' % (abpath_out, offset))
+
+    sleep = retry_sleep
+    tries = 0
+    while tries < max_tries:
+        tries += 1
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        response = None
+        interrupted = False
+
+        try:
+            response = session.get(url, stream=True, headers=headers,
+                                   timeout=timeout, verify=verify)
+
+            if response.status_code == 416 and size is not None and offset >= size:
+                # nothing left to receive
+                break
+
+            response.raise_for_status()
+
+            if offset > 0 and response.status_code != 206:
+                # server ignored the Range header, start over
+                offset = 0
+
+            total = _getTotalSize(response, offset)
+            if size is None and total is not None:
+                size = total
+                _saveCheckpoint(abpath_part, url, size)
+
+            with open(abpath_part, 'ab' if offset > 0 else 'wb') as fout:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        fout.write(chunk)
+                        offset += len(chunk)
+
+        except RESUMABLE_ERRORS as e:
+            interrupted = True
+            if verbose:
+                print('# <downloadFile>: Download interrupted at byte %d: %s' % (offset, e))
+        finally:
+            if response is not None:
+                response.close()
+
+        if size is not None and offset >= size:
+            break
+        if size is None and not interrupted:
+            break
+
+        if tries < max_tries:
+            time.sleep(sleep)
+            sleep = min(sleep * 2, sleep_max)
+
+    if size is None and interrupted:
+        raise Exception('Download failed: interrupted at byte %d' % offset)
+    if size is not None and offset != size:
+        raise Exception('Download failed: downloaded %d byte(s) out of %d' % (offset, size))
+
+    os.replace(abpath_part, abpath_out)
+    os.remove(abpath_part + '.json')
+
+    return abpath_out
@@ -0,0 +1,482 @@
+'''Integrity verification of downloaded files.
+
+A downloaded file is checked for:
+
+    * its size, against the Content-Length given by the server.
+    * its format: it must start with the NetCDF (classic or HDF5) or GRIB
+      magic bytes. GRIB files are walked message by message, to catch
+      truncated messages. Zip archives are checked for CRC errors.
+    * its content, against the request: number of GRIB messages, or for
+      NetCDF files (with the numpy and netCDF4 packages) the variables, the
+      number of levels and time steps, and the area.
+
+Checks run in a pool of processes, so that they do not hold up the threads
+downloading data. Bad files can be moved to a quarantine folder, for their
+jobs to be downloaded again.
+
+Usage, to check the files of a batch:
+
+    python -m era5dl.util_verify OUTPUTDIR --workers 8 --quarantine
+'''
+
+from __future__ import print_function
+import os
+import json
+import zipfile
+import argparse
+from .util_general import canonicalRequest, DEFAULT_GRID, ProcessPool,\
+        getProcessExecutor, DOWN_FILE_KEY
+from .util_request_size import countFields
+from .util_job_store import JobStore, getJobKey
+from . import util_slice
+
+__all__=[
+        'getFileFormat', 'verifyFile', 'quarantineFile', 'Verifier',
+        'verifyOutputdir', 'QUARANTINE_DIR', 'FILE_EXTENSIONS'
+        ]
+
+# name of the quarantine folder, in the folder of a bad file
+QUARANTINE_DIR = 'quarantine'
+
+# extensions of the data files checked by verifyOutputdir()
+FILE_EXTENSIONS = ['.nc', '.grb', '.grib', '.zip']
+
+NETCDF_MAGICS = [b'CDF\x01', b'CDF\x02', b'\x89HDF\r\n\x1a\n']
+GRIB_MAGIC = b'GRIB'
+GRIB_END = b'7777'
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+def getFileFormat(abpath):
+    '''Get the format of a file from its magic bytes
+
+    Args:
+        abpath (str): absolute path to the file.
+    Returns:
+        result (str or None): 'netcdf', 'grib' or 'zip', None if not known.
+    '''
+
+    with open(abpath, 'rb') as fin:
+        head = fin.read(8)
+
+    if any(head.startswith(mii) for mii in NETCDF_MAGICS):
+        return 'netcdf'
+    if head.startswith(GRIB_MAGIC):
+        return 'grib'
+    if head.startswith(ZIP_MAGIC):
+        return 'zip'
+
+    return None
+
+
+def _countGribMessages(abpath):
+    '''Count the messages of a GRIB file, checking each one is complete
+
+    Returns:
+        n_messages (int): number of messages.
+        problem (str or None): description of the 1st bad message, if any.
+    '''
+
+    size = os.path.getsize(abpath)
+    n_messages = 0
+    pos = 0
+    with open(abpath, 'rb') as fin:
+        while pos < size:
+            fin.seek(pos)
+            head = fin.read(16)
+            if not head.startswith(GRIB_MAGIC):
+                if head.strip(b'\x00') == b'':
+                    # padding at the end of file
+                    break
+                return n_messages, 'No GRIB message at byte %d' % pos
+            if len(head) < 16:
+                return n_messages, 'GRIB message at byte %d truncated' % pos
+
+            edition = head[7]
+            if edition == 1:
+                length = int.from_bytes(head[4:7], 'big')
+            else:
+                length = int.from_bytes(head[8:16], 'big')
+
+            fin.seek(pos + length - 4)
+            if pos + length > size or fin.read(4) != GRIB_END:
+                return n_messages, 'GRIB message at byte %d truncated' % pos
+
+            n_messages += 1
+            pos += length
+
+    return n_messages, None
+
+
+def _checkNetCDF(abpath, request):
+    '''Check the content of a NetCDF file against a canonical request'''
+
+    try:
+        import numpy as np
+        import netCDF4
+    except ImportError:
+        # content checks need numpy and netCDF4
+        return []
+
+    problems = []
+    try:
+        ds = netCDF4.Dataset(abpath, 'r')
+    except Exception as e:
+        return ['Can not open as NetCDF: %s' % e]
+
+    with ds:
+        if request is None:
+            return problems
+
+        names = list(ds.variables.keys())
+        dim_names = list(ds.dimensions.keys())
+
+        if 'variable' in request:
+            try:
+                util_slice.getDataVariables(ds, request, dim_names)
+            except Exception as e:
+                problems.append(str(e))
+
+        if 'pressure_level' in request:
+            level_name = util_slice.findName(names, util_slice.LEVEL_NAMES)
+            n_levels = 1 if level_name is None else ds.variables[level_name].size
+            if n_levels != len(request['pressure_level']):
+                problems.append('%d levels in file, %d requested' % (
+                    n_levels, len(request['pressure_level'])))
+
+        time_name = util_slice.findName(names, util_slice.TIME_NAMES)
+        if time_name is not None:
+            times = dict((kk, vv) for kk, vv in request.items()
+                         if kk in ['year', 'month', 'day', 'time'])
+            n_times = countFields(times)
+            if ds.variables[time_name].size != n_times:
+                problems.append('%d time steps in file, %d requested' % (
+                    ds.variables[time_name].size, n_times))
+
+        if 'area' in request:
+            north, west, south, east = request['area']
+            tol = max(request.get('grid', DEFAULT_GRID)) + util_slice.TOL
+            lat_name = util_slice.findName(names, util_slice.LAT_NAMES)
+            lon_name = util_slice.findName(names, util_slice.LON_NAMES)
+            if lat_name is None or lon_name is None:
+                problems.append('No latitude or longitude in file')
+            else:
+                lats = ds.variables[lat_name][:]
+                # longitudes counted eastward from <west>, as in util_slice
+                lons = np.mod(ds.variables[lon_name][:] - west + tol, 360.) - tol
+                extent = east - west if east >= west else east - west + 360.
+                if abs(lats.max() - north) > tol or abs(lats.min() - south) > tol:
+                    problems.append('Latitudes %s-%s in file, %s-%s requested' % (
+                        lats.min(), lats.max(), south, north))
+                if lons.min() > tol or abs(lons.max() - extent) > tol:
+                    problems.append('Longitudes do not match area %s' % request['area'])
+
+    return problems
+
+
+def verifyFile(abpath, data_target=None, job_dict=None, size=None,
+               check_content=True):
+    '''Check the integrity of a downloaded file
+
+    Args:
+        abpath (str): absolute path to the file.
+    Keyword Args:
+        data_target (str or None): target dataset of the request.
+        job_dict (dict or None): dictionary describing the data retrieval
+            task. If None, the content is not checked against the request.
+        size (int or None): expected size in bytes, e.g. the Content-Length
+            given by the server.
+        check_content (bool): if False, only check the size and the format.
+    Returns:
+        problems (list): descriptions of the problems found, empty if the
+            file is fine.
+    '''
+
+    if not os.path.exists(abpath):
+        return ['File not found']
+
+    file_size = os.path.getsize(abpath)
+    if file_size == 0:
+        return ['Empty file']
+    if size is not None and file_size != size:
+        return ['Size %d, %d expected' % (file_size, size)]
+
+    fmt = getFileFormat(abpath)
+    if fmt is None:
+        return ['Not a NetCDF, GRIB or zip file']
+
+    request = None
+    if job_dict is not None:
+        request = canonicalRequest(data_target, job_dict, snap_area=True)
+
+    if fmt == 'grib':
+        n_messages, problem = _countGribMessages(abpath)
+        if problem is not None:
+            return [problem]
+        # ensemble products have a message per member
+        products = request.get('product_type', []) if request else []
+        if check_content and request is not None and len(products) <= 1 and\
+                not any('ensemble' in pii for pii in products):
+            n_fields = countFields(job_dict)
+            if n_messages != n_fields:
+                return ['%d GRIB messages in file, %d requested' % (
+                    n_messages, n_fields)]
+    elif fmt == 'zip':
+        try:
+            with zipfile.ZipFile(abpath) as zin:
+                bad = zin.testzip()
+        except zipfile.BadZipFile as e:
+            return ['Bad zip file: %s' % e]
+        if bad is not None:
+            return ['Bad member in zip file: %s' % bad]
+    elif fmt == 'netcdf':
+        return _checkNetCDF(abpath, request if check_content else None)
+
+    return []
+
+
+def _verifyItem(item):
+    '''Verify a file in a worker process, see verifyFile()
+
+    Args:
+        item (tuple): (abpath, data_target, job_dict, size, check_content).
+    Returns:
+        abpath (str): path of the file.
+        problems (list): problems found.
+    '''
+
+    abpath = item[0]
+    try:
+        return abpath, verifyFile(*item)
+    except Exception as e:
+        return abpath, ['Verification error: %s' % e]
+
+
+def quarantineFile(abpath, quarantine_dir=None):
+    '''Move a bad file to a quarantine folder
+
+    Args:
+        abpath (str): absolute path to the file.
+    Keyword Args:
+        quarantine_dir (str or None): absolute path to the quarantine folder.
+            If None, use the QUARANTINE_DIR folder next to the file.
+    Returns:
+        abpath_out (str or None): new path of the file, None if the file
+            does not exist.
+    '''
+
+    if not os.path.exists(abpath):
+        return None
+    if quarantine_dir is None:
+        quarantine_dir = os.path.join(os.path.dirname(abpath), QUARANTINE_DIR)
+    if not os.path.exists(quarantine_dir):
+        os.makedirs(quarantine_dir, exist_ok=True)
+
+    abpath_out = os.path.join(quarantine_dir, os.path.basename(abpath))
+    os.replace(abpath, abpath_out)
+
+    return abpath_out
+
+
+class Verifier(ProcessPool):
+    def __init__(self, max_workers=None, check_content=True,
+                 quarantine_dir=None):
+        '''Verify downloaded files in a pool of processes
+
+        Keyword Args:
+            max_workers (int or None): number of processes. If None, the
+                number of CPUs.
+            check_content (bool): if False, only check sizes and formats.
+            quarantine_dir (str or None): folder to move bad files to. If
+                None, the QUARANTINE_DIR folder next to each file.
+        '''
+
+        ProcessPool.__init__(self, max_workers)
+        self.check_content = check_content
+        self.quarantine_dir = quarantine_dir
+
+    def submit(self, abpath, data_target=None, job_dict=None, size=None):
+        '''Start verifying a file
+
+        Returns:
+            future (Future): gives the list of problems found, see
+                verifyFile().
+        '''
+
+        future = self.executor.submit(_verifyItem, (
+            abpath, data_target, job_dict, size, self.check_content))
+        return future
+
+    def check(self, abpath, data_target=None, job_dict=None, size=None):
+        '''Verify a file, and quarantine it if bad
+
+        Args are the same as verifyFile().
+
+        Raises an Exception if problems are found, after moving the file to
+        the quarantine folder.
+        '''
+
+        problems = self.submit(abpath, data_target, job_dict, size).result()[1]
+        if len(problems) > 0:
+            abpath_out = quarantineFile(abpath, self.quarantine_dir)
+            raise Exception('Verification failed: %s. File moved to %s.' % (
+                '; '.join(problems), abpath_out))
+
+
+def _getItems(outputdir, store, check_content):
+    '''Get the files of an output folder to verify
+
+    Returns:
+        result (list): list of tuples of (abpath, data_target, job_dict,
+            size, check_content). Files of jobs done in <store>, with their
+            requests, or all the data files in <outputdir> if <store> is None.
+    '''
+
+    if store is not None:
+        return [(rii['abpath_out'], rii['data_target'], rii['request'], None,
+                 check_content) for rii in store.getJobs('done')
+                if os.path.exists(rii['abpath_out'])]
+
+    result = []
+    for fii in sorted(os.listdir(outputdir)):
+        if os.path.splitext(fii)[1] in FILE_EXTENSIONS:
+            result.append((os.path.join(outputdir, fii), None, None, None,
+                           check_content))
+
+    return result
+
+
+def _dropDownloaded(outputdir, requests):
+    '''Remove jobs from the downloaded list of an output folder
+
+    Args:
+        outputdir (str): absolute path to the output folder of a batch.
+        requests (dict): keys: absolute paths to the files of the jobs to
+            remove, values: their request dicts, or None if unknown.
+    Returns:
+        missing (list): paths in <requests> with no line in the downloaded
+            list. Lines are found by their file, or, for lines written
+            without it, by their request.
+    '''
+
+    down_list_file = os.path.join(outputdir, 'downloaded_list.txt')
+    if not os.path.exists(down_list_file):
+        return sorted(requests)
+
+    by_path = dict((os.path.abspath(kk), kk) for kk in requests)
+    by_request = dict((json.dumps(vv, sort_keys=True), kk)
+                      for kk, vv in requests.items() if vv is not None)
+    found = set()
+    keep = []
+    with open(down_list_file, 'r') as fin:
+        for lii in fin:
+            if not lii.strip():
+                continue
+            dii = json.loads(lii)
+            file_out = dii.pop(DOWN_FILE_KEY, None)
+            abpath = None
+            if file_out is not None:
+                abpath = by_path.get(os.path.abspath(
+                    os.path.join(outputdir, file_out)))
+            if abpath is None:
+                abpath = by_request.get(json.dumps(dii, sort_keys=True))
+            if abpath is None:
+                keep.append(lii)
+            else:
+                found.add(abpath)
+
+    tmp_path = down_list_file + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        fout.writelines(keep)
+    os.replace(tmp_path, down_list_file)
+
+    return sorted(set(requests) - found)
+
+
+def verifyOutputdir(outputdir, max_workers=None, quarantine=False,
+                    state_db='job_state.db', check_content=True, verbose=True):
+    '''Verify the downloaded files of a batch in parallel
+
+    Args:
+        outputdir (str): absolute path to the output folder of a batch.
+    Keyword Args:
+        max_workers (int or None): number of processes. If None, the number
+            of CPUs.
+        quarantine (bool): if True, move bad files to the quarantine folder,
+            and remove their jobs from the downloaded list, so that a rerun
+            of the batch downloads them again. If the job store is found,
+            also mark their jobs as failed. A warning is printed for the
+            files whose jobs are not found in the downloaded list.
+        state_db (str or None): name of the job state database in
+            <outputdir>. If found, the files of the jobs done are checked
+            against their requests. Otherwise, all the data files in
+            <outputdir> are checked for size and format only.
+        check_content (bool): if False, only check sizes and formats.
+        verbose (bool): if True, print the bad files.
+    Returns:
+        result (dict): keys 'n_files': number of files checked, 'bad': dict
+            of problems found, keyed by file path.
+    '''
+
+    store = None
+    if state_db is not None and os.path.exists(os.path.join(outputdir, state_db)):
+        store = JobStore(os.path.join(outputdir, state_db))
+
+    try:
+        items = _getItems(outputdir, store, check_content)
+        bad = {}
+        if len(items) > 0:
+            n_workers = max_workers or os.cpu_count() or 1
+            chunksize = max(1, len(items) // (4 * n_workers))
+            with getProcessExecutor(n_workers) as executor:
+                for abpath, problems in executor.map(_verifyItem, items,
+                                                     chunksize=chunksize):
+                    if len(problems) > 0:
+                        bad[abpath] = problems
+
+        if verbose:
+            print('\n# <verifyOutputdir>: Checked %d files, %d bad.' % (
+                len(items), len(bad)))
+            for kk, vv in sorted(bad.items()):
+                print('# <verifyOutputdir>: %s: %s' % (kk, '; '.join(vv)))
+
+        if quarantine and len(bad) > 0:
+            requests = {}
+            for abpath, data_target, job_dict, _, _ in items:
+                if abpath not in bad:
+                    continue
+                quarantineFile(abpath)
+                requests[abpath] = job_dict
+                if store is not None:
+                    store.setState(getJobKey(data_target, job_dict), 'failed',
+                                   error='; '.join(bad[abpath]))
+            missing = _dropDownloaded(outputdir, requests)
+            if verbose:
+                print('# <verifyOutputdir>: Moved %d bad files to quarantine.' % len(bad))
+            if len(missing) > 0:
+                print('# <verifyOutputdir>: WARNING: %d bad file(s) moved to quarantine are not found in downloaded_list.txt. A rerun of the batch may skip their jobs, remove their lines by hand:'
+                      % len(missing))
+                for abpath in missing:
+                    print('# <verifyOutputdir>:     %s' % abpath)
+    finally:
+        if store is not None:
+            store.close()
+
+    return {'n_files': len(items), 'bad': bad}
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Verify the downloaded files of an era5dl batch.')
+    parser.add_argument('outputdir', help='output folder of the batch')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, default: number of CPUs')
+    parser.add_argument('--quarantine', action='store_true',
+                        help='move bad files to quarantine, for a rerun to download them again')
+    parser.add_argument('--format_only', action='store_true',
+                        help='only check sizes and formats')
+    args = parser.parse_args()
+
+    verifyOutputdir(os.path.abspath(args.outputdir), max_workers=args.workers,
+                    quarantine=args.quarantine,
+                    check_content=not args.format_only)
@@ -46,7 +46,16 @@ setuptools.setup(
             ],
         install_requires=[
             'cdsapi',
+            'requests',
             ],
+        extras_require={
+            'plan': ['numpy'],
+            'cache': ['numpy', 'netCDF4'],
+            'verify': ['numpy', 'netCDF4'],
+            'convert': ['xarray', 'cfgrib', 'netCDF4'],
+            'merge': ['numpy', 'netCDF4', 'zarr'],
+            'rechunk': ['numpy', 'netCDF4'],
+            },
         python_requires='>=3',
         package_data={'era5dl': ['tables/*.csv', 'examples/*']},
         )
@@ -0,0 +1,142 @@
+'''Test spreading the requests of a batch over a pool of CDS accounts.
+'''
+
+from __future__ import print_function
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_benchmark
+from era5dl.util_accounts import AccountPool, getAccountPool, loadAccounts
+from era5dl.util_fake_cds import FakeCDSServer
+
+
+class TestAccounts(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        for pii in [mock.patch.object(util_cds, 'POLL_START', 0.02),
+                    mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02)]:
+            pii.start()
+            self.addCleanup(pii.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getPool(self, url, caps, backoff=0.05):
+        pool = AccountPool([{'name': kk, 'url': url, 'key': kk, 'max_active': vv}
+                            for kk, vv in caps], verbose=False)
+        for aii in pool.accounts:
+            aii.pacer.backoff = backoff
+        return pool
+
+    def test_fair_share(self):
+
+        pool = self.getPool('http://localhost', [('1:a', 1), ('2:b', 2)])
+        self.assertEqual(pool.max_active, 3)
+
+        accounts = [pool.tryAcquire() for ii in range(4)]
+        self.assertEqual([aii.name if aii else None for aii in accounts],
+                         ['1:a', '2:b', '2:b', None])
+        pool.release(accounts[1])
+        accounts[1] = pool.acquire()
+        self.assertEqual(accounts[1].name, '2:b')
+        for aii in accounts[:3]:
+            pool.release(aii)
+
+        # more requests submitted per slot by a: b first
+        pool.accounts[0].n_submitted = 2
+        pool.accounts[1].n_submitted = 2
+        self.assertEqual(pool.tryAcquire().name, '2:b')
+        self.assertEqual(pool.tryAcquire().name, '1:a')
+
+    def test_backoff(self):
+
+        pool = self.getPool('http://localhost', [('1:a', 2), ('2:b', 2)],
+                            backoff=10)
+        pool.accounts[0].pacer.onThrottle('HTTP 429')
+        self.assertEqual([pool.tryAcquire().name for ii in range(3)],
+                         ['2:b', '2:b', '1:a'])
+
+    def test_load_accounts(self):
+
+        rc_file = os.path.join(self.outputdir, 'cdsapirc')
+        with open(rc_file, 'w') as fout:
+            fout.write('url: http://localhost/api\nkey: 2:b\n')
+        abpath = os.path.join(self.outputdir, 'accounts.json')
+        with open(abpath, 'w') as fout:
+            json.dump([{'name': 'a', 'key': '1:a', 'max_active': 3},
+                       {'name': 'b', 'rc': rc_file}], fout)
+
+        self.assertEqual(len(loadAccounts(abpath)), 2)
+        pool = getAccountPool(abpath, verbose=False)
+        self.assertEqual([(aii.name, aii.url, aii.key, aii.max_active)
+                          for aii in pool.accounts],
+                         [('a', None, '1:a', 3),
+                          ('b', 'http://localhost/api', '2:b', 2)])
+
+        with self.assertRaises(Exception):
+            AccountPool([{'name': 'a', 'keys': '1:a'}])
+        with self.assertRaises(Exception):
+            AccountPool([{'name': 'a'}, {'name': 'a'}])
+
+    def test_batch(self):
+
+        job_dict = util_benchmark.makeJobDict(12)
+        for backend in ['sync', 'async']:
+            outputdir = os.path.join(self.outputdir, backend)
+            with FakeCDSServer(queue_delay=0.1, run_time=0.1,
+                               max_per_key=1) as server:
+                accounts = [{'name': kk, 'url': server.url, 'key': kk,
+                             'max_active': vv} for kk, vv in
+                            [('1:a', 1), ('2:b', 1), ('3:c', 1)]]
+                util_downloader.batchDownload(
+                    util_benchmark.BENCH_TEMPLATE, job_dict, [], outputdir,
+                    dry=False, pause=0, max_workers=3, backend=backend,
+                    accounts=accounts, verbose=False)
+                stats = server.getStats()
+                key_stats = server.getKeyStats()
+
+            n_done = len(util_downloader.loadDownloadedList(
+                os.path.join(outputdir, 'downloaded_list.txt')))
+            self.assertEqual(n_done, 12)
+            self.assertEqual(stats['submitted'], 12)
+            # the caps of the accounts are kept, and all accounts are used
+            self.assertEqual(stats.get('rejected', 0), 0)
+            self.assertEqual(sorted(key_stats), ['1:a', '2:b', '3:c'])
+            for kk, vv in key_stats.items():
+                self.assertEqual(vv['max_active'], 1, kk)
+                self.assertGreater(vv['submitted'], 0, kk)
+
+    def test_throttled_account(self):
+
+        # the server caps account a lower than the pool
+        for backend in ['sync', 'async']:
+            outputdir = os.path.join(self.outputdir, backend)
+            os.makedirs(outputdir)
+            with FakeCDSServer(queue_delay=0.1, run_time=0.1,
+                               max_per_key={'1:a': 1, '2:b': 2}) as server:
+                pool = self.getPool(server.url, [('1:a', 2), ('2:b', 2)])
+                jobs = util_downloader.prepareBatchJobDicts(
+                    util_benchmark.BENCH_TEMPLATE, util_benchmark.makeJobDict(10),
+                    [], outputdir)
+                done_list, fail_list = util_downloader.processJobs(
+                    jobs, outputdir, False, pause=0, max_workers=4,
+                    backend=backend, accounts=pool, verbose=False)
+                key_stats = server.getKeyStats()
+
+            self.assertEqual((len(done_list), len(fail_list)), (10, 0))
+            self.assertGreater(key_stats['1:a']['rejected'], 0)
+            self.assertEqual(key_stats['2:b']['rejected'], 0)
+            self.assertGreater(pool.accounts[0].pacer.getState()['n_throttled'], 0)
+            self.assertEqual(pool.accounts[1].pacer.getState()['n_throttled'], 0)
+            self.assertEqual([aii['n_active'] for aii in pool.getState()], [0, 0])
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,204 @@
+'''Test the asyncio submit-then-poll backend.
+'''
+
+from __future__ import print_function
+import gc
+import os
+import time
+import shutil
+import tempfile
+import asyncio
+import unittest
+import threading
+from unittest import mock
+
+from era5dl import util_downloader, util_cds, util_async_downloader
+from era5dl.util_cache import DownloadCache
+
+
+class FakeHandle(object):
+    '''Request that completes <delay> seconds after submission'''
+
+    def __init__(self, job_dict, delay):
+        self.job_dict = job_dict
+        self.request_id = 'request-%s' % job_dict['year']
+        self.ready_time = time.time() + delay
+
+    def state(self):
+        if self.job_dict['year'] == 2000:
+            raise Exception('Request failed on server')
+        return 'completed' if time.time() >= self.ready_time else 'queued'
+
+    def download(self, abpath_out):
+        with open(abpath_out, 'w') as fout:
+            fout.write(str(self.job_dict))
+
+
+class TestAsyncBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_overlapping_queue_waits(self):
+
+        jobs = [{'data_target': 'reanalysis-era5-single-levels',
+                 'variable': '2m_temperature', 'year': 1990 + ii,
+                 'abpath_out': os.path.join(self.outputdir, '%d.nc' % ii)}
+                for ii in range(12)]
+
+        patches = [
+            mock.patch.object(util_cds, 'getClient', lambda **kwargs: None),
+            mock.patch.object(util_cds, 'submitRequest',
+                              lambda c, t, d: FakeHandle(d, 0.3)),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: h.state()),
+            mock.patch.object(util_cds, 'downloadResult',
+                              lambda h, p: h.download(p)),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        t0 = time.time()
+        with mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.05):
+            done_list, fail_list = util_downloader.processJobs(
+                jobs, self.outputdir, False, pause=0, max_workers=12,
+                backend='async')
+        elapsed = time.time() - t0
+
+        # 12 requests of 0.3 s each, waited for at the same time
+        self.assertLess(elapsed, 2.)
+        self.assertEqual(len(done_list), 11)
+        self.assertEqual([dd['year'] for dd in fail_list], [2000])
+        # downloaded files, log, downloaded list and failure manifest
+        self.assertEqual(len(os.listdir(self.outputdir)), 11 + 3)
+
+    def test_cache_off_loop(self):
+
+        jobs = [{'data_target': 'reanalysis-era5-single-levels',
+                 'variable': '2m_temperature', 'year': 1990 + ii}
+                for ii in range(4)]
+
+        patches = [
+            mock.patch.object(util_cds, 'getClient', lambda **kwargs: None),
+            mock.patch.object(util_cds, 'submitRequest',
+                              lambda c, t, d: FakeHandle(d, 0.05)),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: h.state()),
+            mock.patch.object(util_cds, 'downloadResult',
+                              lambda h, p: h.download(p)),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        # threads the cache is used from
+        threads = []
+        cache = DownloadCache(os.path.join(self.outputdir, 'cache'))
+        self.addCleanup(cache.close)
+        for name in ['fetch', 'add']:
+            def wrapper(*args, func=getattr(cache, name)):
+                threads.append(threading.current_thread())
+                return func(*args)
+            setattr(cache, name, wrapper)
+
+        with mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02):
+            for run in ['run1', 'run2']:
+                outputdir = os.path.join(self.outputdir, run)
+                os.makedirs(outputdir)
+                job_dicts = [dict(jii, abpath_out=os.path.join(
+                    outputdir, '%d.nc' % jii['year'])) for jii in jobs]
+                done_list, fail_list = util_downloader.processJobs(
+                    job_dicts, outputdir, False, pause=0, max_workers=4,
+                    backend='async', cache=cache)
+                self.assertEqual(len(done_list), 4)
+                self.assertEqual(len(os.listdir(outputdir)), 4 + 2)
+
+        # 4 misses and adds, then 4 hits, none on the event loop thread
+        self.assertEqual(len(threads), 12)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_callbacks_off_loop(self):
+
+        patches = [
+            mock.patch.object(util_cds, 'submitRequest',
+                              lambda c, t, d: FakeHandle(d, 0.05)),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: h.state()),
+            mock.patch.object(util_cds, 'downloadResult',
+                              lambda h, p: h.download(p)),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        # (name, thread) of the jobs taken and the callbacks called
+        calls = []
+
+        def record(name):
+            calls.append((name, threading.current_thread()))
+
+        def iterJobs():
+            # e.g. claimed from a shared job queue
+            for year in [1999, 2000, 2001]:
+                record('claim')
+                yield (str(year), 'reanalysis-era5-single-levels',
+                       {'year': year}, os.path.join(self.outputdir, str(year)),
+                       None)
+
+        with mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02):
+            util_async_downloader.runJobsAsync(
+                iterJobs(), lambda jobid: record('done'),
+                lambda jobid, e: record('fail'), max_requests=2,
+                client=object(),
+                on_state=lambda jobid, state, request_id: record(state))
+
+        names = [nii for nii, _ in calls]
+        self.assertEqual(names.count('claim'), 3)
+        self.assertEqual(names.count('done'), 2)
+        self.assertEqual(names.count('fail'), 1)
+        self.assertEqual(names.count('submitted'), 3)
+        self.assertNotIn(threading.current_thread(), [tii for _, tii in calls])
+
+    def test_finished_tasks_released(self):
+
+        patches = [
+            mock.patch.object(util_cds, 'submitRequest',
+                              lambda c, t, d: FakeHandle(d, 0)),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: h.state()),
+            mock.patch.object(util_cds, 'downloadResult',
+                              lambda h, p: h.download(p)),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        # number of Task objects alive as each job is taken
+        n_tasks = []
+
+        def iterJobs():
+            for year in range(1900, 1960):
+                n_tasks.append(sum(isinstance(oii, asyncio.Task)
+                                   for oii in gc.get_objects()))
+                yield (str(year), 'reanalysis-era5-single-levels',
+                       {'year': year}, os.path.join(self.outputdir, str(year)),
+                       None)
+
+        def onDone(jobid):
+            if jobid == '1959':
+                raise Exception('Failed to record job')
+
+        with mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.01):
+            with self.assertRaises(Exception) as cm:
+                util_async_downloader.runJobsAsync(
+                    iterJobs(), onDone, lambda jobid, e: None,
+                    max_requests=4, client=object())
+
+        self.assertIn('Failed to record job', str(cm.exception))
+        self.assertEqual(len(n_tasks), 60)
+        self.assertLess(max(n_tasks), 20)
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,147 @@
+'''Test the content-addressed download cache.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from unittest import mock
+
+from era5dl import util_downloader, util_cds
+from era5dl.util_cache import DownloadCache, getCacheKey
+
+
+def writeFile(abpath, size):
+    with open(abpath, 'wb') as fout:
+        fout.write(b'x' * size)
+
+
+def addAndFetch(cache_dir, idx):
+    '''Add files to and fetch files from a shared cache, in another process'''
+
+    cache = DownloadCache(cache_dir, max_bytes=2500)
+    workdir = os.path.join(cache_dir, 'work%d' % idx)
+    os.makedirs(workdir)
+    n_hits = 0
+    for ii in range(10):
+        job_dict = {'variable': 'u', 'year': str(ii)}
+        abpath = os.path.join(workdir, '%d.nc' % ii)
+        if cache.fetch('reanalysis-era5-single-levels', job_dict, abpath):
+            n_hits += 1
+        else:
+            writeFile(abpath, 500)
+            cache.add('reanalysis-era5-single-levels', job_dict, abpath)
+    cache.close()
+
+    return n_hits
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_canonical_key(self):
+
+        job1 = {'variable': ['v', 'u'], 'month': [1, 2], 'day': '3',
+                'time': ['12:00', '0'], 'area': [60.1, -10.04, 49.9, 2.02]}
+        job2 = {'variable': ['u', 'v'], 'month': ['02', '01'], 'day': ['03'],
+                'time': ['00:00', '12:00'], 'area': [60, -10, 50, 2]}
+        self.assertEqual(getCacheKey('era5', job1), getCacheKey('era5', job2))
+
+        # area snapped to the grid of the request
+        job3 = dict(job2, area=[60.3, -10, 50, 2], grid=[0.5, 0.5])
+        job4 = dict(job2, area=[60.5, -10, 50, 2], grid='0.5/0.5')
+        self.assertEqual(getCacheKey('era5', job3), getCacheKey('era5', job4))
+        self.assertNotEqual(getCacheKey('era5', job2), getCacheKey('era5', job4))
+
+    def test_add_fetch(self):
+
+        cache = DownloadCache(self.cache_dir)
+        self.addCleanup(cache.close)
+        job_dict = {'variable': 'u', 'year': '2000'}
+        abpath_in = os.path.join(self.tmpdir, 'a', 'u.nc')
+        os.makedirs(os.path.dirname(abpath_in))
+        writeFile(abpath_in, 100)
+
+        abpath_out = os.path.join(self.tmpdir, 'b', 'u2000.nc')
+        self.assertFalse(cache.fetch('era5', job_dict, abpath_out))
+        cache.add('era5', job_dict, abpath_in)
+
+        self.assertTrue(cache.fetch('era5', {'year': 2000, 'variable': ['u']},
+                                    abpath_out))
+        self.assertEqual(os.stat(abpath_out).st_ino, os.stat(abpath_in).st_ino)
+        self.assertTrue(('era5', job_dict) in cache)
+        self.assertEqual(cache.getTotalSize(), 100)
+
+    def test_lru_eviction(self):
+
+        cache = DownloadCache(self.cache_dir, max_bytes=250)
+        self.addCleanup(cache.close)
+        jobs = [{'variable': 'u', 'year': str(ii)} for ii in range(3)]
+        for ii, jobii in enumerate(jobs[:2]):
+            abpath = os.path.join(self.tmpdir, '%d.nc' % ii)
+            writeFile(abpath, 100)
+            cache.add('era5', jobii, abpath)
+
+        # job 0 used more recently than job 1
+        cache.fetch('era5', jobs[0], os.path.join(self.tmpdir, 'out.nc'))
+        abpath = os.path.join(self.tmpdir, '2.nc')
+        writeFile(abpath, 100)
+        cache.add('era5', jobs[2], abpath)
+
+        self.assertTrue(('era5', jobs[0]) in cache)
+        self.assertFalse(('era5', jobs[1]) in cache)
+        self.assertTrue(('era5', jobs[2]) in cache)
+        self.assertEqual(cache.getTotalSize(), 200)
+
+        # files linked out before eviction are kept
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, '1.nc')))
+
+    def test_multi_process(self):
+
+        DownloadCache(self.cache_dir).close()
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.starmap(addAndFetch,
+                         [(self.cache_dir, ii) for ii in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+
+        cache = DownloadCache(self.cache_dir, max_bytes=2500)
+        self.addCleanup(cache.close)
+        self.assertLessEqual(cache.getTotalSize(), 2500)
+        # every indexed entry has its file
+        rows = cache.conn.execute('SELECT path, size FROM entries').fetchall()
+        for path, size in rows:
+            self.assertEqual(os.path.getsize(path), size)
+
+    def test_retrieve_from_cache(self):
+
+        cache = DownloadCache(self.cache_dir)
+        self.addCleanup(cache.close)
+        job_dict = dict(util_downloader.TEMPLATE_DICT)
+        data_target = job_dict.pop('data_target')
+        abpath_in = os.path.join(self.tmpdir, 'in.nc')
+        writeFile(abpath_in, 10)
+        cache.add(data_target, job_dict, abpath_in)
+
+        abpath_out = os.path.join(self.tmpdir, 'project', 'out.nc')
+        with mock.patch.object(util_cds, 'getClient',
+                               side_effect=Exception('CDS contacted')):
+            util_downloader.retrieveData(data_target, job_dict, abpath_out,
+                                         dry=False, cache=cache)
+
+        self.assertEqual(os.path.getsize(abpath_out), 10)
+
+
+if __name__=='__main__':
+
+    unittest.main()
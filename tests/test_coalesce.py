@@ -0,0 +1,88 @@
+'''Test merging fragmented jobs into rectangular jobs.
+'''
+
+from __future__ import print_function
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from era5dl import util_downloader
+from era5dl.util_general import getAttrProduct
+from era5dl.util_coalesce import coalesceJobs, expandJob
+from era5dl.util_request_size import countFields
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def getCells(self, jobs):
+        cells = []
+        for jobii in jobs:
+            cells.extend(expandJob(jobii))
+        return cells
+
+    def test_cover(self):
+
+        jobs = getAttrProduct({'variable': ['u', 'v', 't'],
+                               'year': list(range(2000, 2010)),
+                               'pressure_level': [500, 850]})
+        # ragged remainder after skipping, plus overlapping pieces
+        jobs = [jj for jj in jobs if not (jj[0][1] == 'u' and jj[1][1] < 2004)]
+        jobs.append((('variable', 'v'), ('year', (2000, 2001)),
+                     ('pressure_level', 500)))
+        jobs.append(jobs[0])
+
+        result = coalesceJobs(jobs, max_fields=20, verbose=False)
+        cells = self.getCells(result)
+
+        # every cell once, nothing extra
+        self.assertEqual(len(cells), len(set(cells)))
+        self.assertEqual(set(cells), set(self.getCells(jobs)))
+        self.assertTrue(all(len(expandJob(jj)) <= 20 for jj in result))
+        self.assertLess(len(result), 10)
+
+    def test_size_cap_on_fields(self):
+
+        template_dict = dict(util_downloader.TEMPLATE_DICT,
+                             pressure_level=['500'], year='2000')
+        jobs = getAttrProduct({'variable': ['u', 'v'], 'month': list(range(1, 13))})
+        # 1 level, 4 times a day, 366 days: 1464 fields per variable
+        result = coalesceJobs(jobs, template_dict, max_fields=800,
+                              verbose=False)
+
+        self.assertEqual(len(result), 4)
+        self.assertEqual(set(self.getCells(result)), set(self.getCells(jobs)))
+        for jobii in result:
+            self.assertLessEqual(countFields(
+                dict(template_dict, **dict(jobii))), 800)
+
+    def test_skip_after_merged_download(self):
+
+        outputdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outputdir)
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'year': ['2000', '2001', '2002']}
+
+        jobs = util_downloader.prepareBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, [], outputdir,
+            coalesce=True)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['year'], ('2000', '2001', '2002'))
+
+        # record the merged job as downloaded, as processJobs() does
+        job = dict(jobs[0])
+        job.pop('data_target')
+        job.pop('abpath_out')
+        with open(os.path.join(outputdir, 'downloaded_list.txt'), 'w') as fout:
+            json.dump(job, fout)
+            fout.write('\n')
+
+        jobs = util_downloader.prepareBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, [], outputdir)
+        self.assertEqual(jobs, [])
+
+
+if __name__=='__main__':
+
+    unittest.main()
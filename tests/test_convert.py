@@ -0,0 +1,136 @@
+'''Test fetching NetCDF jobs in GRIB and converting them locally.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_convert
+
+try:
+    import xarray
+    import cfgrib
+    HAS_CFGRIB = True
+except ImportError:
+    HAS_CFGRIB = False
+
+
+class FakeConverter(object):
+    '''Converter writing a dummy NetCDF file, in the calling thread'''
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def convert(self, abpath_in, abpath_out, job_dict=None):
+        with self.lock:
+            self.calls.append((os.path.basename(abpath_in),
+                               os.path.basename(abpath_out), job_dict['format']))
+        with open(abpath_out, 'wb') as fout:
+            fout.write(b'CDF\x01')
+        os.remove(abpath_in)
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_names(self):
+
+        for short_name, name in [('z', 'z'), ('2t', 't2m'), ('2d', 'd2m'),
+                                 ('10u', 'u10'), ('100v', 'v100'),
+                                 ('10fg', 'fg10'), ('mx2t', 'mx2t')]:
+            self.assertEqual(util_convert.getNetCDFName(short_name), name)
+
+        self.assertEqual(util_convert.getVariableNames(
+            {'variable': ['2m_temperature', 'geopotential', 'unknown']}),
+            {167: 't2m', 129: 'z'})
+        self.assertEqual(util_convert.getVariableNames(
+            {'variable': '10m_u-component_of_wind'}), {165: 'u10'})
+
+    def test_grib_request(self):
+
+        job_dict = {'variable': 'geopotential', 'data_format': 'netcdf'}
+        self.assertTrue(util_convert.isNetCDFRequest(job_dict))
+        self.assertEqual(util_convert.getGribRequest(job_dict),
+                         {'variable': 'geopotential', 'data_format': 'grib'})
+        self.assertEqual(job_dict['data_format'], 'netcdf')
+        self.assertFalse(util_convert.isNetCDFRequest({'format': 'grib'}))
+        self.assertFalse(util_convert.isNetCDFRequest({}))
+
+    @unittest.skipIf(HAS_CFGRIB, 'requires cfgrib to be missing')
+    def test_missing_packages(self):
+
+        # fail before any data are downloaded
+        with self.assertRaises(Exception) as cm:
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, {'year': ['2000']}, [],
+                self.outputdir, False, fetch_grib=True)
+        self.assertIn('cfgrib', str(cm.exception))
+
+    def test_fetch_grib(self):
+
+        submits = []
+
+        class FakeHandle(object):
+            def __init__(self):
+                self.request_id = 'r%d' % len(submits)
+
+        def submit(c, t, d):
+            submits.append(d['format'])
+            return FakeHandle()
+
+        def download(h, abpath_out):
+            with open(abpath_out, 'wb') as fout:
+                fout.write(b'GRIB')
+
+        patches = [
+            mock.patch.object(util_cds, 'getClient', lambda **kwargs: None),
+            mock.patch.object(util_cds, 'submitRequest', submit),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: 'completed'),
+            mock.patch.object(util_cds, 'downloadResult', download),
+            mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.01),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        for backend in ['sync', 'async']:
+            outputdir = os.path.join(self.outputdir, backend)
+            os.makedirs(outputdir)
+            jobs = [{'data_target': 'reanalysis-era5-single-levels',
+                     'variable': '2m_temperature', 'year': str(2000 + ii),
+                     'format': 'netcdf' if ii < 2 else 'grib',
+                     'abpath_out': os.path.join(outputdir, '%d.nc' % ii)}
+                    for ii in range(3)]
+            converter = FakeConverter()
+            del submits[:]
+
+            done_list, fail_list = util_downloader.processJobs(
+                jobs, outputdir, False, pause=0, max_workers=2,
+                backend=backend, converter=converter)
+
+            self.assertEqual(len(done_list), 3)
+            # the NetCDF jobs are recorded as they are, but fetched in GRIB
+            self.assertEqual([jii['format'] for jii in done_list
+                              if jii['year'] != '2002'], ['netcdf', 'netcdf'])
+            self.assertEqual(sorted(submits), ['grib', 'grib', 'grib'])
+            self.assertEqual(sorted(converter.calls), [
+                ('0.nc.grb', '0.nc', 'netcdf'), ('1.nc.grb', '1.nc', 'netcdf')])
+            self.assertEqual(sorted(fii for fii in os.listdir(outputdir)
+                                    if fii.endswith(('.nc', '.grb'))),
+                             ['0.nc', '1.nc', '2.nc'])
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,118 @@
+'''Test job timing events, queue-based logging and profiling.
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_events
+
+
+def fakeRetrieve(data_target, job_dict, abpath_out, dry=True, request_id=None,
+                 callback=None, cache=None, **kwargs):
+    callback('submitted', 'r%d' % job_dict['year'])
+    time.sleep(0.005)
+    callback('running', 'r%d' % job_dict['year'])
+    time.sleep(0.005)
+    callback('downloading', 'r%d' % job_dict['year'])
+    with open(abpath_out, 'wb') as fout:
+        fout.write(b'x' * 1000)
+    callback('downloaded', 'r%d' % job_dict['year'])
+    if job_dict['year'] == 3:
+        raise Exception('Bad file')
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getJobs(self, n):
+        return [{'data_target': 'reanalysis-era5-single-levels',
+                 'variable': '2m_temperature', 'year': ii,
+                 'abpath_out': os.path.join(self.outputdir, '%d.nc' % ii)}
+                for ii in range(n)]
+
+    def readEvents(self, abpath):
+        util_events.flushLogs()
+        with open(abpath, 'r') as fin:
+            return [json.loads(lii) for lii in fin]
+
+    def test_job_events(self):
+
+        abpath = os.path.join(self.outputdir, 'events.jsonl')
+        events = util_events.EventLog(abpath)
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.processJobs(iter(self.getJobs(4)), self.outputdir,
+                                        False, pause=0, events=events)
+
+        records = self.readEvents(abpath)
+        self.assertEqual(records[0]['event'], 'batch_start')
+        self.assertEqual(records[-1]['event'], 'batch_end')
+        self.assertEqual(records[-1]['n_failed'], 1)
+
+        job1 = [rii['event'] for rii in records if rii['job'] == '2']
+        self.assertEqual(job1, ['plan', 'submit', 'queue', 'run', 'download',
+                                'postprocess', 'done'])
+        download = [rii for rii in records if rii['event'] == 'download'][0]
+        self.assertEqual(download['bytes'], 1000)
+        self.assertEqual(download['request_id'], 'r0')
+        queue = [rii for rii in records if rii['event'] == 'queue'][0]
+        self.assertGreater(queue['duration'], 0.004)
+        failed = [rii for rii in records if rii['event'] == 'failed']
+        self.assertEqual([rii['job'] for rii in failed], ['4'])
+
+    def test_concurrent_events(self):
+
+        abpath = os.path.join(self.outputdir, 'events.jsonl')
+        events = util_events.EventLog(abpath)
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.processJobs(self.getJobs(40), self.outputdir,
+                                        False, pause=0, max_workers=8,
+                                        events=events)
+
+        # every line is a complete record
+        records = self.readEvents(abpath)
+        self.assertEqual(len(records), 2 + 40 * 7)
+
+    def test_logger_configured_once(self):
+
+        filename = os.path.join(self.outputdir, 'test.log')
+        logger = util_downloader.getLogger('test', filename,
+                                           util_downloader.LOG_CONFIG)
+        logger2 = util_downloader.getLogger('test', filename,
+                                            util_downloader.LOG_CONFIG)
+        self.assertIs(logger, logger2)
+        self.assertEqual(len(logger.handlers), 1)
+
+        logger.info('hello')
+        util_events.flushLogs()
+        with open(filename, 'r') as fin:
+            lines = fin.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('test_logger_configured_once', lines[0])
+
+    def test_profiler(self):
+
+        profiler = util_events.Profiler(self.outputdir)
+        with profiler.phase('planning'):
+            data = [list(range(100)) for ii in range(1000)]
+
+        with open(os.path.join(self.outputdir, 'profile_planning.txt')) as fin:
+            text = fin.read()
+        self.assertIn('Peak traced memory', text)
+        self.assertTrue(os.path.exists(os.path.join(self.outputdir,
+                                                    'profile_planning.prof')))
+
+
+if __name__=='__main__':
+
+    unittest.main()
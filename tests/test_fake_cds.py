@@ -0,0 +1,86 @@
+'''Test batches against the local fake CDS server, and the benchmarks.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_benchmark
+from era5dl.util_fake_cds import FakeCDSServer
+
+
+class TestFakeCDS(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        for pii in [mock.patch.object(util_cds, 'POLL_START', 0.02),
+                    mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02)]:
+            pii.start()
+            self.addCleanup(pii.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_retrieve(self):
+
+        states = []
+        abpath_out = os.path.join(self.outputdir, 'a.nc')
+        with FakeCDSServer(queue_delay=0.05, run_time=0.05,
+                           payload_size=200*1024) as server:
+            util_downloader.retrieveData(
+                'reanalysis-era5-single-levels', {'format': 'netcdf'},
+                abpath_out, dry=False,
+                callback=lambda state, rid: states.append(state))
+            stats = server.getStats()
+
+        self.assertEqual(states[0], 'submitted')
+        self.assertEqual(states[-2:], ['downloading', 'downloaded'])
+        self.assertEqual(os.path.getsize(abpath_out), 200*1024)
+        with open(abpath_out, 'rb') as fin:
+            self.assertEqual(fin.read(4), b'CDF\x01')
+        self.assertEqual(stats['submitted'], 1)
+        self.assertEqual(stats['bytes_sent'], 200*1024)
+        # environment restored
+        self.assertNotEqual(os.environ.get('CDSAPI_URL'), server.url)
+
+    def test_batch_with_failures(self):
+
+        job_dict = util_benchmark.makeJobDict(20)
+        for backend in ['sync', 'async']:
+            outputdir = os.path.join(self.outputdir, backend)
+            with FakeCDSServer(failure_rate=0.3, seed=1) as server:
+                util_downloader.batchDownload(
+                    util_benchmark.BENCH_TEMPLATE, job_dict, [], outputdir,
+                    dry=False, pause=0, max_workers=4, backend=backend)
+                stats = server.getStats()
+
+            n_done = len(util_downloader.loadDownloadedList(
+                os.path.join(outputdir, 'downloaded_list.txt')))
+            self.assertEqual(stats['submitted'], 20)
+            self.assertEqual(n_done, stats['completed'])
+            self.assertEqual(20 - n_done, stats['failed'])
+            self.assertGreater(stats['failed'], 0)
+
+    def test_benchmarks(self):
+
+        results = util_benchmark.runBenchmarks([10, 1000], execute_max=10,
+                                               outputdir=self.outputdir,
+                                               verbose=False, queue_delay=0,
+                                               run_time=0, poll_interval=0.02)
+
+        self.assertEqual([(rii['benchmark'], rii['n_jobs']) for rii in results],
+                         [('planner', 10), ('batch', 10), ('planner', 1000)])
+        batch = results[1]
+        self.assertEqual(batch['n_done'], 10)
+        self.assertGreater(batch['jobs_per_hour'], 0)
+        self.assertEqual(batch['bytes'], 10 * 100 * 1024)
+        self.assertIsNotNone(results[2]['peak_mb'])
+
+
+if __name__=='__main__':
+
+    unittest.main()
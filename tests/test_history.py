@@ -0,0 +1,196 @@
+'''Test the duration model fitted on past runs, LPT ordering and ETA.
+'''
+
+from __future__ import print_function
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_benchmark, util_schedule
+from era5dl.util_history import loadSamples, loadModel, DurationModel,\
+        EtaTracker, getRequestShape
+from era5dl.util_plan_report import planReport, BYTES_PER_VALUE,\
+        REQUEST_OVERHEAD
+from era5dl.util_fake_cds import FakeCDSServer
+
+ERA5 = 'reanalysis-era5-single-levels'
+ERA5_LAND = 'reanalysis-era5-land'
+
+
+def writeEvents(abpath, jobs):
+    '''Write the events of a batch run, jobs given as (shape, server_s, bytes)'''
+
+    with open(abpath, 'a') as fout:
+        def emit(jobid, event, **fields):
+            fields.update(job=jobid, event=event, time=0)
+            fout.write(json.dumps(fields) + '\n')
+
+        emit(None, 'batch_start', n_jobs=len(jobs))
+        for ii, (shape, server_s, nbytes) in enumerate(jobs):
+            jobid = str(ii + 1)
+            emit(jobid, 'plan', duration=0.001, **shape)
+            emit(jobid, 'submit', duration=0.1)
+            emit(jobid, 'queue', duration=server_s * 0.75)
+            emit(jobid, 'run', duration=server_s * 0.25)
+            emit(jobid, 'download', duration=nbytes / 1e6, bytes=nbytes)
+            emit(jobid, 'done', duration=server_s + nbytes / 1e6)
+        emit(None, 'batch_end', n_done=len(jobs))
+
+
+def getShape(data_target, fields, points=1000, data_format='netcdf'):
+    return {'data_target': data_target, 'data_format': data_format,
+            'fields': fields, 'points': points}
+
+
+def greedyMakespan(seconds, n_workers):
+    '''Makespan of jobs started in order by the first free worker'''
+
+    workers = [0.] * n_workers
+    for sii in seconds:
+        workers.sort()
+        workers[0] += sii
+    return max(workers)
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.events_file = os.path.join(self.outputdir, 'job_events.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_fit(self):
+
+        # ERA5: 60 s + 0.5 s per field, 2 bytes per value, 1 MB/s
+        jobs = [(getShape(ERA5, ff), 60 + 0.5 * ff, 2 * ff * 1000)
+                for ff in [10, 100, 200, 400]]
+        writeEvents(self.events_file, jobs)
+        # ids restart in the next run, a retried job and a cache hit
+        jobs = [(getShape(ERA5_LAND, ff), 300 + 0.1 * ff, 4 * ff * 1000)
+                for ff in [10, 20, 30]]
+        writeEvents(self.events_file, jobs)
+        with open(self.events_file, 'a') as fout:
+            for line in [{'event': 'batch_start', 'job': None},
+                         {'event': 'plan', 'job': '1', **getShape(ERA5, 5)},
+                         {'event': 'queue', 'job': '1', 'duration': 5000},
+                         {'event': 'retry', 'job': '1'},
+                         {'event': 'plan', 'job': '2', **getShape(ERA5, 5)},
+                         {'event': 'cache_hit', 'job': '2'},
+                         {'event': 'done', 'job': '2', 'duration': 1}]:
+                fout.write(json.dumps(line) + '\n')
+
+        samples = loadSamples([self.events_file, os.path.join(self.outputdir, 'none')])
+        self.assertEqual(len(samples), 7)
+        self.assertEqual(samples[0]['server_s'], 65)
+
+        model = DurationModel(samples)
+        params = model.getParams(ERA5, 'netcdf')
+        self.assertAlmostEqual(params['overhead'], 60)
+        self.assertAlmostEqual(params['seconds_per_field'], 0.5)
+        self.assertAlmostEqual(params['bytes_per_value'], 2)
+        self.assertAlmostEqual(params['bandwidth'], 1e6)
+        self.assertAlmostEqual(model.getParams(ERA5_LAND, 'netcdf')['overhead'], 300)
+
+        # no GRIB data: fit on all the samples, default bytes per value
+        params = model.getParams(ERA5, 'grib')
+        self.assertEqual(params['bytes_per_value'], BYTES_PER_VALUE['grib'])
+        self.assertNotEqual(params['overhead'], REQUEST_OVERHEAD)
+        self.assertEqual(DurationModel().getParams(ERA5, 'grib')['overhead'],
+                         REQUEST_OVERHEAD)
+
+        job_dict = {'data_target': ERA5, 'format': 'netcdf',
+                    'variable': ['2m_temperature', 'total_precipitation'],
+                    'year': '2000', 'month': '01', 'day': ['01', '02'],
+                    'time': ['00:00', '12:00'], 'area': [10, 0, 0, 10]}
+        shape = getRequestShape(job_dict)
+        self.assertEqual((shape['fields'], shape['points']), (8, 41 * 41))
+        seconds, nbytes = model.predict(job_dict)
+        self.assertAlmostEqual(nbytes, 2 * 8 * 41 * 41)
+        self.assertAlmostEqual(seconds, 60 + 0.5 * 8 + nbytes / 1e6)
+
+    def test_longest_first(self):
+
+        writeEvents(self.events_file,
+                    [(getShape(ERA5, ff, points=pp), 60 + 0.01 * ff * pp / 1000,
+                      2 * ff * pp) for ff, pp in [(10, 1000), (100, 1000),
+                                                   (100, 10000), (10, 100000)]])
+        model = loadModel(self.events_file, verbose=False)
+
+        # same number of fields, a few jobs over a much larger area
+        areas = [(10, 0, 0, 10), (20, 0, 10, 10), (30, 0, 20, 10),
+                 (60, -30, 0, 60)]
+        job_dict = {'month': ['%02d' % mm for mm in range(1, 13)],
+                    'area': areas}
+        template = dict(util_downloader.TEMPLATE_DICT, year='2001',
+                        data_target=ERA5)
+        default = list(util_downloader.iterBatchJobDicts(
+            template, job_dict, [], self.outputdir))
+        longest = list(util_downloader.iterBatchJobDicts(
+            template, job_dict, [], self.outputdir, order='longest', model=model))
+        plan = util_downloader.planBatchJobs(
+            template, job_dict, [], self.outputdir, order='longest', model=model)
+
+        self.assertEqual(list(plan), longest)
+        self.assertEqual([jii['area'] for jii in longest[:12]],
+                         [areas[-1]] * 12)
+        seconds, _ = model.predictPlan(plan)
+        self.assertEqual(list(seconds), [model.predict(jii)[0] for jii in longest])
+
+        makespans = [greedyMakespan([model.predict(jii)[0] for jii in jobs], 4)
+                     for jobs in [default, longest]]
+        self.assertLess(makespans[1], makespans[0])
+
+        # the report uses the model
+        report = planReport(plan, max_workers=4, model=model)
+        self.assertAlmostEqual(report['seconds']['total'], sum(seconds))
+
+        with self.assertRaises(Exception):
+            util_schedule.orderJobs(default, 'shortest')
+
+    def test_eta(self):
+
+        eta = EtaTracker([100, 50, 50], max_workers=2)
+        self.assertEqual(eta.getEta(), 100)
+        eta.t0 -= 10
+        eta.finish(0)
+        eta.finish(0)
+        self.assertAlmostEqual(eta.getEta(), 10, places=1)
+        self.assertTrue(eta.getProgress().startswith('1/3 job(s) finished, ETA 00:00:1'))
+
+    def test_batch_history(self):
+
+        job_dict = util_benchmark.makeJobDict(6)
+        with mock.patch.object(util_cds, 'POLL_START', 0.02),\
+                mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02):
+            for backend in ['sync', 'async']:
+                outputdir = os.path.join(self.outputdir, backend)
+                output = io.StringIO()
+                with FakeCDSServer(queue_delay=0.05, run_time=0.05) as server,\
+                        redirect_stdout(output):
+                    util_downloader.batchDownload(
+                        util_benchmark.BENCH_TEMPLATE, job_dict, [], outputdir,
+                        dry=False, pause=0, max_workers=3, backend=backend,
+                        order='longest')
+                self.assertIn('6/6 job(s) finished, ETA', output.getvalue())
+
+                samples = loadSamples(os.path.join(outputdir, 'job_events.jsonl'))
+                self.assertEqual(len(samples), 6)
+                for sii in samples:
+                    self.assertEqual(sii['data_target'],
+                                     util_benchmark.BENCH_TEMPLATE['data_target'])
+                    self.assertEqual(sii['data_format'], 'netcdf')
+                    self.assertGreater(sii['server_s'], 0)
+                    self.assertGreater(sii['bytes'], 0)
+
+
+if __name__=='__main__':
+
+    unittest.main()
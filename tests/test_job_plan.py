@@ -0,0 +1,131 @@
+'''Test the compact, array-backed job plan.
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from era5dl import util_downloader
+from era5dl.util_job_plan import JobPlan, loadJobPlan, makeProductPlan
+from era5dl.util_job_store import JobStore, getJobKey
+
+
+class TestJobPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                         'year': range(2000, 2003),
+                         'month': ['02', '01'],
+                         'day': [('01', '02'), ('03', ), ('29', '30', '31')]}
+        self.template = dict(util_downloader.TEMPLATE_DICT)
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getJobs(self, **kwargs):
+        jobs1 = list(util_downloader.iterBatchJobDicts(
+            self.template, self.job_dict, [], self.outputdir, **kwargs))
+        plan = util_downloader.planBatchJobs(
+            self.template, self.job_dict, [], self.outputdir, **kwargs)
+        return jobs1, plan
+
+    def test_same_jobs(self):
+
+        with open(os.path.join(self.outputdir, 'downloaded_list.txt'), 'w') as fout:
+            for yii in [2000, 2002]:
+                json.dump({'variable': 'geopotential', 'year': yii, 'month': '01',
+                           'day': ['01', '02']}, fout)
+                fout.write('\n')
+
+        for order in [None, 'locality', 'largest']:
+            jobs1, plan = self.getJobs(order=order)
+            self.assertEqual(len(plan), 34)
+            self.assertIsInstance(plan, JobPlan)
+            self.assertEqual(list(plan), jobs1, order)
+
+        jobs1, plan = self.getJobs(coalesce=True)
+        self.assertEqual(list(plan), jobs1)
+        self.assertLess(len(plan), 34)
+
+        # only the varying fields are stored per job
+        self.assertEqual(plan.keys, list(self.job_dict.keys()))
+        self.assertEqual(str(plan.index.dtype), 'uint8')
+
+    def test_skip_and_store(self):
+
+        skip_list = [{'variable': 'geopotential', 'year': [2001, ],
+                      'month': ['02', '01'], 'day': [('03', )]}]
+        store = JobStore(os.path.join(self.outputdir, 'job_state.db'))
+        self.addCleanup(store.close)
+        jobs = list(util_downloader.iterBatchJobDicts(
+            self.template, self.job_dict, [], self.outputdir))
+        for jobii in jobs[:2]:
+            key = store.addJob(jobii['data_target'], jobii, jobii['abpath_out'])
+            store.setState(key, 'done')
+
+        jobs1 = list(util_downloader.iterBatchJobDicts(
+            self.template, self.job_dict, skip_list, self.outputdir,
+            store=store))
+        plan = util_downloader.planBatchJobs(
+            self.template, self.job_dict, skip_list, self.outputdir,
+            store=store)
+        self.assertEqual(len(plan), 36 - 2 - 2)
+        self.assertEqual(list(plan), jobs1)
+        self.assertFalse(store.isDone(getJobKey(plan[0]['data_target'], plan.getRequest(0))))
+
+    def test_save_load(self):
+
+        plan = util_downloader.planBatchJobs(
+            self.template, self.job_dict, [], self.outputdir, order='locality')
+        abpath = os.path.join(self.outputdir, 'plan.npz')
+        plan.save(abpath)
+
+        plan2 = loadJobPlan(abpath)
+        self.assertEqual(list(plan2), list(plan))
+        self.assertEqual(plan2.axes[3][0], ('01', '02'))
+
+        naming_func = lambda x: '%s-%s.nc' % (x['variable'], x['year'])
+        plan3 = loadJobPlan(abpath, naming_func=naming_func)
+        self.assertEqual(os.path.basename(plan3[0]['abpath_out']),
+                         'geopotential-2000.nc')
+
+    def test_huge_plan(self):
+
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'pressure_level': list(range(1, 38)),
+                    'year': list(range(1940, 2025)),
+                    'month': list(range(1, 13)),
+                    'day': list(range(1, 32))}
+        skip_set = set([(('variable', 'geopotential'), ('pressure_level', 1),
+                         ('year', 1940), ('month', 1), ('day', 1))])
+
+        t0 = time.time()
+        plan = makeProductPlan(self.template, job_dict, self.outputdir,
+                               skip_set=skip_set)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(len(plan), 2 * 37 * 85 * 12 * 31 - 1)
+        self.assertLess(plan.nbytes, 16 * 2**20)
+
+        last = plan[len(plan) - 1]
+        self.assertEqual((last['variable'], last['pressure_level'], last['year'],
+                          last['month'], last['day']),
+                         ('specific_humidity', 37, 2024, 12, 31))
+        self.assertEqual(plan[0]['pressure_level'], 1)
+        self.assertEqual(plan[0]['day'], 2)
+
+        abpath = os.path.join(self.outputdir, 'plan.npz')
+        plan.save(abpath)
+        t0 = time.time()
+        plan2 = loadJobPlan(abpath)
+        self.assertLess(time.time() - t0, 2)
+        self.assertEqual(plan2[12345], plan[12345])
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,180 @@
+'''Test the shared job queue and distributed workers.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+
+from era5dl import util_downloader, util_benchmark
+from era5dl.util_job_queue import JobQueue, QueueWorker
+from era5dl.util_fake_cds import FakeCDSServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER_SCRIPT = '''
+import sys
+from era5dl import runWorker
+runWorker(sys.argv[1], sys.argv[2], pause=0, max_workers=2, lease_time=2,
+          worker_id=sys.argv[3], verbose=False)
+'''
+
+
+def makeJobs(n_jobs, outputdir='/data'):
+    return [{'data_target': 'reanalysis-era5-single-levels',
+             'variable': '2m_temperature', 'year': str(2000 + ii),
+             'abpath_out': os.path.join(outputdir, '%d.nc' % ii)}
+            for ii in range(n_jobs)]
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.queue_db = os.path.join(self.outputdir, 'job_queue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_publish_claim(self):
+
+        queue = JobQueue(self.queue_db)
+        self.assertEqual(queue.publish(makeJobs(3)), 3)
+        # publishing again adds new jobs only
+        self.assertEqual(queue.publish(makeJobs(4)), 1)
+
+        key, token, job = queue.claim('w1')
+        self.assertEqual(job['year'], '2000')
+        self.assertTrue(queue.complete(key, token))
+        key, token, job = queue.claim('w1')
+        self.assertEqual(job['year'], '2001')
+        self.assertTrue(queue.fail(key, token, 'Request too large'))
+        key, token, job = queue.claim('w1')
+        self.assertTrue(queue.release(key, token))
+        self.assertFalse(queue.complete(key, token))
+
+        self.assertEqual(queue.countStates(), {'done': 1, 'failed': 1,
+                                               'pending': 2})
+        self.assertEqual(queue.publish(makeJobs(4)), 0)
+        self.assertEqual(queue.getJobs('failed')[0]['error'], 'Request too large')
+        self.assertFalse(queue.isFinished())
+        queue.close()
+
+    def test_exclusive_claims(self):
+
+        queue = JobQueue(self.queue_db)
+        queue.publish(makeJobs(50))
+        queue.close()
+
+        claimed = []
+
+        def work(worker):
+            # a connection per worker, as on different hosts
+            queue = JobQueue(self.queue_db)
+            while True:
+                item = queue.claim(worker)
+                if item is None:
+                    break
+                claimed.append(item[2]['year'])
+                queue.complete(item[0], item[1])
+            queue.close()
+
+        threads = [threading.Thread(target=work, args=('w%d' % ii,))
+                   for ii in range(4)]
+        for tii in threads:
+            tii.start()
+        for tii in threads:
+            tii.join()
+
+        self.assertEqual(sorted(claimed), sorted(str(2000 + ii) for ii in range(50)))
+
+    def test_lease_expiry(self):
+
+        queue = JobQueue(self.queue_db, lease_time=0.2)
+        queue.publish(makeJobs(1))
+        key1, token1, _ = queue.claim('crashed')
+        self.assertIsNone(queue.claim('w2'))
+
+        time.sleep(0.3)
+        key2, token2, _ = queue.claim('w2')
+        self.assertEqual(key1, key2)
+        self.assertEqual(queue.getJobs()[0]['attempts'], 2)
+        # the crashed worker lost its lease
+        self.assertFalse(queue.renew(key1, token1))
+        self.assertFalse(queue.complete(key1, token1))
+        self.assertTrue(queue.complete(key2, token2))
+        self.assertTrue(queue.isFinished())
+        queue.close()
+
+    def test_renewal(self):
+
+        queue = JobQueue(self.queue_db, lease_time=0.3)
+        queue.publish(makeJobs(3))
+        with QueueWorker(queue, 'w1', renew_interval=0.05,
+                         outputdir=self.outputdir) as worker:
+            job = worker.claim()
+            self.assertEqual(job['abpath_out'], os.path.join(self.outputdir, '0.nc'))
+            time.sleep(0.6)
+            # still leased by w1
+            other = JobQueue(self.queue_db)
+            self.assertEqual(other.claim('w2')[2]['year'], '2001')
+            other.close()
+
+            worker.done(job.pop('data_target'), job)
+            self.assertEqual(queue.getJobs('done')[0]['worker'], 'w1')
+            self.assertEqual(worker.claim()['year'], '2002')
+            self.assertIsNone(worker.claim())
+
+        # a job claimed not finished is given back on close
+        self.assertEqual(queue.countStates(), {'done': 1, 'leased': 1,
+                                               'pending': 1})
+        queue.close()
+
+    def test_workers(self):
+
+        n_jobs = 12
+        coord_dir = os.path.join(self.outputdir, 'coordinator')
+        with FakeCDSServer(queue_delay=0.05, run_time=0.05) as server:
+            queue_db = util_downloader.publishBatch(
+                util_benchmark.BENCH_TEMPLATE, util_benchmark.makeJobDict(n_jobs),
+                [], coord_dir)
+
+            # a job claimed by a worker that crashed
+            queue = JobQueue(queue_db, lease_time=0.5)
+            queue.claim('crashed')
+            queue.close()
+
+            workers = []
+            for ii in range(3):
+                workers.append(subprocess.Popen(
+                    [sys.executable, '-c', WORKER_SCRIPT, queue_db,
+                     os.path.join(self.outputdir, 'host%d' % ii), 'host%d' % ii],
+                    cwd=REPO_DIR, stdout=subprocess.DEVNULL))
+            for pii in workers:
+                self.assertEqual(pii.wait(timeout=120), 0)
+            stats = server.getStats()
+
+        # each job run once
+        self.assertEqual(stats['submitted'], n_jobs)
+        queue = JobQueue(queue_db)
+        jobs = queue.getJobs()
+        queue.close()
+        self.assertEqual([jii['state'] for jii in jobs], ['done'] * n_jobs)
+        self.assertGreater(len(set(jii['worker'] for jii in jobs)), 1)
+
+        files = []
+        for ii in range(3):
+            host_dir = os.path.join(self.outputdir, 'host%d' % ii)
+            files.extend(fii for fii in os.listdir(host_dir) if fii.endswith('.nc'))
+        self.assertEqual(sorted(files), sorted(os.path.basename(
+            jii['job']['abpath_out']) for jii in jobs))
+
+
+if __name__=='__main__':
+
+    unittest.main()
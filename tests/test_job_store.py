@@ -0,0 +1,117 @@
+'''Test the persistent job state store.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_cds
+from era5dl.util_job_store import JobStore, getJobKey
+
+
+class FakeHandle(object):
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+
+class TestJobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.outputdir, 'job_state.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.outputdir)
+
+    def test_job_key(self):
+
+        key1 = getJobKey('reanalysis-era5-single-levels',
+                         {'variable': '2m_temperature', 'month': [2, 1],
+                          'time': ['06:00', '00:00']})
+        key2 = getJobKey('reanalysis-era5-single-levels',
+                         {'variable': ['2m_temperature'], 'month': ['01', '02'],
+                          'time': ['00:00', '06:00'], 'abpath_out': 'a.nc'})
+        key3 = getJobKey('reanalysis-era5-single-levels',
+                         {'variable': '2m_temperature', 'month': [1, 3]})
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+    def test_lifecycle(self):
+
+        key = self.store.addJob('reanalysis-era5-single-levels',
+                                {'variable': '2m_temperature'}, 'a.nc')
+        self.assertEqual(self.store.getJob(key)['state'], 'planned')
+        self.assertIsNone(self.store.getActiveRequestId(key))
+
+        self.store.setState(key, 'submitted', request_id='abc')
+        self.store.setState(key, 'running')
+        self.assertEqual(self.store.getActiveRequestId(key), 'abc')
+
+        # adding again keeps the recorded state
+        self.store.addJob('reanalysis-era5-single-levels',
+                          {'variable': '2m_temperature'}, 'b.nc')
+        self.assertEqual(self.store.getJob(key)['abpath_out'], 'a.nc')
+
+        self.store.setState(key, 'done')
+        self.assertTrue(self.store.isDone(key))
+        self.assertEqual(self.store.countStates(), {'done': 1})
+
+    def test_reattach_after_restart(self):
+
+        job = {'data_target': 'reanalysis-era5-single-levels',
+               'variable': '2m_temperature', 'year': '2000',
+               'abpath_out': os.path.join(self.outputdir, '2000.nc')}
+        key = self.store.addJob(job['data_target'],
+                                {'variable': '2m_temperature', 'year': '2000'},
+                                job['abpath_out'])
+        self.store.setState(key, 'submitted', request_id='abc')
+
+        submitted = []
+
+        def download(handle, abpath_out):
+            with open(abpath_out, 'w') as fout:
+                fout.write(handle.request_id)
+
+        with mock.patch.object(util_cds, 'getClient', lambda **kwargs: None), \
+                mock.patch.object(util_cds, 'attachRequest',
+                                  lambda c, rid: FakeHandle(rid)), \
+                mock.patch.object(util_cds, 'getRequestState',
+                                  lambda h: 'completed'), \
+                mock.patch.object(util_cds, 'submitRequest',
+                                  lambda c, t, d: submitted.append(d)), \
+                mock.patch.object(util_cds, 'downloadResult', download):
+            done_list, fail_list = util_downloader.processJobs(
+                [job], self.outputdir, False, pause=0, store=self.store)
+
+        self.assertEqual(submitted, [])
+        self.assertEqual(len(done_list), 1)
+        self.assertTrue(self.store.isDone(key))
+        with open(os.path.join(self.outputdir, '2000.nc')) as fin:
+            self.assertEqual(fin.read(), 'abc')
+
+    def test_skip_done_jobs_in_planning(self):
+
+        template = dict(util_downloader.TEMPLATE_DICT)
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'year': ['2000', '2001']}
+        jobs = util_downloader.prepareBatchJobDicts(
+            template, job_dict, [], self.outputdir, store=self.store)
+        self.assertEqual(len(jobs), 4)
+
+        job = jobs[0]
+        key = self.store.addJob(job['data_target'], job, job['abpath_out'])
+        self.store.setState(key, 'done')
+
+        jobs = util_downloader.prepareBatchJobDicts(
+            template, job_dict, [], self.outputdir, store=self.store)
+        self.assertEqual(len(jobs), 3)
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,189 @@
+'''Test the streaming merge of downloaded pieces into one store per variable.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_merge
+from era5dl.util_slice import NETCDF_LOCK
+
+try:
+    import numpy as np
+    import netCDF4
+    HAS_NETCDF = True
+except ImportError:
+    HAS_NETCDF = False
+
+DATA_TARGET = 'reanalysis-era5-pressure-levels'
+LEVELS = [850, 500]
+
+
+def getValue(day, hour, level):
+    '''Value of the test data at a time step and level'''
+
+    return day * 100 + hour + level / 1000.
+
+
+def writePiece(abpath, day, levels=LEVELS, packed=False):
+    '''Write a NetCDF piece for a day of January 2000, at 00:00 and 12:00'''
+
+    with netCDF4.Dataset(abpath, 'w') as ds:
+        ds.createDimension('valid_time', None)
+        ds.createDimension('pressure_level', len(levels))
+        ds.createDimension('latitude', 3)
+        ds.createDimension('longitude', 4)
+
+        var = ds.createVariable('valid_time', 'i8', ('valid_time',))
+        var.units = 'seconds since 1970-01-01'
+        var.calendar = 'proleptic_gregorian'
+        var[:] = netCDF4.date2num([datetime.datetime(2000, 1, day, hh)
+                                   for hh in [0, 12]], var.units, var.calendar)
+        ds.createVariable('pressure_level', 'f8', ('pressure_level',))[:] = levels
+        ds.createVariable('latitude', 'f8', ('latitude',))[:] = [10, 9, 8]
+        ds.createVariable('longitude', 'f8', ('longitude',))[:] = [0, 1, 2, 3]
+        ds.createVariable('number', 'i8', ())[...] = 0
+        ds.createVariable('expver', str, ('valid_time',))[:] = np.array(
+            ['0001', '0001'], dtype='O')
+
+        dims = ('valid_time', 'pressure_level', 'latitude', 'longitude')
+        data = np.zeros((2, len(levels), 3, 4))
+        for ii, hh in enumerate([0, 12]):
+            for jj, lev in enumerate(levels):
+                data[ii, jj] = getValue(day, hh, lev)
+        if packed:
+            var = ds.createVariable('z', 'i2', dims)
+            var.scale_factor = (data.max() - data.min() + 1) / 60000.
+            var.add_offset = data.mean()
+        else:
+            var = ds.createVariable('z', 'f4', dims)
+        var.units = 'm**2 s**-2'
+        var[:] = data
+
+        dims = ('valid_time', 'latitude', 'longitude')
+        ds.createVariable('t2m', 'f4', dims)[:] = data[:, 0]
+
+
+@unittest.skipUnless(HAS_NETCDF, 'requires numpy and netCDF4')
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.merge_dir = os.path.join(self.outputdir, 'merged')
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def checkStore(self, abpath, days, levels=LEVELS, n_days=4):
+        '''Check the data of merged days, and missing values elsewhere'''
+
+        with netCDF4.Dataset(abpath, 'r') as ds:
+            self.assertEqual(ds.variables['valid_time'].shape, (n_days * 2,))
+            times = netCDF4.num2date(ds.variables['valid_time'][:],
+                                     ds.variables['valid_time'].units)
+            self.assertEqual(times[0].day, 1)
+            self.assertEqual(list(ds.variables['pressure_level'][:]), levels)
+            self.assertEqual(ds.variables['z'].units, 'm**2 s**-2')
+            self.assertEqual(ds.variables['z'].dtype, np.dtype('float32'))
+            self.assertEqual(ds.variables['z'].filters()['zlib'], True)
+            ds.variables['z'].set_auto_mask(False)
+            data = ds.variables['z'][:]
+            for ii, tii in enumerate(times):
+                for jj, lev in enumerate(levels):
+                    if tii.day in days:
+                        np.testing.assert_allclose(
+                            data[ii, jj], getValue(tii.day, tii.hour, lev),
+                            rtol=1e-4)
+                    else:
+                        self.assertTrue(np.all(np.isnan(data[ii, jj])))
+
+    def test_request_axes(self):
+
+        axes = util_merge.getRequestAxes(
+            {'year': '2000', 'month': ['02'], 'day': ['28', '29', '30'],
+             'time': ['12:00', '00:00'], 'pressure_level': ['500', '850']},
+            {'pressure_level': [('500', '1000')]})
+        self.assertEqual(axes['times'], [
+            datetime.datetime(2000, 2, dd, hh) for dd in [28, 29] for hh in [0, 12]])
+        self.assertEqual(axes['levels'], [1000., 500.])
+
+        axes = util_merge.getRequestAxes({'year': [2000], 'month': ['01', '02']})
+        self.assertEqual(axes['times'], [datetime.datetime(2000, 1, 1),
+                                         datetime.datetime(2000, 2, 1)])
+        self.assertIsNone(axes['levels'])
+
+    def test_merge_any_order(self):
+
+        axes = util_merge.getRequestAxes({
+            'year': '2000', 'month': '01', 'day': ['01', '02', '03', '04'],
+            'time': ['00:00', '12:00'], 'pressure_level': ['500', '850']})
+        pieces = []
+        for day in [3, 1, 2]:
+            pieces.append(os.path.join(self.outputdir, '%d.nc' % day))
+            writePiece(pieces[-1], day, packed=day == 2)
+
+        with mock.patch.object(util_merge, 'BLOCK_SIZE', 12),\
+                util_merge.Merger(self.merge_dir, axes, chunks={'valid_time': 3},
+                                  verbose=False) as merger:
+            for pii in pieces:
+                merger.add(pii)
+        result = merger.close()
+
+        self.assertEqual(result['n_merged'], 3)
+        self.assertEqual(result['failed'], {})
+        self.assertEqual([os.path.basename(pii) for pii in result['stores']],
+                         ['t2m_single_levels.nc', 'z_pressure_levels.nc'])
+        self.checkStore(result['stores'][1], [1, 2, 3], levels=[850, 500])
+        with netCDF4.Dataset(result['stores'][1], 'r') as ds:
+            self.assertEqual(ds.variables['z'].chunking(), [3, 1, 3, 4])
+            self.assertEqual(int(ds.variables['number'][...]), 0)
+
+        # an existing store keeps its axes, a GRIB file fails
+        writePiece(os.path.join(self.outputdir, '4.nc'), 4)
+        with open(os.path.join(self.outputdir, 'x.grb'), 'wb') as fout:
+            fout.write(b'GRIB')
+        merger = util_merge.Merger(self.merge_dir, {'times': []}, verbose=False)
+        self.assertTrue(merger.mergeFile(os.path.join(self.outputdir, '4.nc')))
+        self.assertFalse(merger.mergeFile(os.path.join(self.outputdir, 'x.grb')))
+        merger.close()
+        self.checkStore(result['stores'][1], [1, 2, 3, 4], levels=[850, 500])
+
+    def test_merge_levels(self):
+
+        pieces = []
+        for day, levels in [(1, [500]), (1, [850]), (2, [850, 500])]:
+            pieces.append(os.path.join(self.outputdir, '%d-%d.nc' % (day, levels[0])))
+            writePiece(pieces[-1], day, levels=levels)
+
+        result = util_merge.mergeFiles(pieces, self.merge_dir, verbose=False)
+
+        self.assertEqual(result['n_merged'], 3)
+        self.checkStore(result['stores'][1], [1, 2], levels=[850, 500], n_days=2)
+
+    def test_merge_while_downloading(self):
+
+        def fakeRetrieve(data_target, job_dict, abpath_out, dry=True, **kwargs):
+            with NETCDF_LOCK:
+                writePiece(abpath_out, int(job_dict['day']))
+
+        template = {'data_target': DATA_TARGET, 'product_type': 'reanalysis',
+                    'format': 'netcdf', 'variable': 'geopotential',
+                    'pressure_level': ['500', '850'], 'year': '2000',
+                    'month': '01', 'day': ['01', '02', '03', '04'],
+                    'time': ['00:00', '12:00']}
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.batchDownload(template, {'day': ['01', '02', '04']},
+                                          [], self.outputdir, False, pause=0,
+                                          max_workers=2, merge='netcdf')
+
+        self.checkStore(os.path.join(self.merge_dir, 'z_pressure_levels.nc'),
+                        [1, 2, 4], levels=[850, 500], n_days=3)
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,132 @@
+'''Test the adaptive pacing of submissions.
+'''
+
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_benchmark
+from era5dl.util_pacer import Pacer, isThrottleError
+from era5dl.util_fake_cds import FakeCDSServer
+
+
+class TestPacer(unittest.TestCase):
+
+    def test_throttle_errors(self):
+
+        for eii in ['Could not connect: HTTP 429 Too Many Requests',
+                    '503 Server Error: Service Unavailable for url: x',
+                    'Too many queued requests',
+                    'Connection error: [Errno 111]']:
+            self.assertTrue(isThrottleError(Exception(eii)), eii)
+
+        for eii in ['Request too large. Requested 500 items',
+                    'Simulated failure',
+                    '404 Client Error: Not Found for url: x']:
+            self.assertFalse(isThrottleError(Exception(eii)), eii)
+
+    def test_aimd(self):
+
+        pacer = Pacer(interval=2., increase=0.5, decrease=0.5, backoff=10.,
+                      verbose=False)
+        pacer.onSuccess()
+        self.assertAlmostEqual(pacer.getState()['rate'], 0.75)
+
+        backoff = pacer.onThrottle('HTTP 429')
+        state = pacer.getState()
+        self.assertAlmostEqual(state['rate'], 0.375)
+        self.assertTrue(8 <= backoff <= 12)
+        self.assertTrue(state['throttled'])
+        self.assertEqual(state['last_reason'], 'HTTP 429')
+        self.assertGreater(pacer.reserve(), 7)
+
+        # throttles during the back-off do not cut the rate again
+        pacer.onThrottle('HTTP 503')
+        state = pacer.getState()
+        self.assertAlmostEqual(state['rate'], 0.375)
+        self.assertEqual(state['n_throttled'], 2)
+        self.assertEqual(state['n_consecutive'], 1)
+
+    def test_spacing(self):
+
+        pacer = Pacer(interval=0.5, burst=1)
+        waits = [pacer.reserve() for ii in range(3)]
+        self.assertAlmostEqual(waits[0], 0, places=2)
+        self.assertAlmostEqual(waits[1], 0.5, places=2)
+        self.assertAlmostEqual(waits[2], 1., places=2)
+
+        self.assertEqual(Pacer(interval=0).reserve(), 0)
+
+    def test_call_retries(self):
+
+        pacer = Pacer(interval=0, backoff=0.01, max_retries=2, verbose=False)
+        replies = [Exception('HTTP 429'), Exception('HTTP 502'), 'ok']
+        func = mock.Mock(side_effect=replies)
+        self.assertEqual(pacer.call(func), 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(pacer.getState()['n_consecutive'], 0)
+
+        func = mock.Mock(side_effect=Exception('Bad request'))
+        with self.assertRaises(Exception):
+            pacer.call(func)
+        self.assertEqual(func.call_count, 1)
+
+
+class TestPacerAgainstServer(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        for pii in [mock.patch.object(util_cds, 'POLL_START', 0.02),
+                    mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.02)]:
+            pii.start()
+            self.addCleanup(pii.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_error_reason(self):
+
+        with FakeCDSServer(max_queued=0):
+            client = util_cds.getClient(fail_fast=True, quiet=True)
+            t0 = time.time()
+            with self.assertRaises(Exception) as cm:
+                util_cds.submitRequest(client, 'reanalysis-era5-single-levels',
+                                       {'format': 'netcdf'})
+        self.assertLess(time.time() - t0, 5)
+        self.assertIn('HTTP 429', str(cm.exception))
+        self.assertTrue(isThrottleError(cm.exception))
+
+    def test_batch_with_queue_limit(self):
+
+        job_dict = util_benchmark.makeJobDict(12)
+        for backend in ['sync', 'async']:
+            outputdir = os.path.join(self.outputdir, backend)
+            os.makedirs(outputdir)
+            pacer = Pacer(interval=0, backoff=0.05, max_backoff=0.2,
+                          max_retries=50, verbose=False)
+            jobs = util_downloader.iterBatchJobDicts(
+                util_benchmark.BENCH_TEMPLATE, job_dict, [], outputdir)
+            with FakeCDSServer(queue_delay=0.1, run_time=0.1,
+                               max_queued=2) as server:
+                done_list, fail_list = util_downloader.processJobs(
+                    jobs, outputdir, False, max_workers=6, backend=backend,
+                    pacer=pacer)
+                stats = server.getStats()
+
+            state = pacer.getState()
+            self.assertEqual(len(done_list), 12, backend)
+            self.assertEqual(fail_list, [])
+            self.assertGreater(stats['rejected'], 0)
+            self.assertEqual(state['n_accepted'], 12)
+            self.assertEqual(state['n_throttled'], stats['rejected'])
+            self.assertIn('HTTP 429', state['last_reason'])
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,80 @@
+'''Test the parameter table index.
+'''
+
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_read_param_table, util_downloader
+
+
+class TestParamIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        index_file = os.path.join(self.tmpdir, 'param_index.json')
+        patches = [mock.patch.object(util_read_param_table, 'PARAM_INDEX_FILE',
+                                     index_file),
+                   mock.patch.object(util_read_param_table, '_PARAM_INDEX', None)]
+        for pii in patches:
+            pii.start()
+            self.addCleanup(pii.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+
+        entry = util_read_param_table.lookupParam('geopotential')
+        self.assertEqual(entry['shortName'], 'z')
+        self.assertEqual(entry['paramId'], '129')
+        self.assertEqual(entry['level_type'], 'p')
+        self.assertEqual(util_read_param_table.lookupParam('2m_temperature')['level_type'], 's')
+        self.assertIsNone(util_read_param_table.lookupParam('aaa'))
+
+        self.assertEqual(util_read_param_table.getShortNames(
+            'geopotential', 'divergence', 'runoff', 'aaa'), ['z', 'd', 'ro', 'aaa'])
+        self.assertEqual(util_read_param_table.checkVariables(
+            ['geopotential', '2m_temperature', 'aaa'], 'p'), ['2m_temperature', 'aaa'])
+
+    def test_saved_index(self):
+
+        index = util_read_param_table.getParamIndex()
+        self.assertTrue(os.path.exists(util_read_param_table.PARAM_INDEX_FILE))
+
+        # a new process loads the saved index without parsing the tables
+        util_read_param_table._PARAM_INDEX = None
+        with mock.patch.object(util_read_param_table, 'readAllTables',
+                               side_effect=Exception('tables parsed')):
+            self.assertEqual(util_read_param_table.getParamIndex(), index)
+
+        # rebuilt when the tables change
+        util_read_param_table._PARAM_INDEX = None
+        with mock.patch.object(util_read_param_table, '_getTableSignature',
+                               return_value=[]),\
+                mock.patch.object(util_read_param_table, 'readAllTables',
+                                  return_value={}) as read:
+            self.assertEqual(util_read_param_table.getParamIndex(), {})
+            self.assertEqual(read.call_count, 1)
+
+    def test_batch_validation(self):
+
+        util_read_param_table.getParamIndex()
+        t0 = time.time()
+        for ii in range(5000):
+            util_downloader.prepareJobDict(['geopotential', 'temperature'],
+                                           2000, 1, 1, 0, 'hourly', 'p', 500)
+        self.assertLess(time.time() - t0, 2.)
+
+        with self.assertRaises(Exception):
+            util_downloader.prepareJobDict('2m_temperature', 2000, 1, 1, 0,
+                                           'hourly', 'p', 500)
+
+
+if __name__=='__main__':
+
+    unittest.main()
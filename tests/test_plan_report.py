@@ -0,0 +1,99 @@
+'''Test the planning report of a batch.
+'''
+
+from __future__ import print_function
+import io
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from era5dl import util_downloader
+from era5dl.util_plan_report import planReport, formatReport, countGridPoints,\
+        BYTES_PER_VALUE, REQUEST_OVERHEAD
+from era5dl.util_request_size import countFields
+
+
+class TestPlanReport(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_grid_points(self):
+
+        self.assertEqual(countGridPoints({'area': [10, 80, -10, 100]}), 81 * 81)
+        self.assertEqual(countGridPoints({}), 721 * 1440)
+        self.assertEqual(countGridPoints({'area': [10, 170, 0, -170],
+                                          'grid': '1.0/2.0'}), 11 * 11)
+
+    def test_same_as_requests(self):
+
+        job_dict = {'variable': ['geopotential', 'temperature'],
+                    'year': ['2000', '2001'],
+                    'month': [('01', '02'), ('02', )],
+                    'area': [[10, 80, -10, 100], [50, 0, 40, 10]]}
+        template = dict(util_downloader.TEMPLATE_DICT, day=['29', '30', '31'])
+        plan = util_downloader.planBatchJobs(template, job_dict, [],
+                                             self.outputdir)
+        report = planReport(plan, max_workers=4)
+
+        fields = [countFields(plan.getRequest(ii)) for ii in range(len(plan))]
+        sizes = [countFields(rii) * countGridPoints(rii) * BYTES_PER_VALUE['netcdf']
+                 for rii in map(plan.getRequest, range(len(plan)))]
+        self.assertEqual(report['n_jobs'], 16)
+        self.assertEqual(report['fields']['total'], sum(fields))
+        self.assertEqual(report['fields']['max'], max(fields))
+        self.assertEqual(report['bytes']['total'], sum(sizes))
+        self.assertEqual(report['bytes']['min'], min(sizes))
+        # 3 levels x 4 times x dates: 29-31 Jan, 29 Feb 2000
+        self.assertEqual(report['fields']['max'], 3 * 4 * 4)
+        # no valid date in Feb 2001
+        self.assertEqual(report['fields']['min'], 0)
+
+        seconds = report['seconds']
+        self.assertEqual(seconds['min'], REQUEST_OVERHEAD)
+        self.assertGreater(seconds['max'], REQUEST_OVERHEAD)
+        self.assertAlmostEqual(report['wall_clock_s'], seconds['total'] / 4)
+        self.assertEqual(planReport(plan, max_workers=100)['wall_clock_s'],
+                         seconds['max'])
+        self.assertIn('Wall clock with 4 worker(s)', formatReport(report))
+
+    def test_dry_run_report(self):
+
+        job_dict = {'variable': ['geopotential', 'temperature'],
+                    'year': [str(yy) for yy in range(1940, 2025)],
+                    'month': ['%02d' % mm for mm in range(1, 13)],
+                    'day': ['%02d' % dd for dd in range(1, 32)]}
+        output = io.StringIO()
+        t0 = time.time()
+        with redirect_stdout(output):
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir,
+                dry=True, max_workers=8, state_db=None, events_file=None,
+                report='json')
+        self.assertLess(time.time() - t0, 10)
+
+        output = output.getvalue()
+        self.assertNotIn('DRY RUN', output)
+        report = json.loads(output.strip().splitlines()[-1])
+        self.assertEqual(report['n_jobs'], 2 * 85 * 12 * 31)
+        self.assertEqual(report['n_over_limit'], 0)
+        # 3 levels x 4 times, 31st of a month counted only in long months
+        self.assertEqual(report['fields']['min'], 0)
+        self.assertEqual(report['fields']['max'], 12)
+        self.assertEqual(report['max_workers'], 8)
+
+        with self.assertRaises(Exception):
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir,
+                dry=True, state_db=None, events_file=None, report='csv')
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,127 @@
+'''Test lazy job generation.
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader
+from era5dl.util_job_store import JobStore
+from era5dl.util_general import getAttrProduct, iterAttrProduct,\
+        countAttrProduct
+
+
+class TestPlanning(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_attr_product(self):
+
+        job_dict = {'vars': ['u', 'v'], 'years': range(1997, 1999),
+                    'levels': [1000, 900, 800], 'format': 'netcdf'}
+        result = getAttrProduct(job_dict)
+
+        self.assertEqual(list(iterAttrProduct(job_dict)), result)
+        self.assertEqual(countAttrProduct(job_dict), len(result))
+        self.assertEqual(result[1], (('vars', 'u'), ('years', 1997),
+                                     ('levels', 900), ('format', 'netcdf')))
+
+    def test_same_jobs_as_list(self):
+
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'year': range(2000, 2003), 'pressure_level': [1000, 800]}
+        skip_list = [{'variable': 'geopotential', 'year': [2001, ],
+                      'pressure_level': [800, ]}]
+        with open(os.path.join(self.outputdir, 'downloaded_list.txt'), 'w') as fout:
+            json.dump({'variable': 'specific_humidity', 'year': 2002,
+                       'pressure_level': 1000}, fout)
+            fout.write('\n')
+
+        jobs1 = util_downloader.prepareBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, skip_list, self.outputdir)
+        jobs2 = list(util_downloader.iterBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, skip_list, self.outputdir))
+
+        self.assertEqual(len(jobs2), 10)
+        self.assertEqual(jobs1, jobs2)
+
+    def test_same_file_names(self):
+
+        job_dict = {'year': range(2000, 2010)}
+        with open(os.path.join(self.outputdir, 'downloaded_list.txt'), 'w') as fout:
+            json.dump({'year': 2000}, fout)
+            fout.write('\n')
+
+        jobs1 = util_downloader.prepareBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir)
+        jobs2 = list(util_downloader.iterBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir))
+        plan = util_downloader.planBatchJobs(
+            util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir)
+
+        self.assertEqual(len(jobs1), 9)
+        self.assertEqual(jobs1, jobs2)
+        self.assertEqual(list(plan), jobs2)
+        # padded to the number of jobs before skipping
+        self.assertEqual(os.path.basename(jobs1[0]['abpath_out']),
+                         '[ID00]2001.nc')
+
+    def test_first_job_of_huge_batch(self):
+
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'pressure_level': list(range(1, 38)),
+                    'year': list(range(1940, 2025)),
+                    'month': list(range(1, 13)),
+                    'day': list(range(1, 32))}
+        self.assertGreater(countAttrProduct(job_dict), 2000000)
+
+        t0 = time.time()
+        jobs = util_downloader.iterBatchJobDicts(
+            util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir)
+        first = next(jobs)
+        self.assertLess(time.time() - t0, 0.5)
+
+        self.assertEqual(first['variable'], 'geopotential')
+        self.assertEqual(first['time'], util_downloader.TEMPLATE_DICT['time'])
+        self.assertEqual(os.path.basename(first['abpath_out']),
+                         '[ID0000000]1-1-1-geopotential-1940.nc')
+
+    def test_first_job_of_batch_run(self):
+
+        job_dict = {'variable': ['geopotential', 'specific_humidity'],
+                    'pressure_level': list(range(1, 38)),
+                    'year': list(range(1940, 2025)),
+                    'month': list(range(1, 13)),
+                    'day': list(range(1, 32))}
+        firsts = []
+
+        def fakeProcessJobs(job_dicts, *args, **kwargs):
+            firsts.append(next(iter(job_dicts)))
+
+        # the job store is on by default, look up the 1st job only
+        t0 = time.time()
+        with mock.patch.object(util_downloader, 'processJobs', fakeProcessJobs),\
+                mock.patch.object(JobStore, 'isDone', autospec=True,
+                                  return_value=False) as isDone:
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, job_dict, [], self.outputdir,
+                dry=False, pause=0, verbose=False, events_file=None)
+        self.assertLess(time.time() - t0, 2)
+
+        self.assertEqual(isDone.call_count, 1)
+        self.assertEqual(os.path.basename(firsts[0]['abpath_out']),
+                         '[ID0000000]1-1-1-geopotential-1940.nc')
+
+
+if __name__=='__main__':
+
+    unittest.main()
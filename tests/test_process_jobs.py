@@ -0,0 +1,83 @@
+'''Test concurrent job processing.
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader
+
+
+def fakeRetrieve(data_target, job_dict, abpath_out, dry=True, **kwargs):
+    time.sleep(0.01)
+    if job_dict['year'] % 5 == 0:
+        raise Exception('Bad request')
+
+
+class TestProcessJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getJobs(self, n):
+        return [{'data_target': 'reanalysis-era5-single-levels',
+                 'variable': '2m_temperature', 'year': ii,
+                 'abpath_out': os.path.join(self.outputdir, '%d.nc' % ii)}
+                for ii in range(n)]
+
+    def test_concurrent_bookkeeping(self):
+
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            done_list, fail_list = util_downloader.processJobs(
+                self.getJobs(40), self.outputdir, False, pause=0,
+                max_workers=8)
+
+        self.assertEqual(len(done_list), 32)
+        self.assertEqual(len(fail_list), 8)
+
+        down_list = util_downloader.loadDownloadedList(
+            os.path.join(self.outputdir, 'downloaded_list.txt'))
+        self.assertEqual(sorted(dd['year'] for dd in down_list),
+                         sorted(dd['year'] for dd in done_list))
+
+        with open(os.path.join(self.outputdir, 'era5_downloader.log')) as fin:
+            launched = [ll for ll in fin if 'Launch job' in ll]
+        self.assertEqual(len(launched), 40)
+
+    def test_sequential_matches_concurrent(self):
+
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            done_list, fail_list = util_downloader.processJobs(
+                self.getJobs(10), self.outputdir, False, pause=0)
+
+        self.assertEqual([dd['year'] for dd in fail_list], [0, 5])
+        self.assertEqual(len(done_list), 8)
+
+    def test_batch_options(self):
+
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, {'year': [1, 2, 5]}, [],
+                self.outputdir, False, pause=0, max_workers=2, state_db=None)
+        down_list = util_downloader.loadDownloadedList(
+            os.path.join(self.outputdir, 'downloaded_list.txt'))
+        self.assertEqual(sorted(dd['year'] for dd in down_list), [1, 2])
+
+        with self.assertRaises(Exception) as cm:
+            util_downloader.batchDownload(
+                util_downloader.TEMPLATE_DICT, {'year': [1, 2]}, [],
+                self.outputdir, True, max_worker=2)
+        self.assertIn('max_worker', str(cm.exception))
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,173 @@
+'''Test rewriting NetCDF files with chunks suited to an access pattern.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_downloader, util_rechunk
+from era5dl.util_slice import NETCDF_LOCK
+
+try:
+    import numpy as np
+    import netCDF4
+    HAS_NETCDF = True
+except ImportError:
+    HAS_NETCDF = False
+
+DIMS = ('valid_time', 'pressure_level', 'latitude', 'longitude')
+
+
+def writeFile(abpath, n_time=10, packed=False):
+    '''Write a contiguous NetCDF file, as downloaded from CDS'''
+
+    with netCDF4.Dataset(abpath, 'w') as ds:
+        ds.title = 'test'
+        for kk, nn in zip(DIMS, [n_time, 2, 6, 8]):
+            ds.createDimension(kk, nn)
+            ds.createVariable(kk, 'f8', (kk,))[:] = np.arange(nn)
+        ds.variables['valid_time'].units = 'seconds since 1970-01-01'
+        ds.createVariable('number', 'i8', ())[...] = 0
+
+        data = np.arange(n_time * 2 * 6 * 8, dtype='f4').reshape(n_time, 2, 6, 8)
+        if packed:
+            var = ds.createVariable('z', 'i2', DIMS)
+            var.scale_factor = 0.5
+            var.add_offset = 100.
+        else:
+            var = ds.createVariable('z', 'f4', DIMS, fill_value=-9999.)
+        var.units = 'm**2 s**-2'
+        var[:] = data
+        var[0, 0, 0, 0] = np.ma.masked
+
+    return data
+
+
+@unittest.skipUnless(HAS_NETCDF, 'requires numpy and netCDF4')
+class TestRechunk(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.abpath = os.path.join(self.outputdir, 'z.nc')
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def checkData(self, data, atol=0):
+        with netCDF4.Dataset(self.abpath, 'r') as ds:
+            self.assertEqual(ds.title, 'test')
+            self.assertEqual(ds.variables['z'].units, 'm**2 s**-2')
+            self.assertEqual(int(ds.variables['number'][...]), 0)
+            np.testing.assert_array_equal(ds.variables['latitude'][:], np.arange(6))
+            values = ds.variables['z'][:]
+            self.assertTrue(values.mask[0, 0, 0, 0])
+            self.assertEqual(np.ma.count_masked(values), 1)
+            np.testing.assert_allclose(values[0, 0, 0, 1:], data[0, 0, 0, 1:], atol=atol)
+            np.testing.assert_allclose(values[1:], data[1:], atol=atol)
+            return ds.variables['z'].chunking(), ds.variables['z'].filters()
+
+    def test_chunk_shape(self):
+
+        shape = [744, 37, 721, 1440]
+        self.assertEqual(util_rechunk.getChunkShape(DIMS, shape, 'map'),
+                         [1, 1, 182, 1440])
+        self.assertEqual(util_rechunk.getChunkShape(DIMS, shape, 'timeseries'),
+                         [744, 1, 18, 19])
+        # fewer time steps, larger tiles
+        self.assertEqual(util_rechunk.getChunkShape(
+            ['time', 'lat', 'lon'], [24, 721, 1440], 'timeseries'),
+            [24, 104, 105])
+        self.assertEqual(util_rechunk.getChunkShape(
+            ['time', 'lat', 'lon'], [24, 6, 8], 'timeseries'), [24, 6, 8])
+        with self.assertRaises(Exception):
+            util_rechunk.getChunkShape(DIMS, shape, 'points')
+
+    def test_rechunk_file(self):
+
+        data = writeFile(self.abpath)
+        # small blocks, to copy by several blocks
+        with mock.patch.object(util_rechunk, 'BLOCK_SIZE', 100):
+            util_rechunk.rechunkFile(self.abpath, 'timeseries', chunk_size=40)
+        chunks, filters = self.checkData(data)
+        self.assertEqual(chunks, [10, 1, 2, 2])
+        self.assertTrue(filters['zlib'])
+        self.assertTrue(filters['shuffle'])
+        self.assertEqual(os.listdir(self.outputdir), ['z.nc'])
+
+        util_rechunk.rechunkFile(self.abpath, 'map', compression=None)
+        chunks, filters = self.checkData(data)
+        self.assertEqual(chunks, [1, 1, 6, 8])
+        self.assertFalse(filters['zlib'])
+
+        if netCDF4.__has_zstandard_support__:
+            util_rechunk.rechunkFile(self.abpath, compression='zstd')
+            chunks, filters = self.checkData(data)
+            self.assertTrue(filters['zstd'])
+
+    def test_pack(self):
+
+        data = writeFile(self.abpath)
+        util_rechunk.rechunkFile(self.abpath, pack=True)
+        # 16 bits over the range of the data
+        self.checkData(data, atol=data.max() / 2**15)
+        with netCDF4.Dataset(self.abpath, 'r') as ds:
+            self.assertEqual(ds.variables['z'].dtype, np.dtype('i2'))
+
+        # packed data are copied as they are
+        data = writeFile(self.abpath, packed=True)
+        util_rechunk.rechunkFile(self.abpath, pack=True)
+        self.checkData(data)
+        with netCDF4.Dataset(self.abpath, 'r') as ds:
+            self.assertEqual(ds.variables['z'].scale_factor, 0.5)
+
+    def test_rechunk_while_downloading(self):
+
+        def fakeRetrieve(data_target, job_dict, abpath_out, dry=True, **kwargs):
+            if job_dict['year'] == '2001':
+                with open(abpath_out, 'wb') as fout:
+                    fout.write(b'GRIB')
+            else:
+                with NETCDF_LOCK:
+                    writeFile(abpath_out)
+
+        template = {'data_target': 'reanalysis-era5-pressure-levels',
+                    'product_type': 'reanalysis', 'format': 'netcdf',
+                    'variable': 'geopotential', 'year': '2000'}
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.batchDownload(
+                template, {'year': ['2000', '2001', '2002']}, [],
+                self.outputdir, False, pause=0, max_workers=2,
+                naming_func=lambda d: '%s.nc' % d['year'],
+                rechunk='timeseries', verbose=False)
+
+        for year in ['2000', '2002']:
+            with netCDF4.Dataset(os.path.join(self.outputdir, year + '.nc')) as ds:
+                self.assertEqual(ds.variables['z'].chunking(), [10, 1, 6, 8])
+        # files not in NetCDF format are skipped
+        with open(os.path.join(self.outputdir, '2001.nc'), 'rb') as fin:
+            self.assertEqual(fin.read(), b'GRIB')
+
+    def test_rechunker_failure(self):
+
+        # a truncated NetCDF4 file
+        writeFile(self.abpath)
+        with open(self.abpath, 'rb') as fin:
+            head = fin.read(1000)
+        with open(self.abpath, 'wb') as fout:
+            fout.write(head)
+        with util_rechunk.Rechunker(max_workers=1, verbose=False) as rechunker:
+            rechunker.submit(self.abpath)
+        result = rechunker.close()
+
+        self.assertEqual(result['n_files'], 0)
+        self.assertEqual(list(result['failed']), [self.abpath])
+        with open(self.abpath, 'rb') as fin:
+            self.assertEqual(fin.read(), head)
+
+
+if __name__=='__main__':
+
+    unittest.main()
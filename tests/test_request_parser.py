@@ -0,0 +1,112 @@
+'''Test the parsing of web generated API requests.
+'''
+
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from era5dl import util_request_parser
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'era5dl', 'examples', 'test_api1.txt')
+
+NEW_REQUEST = '''import cdsapi
+
+dataset = "reanalysis-era5-single-levels"
+request = {
+    "product_type": ["reanalysis"],
+    "variable": ["2m_temperature", "total_precipitation"],
+    "year": ["2001"],
+    "month": ["01", "02"],
+    "day": ["01", "02"],
+    "time": ["00:00", "12:00"],
+    "data_format": "netcdf",
+    "download_format": "unarchived",
+    "area": [60, -10, 50, 2]
+}
+
+client = cdsapi.Client()
+client.retrieve(dataset, request).download()
+'''
+
+
+class TestRequestParser(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_legacy(self):
+
+        job_dict = util_request_parser.parseFile(EXAMPLE_FILE)
+        self.assertEqual(job_dict['data_target'], 'reanalysis-era5-pressure-levels')
+        self.assertEqual(job_dict['pressure_level'], ['300', '500', '700'])
+        self.assertEqual(job_dict['area'], [10, 80, -10, 100])
+        self.assertEqual(len(job_dict), 10)
+
+    def test_new_form(self):
+
+        job_dict = util_request_parser.parseString(NEW_REQUEST)
+        self.assertEqual(job_dict['data_target'], 'reanalysis-era5-single-levels')
+        self.assertEqual(job_dict['variable'], ['2m_temperature', 'total_precipitation'])
+        self.assertEqual(job_dict['data_format'], 'netcdf')
+
+        # without the retrieve() call, or with keyword arguments
+        lines = NEW_REQUEST.split('client =')[0]
+        self.assertEqual(util_request_parser.parseString(lines), job_dict)
+        lines = lines + 'cdsapi.Client().retrieve(name=dataset, request=request, target="a.nc")'
+        self.assertEqual(util_request_parser.parseString(lines), job_dict)
+
+    def test_no_code_run(self):
+
+        for lines in ["c.retrieve('era5', {'year': __import__('os').getcwd()})",
+                      "dataset = 'era5'\nrequest = dict(year='2001')",
+                      "c.retrieve(dataset, {'year': '2001'})",
+                      "c.retrieve('era5', ['2001'])",
+                      "c.retrieve('era5', {'year': ",
+                      "import cdsapi\n"]:
+            with self.assertRaises(Exception):
+                util_request_parser.parseString(lines)
+
+        with self.assertRaises(Exception):
+            util_request_parser.parseJobDict([('year', "__import__('os').getcwd()")])
+        self.assertEqual(util_request_parser.parseJobDict(
+            [('year', "['2001', '2002'],\n")]), {'year': ['2001', '2002']})
+
+    def test_large_request(self):
+
+        dates = ['%d-%02d-%02d' % (yy, mm, dd) for yy in range(1950, 2025)
+                 for mm in range(1, 13) for dd in range(1, 29)]
+        lines = 'c.retrieve(\n    "reanalysis-era5-single-levels",\n    {\n        "date": [\n%s\n        ],\n    },\n)' % \
+            '\n'.join('            "%s",' % dii for dii in dates)
+
+        t0 = time.time()
+        job_dict = util_request_parser.parseString(lines)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(job_dict['date'], dates)
+
+    def test_directory(self):
+
+        for ii in range(200):
+            with open(os.path.join(self.outputdir, 'request%03d.txt' % ii), 'w') as fout:
+                fout.write(NEW_REQUEST.replace('"2001"', '"%d"' % (1900 + ii)))
+        with open(os.path.join(self.outputdir, 'broken.txt'), 'w') as fout:
+            fout.write('c.retrieve(')
+        with open(os.path.join(self.outputdir, 'notes.md'), 'w') as fout:
+            fout.write('not a request')
+
+        results, failed = util_request_parser.parseDirectory(self.outputdir,
+                                                             verbose=False)
+        self.assertEqual(len(results), 200)
+        self.assertEqual(results['request150.txt']['year'], ['2050'])
+        self.assertEqual(list(failed), ['broken.txt'])
+
+
+if __name__=='__main__':
+
+    unittest.main()
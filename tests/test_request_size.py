@@ -0,0 +1,81 @@
+'''Test request size counting and automatic splitting.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+from era5dl import util_downloader, util_request_parser
+from era5dl.util_request_size import countValidDates, countFields,\
+        autoSplitFields
+
+HOURS = ['%02d:00' % ii for ii in range(24)]
+DAYS = ['%02d' % ii for ii in range(1, 32)]
+MONTHS = ['%02d' % ii for ii in range(1, 13)]
+
+
+class TestRequestSize(unittest.TestCase):
+
+    def test_valid_dates(self):
+
+        self.assertEqual(countValidDates([2000, 2001], MONTHS, DAYS), 366 + 365)
+        self.assertEqual(countValidDates(['2001'], ['02'], ['28', '29', '30', '31']), 1)
+        self.assertEqual(countValidDates(['2001'], MONTHS), 12)
+
+    def test_count_fields(self):
+
+        job_dict = {'variable': ['u', 'v'], 'pressure_level': ['500', '850'],
+                    'year': '2001', 'month': '02', 'day': DAYS,
+                    'time': ['00:00', '12:00']}
+        self.assertEqual(countFields(job_dict), 2 * 2 * 28 * 2)
+
+    def test_auto_split(self):
+
+        job_dict = {'variable': ['geopotential', 'temperature'],
+                    'pressure_level': [str(ii) for ii in range(37)],
+                    'year': ['2000', '2001'], 'month': MONTHS, 'day': DAYS,
+                    'time': HOURS}
+        result = autoSplitFields(job_dict, max_fields=120000)
+
+        self.assertEqual(list(result.keys()), ['variable', 'year', 'month'])
+        self.assertEqual(result['month'][0], ('01', '02', '03', '04'))
+
+        sub_jobs = util_request_parser.splitBy(job_dict, result, verbose=False)
+        self.assertEqual(len(sub_jobs), 2 * 2 * 3)
+        sizes = [countFields(dd) for dd in sub_jobs]
+        self.assertLessEqual(max(sizes), 120000)
+        self.assertEqual(sum(sizes), countFields(job_dict))
+
+        # a request under the limit is not split
+        self.assertEqual(autoSplitFields(sub_jobs[0], max_fields=120000), {})
+
+    def test_auto_split_batch(self):
+
+        outputdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outputdir)
+        template_dict = dict(util_downloader.TEMPLATE_DICT, time=HOURS,
+                             pressure_level=[str(ii) for ii in range(37)],
+                             year=['2000'])
+        jobs = util_downloader.prepareBatchJobDicts(template_dict, 'auto', [],
+                                                    outputdir)
+
+        self.assertEqual(len(jobs), 2 * 3)
+        self.assertEqual(os.path.basename(jobs[0]['abpath_out']),
+                         '[ID0]01_04-geopotential.nc')
+        self.assertTrue(all(countFields(jj) <= 120000 for jj in jobs))
+
+        # a smaller limit gives more sub-jobs, by all the planners
+        jobs = util_downloader.prepareBatchJobDicts(template_dict, 'auto', [],
+                                                    outputdir, max_fields=50000)
+        self.assertEqual(len(jobs), 2 * 12)
+        self.assertTrue(all(countFields(jj) <= 50000 for jj in jobs))
+        plan = util_downloader.planBatchJobs(template_dict, 'auto', [],
+                                             outputdir, max_fields=50000)
+        self.assertEqual(list(plan), jobs)
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,199 @@
+'''Test failure classification, in-run requeue and the failure manifest.
+'''
+
+from __future__ import print_function
+import io
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+import requests
+from era5dl import util_downloader, util_cds, util_async_downloader,\
+        util_retry
+
+
+class FlakyRetrieve(object):
+    '''Fake retrieveData(): years 1 and 2 fail transiently once, year 3
+    fails permanently, year 4 always fails transiently'''
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, data_target, job_dict, abpath_out, dry=True, **kwargs):
+        year = job_dict['year']
+        with self.lock:
+            self.calls[year] = self.calls.get(year, 0) + 1
+            n_calls = self.calls[year]
+
+        if year in [1, 2] and n_calls == 1:
+            raise requests.exceptions.ConnectionError('Connection reset by peer')
+        if year == 3:
+            raise Exception('Invalid variable: 2m_temperatur')
+        if year == 4:
+            raise Exception('Download failed: downloaded 10 byte(s) out of 100')
+        with open(abpath_out, 'w') as fout:
+            fout.write('x')
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getJobs(self, n):
+        return [{'data_target': 'reanalysis-era5-single-levels',
+                 'variable': '2m_temperature', 'year': ii,
+                 'abpath_out': os.path.join(self.outputdir, '%d.nc' % ii)}
+                for ii in range(n)]
+
+    def test_classify(self):
+
+        for eii in [requests.exceptions.ReadTimeout('read timed out'),
+                    Exception('Could not connect: HTTP 503 Service Unavailable'),
+                    Exception('Download failed: interrupted at byte 10'),
+                    Exception('Internal server error, please try again')]:
+            self.assertEqual(util_retry.classifyError(eii), 'transient', eii)
+
+        for eii in [Exception('Invalid variable'),
+                    Exception('Request too large. Requested 200000 items'),
+                    Exception('400 Client Error: the request you have submitted is not valid'),
+                    Exception('Request failed. Cost limits exceeded.')]:
+            self.assertEqual(util_retry.classifyError(eii), 'permanent', eii)
+
+        # local errors and bugs are not skipped by later runs
+        for eii in [OSError(28, 'No space left on device'),
+                    OSError(2, 'Invalid request file not found'),
+                    KeyError('time'), ValueError('could not convert GRIB'),
+                    Exception('Request failed. Simulated failure.')]:
+            self.assertEqual(util_retry.classifyError(eii), 'unknown', eii)
+
+    def test_retry_delay(self):
+
+        delays = [util_retry.getRetryDelay(ii, backoff=10, max_backoff=30)
+                  for ii in [1, 2, 3, 4]]
+        self.assertTrue(5 <= delays[0] <= 15)
+        self.assertTrue(10 <= delays[1] <= 30)
+        self.assertTrue(15 <= delays[3] <= 45)
+
+    def test_queue(self):
+
+        queue = util_retry.RetryQueue(['a', 'b'])
+        self.assertEqual(queue.get(), 'a')
+        queue.retry('a', 0.1)
+        # new jobs are taken while the retry waits
+        self.assertEqual(queue.get(), 'b')
+        queue.done()
+        t0 = time.time()
+        self.assertEqual(queue.get(), 'a')
+        self.assertGreater(time.time() - t0, 0.05)
+        queue.done()
+        self.assertIsNone(queue.get())
+
+    def test_requeue_and_manifest(self):
+
+        for max_workers in [1, 4]:
+            outputdir = os.path.join(self.outputdir, str(max_workers))
+            os.makedirs(outputdir)
+            retrieve = FlakyRetrieve()
+            with mock.patch.object(util_downloader, 'retrieveData', retrieve):
+                done_list, fail_list = util_downloader.processJobs(
+                    self.getJobs(6), outputdir, False, pause=0,
+                    max_workers=max_workers, max_retries=2, retry_backoff=0.01)
+
+            self.assertEqual(sorted(dd['year'] for dd in done_list), [0, 1, 2, 5])
+            self.assertEqual(sorted(dd['year'] for dd in fail_list), [3, 4])
+            self.assertEqual(retrieve.calls, {0: 1, 1: 2, 2: 2, 3: 1, 4: 3, 5: 1})
+
+            manifest = util_retry.loadFailureManifest(
+                os.path.join(outputdir, util_retry.FAILURE_MANIFEST))
+            records = dict((rii['job']['year'], rii) for rii in manifest)
+            self.assertEqual(sorted(records), [3, 4])
+            self.assertEqual(records[3]['category'], 'permanent')
+            self.assertEqual(records[3]['attempts'], 1)
+            self.assertIn('Invalid variable', records[3]['error'])
+            self.assertEqual(records[3]['data_target'],
+                             'reanalysis-era5-single-levels')
+            self.assertEqual(records[4]['category'], 'transient')
+            self.assertEqual(records[4]['attempts'], 3)
+
+    def test_async_requeue(self):
+
+        submits = []
+
+        class FakeHandle(object):
+            def __init__(self, job_dict):
+                self.job_dict = job_dict
+                self.request_id = 'r%d' % len(submits)
+
+            def download(self, abpath_out):
+                if submits.count(self.job_dict['year']) == 1:
+                    raise Exception('Download failed: interrupted at byte 0')
+                with open(abpath_out, 'w') as fout:
+                    fout.write('x')
+
+        def submit(c, t, d):
+            submits.append(d['year'])
+            return FakeHandle(d)
+
+        patches = [
+            mock.patch.object(util_cds, 'getClient', lambda **kwargs: None),
+            mock.patch.object(util_cds, 'submitRequest', submit),
+            mock.patch.object(util_cds, 'getRequestState', lambda h: 'completed'),
+            mock.patch.object(util_cds, 'downloadResult',
+                              lambda h, p: h.download(p)),
+            mock.patch.object(util_async_downloader, 'POLL_INTERVAL', 0.01),
+        ]
+        for pii in patches:
+            pii.start()
+        self.addCleanup(mock.patch.stopall)
+
+        done_list, fail_list = util_downloader.processJobs(
+            self.getJobs(3), self.outputdir, False, pause=0, max_workers=2,
+            backend='async', retry_backoff=0.01)
+
+        self.assertEqual(len(done_list), 3)
+        self.assertEqual(fail_list, [])
+        self.assertEqual(sorted(submits), [0, 0, 1, 1, 2, 2])
+
+    def test_skip_permanent_failures(self):
+
+        template = dict(util_downloader.TEMPLATE_DICT)
+        job_dict = {'year': ['2000', '2001', '2002']}
+        manifest = os.path.join(self.outputdir, util_retry.FAILURE_MANIFEST)
+        jobs = list(util_downloader.iterBatchJobDicts(template, job_dict, [],
+                                                      self.outputdir))
+        for jobii, category in zip(jobs, ['permanent', 'transient', 'unknown']):
+            data_target = jobii.pop('data_target')
+            jobii.pop('abpath_out')
+            util_retry.recordFailure(manifest, data_target, jobii, 'error',
+                                     category, 1)
+
+        jobs = util_downloader.iterBatchJobDicts(template, job_dict, [],
+                                                 self.outputdir)
+        self.assertEqual([jii['year'] for jii in jobs], ['2001', '2002'])
+        output = io.StringIO()
+        with redirect_stdout(output):
+            jobs = util_downloader.prepareBatchJobDicts(template, job_dict, [],
+                                                        self.outputdir)
+        self.assertEqual([jii['year'] for jii in jobs], ['2001', '2002'])
+        # failed jobs are not counted as downloaded
+        self.assertIn('Number of already downloaded jobs: 0', output.getvalue())
+        self.assertIn('failed permanently in earlier runs: 1', output.getvalue())
+        jobs = util_downloader.iterBatchJobDicts(template, job_dict, [],
+                                                 self.outputdir,
+                                                 skip_failed=False)
+        self.assertEqual(len(list(jobs)), 3)
+
+
+if __name__=='__main__':
+
+    unittest.main()
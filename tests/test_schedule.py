@@ -0,0 +1,75 @@
+'''Test the ordering policies of the jobs of a batch.
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+from era5dl import util_downloader, util_schedule
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def getJobs(self, job_dict, order, template_dict=None):
+        return list(util_downloader.iterBatchJobDicts(
+            template_dict or util_downloader.TEMPLATE_DICT, job_dict, [],
+            self.outputdir, order=order))
+
+    def test_locality(self):
+
+        job_dict = {'variable': ['geopotential', 'temperature'],
+                    'year': ['2001', '2000'], 'month': ['02', '01']}
+        jobs = self.getJobs(job_dict, None)
+        self.assertEqual(util_schedule.countGroups(jobs), 8)
+
+        jobs = self.getJobs(job_dict, 'locality')
+        self.assertEqual(util_schedule.countGroups(jobs), 4)
+        self.assertEqual([(jii['year'], jii['month'], jii['variable'])
+                          for jii in jobs[:3]],
+                         [('2000', '01', 'geopotential'),
+                          ('2000', '01', 'temperature'),
+                          ('2000', '02', 'geopotential')])
+        # ids in file names follow the attribute combinations
+        self.assertTrue(os.path.basename(jobs[0]['abpath_out']).startswith('[ID3]'))
+
+        # the same order whatever the order of <job_dict>
+        job_dict2 = {'month': ['01', '02'], 'year': [2000, 2001],
+                     'variable': ['temperature', 'geopotential']}
+        jobs2 = self.getJobs(job_dict2, 'locality')
+        self.assertEqual([(str(jii['year']), jii['month'], jii['variable'])
+                          for jii in jobs2],
+                         [(jii['year'], jii['month'], jii['variable'])
+                          for jii in jobs])
+
+    def test_largest(self):
+
+        # chunks of days make jobs of different sizes
+        job_dict = {'month': ['01', '02'],
+                    'day': [('01', '02'), ('03', ), ('29', '30', '31')]}
+        template = dict(util_downloader.TEMPLATE_DICT, year='2001')
+        jobs = self.getJobs(job_dict, 'largest', template)
+
+        self.assertEqual([(jii['month'], jii['day']) for jii in jobs],
+                         [('01', ('29', '30', '31')), ('01', ('01', '02')),
+                          ('02', ('01', '02')), ('01', ('03', )),
+                          ('02', ('03', )), ('02', ('29', '30', '31'))])
+
+        jobs2 = util_downloader.prepareBatchJobDicts(
+            template, job_dict, [], self.outputdir, order='largest')
+        self.assertEqual(jobs2, jobs)
+
+        with self.assertRaises(Exception):
+            self.getJobs(job_dict, 'smallest')
+
+
+if __name__=='__main__':
+
+    unittest.main()
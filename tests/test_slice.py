@@ -0,0 +1,188 @@
+'''Test serving requests by slicing cached superset files.
+'''
+
+from __future__ import print_function
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from era5dl import util_cache
+from era5dl.util_cache import DownloadCache, getCacheKey
+from era5dl.util_slice import requestCovers, getCoverIndex, sliceNetCDF
+
+try:
+    import numpy as np
+    import netCDF4
+    HAS_NETCDF = True
+except ImportError:
+    HAS_NETCDF = False
+
+DATA_TARGET = 'reanalysis-era5-pressure-levels'
+HELD_DICT = {
+    'product_type': 'reanalysis',
+    'format': 'netcdf',
+    'variable': ['geopotential', 'temperature'],
+    'pressure_level': ['500', '850'],
+    'year': '2000',
+    'month': '01',
+    'day': ['01', '02'],
+    'time': ['00:00', '12:00'],
+    'area': [10, -10, -10, 10],
+    'grid': [1.0, 1.0],
+}
+
+
+def writeHeldFile(abpath):
+    '''Write a NetCDF file with the data layout of HELD_DICT'''
+
+    with netCDF4.Dataset(abpath, 'w') as ds:
+        ds.createDimension('valid_time', None)
+        ds.createDimension('pressure_level', 2)
+        ds.createDimension('latitude', 21)
+        ds.createDimension('longitude', 21)
+
+        var = ds.createVariable('valid_time', 'i8', ('valid_time',))
+        var.units = 'hours since 2000-01-01'
+        var.calendar = 'proleptic_gregorian'
+        var[:] = [0, 12, 24, 36]
+        ds.createVariable('pressure_level', 'f8', ('pressure_level',))[:] = [500, 850]
+        ds.createVariable('latitude', 'f8', ('latitude',))[:] = np.arange(10, -11, -1)
+        ds.createVariable('longitude', 'f8', ('longitude',))[:] = np.arange(-10, 11)
+
+        dims = ('valid_time', 'pressure_level', 'latitude', 'longitude')
+        data = np.arange(4 * 2 * 21 * 21, dtype='f4').reshape(4, 2, 21, 21)
+        for name, offset in [('z', 0), ('t', 1e5)]:
+            var = ds.createVariable(name, 'f4', dims, zlib=True)
+            var.GRIB_shortName = name
+            var[:] = data + offset
+
+
+class TestRequestCovers(unittest.TestCase):
+
+    def test_covers(self):
+
+        job_dict = dict(HELD_DICT, variable='temperature', pressure_level=500,
+                        day='2', time='12:00', area=[5, -5, 0, 5])
+        self.assertTrue(requestCovers(DATA_TARGET, HELD_DICT, job_dict))
+
+        for kk, vv in [('area', [11, -5, 0, 5]), ('year', '2001'),
+                       ('variable', ['temperature', 'divergence']),
+                       ('grid', [0.5, 0.5]), ('format', 'grib')]:
+            self.assertFalse(requestCovers(DATA_TARGET, HELD_DICT,
+                                           dict(job_dict, **{kk: vv})), kk)
+
+        # a global file covers any area
+        held_dict = dict(HELD_DICT)
+        held_dict.pop('area')
+        self.assertTrue(requestCovers(DATA_TARGET, held_dict, job_dict))
+        self.assertFalse(requestCovers(DATA_TARGET, job_dict, held_dict))
+
+    def test_cover_index(self):
+
+        held = getCoverIndex(DATA_TARGET, dict(HELD_DICT, year=['1999', '2000'],
+                                               month=['01', '12']))
+        new = getCoverIndex(DATA_TARGET, dict(HELD_DICT, variable='temperature',
+                                              month='06', area=[5, -5, 0, 5]))
+        self.assertEqual(held[0], new[0])
+        self.assertEqual(held[1:], (1999, 2000, 1, 12))
+        self.assertEqual(new[1:], (2000, 2000, 6, 6))
+
+        for kk, vv in [('grid', [0.5, 0.5]), ('product_type', 'ensemble_mean')]:
+            self.assertNotEqual(getCoverIndex(DATA_TARGET, dict(HELD_DICT, **{kk: vv}))[0],
+                                held[0], kk)
+        self.assertIsNone(getCoverIndex(DATA_TARGET, dict(HELD_DICT, format='grib')))
+
+    def test_find_cover(self):
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_dir = os.path.join(tmpdir, 'cache')
+        abpath = os.path.join(tmpdir, 'held.nc')
+        with open(abpath, 'w') as fout:
+            fout.write('x')
+
+        # an index of an older version, without the cover columns
+        os.makedirs(cache_dir)
+        conn = sqlite3.connect(os.path.join(cache_dir, 'cache.db'))
+        conn.executescript(util_cache.SCHEMA)
+        conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     ('old', DATA_TARGET, json.dumps(dict(HELD_DICT, year='1900')),
+                      abpath, 1, 0, 0))
+        conn.commit()
+        conn.close()
+
+        cache = DownloadCache(cache_dir)
+        self.addCleanup(cache.close)
+        for year in range(1950, 1990):
+            for fmt in ['netcdf', 'grib']:
+                cache.add(DATA_TARGET, dict(HELD_DICT, year=str(year), format=fmt),
+                          abpath)
+
+        job_dict = dict(HELD_DICT, year='1960', variable='temperature')
+        with mock.patch.object(util_cache, 'requestCovers',
+                               side_effect=requestCovers) as covers:
+            key, path = cache.findCover(DATA_TARGET, job_dict)
+            self.assertEqual(key, getCacheKey(DATA_TARGET, dict(HELD_DICT, year='1960')))
+            self.assertEqual(cache.findCover(DATA_TARGET, dict(job_dict, year='1900'))[0],
+                             'old')
+            self.assertEqual(cache.findCover(DATA_TARGET, dict(job_dict, year='2000')),
+                             (None, None))
+        # only the entries of the same group and spans are checked
+        self.assertEqual(covers.call_count, 2)
+
+
+@unittest.skipUnless(HAS_NETCDF, 'requires numpy and netCDF4')
+class TestSlice(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.abpath_held = os.path.join(self.tmpdir, 'held.nc')
+        writeHeldFile(self.abpath_held)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_slice(self):
+
+        job_dict = dict(HELD_DICT, variable='temperature', pressure_level=850,
+                        day='02', time=['00:00', '12:00'], area=[5, -5, 0, 5])
+        abpath_out = os.path.join(self.tmpdir, 'out.nc')
+        sliceNetCDF(self.abpath_held, abpath_out, DATA_TARGET, job_dict)
+
+        with netCDF4.Dataset(abpath_out) as ds, netCDF4.Dataset(self.abpath_held) as held:
+            self.assertNotIn('z', ds.variables)
+            self.assertEqual(ds.variables['t'].shape, (2, 1, 6, 11))
+            self.assertEqual(list(ds.variables['valid_time'][:]), [24, 36])
+            self.assertEqual(list(ds.variables['latitude'][:]), [5, 4, 3, 2, 1, 0])
+            self.assertEqual(ds.variables['t'].GRIB_shortName, 't')
+            np.testing.assert_array_equal(ds.variables['t'][:],
+                                          held.variables['t'][2:, 1:, 5:11, 5:16])
+
+    def test_cache_serves_subset(self):
+
+        cache = DownloadCache(os.path.join(self.tmpdir, 'cache'))
+        self.addCleanup(cache.close)
+        cache.add(DATA_TARGET, HELD_DICT, self.abpath_held)
+
+        job_dict = dict(HELD_DICT, variable='geopotential', time='00:00')
+        abpath_out = os.path.join(self.tmpdir, 'project', 'z.nc')
+        self.assertTrue(cache.fetch(DATA_TARGET, job_dict, abpath_out))
+        with netCDF4.Dataset(abpath_out) as ds:
+            self.assertEqual(list(ds.variables.keys()),
+                             ['valid_time', 'pressure_level', 'latitude',
+                              'longitude', 'z'])
+            self.assertEqual(ds.variables['z'].shape, (2, 2, 21, 21))
+
+        # not covered
+        job_dict = dict(HELD_DICT, year='2001')
+        self.assertFalse(cache.fetch(DATA_TARGET, job_dict, abpath_out + '2'))
+        self.assertFalse(os.path.exists(abpath_out + '2'))
+
+
+if __name__=='__main__':
+
+    unittest.main()
@@ -0,0 +1,106 @@
+'''Test resumable downloads against a local server dropping connections.
+'''
+
+from __future__ import print_function
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from era5dl import util_transfer
+
+PAYLOAD = os.urandom(300 * 1024)
+
+
+class DroppingHandler(BaseHTTPRequestHandler):
+    '''Serve PAYLOAD with Range support, dropping the first few connections
+    after 100 KB have been sent'''
+
+    drops_left = 0
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+        type(self).ranges.append(start)
+
+        body = PAYLOAD[start:]
+        self.send_response(206 if start > 0 else 200)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if type(self).drops_left > 0:
+            type(self).drops_left -= 1
+            self.wfile.write(body[:100 * 1024])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DroppingHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/result.nc' % self.server.server_port
+        DroppingHandler.ranges = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.outputdir)
+
+    def test_resume_after_drops(self):
+
+        DroppingHandler.drops_left = 2
+        abpath_out = os.path.join(self.outputdir, 'result.nc')
+        util_transfer.downloadFile(self.url, abpath_out, size=len(PAYLOAD),
+                                   retry_sleep=0, chunk_size=8192)
+
+        with open(abpath_out, 'rb') as fin:
+            self.assertEqual(fin.read(), PAYLOAD)
+        # resumed twice, each time from where the previous transfer stopped
+        ranges = DroppingHandler.ranges
+        self.assertEqual(len(ranges), 3)
+        self.assertTrue(0 == ranges[0] < ranges[1] < ranges[2] <= 200 * 1024)
+        self.assertEqual(os.listdir(self.outputdir), ['result.nc'])
+
+    def test_part_file_kept_on_failure(self):
+
+        DroppingHandler.drops_left = 1
+        abpath_out = os.path.join(self.outputdir, 'result.nc')
+
+        with self.assertRaises(Exception):
+            util_transfer.downloadFile(self.url, abpath_out, max_tries=1,
+                                       retry_sleep=0, chunk_size=8192)
+        self.assertFalse(os.path.exists(abpath_out))
+        part_size = os.path.getsize(abpath_out + '.part')
+        self.assertTrue(0 < part_size <= 100 * 1024)
+
+        # a later call resumes from the checkpoint
+        util_transfer.downloadFile(self.url, abpath_out, retry_sleep=0,
+                                   chunk_size=8192)
+        with open(abpath_out, 'rb') as fin:
+            self.assertEqual(fin.read(), PAYLOAD)
+        self.assertEqual(DroppingHandler.ranges, [0, part_size])
+
+
+if __name__=='__main__':
+
+    unittest.main()
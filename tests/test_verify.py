@@ -0,0 +1,230 @@
+'''Test the integrity verification of downloaded files.
+'''
+
+from __future__ import print_function
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+from era5dl import util_downloader, util_verify
+from era5dl.util_job_store import JobStore, getJobKey
+from tests.test_slice import DATA_TARGET, HELD_DICT, writeHeldFile, HAS_NETCDF
+
+
+def gribMessage(edition=2, body_size=20):
+    '''Create a dummy GRIB message'''
+
+    length = 16 + body_size + 4
+    if edition == 1:
+        head = b'GRIB' + length.to_bytes(3, 'big') + b'\x01' + b'\x00' * 8
+    else:
+        head = b'GRIB' + b'\x00\x00\x00\x02' + length.to_bytes(8, 'big')
+    return head + b'\x01' * body_size + b'7777'
+
+
+def writeFile(abpath, data):
+    with open(abpath, 'wb') as fout:
+        fout.write(data)
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir)
+
+    def test_formats(self):
+
+        abpath = os.path.join(self.outputdir, 'a.grb')
+        job_dict = {'format': 'grib', 'variable': ['a', 'b'], 'year': '2000',
+                    'month': '01', 'day': '01', 'time': '00:00'}
+
+        writeFile(abpath, gribMessage(1) + gribMessage(2))
+        self.assertEqual(util_verify.verifyFile(abpath), [])
+        self.assertEqual(util_verify.verifyFile(abpath, DATA_TARGET, job_dict), [])
+        self.assertEqual(len(util_verify.verifyFile(
+            abpath, DATA_TARGET, dict(job_dict, variable='a'))), 1)
+        self.assertEqual(len(util_verify.verifyFile(abpath, size=100)), 1)
+
+        # truncated
+        writeFile(abpath, gribMessage(2) + gribMessage(2)[:30])
+        self.assertIn('truncated', util_verify.verifyFile(abpath)[0])
+
+        writeFile(abpath, b'<html>error</html>')
+        self.assertEqual(util_verify.verifyFile(abpath),
+                         ['Not a NetCDF, GRIB or zip file'])
+        writeFile(abpath, b'')
+        self.assertEqual(util_verify.verifyFile(abpath), ['Empty file'])
+
+    @unittest.skipUnless(HAS_NETCDF, 'requires numpy and netCDF4')
+    def test_netcdf_content(self):
+
+        abpath = os.path.join(self.outputdir, 'a.nc')
+        writeHeldFile(abpath)
+        self.assertEqual(util_verify.verifyFile(abpath, DATA_TARGET, HELD_DICT), [])
+
+        for kk, vv in [('pressure_level', ['500']),
+                       ('day', ['01', '02', '03']),
+                       ('variable', ['geopotential', 'divergence']),
+                       ('area', [20, -10, -10, 10])]:
+            problems = util_verify.verifyFile(abpath, DATA_TARGET,
+                                              dict(HELD_DICT, **{kk: vv}))
+            self.assertEqual(len(problems), 1, kk)
+        self.assertEqual(util_verify.verifyFile(
+            abpath, DATA_TARGET, dict(HELD_DICT, day='03'),
+            check_content=False), [])
+
+        # truncated
+        with open(abpath, 'rb') as fin:
+            data = fin.read()
+        writeFile(abpath, data[:len(data) // 2])
+        self.assertIn('Can not open', util_verify.verifyFile(abpath)[0])
+
+    def test_verifier_quarantine(self):
+
+        good = os.path.join(self.outputdir, 'good.grb')
+        bad = os.path.join(self.outputdir, 'bad.grb')
+        writeFile(good, gribMessage())
+        writeFile(bad, gribMessage()[:-2])
+
+        with util_verify.Verifier(max_workers=2) as verifier:
+            verifier.check(good)
+            with self.assertRaises(Exception) as cm:
+                verifier.check(bad)
+
+        self.assertIn('Verification failed', str(cm.exception))
+        self.assertFalse(os.path.exists(bad))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.outputdir, util_verify.QUARANTINE_DIR, 'bad.grb')))
+
+    def test_requeue_bad_download(self):
+
+        calls = []
+
+        def fakeRetrieve(data_target, job_dict, abpath_out, dry=True,
+                         verify=None, **kwargs):
+            calls.append(job_dict['year'])
+            # the 1st download is truncated
+            data = gribMessage()
+            writeFile(abpath_out, data[:-2] if len(calls) == 1 else data)
+            verify(abpath_out, None)
+
+        abpath_out = os.path.join(self.outputdir, 'a.grb')
+        jobs = [{'data_target': DATA_TARGET, 'format': 'grib',
+                 'variable': 'a', 'year': '2000', 'abpath_out': abpath_out}]
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve),\
+                util_verify.Verifier(max_workers=1) as verifier:
+            done_list, fail_list = util_downloader.processJobs(
+                jobs, self.outputdir, False, pause=0, retry_backoff=0.01,
+                verifier=verifier)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(done_list), 1)
+        self.assertEqual(util_verify.verifyFile(abpath_out), [])
+
+    def test_verify_while_downloading(self):
+
+        calls = []
+
+        def fakeRetrieve(data_target, job_dict, abpath_out, dry=True,
+                         verify=None, wait=True, **kwargs):
+            calls.append(('download', job_dict['year']))
+            writeFile(abpath_out, gribMessage())
+
+            def finish():
+                time.sleep(0.2)
+                verify(abpath_out, None)
+                calls.append(('verified', job_dict['year']))
+            if not wait:
+                return finish
+            finish()
+
+        jobs = [{'data_target': DATA_TARGET, 'format': 'grib', 'variable': 'a',
+                 'year': yy, 'abpath_out': os.path.join(self.outputdir, yy)}
+                for yy in ['2000', '2001']]
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve),\
+                util_verify.Verifier(max_workers=1) as verifier:
+            done_list, fail_list = util_downloader.processJobs(
+                jobs, self.outputdir, False, pause=0, verifier=verifier)
+
+        # the 2nd job is downloaded while the 1st file is verified
+        self.assertEqual(calls[:2], [('download', '2000'), ('download', '2001')])
+        self.assertEqual(len(done_list), 2)
+        self.assertEqual(fail_list, [])
+
+    def test_verify_outputdir(self):
+
+        store = JobStore(os.path.join(self.outputdir, 'job_state.db'))
+        down_list = []
+        for ii, data in enumerate([gribMessage(), gribMessage()[:-2],
+                                   gribMessage() * 2]):
+            job_dict = {'format': 'grib', 'variable': 'a', 'year': str(2000 + ii)}
+            abpath = os.path.join(self.outputdir, '%d.grb' % ii)
+            writeFile(abpath, data)
+            key = store.addJob(DATA_TARGET, job_dict, abpath)
+            store.setState(key, 'done')
+            down_list.append(job_dict)
+        store.close()
+        with open(os.path.join(self.outputdir, 'downloaded_list.txt'), 'w') as fout:
+            for dii in down_list:
+                fout.write(json.dumps(dii) + '\n')
+
+        result = util_verify.verifyOutputdir(self.outputdir, max_workers=2,
+                                             quarantine=True, verbose=False)
+
+        self.assertEqual(result['n_files'], 3)
+        self.assertEqual(sorted(os.path.basename(kk) for kk in result['bad']),
+                         ['1.grb', '2.grb'])
+        self.assertEqual(sorted(os.listdir(os.path.join(
+            self.outputdir, util_verify.QUARANTINE_DIR))), ['1.grb', '2.grb'])
+
+        store = JobStore(os.path.join(self.outputdir, 'job_state.db'))
+        self.assertEqual(store.countStates(), {'done': 1, 'failed': 2})
+        self.assertTrue(store.isDone(getJobKey(DATA_TARGET, down_list[0])))
+        store.close()
+        self.assertEqual(util_downloader.loadDownloadedList(
+            os.path.join(self.outputdir, 'downloaded_list.txt')), down_list[:1])
+
+        # format only, without a job store
+        os.remove(os.path.join(self.outputdir, 'job_state.db'))
+        result = util_verify.verifyOutputdir(self.outputdir, verbose=False)
+        self.assertEqual((result['n_files'], result['bad']), (1, {}))
+
+    def test_quarantine_without_store(self):
+
+        def fakeRetrieve(data_target, job_dict, abpath_out, dry=True, **kwargs):
+            data = gribMessage()
+            writeFile(abpath_out, data[:-2] if job_dict['year'] == 2001 else data)
+
+        with mock.patch.object(util_downloader, 'retrieveData', fakeRetrieve):
+            util_downloader.batchDownload(
+                dict(util_downloader.TEMPLATE_DICT, format='grib'),
+                {'year': [2000, 2001, 2002]}, [], self.outputdir, False,
+                pause=0, state_db=None)
+        # a bad file of no job in the downloaded list
+        writeFile(os.path.join(self.outputdir, 'extra.grb'), b'')
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = util_verify.verifyOutputdir(self.outputdir, quarantine=True,
+                                                 verbose=False)
+
+        self.assertEqual(len(result['bad']), 2)
+        down_list = util_downloader.loadDownloadedList(
+            os.path.join(self.outputdir, 'downloaded_list.txt'))
+        self.assertEqual([dd['year'] for dd in down_list], [2000, 2002])
+        self.assertIn('WARNING: 1 bad file(s)', output.getvalue())
+        self.assertIn('extra.grb', output.getvalue())
+
+
+if __name__=='__main__':
+
+    unittest.main()